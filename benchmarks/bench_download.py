@@ -0,0 +1,51 @@
+"""Compare single-stream and ranged downloads against a throttled local server
+
+    poetry run python benchmarks/bench_download.py --size-mb 64 --rate-mb 8
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from post_production.stand_in import StandInServer
+from post_production.transfer import RangedDownload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=32)
+    parser.add_argument("--rate-mb", type=float, default=8.0, help="Per-connection cap")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    data = os.urandom(args.size_mb * 1024 * 1024)
+    results = []
+    with StandInServer() as server, tempfile.TemporaryDirectory() as tmp:
+        server.files["/episode.wav"] = bytearray(data)
+        server.connection_rate = args.rate_mb * 1e6
+        for workers in args.workers:
+            out_file = Path(tmp) / f"episode-{workers}.wav"
+            chunk_size = max(1024 * 1024, len(data) // (workers * 4))
+            start = time.perf_counter()
+            stats = RangedDownload(
+                server.url("/episode.wav"),
+                out_file,
+                workers=workers,
+                chunk_size=chunk_size,
+            ).run()
+            results.append(
+                {
+                    "benchmark": "download",
+                    "workers": workers,
+                    "bytes": stats.total_bytes,
+                    "seconds": round(time.perf_counter() - start, 3),
+                    "mb_per_second": round(stats.bytes_per_second / 1e6, 2),
+                }
+            )
+            print(json.dumps(results[-1]))
+
+
+if __name__ == "__main__":
+    main()
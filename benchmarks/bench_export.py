@@ -0,0 +1,66 @@
+"""Compare exporting every format in one pass with the old as_txt export
+
+    poetry run python benchmarks/bench_export.py --minutes 90
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from bench_transcript import DictTranscript, synthetic_response
+
+from post_production.export import ExportFormat, export_file
+
+
+def as_txt(transcript: Path, out_dir: Path) -> Path:
+    """What transcribe did before: load the whole JSON, then build the text"""
+    with transcript.open() as infile:
+        result = DictTranscript(**json.load(infile))
+    out_path = out_dir / "as_txt.txt"
+    text = "\n".join(
+        f"{u.get('speaker')}:\n{u.get('text')}\n" for u in result.utterances
+    )
+    out_path.write_text(text)
+    return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--minutes", type=int, default=90)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = (
+        ("as_txt", lambda path, out: as_txt(path, out)),
+        (
+            "export txt",
+            lambda path, out: export_file(path, out, [ExportFormat.TXT], {}),
+        ),
+        (
+            "export srt",
+            lambda path, out: export_file(path, out, [ExportFormat.SRT], {}),
+        ),
+        (
+            "export all",
+            lambda path, out: export_file(path, out, list(ExportFormat), {}),
+        ),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        transcript = Path(tmp) / "episode.json"
+        transcript.write_text(synthetic_response(args.minutes, 160))
+        for name, run in runs:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                run(transcript, Path(tmp))
+            result = {
+                "benchmark": "export",
+                "run": name,
+                "minutes": args.minutes,
+                "seconds": round((time.perf_counter() - start) / args.repeat, 4),
+            }
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
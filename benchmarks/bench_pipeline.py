@@ -0,0 +1,98 @@
+"""Time a season through the pipeline DAG against running episodes one at a time
+
+Runs transcode, enhance, transcribe and export against the local fake
+providers, so no API keys are needed.
+
+    poetry run python benchmarks/bench_pipeline.py --episodes 8 --job-seconds 2
+"""
+import argparse
+import json
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from bench_transcode import synthetic_audio
+
+from post_production.assembly_ai import AssemblyAI
+from post_production.batch import BatchProgress
+from post_production.cache import ASSEMBLYAI, DOLBY
+from post_production.dolby import DolbyIO
+from post_production.pipeline import (
+    LOCAL,
+    MANIFEST,
+    PipelineRunner,
+    StageManifest,
+    load_spec,
+)
+from post_production.poller import JobPoller
+from post_production.render_cache import RenderCache
+from post_production.stand_in import FakeProviderServer
+
+STAGES = [
+    {"name": "transcode", "uses": "transcode", "params": {"intro_music": "intro.wav"}},
+    {"name": "enhance", "uses": "enhance", "input": "transcode"},
+    {"name": "transcribe", "uses": "transcribe", "input": "enhance"},
+    {"name": "export", "uses": "export", "input": "transcribe"},
+]
+
+
+def run(spec_file: Path, episodes, force: bool, one_at_a_time: bool = False) -> dict:
+    spec = load_spec(spec_file)
+    progress = BatchProgress(episodes, [s.name for s in spec.stages])
+    with JobPoller(min_interval=0.2, max_interval=1.0) as poller:
+        poller.register(DOLBY, DolbyIO("key"))
+        poller.register(ASSEMBLYAI, AssemblyAI("key"))
+        runner = PipelineRunner(
+            spec,
+            StageManifest(spec.output / MANIFEST),
+            progress,
+            {LOCAL: 1, DOLBY: 4, ASSEMBLYAI: 4},
+            poller,
+            keys={DOLBY: "key", ASSEMBLYAI: "key"},
+            force=force,
+            renders=RenderCache(spec_file.parent / "renders"),
+        )
+        start = time.perf_counter()
+        if one_at_a_time:
+            counts = Counter()
+            for episode in episodes:
+                counts.update(runner.run([episode]))
+        else:
+            counts = runner.run(episodes)
+        return {"seconds": round(time.perf_counter() - start, 2), **counts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--episodes", type=int, default=8)
+    parser.add_argument("--episode-seconds", type=int, default=120)
+    parser.add_argument("--job-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, FakeProviderServer() as provider:
+        tmp = Path(tmp)
+        provider.job_duration = args.job_seconds
+        DolbyIO.api_endpoint = provider.url("/media")
+        AssemblyAI.api_endpoint = provider.url("/v2")
+        synthetic_audio(tmp / "intro.wav", 20, "sine=f=330")
+        episodes = [
+            synthetic_audio(
+                tmp / f"ep{i:02}.wav", args.episode_seconds, "anoisesrc=a=0.05"
+            )
+            for i in range(args.episodes)
+        ]
+        spec_file = tmp / "spec.json"
+        spec_file.write_text(json.dumps({"stages": STAGES}))
+
+        for mode, force, one_at_a_time in (
+            ("one episode at a time", True, True),
+            ("dag", True, False),
+            ("dag, unchanged", False, False),
+        ):
+            result = run(spec_file, episodes, force, one_at_a_time)
+            print(json.dumps({"benchmark": "pipeline", "mode": mode, **result}))
+
+
+if __name__ == "__main__":
+    main()
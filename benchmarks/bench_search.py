@@ -0,0 +1,81 @@
+"""Index a synthetic transcript archive and time searches against it
+
+    poetry run python benchmarks/bench_search.py --episodes 300 --minutes 60
+"""
+import argparse
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from post_production.search import TranscriptIndex, find_transcripts
+
+VOCABULARY = (
+    "the a and to of we python pandas data science students teaching class code "
+    "function loop list dictionary turtle classroom lesson project test debug"
+).split()
+
+
+def write_episode(path: Path, rng: random.Random, words_per_episode: int):
+    words, t = [], 0
+    for i in range(words_per_episode):
+        words.append(
+            {
+                "text": rng.choice(VOCABULARY),
+                "start": t,
+                "end": t + 300,
+                "confidence": 0.9,
+                "speaker": "AB"[(i // 40) % 2],
+            }
+        )
+        t += 350
+    path.write_text(json.dumps({"status": "completed", "words": words}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--episodes", type=int, default=300)
+    parser.add_argument("--minutes", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        archive_dir = Path(tmp) / "episodes"
+        archive_dir.mkdir()
+        for i in range(args.episodes):
+            write_episode(archive_dir / f"ep{i:04}.json", rng, args.minutes * 160)
+
+        start = time.perf_counter()
+        stats = TranscriptIndex(Path(tmp) / "index").update(
+            find_transcripts([archive_dir])
+        )
+        print(
+            json.dumps(
+                {
+                    "benchmark": "index",
+                    "episodes": stats.added,
+                    "words": stats.words,
+                    "seconds": round(time.perf_counter() - start, 2),
+                }
+            )
+        )
+
+        queries = ["pandas", "turtle", "data science", "pand*", "the python loop"]
+        for query in queries:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                # A fresh index each time, so every query pays for opening it
+                hits = TranscriptIndex(Path(tmp) / "index").search(query, limit=20)
+            result = {
+                "benchmark": "search",
+                "query": query,
+                "hits": len(hits),
+                "ms": round((time.perf_counter() - start) / args.repeat * 1000, 2),
+            }
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
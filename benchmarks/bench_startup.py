@@ -0,0 +1,61 @@
+"""Time cold starts of `tppp --help` and of `--help` for every command
+
+Each run starts a fresh interpreter, like a script or watch loop calling tppp:
+
+    poetry run python benchmarks/bench_startup.py --repeat 20
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from post_production.main import COMMANDS
+
+RUN_APP = "from post_production.main import app; app(prog_name='tppp')"
+
+
+def cold_start(args, cwd) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", RUN_APP, *args],
+        stdout=subprocess.DEVNULL,
+        check=True,
+        cwd=cwd,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--only", nargs="+", choices=list(COMMANDS))
+    args = parser.parse_args()
+
+    baseline = [sys.executable, "-c", "pass"]
+    with tempfile.TemporaryDirectory() as tmp:
+        interpreter = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run(baseline, check=True)
+            interpreter.append(time.perf_counter() - start)
+        print(json.dumps({"command": "python", "ms": round(min(interpreter) * 1000)}))
+
+        for command in [None, *(args.only or COMMANDS)]:
+            cli_args = [command, "--help"] if command else ["--help"]
+            times = [cold_start(cli_args, tmp) for _ in range(args.repeat)]
+            print(
+                json.dumps(
+                    {
+                        "command": " ".join(cli_args),
+                        "ms": round(min(times) * 1000),
+                        "median_ms": round(statistics.median(times) * 1000),
+                    }
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
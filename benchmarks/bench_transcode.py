@@ -0,0 +1,128 @@
+"""Time transcode with single-pass loudnorm and with cached two-pass renders
+
+Also times every rendition encoded on its own against all of them encoded
+from one decode with asplit.
+
+    poetry run python benchmarks/bench_transcode.py --episode-minutes 10
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import ffmpeg
+
+from post_production.render_cache import RenderCache
+from post_production.transcoding import Rendition, _transcode
+
+
+def synthetic_audio(path: Path, seconds: int, source: str = "sine=f=220") -> Path:
+    (
+        ffmpeg.input(f"{source}:d={seconds}", f="lavfi")
+        .output(str(path), ac=2, ar=48000)
+        .run(overwrite_output=True, quiet=True)
+    )
+    return path
+
+
+def single_pass(input_file, output_file, intro_music, outro_music):
+    """The previous transcode, which normalized the music inline on every call"""
+    main_episode = ffmpeg.input(str(input_file))
+    intro = ffmpeg.input(str(intro_music)).filter("loudnorm", i=-23, dual_mono="true")
+    main_episode = ffmpeg.filter(
+        [intro, main_episode], "acrossfade", d=4, c1="tri", c2="nofade"
+    )
+    outro = ffmpeg.input(str(outro_music)).filter("loudnorm", i=-23, dual_mono="true")
+    main_episode = ffmpeg.filter(
+        [main_episode, outro], "acrossfade", d=1, c1="nofade", c2="tri"
+    )
+    main_episode.output(str(output_file), ac=1, ab="160k", f="mp3").run(quiet=True)
+
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--episode-minutes", type=int, default=10)
+    parser.add_argument("--music-seconds", type=int, default=60)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        episode = synthetic_audio(
+            tmp / "episode.wav", args.episode_minutes * 60, "anoisesrc=a=0.05"
+        )
+        intro = synthetic_audio(tmp / "intro.wav", args.music_seconds, "sine=f=330")
+        outro = synthetic_audio(tmp / "outro.wav", args.music_seconds, "sine=f=440")
+        renders = RenderCache(tmp / "renders")
+
+        runs = (
+            ("single-pass", lambda: single_pass(episode, tmp / "1.mp3", intro, outro)),
+            (
+                "no-cache",
+                lambda: _transcode(
+                    episode,
+                    tmp / "2.mp3",
+                    intro,
+                    outro,
+                    RenderCache(tmp / "scratch", None),
+                ),
+            ),
+            (
+                "cold cache",
+                lambda: _transcode(episode, tmp / "3.mp3", intro, outro, renders),
+            ),
+            (
+                "warm cache",
+                lambda: _transcode(episode, tmp / "4.mp3", intro, outro, renders),
+            ),
+        )
+        for name, run in runs:
+            result = {
+                "benchmark": "transcode",
+                "mode": name,
+                "episode_minutes": args.episode_minutes,
+                "seconds": round(timed(run), 3),
+            }
+            print(json.dumps(result))
+
+        separate = 0.0
+        for rendition in Rendition:
+            seconds = timed(
+                lambda: _transcode(
+                    episode,
+                    tmp / f"{rendition.value}.mp3",
+                    intro,
+                    outro,
+                    renders,
+                    [rendition],
+                )
+            )
+            separate += seconds
+            result = {
+                "benchmark": "rendition",
+                "rendition": rendition.value,
+                "seconds": round(seconds, 3),
+            }
+            print(json.dumps(result))
+        combined = timed(
+            lambda: _transcode(
+                episode, tmp / "all.mp3", intro, outro, renders, list(Rendition)
+            )
+        )
+        result = {
+            "benchmark": "renditions",
+            "renditions": len(Rendition),
+            "separate_seconds": round(separate, 3),
+            "one_decode_seconds": round(combined, 3),
+        }
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
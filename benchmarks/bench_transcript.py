@@ -0,0 +1,192 @@
+"""Compare memory and speed of the columnar TranscriptResult with plain dicts
+
+Also compares peak memory of parsing a saved transcript with json.load and
+with the streaming parser.
+
+    poetry run python benchmarks/bench_transcript.py --minutes 90
+"""
+import argparse
+import gc
+import json
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from post_production.assembly_ai import STREAM_CHUNK_SIZE, TranscriptResult, read_file
+from post_production.transcript import iter_transcript, iter_txt
+
+
+class DictTranscript:
+    """The previous TranscriptResult, which kept the response as dicts and lists"""
+
+    def __init__(self, **kwargs):
+        for kwarg, value in kwargs.items():
+            self.__setattr__(kwarg, value)
+
+
+def synthetic_response(minutes: int, words_per_minute: int) -> str:
+    rng = random.Random(0)
+    vocabulary = ["python", "teaching", "students", "the", "a", "classroom", "code"]
+    words, utterances, t = [], [], 0
+    for i in range(minutes * words_per_minute):
+        duration = rng.randint(120, 500)
+        words.append(
+            {
+                "text": rng.choice(vocabulary),
+                "start": t,
+                "end": t + duration,
+                "confidence": round(rng.uniform(0.6, 1.0), 5),
+                "speaker": "AB"[(i // 40) % 2],
+            }
+        )
+        t += duration + rng.randint(0, 80)
+    for first in range(0, len(words), 40):
+        spoken = words[first : first + 40]
+        utterances.append(
+            {
+                "speaker": spoken[0]["speaker"],
+                "text": " ".join(w["text"] for w in spoken),
+                "start": spoken[0]["start"],
+                "end": spoken[-1]["end"],
+                "confidence": 0.9,
+                "words": spoken,
+            }
+        )
+    return json.dumps(
+        {
+            "id": "benchmark",
+            "status": "completed",
+            "text": " ".join(w["text"] for w in words),
+            "words": words,
+            "utterances": utterances,
+            "audio_duration": t // 1000,
+        }
+    )
+
+
+def retained_bytes(build, raw: str) -> int:
+    """Memory still held by the transcript once the parsed response is freed"""
+    gc.collect()
+    tracemalloc.start()
+    transcript = build(**json.loads(raw))
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del transcript
+    return size
+
+
+def peak_bytes(func) -> int:
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def txt_from_json(path: Path) -> int:
+    with path.open() as infile:
+        transcript = DictTranscript(**json.load(infile))
+    pieces = iter_txt(transcript.utterances, lambda u: u.get("speaker"))
+    return sum(len(piece) for piece in pieces)
+
+
+def txt_from_stream(path: Path) -> int:
+    utterances = (
+        value
+        for key, value in iter_transcript(read_file(path, STREAM_CHUNK_SIZE))
+        if key == "utterances" and value
+    )
+    pieces = iter_txt(utterances, lambda u: u.get("speaker"))
+    return sum(len(piece) for piece in pieces)
+
+
+def speaking_time(transcript) -> dict:
+    totals = {}
+    for word in transcript.words:
+        speaker = word["speaker"]
+        totals[speaker] = totals.get(speaker, 0) + word["end"] - word["start"]
+    return totals
+
+
+def column_speaking_time(transcript) -> dict:
+    words = transcript.words
+    totals = [0] * len(transcript.speaker_ids)
+    for code, start, end in zip(
+        words.column("speaker"), words.column("start"), words.column("end")
+    ):
+        totals[code] += end - start
+    return dict(zip(transcript.speaker_ids, totals))
+
+
+def dict_between(transcript, start: int, end: int) -> list:
+    return [w for w in transcript.words if w["end"] > start and w["start"] < end]
+
+
+def columnar_between(transcript, start: int, end: int):
+    return transcript.words.between(start, end)
+
+
+def timed(func, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--minutes", type=int, default=90)
+    parser.add_argument("--words-per-minute", type=int, default=160)
+    parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    raw = synthetic_response(args.minutes, args.words_per_minute)
+    duration_ms = json.loads(raw)["audio_duration"] * 1000
+    rng = random.Random(1)
+    windows = [(s, s + 30_000) for s in rng.sample(range(duration_ms), args.queries)]
+
+    forms = (
+        ("dict", DictTranscript, speaking_time, dict_between),
+        ("columnar", TranscriptResult, column_speaking_time, columnar_between),
+        ("columnar views", TranscriptResult, speaking_time, columnar_between),
+    )
+    for name, build, per_word, between in forms:
+        transcript = build(**json.loads(raw))
+        result = {
+            "benchmark": "transcript",
+            "form": name,
+            "words": len(transcript.words),
+            "retained_bytes": retained_bytes(build, raw),
+            "build_seconds": round(timed(lambda: build(**json.loads(raw)), 3), 4),
+            "speaking_time_seconds": round(timed(lambda: per_word(transcript), 3), 4),
+            "range_query_us": round(
+                timed(lambda: [len(between(transcript, *w)) for w in windows], 1)
+                / args.queries
+                * 1e6,
+                1,
+            ),
+        }
+        print(json.dumps(result))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "transcript.json"
+        path.write_text(raw)
+        for name, to_txt in (("json.load", txt_from_json), ("stream", txt_from_stream)):
+            start = time.perf_counter()
+            peak = peak_bytes(lambda: to_txt(path))
+            result = {
+                "benchmark": "transcript_txt",
+                "parser": name,
+                "json_bytes": len(raw),
+                "peak_bytes": peak,
+                "seconds": round(time.perf_counter() - start, 4),
+            }
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
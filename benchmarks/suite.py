@@ -0,0 +1,443 @@
+"""Run the offline benchmark suite against local stand-ins for Dolby.io and AssemblyAI
+
+Every result goes into one JSON document, together with the version and
+the network conditions it ran under, so that runs of different versions can
+be compared for regressions:
+
+    poetry run python benchmarks/suite.py --output results/0.2.2.json
+    poetry run python benchmarks/suite.py --compare results/0.2.2.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import ffmpeg
+from bench_transcript import synthetic_response
+from tabulate import tabulate
+from typer.testing import CliRunner
+
+from post_production import __version__
+from post_production.assembly_ai import AssemblyAI, UploadFormat
+from post_production.cache import DOLBY
+from post_production.dolby import DolbyIO, JobType
+from post_production.export import ExportFormat, export_file
+from post_production.loudness import analyze_file
+from post_production.main import app
+from post_production.poller import JobPoller
+from post_production.render_cache import RenderCache
+from post_production.stand_in import FakeProviderServer
+from post_production.transcoding import Rendition, _transcode
+
+SUITE_VERSION = 1
+# Metrics a regression makes larger. Every other metric should not shrink.
+LOWER_IS_BETTER = {"seconds", "requests_per_job", "finish_lag_seconds", "upload_mb"}
+METRICS = LOWER_IS_BETTER | {
+    "mb_per_second",
+    "episodes_per_minute",
+    "words_per_second",
+    "times_realtime",
+    "speedup",
+}
+
+
+@dataclass
+class Conditions:
+    """How the stand-in servers behave during a run"""
+
+    latency_ms: float = 20.0
+    error_rate: float = 0.0
+    rate_mb: float = 32.0
+    job_seconds: float = 1.0
+
+    def apply(self, server: FakeProviderServer):
+        server.latency = self.latency_ms / 1000
+        server.error_rate = self.error_rate
+        server.connection_rate = self.rate_mb * 1e6 if self.rate_mb else None
+        server.job_duration = self.job_seconds
+
+
+def provider_server(conditions: Conditions) -> FakeProviderServer:
+    server = FakeProviderServer()
+    conditions.apply(server)
+    DolbyIO.api_endpoint = server.url("/media")
+    AssemblyAI.api_endpoint = server.url("/v2")
+    return server
+
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def bench_upload(args, conditions: Conditions, tmp: Path) -> List[dict]:
+    audio = tmp / "upload.wav"
+    audio.write_bytes(os.urandom(args.size_mb * 1024 * 1024))
+    dolby, assembly = DolbyIO("key"), AssemblyAI("key")
+    uploads = (
+        ("dolby", lambda: dolby.upload(audio)),
+        ("dolby chunked", lambda: dolby.upload(audio, chunked=True)),
+        ("assemblyai", lambda: assembly.upload(audio)),
+    )
+    results = []
+    with provider_server(conditions):
+        for client, upload in uploads:
+            seconds = timed(upload)
+            results.append(
+                {
+                    "benchmark": "upload",
+                    "client": client,
+                    "seconds": round(seconds, 3),
+                    "mb_per_second": round(audio.stat().st_size / seconds / 1e6, 2),
+                }
+            )
+    return results
+
+
+def bench_upload_format(args, conditions: Conditions, tmp: Path) -> List[dict]:
+    # A studio master: stereo 48 kHz 24-bit WAV, with speech-like noise
+    audio = tmp / "episode.wav"
+    (
+        ffmpeg.input(f"anoisesrc=d={args.episode_minutes * 60}:c=pink", f="lavfi")
+        .filter("lowpass", f=4000)
+        .output(str(audio), ac=2, ar=48000, acodec="pcm_s24le")
+        .run(quiet=True)
+    )
+    assembly = AssemblyAI("key")
+    results = []
+    with provider_server(conditions) as server:
+        for upload_format in UploadFormat:
+            seconds = timed(lambda: assembly.upload(audio, upload_format))
+            sent = sum(
+                len(body)
+                for path, body in server.files.items()
+                if path.startswith("/storage/upload/")
+            )
+            server.files.clear()
+            results.append(
+                {
+                    "benchmark": "upload_format",
+                    "format": upload_format.value,
+                    "minutes": args.episode_minutes,
+                    "seconds": round(seconds, 3),
+                    "upload_mb": round(sent / 1e6, 2),
+                }
+            )
+    return results
+
+
+def bench_download(args, conditions: Conditions, tmp: Path) -> List[dict]:
+    data = os.urandom(args.size_mb * 1024 * 1024)
+    dolby = DolbyIO("key")
+    results = []
+    with provider_server(conditions) as server:
+        server.files["/storage/out/download.wav"] = bytearray(data)
+        for workers in (1, 4):
+            out_path = tmp / f"download-{workers}"
+            seconds = timed(
+                lambda: dolby.download(
+                    "dlb://out/download.wav", out_path=out_path, workers=workers
+                )
+            )
+            results.append(
+                {
+                    "benchmark": "download",
+                    "workers": workers,
+                    "seconds": round(seconds, 3),
+                    "mb_per_second": round(len(data) / seconds / 1e6, 2),
+                }
+            )
+    return results
+
+
+def bench_poll(args, conditions: Conditions, tmp: Path) -> List[dict]:
+    dolby = DolbyIO("key")
+    with provider_server(conditions) as server:
+        server.files["/storage/in/poll.wav"] = bytearray(b"RIFF")
+        job_ids = [dolby.enhance("dlb://in/poll.wav")[0] for _ in range(args.jobs)]
+        start = time.perf_counter()
+        with JobPoller(max_interval=max(conditions.job_seconds, 1.0)) as poller:
+            poller.register(DOLBY, dolby)
+            futures = [poller.track(DOLBY, i, JobType.ENHANCE) for i in job_ids]
+            for future in futures:
+                future.result()
+            seconds = time.perf_counter() - start
+            requests = poller.stats.requests
+    return [
+        {
+            "benchmark": "poll",
+            "jobs": args.jobs,
+            "seconds": round(seconds, 3),
+            "requests_per_job": round(requests / args.jobs, 2),
+            "finish_lag_seconds": round(max(0.0, seconds - conditions.job_seconds), 3),
+        }
+    ]
+
+
+def bench_batch(args, conditions: Conditions, tmp: Path) -> List[dict]:
+    os.environ.setdefault("DOLBY_API_KEY", "key")
+    os.environ.setdefault("ASSEMBLYAI_API_KEY", "key")
+    episodes = tmp / "episodes"
+    episodes.mkdir()
+    for i in range(args.episodes):
+        (episodes / f"ep{i:02}.wav").write_bytes(b"RIFF" + os.urandom(256 * 1024))
+    with provider_server(conditions):
+        start = time.perf_counter()
+        result = CliRunner().invoke(
+            app,
+            ["batch", str(episodes), "--no-cache", "--max-poll-interval", "1"],
+        )
+        seconds = time.perf_counter() - start
+    if result.exit_code != 0:
+        raise RuntimeError(f"batch failed: {result.output[-500:]}")
+    return [
+        {
+            "benchmark": "batch",
+            "episodes": args.episodes,
+            "seconds": round(seconds, 3),
+            "episodes_per_minute": round(args.episodes / seconds * 60, 1),
+        }
+    ]
+
+
+def bench_export(args, conditions: Conditions, tmp: Path) -> List[dict]:
+    transcript = tmp / "transcript.json"
+    transcript.write_text(synthetic_response(args.minutes, 160))
+    words = args.minutes * 160
+    results = []
+    for formats in ([ExportFormat.TXT], list(ExportFormat)):
+        out_dir = tmp / f"export-{len(formats)}"
+        out_dir.mkdir()
+        seconds = timed(lambda: export_file(transcript, out_dir, formats, {}))
+        results.append(
+            {
+                "benchmark": "export",
+                "formats": "+".join(f.value for f in formats),
+                "minutes": args.minutes,
+                "seconds": round(seconds, 3),
+                "words_per_second": round(words / seconds),
+            }
+        )
+    return results
+
+
+def bench_loudness(args, conditions: Conditions, tmp: Path) -> List[dict]:
+    audio = tmp / "episode.flac"
+    (
+        ffmpeg.input(f"anoisesrc=d={args.episode_minutes * 60}:c=pink", f="lavfi")
+        .filter("lowpass", f=4000)
+        .output(str(audio), ac=2, ar=48000)
+        .run(quiet=True)
+    )
+    # ffmpeg's own meter, which measures in C but reports no clipping or silence
+    measures = (
+        ("numpy", lambda: analyze_file(audio)),
+        (
+            "ffmpeg ebur128",
+            lambda: ffmpeg.input(str(audio))
+            .filter("ebur128", peak="true")
+            .output("-", f="null")
+            .run(quiet=True),
+        ),
+    )
+    results = []
+    for name, measure in measures:
+        seconds = timed(measure)
+        results.append(
+            {
+                "benchmark": "loudness",
+                "meter": name,
+                "minutes": args.episode_minutes,
+                "seconds": round(seconds, 3),
+                "times_realtime": round(args.episode_minutes * 60 / seconds, 1),
+            }
+        )
+    return results
+
+
+def bench_parallel_encoding(args, conditions: Conditions, tmp: Path) -> List[dict]:
+    audio = tmp / "episode.flac"
+    (
+        ffmpeg.input(f"anoisesrc=d={args.episode_minutes * 60}:c=pink", f="lavfi")
+        .filter("lowpass", f=4000)
+        .output(str(audio), ac=2, ar=48000)
+        .run(quiet=True)
+    )
+    renders = RenderCache(tmp / "renders", max_bytes=None)
+    # Parts beyond the machine's cores only add pre-roll to encode
+    counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    results = []
+    for rendition in (Rendition.master, Rendition.aac):
+        serial = None
+        for jobs in counts:
+            seconds = timed(
+                lambda: _transcode(
+                    audio,
+                    tmp / "episode.mp3",
+                    None,
+                    None,
+                    renders,
+                    [rendition],
+                    overwrite=True,
+                    quiet=True,
+                    jobs=jobs,
+                )
+            )
+            serial = serial or seconds
+            results.append(
+                {
+                    "benchmark": "parallel_encoding",
+                    "rendition": rendition.value,
+                    "jobs": jobs,
+                    "cpus": os.cpu_count(),
+                    "minutes": args.episode_minutes,
+                    "seconds": round(seconds, 3),
+                    "times_realtime": round(args.episode_minutes * 60 / seconds, 1),
+                    "speedup": round(serial / seconds, 2),
+                }
+            )
+    return results
+
+
+BENCHMARKS: Dict[str, Callable[..., List[dict]]] = {
+    "upload": bench_upload,
+    "upload_format": bench_upload_format,
+    "download": bench_download,
+    "poll": bench_poll,
+    "batch": bench_batch,
+    "export": bench_export,
+    "loudness": bench_loudness,
+    "parallel_encoding": bench_parallel_encoding,
+}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def result_id(result: dict) -> tuple:
+    """Everything that names a result, as opposed to what it measured"""
+    return tuple(
+        sorted((k, v) for k, v in result.items() if k not in METRICS | {"error"})
+    )
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> int:
+    """Print the change of every metric and return the number of regressions"""
+    previous = {result_id(r): r for r in baseline["results"]}
+    rows, regressions = [], 0
+    for result in current["results"]:
+        before = previous.get(result_id(result))
+        if not before:
+            continue
+        name = " ".join(str(v) for _, v in result_id(result))
+        for metric in sorted(METRICS & result.keys() & before.keys()):
+            old, new = before[metric], result[metric]
+            change = (new - old) / old if old else 0.0
+            worse = (
+                change > threshold if metric in LOWER_IS_BETTER else -change > threshold
+            )
+            regressions += worse
+            rows.append(
+                [
+                    name,
+                    metric,
+                    old,
+                    new,
+                    f"{change:+.1%}",
+                    "REGRESSION" if worse else "",
+                ]
+            )
+    print(
+        tabulate(
+            rows, headers=["Benchmark", "Metric", "Baseline", "Current", "Change", ""]
+        ),
+        file=sys.stderr,
+    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS))
+    parser.add_argument("--output", type=Path, help="Write the results to this file")
+    parser.add_argument("--compare", type=Path, help="Results of an earlier run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Change that counts as a regression",
+    )
+    parser.add_argument("--latency-ms", type=float, default=Conditions.latency_ms)
+    parser.add_argument("--error-rate", type=float, default=Conditions.error_rate)
+    parser.add_argument(
+        "--rate-mb", type=float, default=Conditions.rate_mb, help="Per-connection cap"
+    )
+    parser.add_argument("--job-seconds", type=float, default=Conditions.job_seconds)
+    parser.add_argument("--size-mb", type=int, default=16)
+    parser.add_argument("--jobs", type=int, default=50)
+    parser.add_argument("--episodes", type=int, default=8)
+    parser.add_argument("--minutes", type=int, default=60)
+    parser.add_argument("--episode-minutes", type=int, default=10)
+    args = parser.parse_args()
+
+    conditions = Conditions(
+        args.latency_ms, args.error_rate, args.rate_mb, args.job_seconds
+    )
+    results = []
+    for name in args.only or BENCHMARKS:
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                found = BENCHMARKS[name](args, conditions, Path(tmp))
+            except Exception as e:
+                traceback.print_exc()
+                found = [{"benchmark": name, "error": f"{type(e).__name__}: {e}"}]
+        for result in found:
+            print(json.dumps(result), file=sys.stderr)
+        results.extend(found)
+
+    document = {
+        "suite": SUITE_VERSION,
+        "version": __version__,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "conditions": asdict(conditions),
+        "results": results,
+    }
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(document, indent=2))
+    else:
+        print(json.dumps(document, indent=2))
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if baseline["conditions"] != document["conditions"]:
+            print("Warning: the baseline ran under other conditions", file=sys.stderr)
+        if compare(baseline, document, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
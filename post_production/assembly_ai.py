@@ -1,25 +1,103 @@
 import logging
+import os
+import time
+from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-import requests
+from post_production.cache import ASSEMBLYAI, read_file
+from post_production.metrics import metrics
+from post_production.scheduler import Priority, ScheduledSession
+from post_production.transcript import (
+    STREAM_CHUNK_SIZE,
+    STREAMED_FIELDS,
+    TranscriptParser,
+    TranscriptResult,
+    iter_transcript,
+)
+from post_production.transfer import DEFAULT_WORKERS, pooled_session
+
+__all__ = [
+    "UPLOAD_ENCODINGS",
+    "AssemblyAI",
+    "TranscriptResult",
+    "UploadFormat",
+    "upload_key",
+]
 
 logger = logging.getLogger(__name__)
 
 
+class UploadFormat(str, Enum):
+    original = "original"
+    flac = "flac"
+    opus = "opus"
+
+
+# ffmpeg output options for compressed uploads, formats that stream to a pipe.
+# Opus at compression level 5 encodes twice as fast as the default of 10 for
+# a few percent more bytes, and encoding is slower than the upload it feeds.
+UPLOAD_ENCODINGS: Dict[UploadFormat, Dict[str, Any]] = {
+    UploadFormat.flac: {"ac": 1, "ar": 16000, "acodec": "flac", "f": "flac"},
+    UploadFormat.opus: {
+        "ac": 1,
+        "ar": 16000,
+        "ab": "32k",
+        "acodec": "libopus",
+        "compression_level": 5,
+        "f": "opus",
+    },
+}
+
+
 class AssemblyAI:
     api_endpoint = "https://api.assemblyai.com/v2"
 
     def __init__(self, api_key: str):
         self.api_key = api_key
-        self._session = requests.Session()
+        self._session = ScheduledSession(ASSEMBLYAI, self)
+        pooled_session(DEFAULT_WORKERS, self._session)
         headers = {"authorization": api_key}
         self._session.headers.update(headers)
+        self._session.hooks["response"].append(metrics.request_hook(ASSEMBLYAI, self))
+
+    def upload(
+        self,
+        file_path: Path,
+        upload_format: UploadFormat = UploadFormat.original,
+        start: float = 0.0,
+        duration: Optional[float] = None,
+    ):
+        """Upload a file as it is, or compressed on the fly by ffmpeg
 
-    def upload(self, file_path: Path):
+        Compressed uploads are mono 16 kHz, which is all transcription needs.
+        ffmpeg's output goes straight into the request body, so encoding
+        overlaps the transfer and nothing is written to disk. A part of the
+        file, from `start` for `duration` seconds, can only be sent compressed.
+        """
         url = self.api_endpoint + "/upload"
-        r = self._session.post(url, data=read_file(file_path))
-        r.raise_for_status()
+        upload_format = UploadFormat(upload_format)
+        file_path = Path(file_path)
+        chunks = upload_chunks(file_path, upload_format, start, duration)
+
+        began = time.monotonic()
+        with metrics.stage(
+            "upload", ASSEMBLYAI, file=file_path.name, format=upload_format.value
+        ) as stage:
+            stage["bytes"] = 0
+
+            def body() -> Iterator[bytes]:
+                for chunk in chunks:
+                    stage["bytes"] += len(chunk)
+                    yield chunk
+
+            r = self._session.post(url, data=body(), priority=Priority.TRANSFER)
+            r.raise_for_status()
+        rate = stage["bytes"] / max(time.monotonic() - began, 1e-9)
+        logger.info(
+            f"Uploaded {file_path.name} as {upload_format.value}, {stage['bytes']} "
+            f"of {file_path.stat().st_size} bytes, at {rate:.0f} bytes/s"
+        )
         return r.json().get("upload_url")
 
     def transcribe(
@@ -27,13 +105,10 @@ class AssemblyAI:
         audio_url: str,
         speaker_labels: bool = False,
         word_boost: Optional[List[str]] = [],
+        webhook_url: Optional[str] = None,
     ):
         url = self.api_endpoint + "/transcript"
-        payload = {
-            "audio_url": audio_url,
-            "speaker_labels": speaker_labels,
-            "word_boost": word_boost,
-        }
+        payload = transcript_body(audio_url, speaker_labels, word_boost, webhook_url)
         r = self._session.post(url, json=payload)
         r.raise_for_status()
         data = r.json()
@@ -46,42 +121,104 @@ class AssemblyAI:
         r.raise_for_status()
         return r.json()
 
+    def status(self, job_id: str) -> Dict[str, Any]:
+        """The fields of a transcript up to its status, without the words
+
+        Reading stops as soon as a completed status arrives, so polling a
+        finished job does not download the whole transcript.
+        """
+        url = f"{self.api_endpoint}/transcript/{job_id}"
+        fields: Dict[str, Any] = {}
+        with self._session.get(url, stream=True) as r:
+            r.raise_for_status()
+            for key, value in iter_transcript(r.iter_content(STREAM_CHUNK_SIZE)):
+                if key in STREAMED_FIELDS:
+                    continue
+                fields[key] = value
+                if key == "status" and value == "completed":
+                    break
+        return fields
+
+    def stream_result(self, job_id: str, out_file: Path) -> Iterator[Tuple[str, Any]]:
+        """Save a transcript as json while yielding its parsed fields as they arrive
+
+        Words and utterances are yielded one at a time under their field name,
+        see TranscriptParser. The file only appears once the body is complete.
+        """
+        url = f"{self.api_endpoint}/transcript/{job_id}"
+        part_file = Path(f"{out_file}.part")
+        parser = TranscriptParser()
+        try:
+            name = Path(out_file).name
+            with metrics.stage("download", ASSEMBLYAI, file=name, bytes=0) as stage:
+                with self._session.get(url, stream=True) as r, part_file.open(
+                    "wb"
+                ) as f:
+                    r.raise_for_status()
+                    for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+                        f.write(chunk)
+                        stage["bytes"] += len(chunk)
+                        yield from parser.feed(chunk)
+                    yield from parser.close()
+        except BaseException:
+            part_file.unlink(missing_ok=True)
+            raise
+        os.replace(part_file, out_file)
+
+    def save_result(self, job_id: str, out_file: Path) -> Dict[str, Any]:
+        """Stream a transcript to disk and return its fields other than the words"""
+        return {
+            key: value
+            for key, value in self.stream_result(job_id, out_file)
+            if key not in STREAMED_FIELDS
+        }
+
+
+def upload_chunks(
+    file_path: Path,
+    upload_format: UploadFormat,
+    start: float = 0.0,
+    duration: Optional[float] = None,
+) -> Iterator[bytes]:
+    """The body of an upload, the file as it is or as ffmpeg compresses it"""
+    clip = {"ss": start} if start else {}
+    if duration is not None:
+        clip["t"] = duration
+    if upload_format == UploadFormat.original:
+        if clip:
+            raise ValueError("Parts of a file are uploaded as flac or opus")
+        return read_file(file_path)
+    from post_production.transcoding import encode_stream
+
+    return encode_stream(
+        file_path, UPLOAD_ENCODINGS[upload_format], STREAM_CHUNK_SIZE, clip
+    )
+
+
+def transcript_body(
+    audio_url: str,
+    speaker_labels: bool = False,
+    word_boost: Optional[List[str]] = [],
+    webhook_url: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Build the request body for a transcription job"""
+    payload = {
+        "audio_url": audio_url,
+        "speaker_labels": speaker_labels,
+        "word_boost": word_boost,
+    }
+    if webhook_url:
+        payload["webhook_url"] = webhook_url
+    return payload
+
 
-class TranscriptResult:
-    def __init__(self, **kwargs):
-        for kwarg, value in kwargs.items():
-            self.__setattr__(kwarg, value)
-
-        self.speakers = {}
-
-    def as_txt(self, prompt_speaker_labels: bool = True):
-        sections = []
-        for utterance in self.utterances:
-            if prompt_speaker_labels:
-                speaker_name = self.get_speaker(utterance)
-            else:
-                speaker_name = utterance.get("speaker")
-            section = f"{speaker_name}:\n{utterance.get('text')}\n"
-            sections.append(section)
-        return "\n".join(sections)
-
-    def get_speaker(self, utterance) -> str:
-        speaker = utterance.get("speaker")
-        speaker_name = self.speakers.get(speaker)
-        if not speaker_name:
-            print(f"Speaker {speaker} not found for {utterance.get('text')}")
-            speaker_name = input("Enter speaker label for this section: ")
-            self.speakers[speaker] = speaker_name
-        return speaker_name
-
-
-def read_file(filename, chunk_size=5242880):
-    with open(filename, "rb") as _file:
-        while True:
-            data = _file.read(chunk_size)
-            if not data:
-                break
-            yield data
+def upload_key(content_hash: str, upload_format: UploadFormat) -> str:
+    """Cache key of an upload, which keeps compressed uploads and their
+    transcripts apart from those of the original file"""
+    upload_format = UploadFormat(upload_format)
+    if upload_format == UploadFormat.original:
+        return content_hash
+    return f"{content_hash}:{upload_format.value}"
 
 
 sample_response = {
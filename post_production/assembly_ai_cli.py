@@ -1,62 +1,191 @@
-import json
 import logging
 import os
-import time
 from pathlib import Path
-from typing import List
+from typing import Any, Iterable, List, Optional, Tuple
 
 import click_spinner
 import typer
 from tabulate import tabulate
 
-from post_production.assembly_ai import AssemblyAI, TranscriptResult
+from post_production.assembly_ai import (
+    STREAM_CHUNK_SIZE,
+    AssemblyAI,
+    TranscriptResult,
+    UploadFormat,
+    read_file,
+    upload_key,
+)
+from post_production.cache import ASSEMBLYAI, ResultCache, file_hash
+from post_production.journal import JobJournal, Stage
+from post_production.poller import JobPoller
+from post_production.segments import transcribe_segments
+from post_production.transcript import iter_transcript, iter_txt
 
 logger = logging.getLogger(__name__)
 
 
-def transcribe(input_file: Path = typer.Argument(..., exists=True)):
+def transcribe(
+    input_file: Path = typer.Argument(..., exists=True),
+    cache: bool = typer.Option(
+        True, help="Reuse uploads and results for unchanged files."
+    ),
+    upload_format: UploadFormat = typer.Option(
+        UploadFormat.original,
+        help="Compress to mono 16 kHz with ffmpeg while uploading.",
+    ),
+    segment_minutes: Optional[float] = typer.Option(
+        None,
+        min=1,
+        help="Cut longer episodes at silences into parts of about this length "
+        "and transcribe the parts in parallel.",
+    ),
+    workers: int = typer.Option(
+        4, min=1, help="Parts to upload and transcribe at once."
+    ),
+    journal: bool = typer.Option(
+        True, help="Record jobs so that tppp resume can finish them after a crash."
+    ),
+):
+    """Transcribe an episode with AssemblyAI and save the transcript."""
     assembly_banner()
 
     infile = Path(input_file)
     api_key = get_assemblyai_key()
     client = AssemblyAI(api_key)
 
-    typer.echo(f"Uploading {infile.name} to AssemblyAI")
-    audio_url = client.upload(infile)
-
     if typer.confirm("Do you want to add a list of priority words? ", default=True):
         word_list = get_word_list()
     else:
         word_list = []
-
-    typer.echo(f"Beginning transcription job.")
-    job_id = client.transcribe(
-        audio_url=audio_url, speaker_labels=True, word_boost=word_list
-    )
-    result = client.result(job_id)
-    typer.echo(f"Job {result.get('id')}: {result.get('status')}")
-    with click_spinner.spinner():
-        while result.get("status") not in ("completed", "error"):
-            time.sleep(1)
-            result = client.result(job_id)
-
-    if result.get("status") == "completed":
+    txt_path = None
+    if typer.confirm("Would you like to generate a plain-text transcript?"):
+        txt_path = infile.parent / (infile.stem + " - transcript.txt")
+    params = {"speaker_labels": True, "word_boost": word_list}
+    cache_params = params
+    if segment_minutes:
+        # The transcript of a split episode is cached apart from a whole one's
+        cache_params = dict(params, segment_minutes=segment_minutes)
+
+    result_cache = content_hash = cached = None
+    txt_written = False
+    if cache:
+        result_cache = ResultCache()
+        content_hash = upload_key(file_hash(infile), upload_format)
+        cached = result_cache.get_job(ASSEMBLYAI, content_hash, cache_params)
+
+    if cached and cached.has_artifact:
+        typer.echo(f"Using cached transcript {cached.artifact}")
+        out_path = cached.artifact
+    elif segment_minutes:
         out_path = infile.parent / Path(infile.stem + ".json")
-        save_json(out_path, result)
-
-    typer.echo(f"Transcript JSON saved to output directory")
-    if typer.prompt("Would you like to generate a plain-text transcript?"):
-        transcript = TranscriptResult(**result)
-        text_transcript = transcript.as_txt(prompt_speaker_labels=True)
-        out_path = infile.parent / (infile.stem + " - transcript.txt")
-        typer.echo(f"Writing transcript to {out_path}")
-        with out_path.open("w") as outfile:
-            outfile.write(text_transcript)
+        typer.echo(f"Transcribing {infile.name} in parts of {segment_minutes} minutes")
+        with click_spinner.spinner(), JobPoller() as poller:
+            poller.register(ASSEMBLYAI, client)
+            transcript = transcribe_segments(
+                client,
+                infile,
+                out_path,
+                params,
+                poller,
+                segment_minutes * 60,
+                upload_format,
+                workers,
+                result_cache,
+                content_hash,
+            )
+        if cache:
+            segment_ids = ",".join(transcript.segment_ids)
+            result_cache.put_job(ASSEMBLYAI, content_hash, cache_params, segment_ids)
+            result_cache.put_artifact(ASSEMBLYAI, content_hash, cache_params, out_path)
+        typer.echo(f"Transcript of {len(transcript.segment_ids)} parts saved")
+    else:
+        # Split episodes are picked up again from the cache instead
+        job_journal = JobJournal() if journal else None
 
+        def record(stage: Stage, **details):
+            if job_journal:
+                job_journal.record(ASSEMBLYAI, infile, stage, **details)
 
-def save_json(file_path: Path, data):
-    with file_path.open("w") as outfile:
-        json.dump(data, outfile)
+        out_path = infile.parent / Path(infile.stem + ".json")
+        if cached:
+            job_id = cached.job_id
+            typer.echo(f"Re-attaching to transcription job {job_id}.")
+            record(
+                Stage.SUBMITTED,
+                job_id=job_id,
+                params=params,
+                out_path=out_path,
+                content_hash=content_hash,
+            )
+        else:
+            audio_url = (
+                result_cache.get_upload(ASSEMBLYAI, content_hash) if cache else None
+            )
+            if not audio_url:
+                typer.echo(f"Uploading {infile.name} to AssemblyAI")
+                audio_url = client.upload(infile, upload_format)
+                if cache:
+                    result_cache.put_upload(ASSEMBLYAI, content_hash, audio_url)
+            record(
+                Stage.UPLOADED,
+                audio_url=audio_url,
+                params=params,
+                out_path=out_path,
+                content_hash=content_hash,
+            )
+
+            typer.echo(f"Beginning transcription job.")
+            job_id = client.transcribe(audio_url=audio_url, **params)
+            record(Stage.SUBMITTED, job_id=job_id)
+            if cache:
+                result_cache.put_job(ASSEMBLYAI, content_hash, params, job_id)
+
+        typer.echo(f"Waiting for job {job_id}")
+        with click_spinner.spinner(), JobPoller() as poller:
+            poller.register(ASSEMBLYAI, client)
+            fields = poller.track(ASSEMBLYAI, job_id).result().data
+
+        if fields.get("status") != "completed":
+            typer.echo(f"Transcription failed: {fields.get('error')}")
+            record(Stage.FAILED, status=fields.get("status"), error=fields.get("error"))
+            if cache:
+                result_cache.forget_job(ASSEMBLYAI, content_hash, params)
+            raise typer.Exit(code=1)
+
+        record(Stage.COMPLETED)
+        try:
+            if txt_path:
+                # Write the text out as the utterances arrive, not after the download
+                write_txt(client.stream_result(job_id, out_path), txt_path)
+                txt_written = True
+            else:
+                client.save_result(job_id, out_path)
+        except Exception:
+            if cache:
+                result_cache.forget_job(ASSEMBLYAI, content_hash, params)
+            raise
+        record(Stage.DOWNLOADED, file=out_path)
+        if cache:
+            result_cache.put_artifact(ASSEMBLYAI, content_hash, params, out_path)
+
+        typer.echo(f"Transcript JSON saved to output directory")
+
+    if txt_path and not txt_written:
+        # Read the saved JSON one utterance at a time rather than all at once
+        write_txt(iter_transcript(read_file(out_path, STREAM_CHUNK_SIZE)), txt_path)
+
+
+def write_txt(events: Iterable[Tuple[str, Any]], txt_path: Path):
+    """Write a plain-text transcript from parsed transcript fields, see iter_transcript"""
+    utterances = (value for key, value in events if key == "utterances" and value)
+    speakers = TranscriptResult()
+    typer.echo(f"Writing transcript to {txt_path}")
+    try:
+        with txt_path.open("w") as outfile:
+            outfile.writelines(iter_txt(utterances, speakers.get_speaker))
+    except BaseException:
+        txt_path.unlink(missing_ok=True)
+        raise
 
 
 def get_assemblyai_key() -> str:
@@ -0,0 +1,505 @@
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+from post_production.assembly_ai import (
+    AssemblyAI,
+    UploadFormat,
+    transcript_body,
+    upload_chunks,
+)
+from post_production.cache import ASSEMBLYAI, DOLBY, read_file
+from post_production.dolby import (
+    DolbyIO,
+    JobType,
+    analysis_url,
+    download_path,
+    enhance_body,
+    enhanced_url,
+    input_url,
+)
+from post_production.metrics import endpoint_label, metrics
+from post_production.poller import ASSEMBLYAI_ACTIVE, DOLBY_ACTIVE
+from post_production.scheduler import (
+    IDEMPOTENT_METHODS,
+    Priority,
+    RetryRules,
+    scheduler_for,
+)
+from post_production.transcript import (
+    STREAM_CHUNK_SIZE,
+    STREAMED_FIELDS,
+    TranscriptParser,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = 20
+# Waiting for a free connection in a shared pool is not an error, however long
+DEFAULT_TIMEOUT = httpx.Timeout(60.0, connect=10.0, pool=None)
+
+
+def connection_pool(
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+) -> httpx.AsyncHTTPTransport:
+    """A bounded pool of keep-alive connections for async clients to share
+
+    Requests beyond `max_connections` wait for a connection to come free
+    rather than opening another one.
+    """
+    limits = httpx.Limits(
+        max_connections=max_connections, max_keepalive_connections=max_connections
+    )
+    return httpx.AsyncHTTPTransport(limits=limits)
+
+
+class ScheduledTransport(RetryRules, httpx.AsyncBaseTransport):
+    """ScheduledSession for httpx, sending through a shared connection pool
+
+    API requests wait their turn with the provider's RequestScheduler, the
+    same one the sync clients in this process use, and are sent again as
+    RetryRules allow. Every request is recorded in the run's metrics.
+    Requests may set "priority" and "idempotent" in their extensions.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        client: Any,
+        pool: httpx.AsyncBaseTransport,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ):
+        self.provider = provider
+        # The client's api_endpoint is read for every request, as it may change
+        self.client = client
+        self.pool = pool
+        self.scheduler = scheduler_for(provider)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        if not url.startswith(self.client.api_endpoint):
+            return await self._send(request)
+        method = request.method
+        priority = request.extensions.get("priority")
+        if priority is None:
+            priority = Priority.SUBMIT if method == "POST" else Priority.POLL
+        idempotent = request.extensions.get("idempotent")
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            await self.scheduler.acquire_async(priority)
+            try:
+                response = await self._send(request)
+                error = None
+            except (httpx.TimeoutException, httpx.NetworkError) as e:
+                response, error = None, e
+            finally:
+                self.scheduler.release()
+
+            wait = self._retry_wait(response, error, idempotent, attempt)
+            # A streamed body, e.g. ffmpeg's output, is used up by the first attempt
+            if wait is None or not isinstance(request.stream, httpx.ByteStream):
+                if error:
+                    raise error
+                return response
+            self._count_retry(method, url, response, error, wait, attempt)
+            if response is not None:
+                await response.aclose()
+            await asyncio.sleep(wait)
+            attempt += 1
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        start = time.monotonic()
+        response = await self.pool.handle_async_request(request)
+        if metrics.enabled:
+            metrics.record_request(
+                self.provider,
+                request.method,
+                endpoint_label(str(request.url), self.client.api_endpoint),
+                response.status_code,
+                time.monotonic() - start,
+                int(request.headers.get("Content-Length", 0)),
+                int(response.headers.get("Content-Length", 0)),
+            )
+        return response
+
+    def _never_sent(self, error: Exception) -> bool:
+        # Neither a refused connection nor a wait for one reached the provider
+        return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+async def in_thread(chunks: Iterator[bytes]) -> AsyncIterator[bytes]:
+    """Iterate a blocking iterator, such as a file or ffmpeg's output, in a thread
+
+    The event loop carries on with other requests while each chunk is read.
+    """
+    loop = asyncio.get_running_loop()
+    pending = None
+    try:
+        while True:
+            pending = loop.run_in_executor(None, next, chunks, None)
+            chunk = await asyncio.shield(pending)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        if pending is not None and not pending.done():
+            # The iterator cannot be closed while a read is still running
+            await asyncio.wait([pending])
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+
+async def save_stream(response: httpx.Response, out_file: Path) -> int:
+    """Write a response body to disk as it arrives and return its size
+
+    The file only appears once the body is complete. A cancelled or failed
+    download leaves nothing behind.
+    """
+    loop = asyncio.get_running_loop()
+    part_file = Path(f"{out_file}.part")
+    size = 0
+    try:
+        with part_file.open("wb") as f:
+            async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                await loop.run_in_executor(None, f.write, chunk)
+                size += len(chunk)
+    except BaseException:
+        part_file.unlink(missing_ok=True)
+        raise
+    os.replace(part_file, out_file)
+    return size
+
+
+class _AsyncClient:
+    provider: str
+    api_endpoint: str
+
+    def __init__(
+        self, headers: Dict[str, str], pool: Optional[httpx.AsyncBaseTransport]
+    ):
+        self._owns_pool = pool is None
+        self._pool = pool or connection_pool()
+        self._http = httpx.AsyncClient(
+            headers=headers,
+            transport=ScheduledTransport(self.provider, self, self._pool),
+            timeout=DEFAULT_TIMEOUT,
+            follow_redirects=True,
+        )
+
+    async def aclose(self):
+        await self._http.aclose()
+        if self._owns_pool:
+            await self._pool.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        priority: Optional[Priority] = None,
+        idempotent: Optional[bool] = None,
+        **kwargs,
+    ) -> httpx.Response:
+        extensions = {"priority": priority, "idempotent": idempotent}
+        r = await self._http.request(method, url, extensions=extensions, **kwargs)
+        r.raise_for_status()
+        return r
+
+
+class AsyncDolbyIO(_AsyncClient):
+    """DolbyIO for asyncio, with the same methods as coroutines
+
+    Clients given the same connection_pool() share its connections, so one
+    process can keep a season's worth of jobs going without a thread for
+    each. Requests are paced by the same scheduler as DolbyIO's. Cancelling
+    a call gives up its place in the queue and removes partial downloads.
+
+    Usage:
+        async with AsyncDolbyIO(api_key, pool) as dolby:
+            in_urls = await asyncio.gather(*(dolby.upload(f) for f in episodes))
+    """
+
+    provider = DOLBY
+    api_endpoint = DolbyIO.api_endpoint
+
+    def __init__(self, api_key: str, pool: Optional[httpx.AsyncBaseTransport] = None):
+        headers = {"x-api-key": api_key, "Accept": "application/json"}
+        super().__init__(headers, pool)
+
+    def endpoint(self, job_type: JobType) -> str:
+        return f"{self.api_endpoint}/{job_type.value}"
+
+    async def upload(self, file_path: Path, content_hash: Optional[str] = None) -> str:
+        """Upload a file and return its Dolby-compatible url, see DolbyIO.upload"""
+        file_path = Path(file_path)
+        in_url = input_url(file_path, content_hash)
+        size = file_path.stat().st_size
+
+        began = time.monotonic()
+        with metrics.stage("upload", DOLBY, file=file_path.name) as stage:
+            # Asking for the same input url again is harmless
+            r = await self._request(
+                "POST",
+                self.endpoint(JobType.UPLOAD),
+                json={"url": in_url},
+                priority=Priority.TRANSFER,
+                idempotent=True,
+            )
+            logger.info(f"Created endpoint for {in_url}")
+
+            # Pre-signed urls want a length rather than a chunked body
+            r = await self._http.put(
+                r.json()["url"],
+                content=in_thread(read_file(file_path)),
+                headers={"Content-Length": str(size)},
+            )
+            r.raise_for_status()
+            stage["bytes"] = size
+        rate = size / max(time.monotonic() - began, 1e-9)
+        logger.info(f"Uploaded {file_path.name} to {in_url} at {rate:.0f} bytes/s")
+        return in_url
+
+    async def enhance(
+        self,
+        in_url: str,
+        out_url: Optional[str] = None,
+        webhook_url: Optional[str] = None,
+        **settings,
+    ) -> Tuple[str, str]:
+        """Start an enhance job, see DolbyIO.enhance for the settings"""
+        out_url = enhanced_url(in_url, out_url)
+        body = enhance_body(in_url, out_url, **settings)
+        if webhook_url:
+            body["on_complete"] = {"url": webhook_url}
+
+        logger.info(f"Beginning enhancement for {in_url}")
+        r = await self._request("POST", self.endpoint(JobType.ENHANCE), json=body)
+        job_id = r.json().get("job_id")
+        logger.info(f"Created enhancement job {job_id} with expected output {out_url}")
+        return job_id, out_url
+
+    async def analyze(
+        self,
+        in_url: str,
+        out_url: Optional[str] = None,
+        speech: bool = False,
+        webhook_url: Optional[str] = None,
+    ) -> Tuple[str, str]:
+        """Start an analyze job, see DolbyIO.analyze"""
+        out_url = analysis_url(in_url, speech)
+        body: Dict[str, Any] = {"input": in_url, "output": out_url}
+        if webhook_url:
+            body["on_complete"] = {"url": webhook_url}
+        if speech:
+            job_type = JobType.SPEECH_ANALYZE
+            logger.info(f"Beginning speech analysis for {in_url}")
+        else:
+            job_type = JobType.ANALYZE
+            logger.info(f"Beginning analysis for {in_url}")
+
+        r = await self._request("POST", self.endpoint(job_type), json=body)
+        return r.json().get("job_id"), out_url
+
+    async def get_status(
+        self, job_id: str, job_type: JobType = JobType.ENHANCE
+    ) -> Tuple[str, int]:
+        r = await self._request(
+            "GET", self.endpoint(job_type), params={"job_id": job_id}
+        )
+        data = r.json()
+        return data.get("status"), data.get("progress")
+
+    async def wait(
+        self,
+        job_id: str,
+        job_type: JobType = JobType.ENHANCE,
+        min_interval: float = 1.0,
+        max_interval: float = 30.0,
+        backoff: float = 1.5,
+    ) -> Tuple[str, int]:
+        """Check on a job, less often the longer it runs, until it is done"""
+        interval = min_interval
+        while True:
+            status, progress = await self.get_status(job_id, job_type)
+            if status not in DOLBY_ACTIVE:
+                return status, progress
+            await asyncio.sleep(interval)
+            interval = min(max_interval, interval * backoff)
+
+    async def download(
+        self,
+        out_url: str,
+        out_path: Optional[Path] = None,
+        job_type: JobType = JobType.ENHANCE,
+    ) -> Path:
+        """Save a job's output as it arrives, see DolbyIO.download"""
+        out_file = download_path(out_url, out_path, job_type)
+        logger.info(f"Downloading file from {out_url} to {out_file}")
+        with metrics.stage("download", DOLBY, file=out_file.name) as stage:
+            async with self._http.stream(
+                "GET", self.endpoint(JobType.DOWNLOAD), params={"url": out_url}
+            ) as r:
+                r.raise_for_status()
+                stage["bytes"] = await save_stream(r, out_file)
+        return out_file
+
+
+class AsyncAssemblyAI(_AsyncClient):
+    """AssemblyAI for asyncio, with the same methods as coroutines
+
+    Shares connections, pacing and cancellation with AsyncDolbyIO.
+
+    Usage:
+        async with AsyncAssemblyAI(api_key, pool) as assembly:
+            job_id = await assembly.transcribe(await assembly.upload(episode))
+            fields = await assembly.wait(job_id)
+    """
+
+    provider = ASSEMBLYAI
+    api_endpoint = AssemblyAI.api_endpoint
+
+    def __init__(self, api_key: str, pool: Optional[httpx.AsyncBaseTransport] = None):
+        super().__init__({"authorization": api_key}, pool)
+
+    async def upload(
+        self,
+        file_path: Path,
+        upload_format: UploadFormat = UploadFormat.original,
+        start: float = 0.0,
+        duration: Optional[float] = None,
+    ) -> str:
+        """Upload a file as it is, or compressed on the fly, see AssemblyAI.upload"""
+        upload_format = UploadFormat(upload_format)
+        file_path = Path(file_path)
+        chunks = upload_chunks(file_path, upload_format, start, duration)
+
+        began = time.monotonic()
+        with metrics.stage(
+            "upload", ASSEMBLYAI, file=file_path.name, format=upload_format.value
+        ) as stage:
+            stage["bytes"] = 0
+
+            async def body() -> AsyncIterator[bytes]:
+                async for chunk in in_thread(chunks):
+                    stage["bytes"] += len(chunk)
+                    yield chunk
+
+            r = await self._request(
+                "POST",
+                self.api_endpoint + "/upload",
+                content=body(),
+                priority=Priority.TRANSFER,
+            )
+        rate = stage["bytes"] / max(time.monotonic() - began, 1e-9)
+        logger.info(
+            f"Uploaded {file_path.name} as {upload_format.value}, {stage['bytes']} "
+            f"of {file_path.stat().st_size} bytes, at {rate:.0f} bytes/s"
+        )
+        return r.json().get("upload_url")
+
+    async def transcribe(
+        self,
+        audio_url: str,
+        speaker_labels: bool = False,
+        word_boost: Optional[List[str]] = [],
+        webhook_url: Optional[str] = None,
+    ) -> str:
+        payload = transcript_body(audio_url, speaker_labels, word_boost, webhook_url)
+        r = await self._request("POST", self.api_endpoint + "/transcript", json=payload)
+        data = r.json()
+        logger.info(f"Created job with id {data.get('id')}")
+        return data.get("id")
+
+    async def result(self, job_id: str) -> Dict[Any, Any]:
+        r = await self._request("GET", f"{self.api_endpoint}/transcript/{job_id}")
+        return r.json()
+
+    async def status(self, job_id: str) -> Dict[str, Any]:
+        """The fields of a transcript up to its status, see AssemblyAI.status"""
+        fields: Dict[str, Any] = {}
+        async with self._http.stream(
+            "GET", f"{self.api_endpoint}/transcript/{job_id}"
+        ) as r:
+            r.raise_for_status()
+            parser = TranscriptParser()
+            async for chunk in r.aiter_bytes(STREAM_CHUNK_SIZE):
+                for key, value in parser.feed(chunk):
+                    if key in STREAMED_FIELDS:
+                        continue
+                    fields[key] = value
+                    if key == "status" and value == "completed":
+                        return fields
+            for key, value in parser.close():
+                if key not in STREAMED_FIELDS:
+                    fields[key] = value
+        return fields
+
+    async def wait(
+        self,
+        job_id: str,
+        min_interval: float = 1.0,
+        max_interval: float = 30.0,
+        backoff: float = 1.5,
+    ) -> Dict[str, Any]:
+        """Check on a transcript, less often the longer it runs, until it is done"""
+        interval = min_interval
+        while True:
+            fields = await self.status(job_id)
+            if fields.get("status") not in ASSEMBLYAI_ACTIVE:
+                return fields
+            await asyncio.sleep(interval)
+            interval = min(max_interval, interval * backoff)
+
+    async def stream_result(
+        self, job_id: str, out_file: Path
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """Save a transcript while yielding its fields, see AssemblyAI.stream_result"""
+        loop = asyncio.get_running_loop()
+        part_file = Path(f"{out_file}.part")
+        parser = TranscriptParser()
+        try:
+            name = Path(out_file).name
+            with metrics.stage("download", ASSEMBLYAI, file=name, bytes=0) as stage:
+                async with self._http.stream(
+                    "GET", f"{self.api_endpoint}/transcript/{job_id}"
+                ) as r:
+                    r.raise_for_status()
+                    with part_file.open("wb") as f:
+                        async for chunk in r.aiter_bytes(STREAM_CHUNK_SIZE):
+                            await loop.run_in_executor(None, f.write, chunk)
+                            stage["bytes"] += len(chunk)
+                            for event in parser.feed(chunk):
+                                yield event
+                    for event in parser.close():
+                        yield event
+        except BaseException:
+            part_file.unlink(missing_ok=True)
+            raise
+        os.replace(part_file, out_file)
+
+    async def save_result(self, job_id: str, out_file: Path) -> Dict[str, Any]:
+        """Stream a transcript to disk and return its fields other than the words"""
+        return {
+            key: value
+            async for key, value in self.stream_result(job_id, out_file)
+            if key not in STREAMED_FIELDS
+        }
@@ -0,0 +1,418 @@
+import glob
+import logging
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import typer
+from tabulate import tabulate
+
+from post_production.assembly_ai import AssemblyAI, UploadFormat, upload_key
+from post_production.assembly_ai_cli import get_assemblyai_key
+from post_production.cache import ASSEMBLYAI as ASSEMBLY_KEY
+from post_production.cache import DOLBY as DOLBY_KEY
+from post_production.cache import ResultCache, file_hash
+from post_production.dolby import DolbyIO, JobType
+from post_production.dolby_cli import copy_artifact, get_dolby_key, job_params
+from post_production.poller import JobPoller
+from post_production.webhooks import WebhookReceiver
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = {".aac", ".aif", ".aiff", ".flac", ".m4a", ".mp3", ".ogg", ".wav"}
+
+DOLBY = "Dolby.io"
+ASSEMBLY = "AssemblyAI"
+
+
+def batch(
+    inputs: List[str] = typer.Argument(
+        ..., help="Audio files, directories or glob patterns to process."
+    ),
+    enhance: bool = typer.Option(True, help="Run Dolby.io enhancement."),
+    transcribe: bool = typer.Option(True, help="Run AssemblyAI transcription."),
+    output: Optional[Path] = typer.Option(
+        None, help="Folder for enhanced files. Defaults to output/ next to each input."
+    ),
+    word_boost: List[str] = typer.Option(
+        [], help="Priority word for transcription. Can be repeated."
+    ),
+    workers: int = typer.Option(8, min=1, help="Number of jobs to run at once."),
+    dolby_concurrency: int = typer.Option(
+        4, min=1, help="Maximum Dolby.io jobs in flight."
+    ),
+    assembly_concurrency: int = typer.Option(
+        4, min=1, help="Maximum AssemblyAI jobs in flight."
+    ),
+    max_poll_interval: float = typer.Option(
+        30.0, help="Longest wait in seconds between status checks for a job."
+    ),
+    webhook_url: Optional[str] = typer.Option(
+        None,
+        help="Public url that forwards to the local webhook receiver. "
+        "Jobs then finish on callback and are only polled as a fallback.",
+    ),
+    webhook_port: int = typer.Option(8765, help="Local port for webhook callbacks."),
+    webhook_fallback: float = typer.Option(
+        120.0, help="Seconds between fallback status checks when using webhooks."
+    ),
+    cache: bool = typer.Option(
+        True, help="Reuse uploads and results for unchanged files."
+    ),
+    upload_format: UploadFormat = typer.Option(
+        UploadFormat.original,
+        help="Compress to mono 16 kHz with ffmpeg while uploading for transcription.",
+    ),
+):
+    """Run many episodes through Dolby.io and AssemblyAI in parallel."""
+    files = find_audio_files(inputs)
+    if not files:
+        typer.echo("No audio files found.")
+        raise typer.Exit(code=1)
+
+    providers = []
+    if enhance:
+        providers.append(DOLBY)
+    if transcribe:
+        providers.append(ASSEMBLY)
+    if not providers:
+        typer.echo("Nothing to do. Enable --enhance and/or --transcribe.")
+        raise typer.Exit(code=1)
+
+    dolby_key = get_dolby_key() if enhance else None
+    assembly_key = get_assemblyai_key() if transcribe else None
+
+    result_cache = ResultCache() if cache else None
+    if webhook_url:
+        poller = JobPoller(min_interval=webhook_fallback, max_interval=webhook_fallback)
+        hooks = WebhookReceiver(poller, port=webhook_port, public_url=webhook_url)
+        hooks.start()
+    else:
+        poller = JobPoller(max_interval=max_poll_interval)
+        hooks = None
+    if enhance:
+        poller.register(DOLBY_KEY, DolbyIO(dolby_key))
+    if transcribe:
+        poller.register(ASSEMBLY_KEY, AssemblyAI(assembly_key))
+    progress = BatchProgress(files, providers)
+    limits = {
+        DOLBY: threading.BoundedSemaphore(dolby_concurrency),
+        ASSEMBLY: threading.BoundedSemaphore(assembly_concurrency),
+    }
+
+    tasks = []
+    for infile in files:
+        if enhance:
+            out_path = output if output else infile.parent / "output"
+            tasks.append(
+                (
+                    infile,
+                    DOLBY,
+                    lambda infile=infile, out_path=out_path: enhance_file(
+                        DolbyIO(dolby_key),
+                        infile,
+                        out_path,
+                        progress,
+                        poller,
+                        result_cache,
+                        hooks,
+                    ),
+                )
+            )
+        if transcribe:
+            tasks.append(
+                (
+                    infile,
+                    ASSEMBLY,
+                    lambda infile=infile: transcribe_file(
+                        AssemblyAI(assembly_key),
+                        infile,
+                        word_boost,
+                        progress,
+                        poller,
+                        result_cache,
+                        hooks,
+                        upload_format,
+                    ),
+                )
+            )
+
+    typer.echo(f"Processing {len(files)} files with {workers} workers")
+    start = time.monotonic()
+    failures = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(run_limited, limits[provider], job): (infile, provider)
+            for infile, provider, job in tasks
+        }
+        renderer = ProgressRenderer(progress)
+        renderer.start()
+        try:
+            for future in as_completed(futures):
+                infile, provider = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    failures += 1
+                    logger.exception(f"{provider} job for {infile} failed")
+                    progress.update(infile, provider, f"failed: {e}")
+        finally:
+            renderer.stop()
+            poller.stop()
+            if hooks:
+                hooks.stop()
+
+    elapsed = time.monotonic() - start
+    typer.echo(f"Finished {len(tasks)} jobs in {elapsed:.1f}s ({failures} failed)")
+    typer.echo(
+        f"{poller.stats.requests} status requests, "
+        f"{poller.stats.requests_per_job:.1f} per completed job"
+    )
+    if failures:
+        raise typer.Exit(code=1)
+
+
+def find_audio_files(inputs: List[str]) -> List[Path]:
+    """Expand files, directories and glob patterns into a sorted list of audio files"""
+    found = set()
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            candidates = [p for p in path.iterdir() if p.is_file()]
+        elif path.is_file():
+            candidates = [path]
+        else:
+            candidates = [Path(p) for p in glob.glob(item, recursive=True)]
+        for candidate in candidates:
+            if candidate.is_file() and candidate.suffix.lower() in AUDIO_EXTENSIONS:
+                found.add(candidate)
+    return sorted(found)
+
+
+def run_limited(limit: threading.BoundedSemaphore, job: Callable[[], Path]) -> Path:
+    with limit:
+        return job()
+
+
+def enhance_file(
+    dolby: DolbyIO,
+    infile: Path,
+    out_path: Path,
+    progress: "BatchProgress",
+    poller: JobPoller,
+    result_cache: Optional[ResultCache] = None,
+    hooks: Optional[WebhookReceiver] = None,
+) -> Path:
+    params = job_params(JobType.ENHANCE)
+    cached = content_hash = None
+    if result_cache:
+        progress.update(infile, DOLBY, "hashing")
+        content_hash = file_hash(infile)
+        cached = result_cache.get_job(DOLBY_KEY, content_hash, params)
+
+    if cached and cached.has_artifact:
+        progress.update(infile, DOLBY, "cached")
+        return copy_artifact(cached.artifact, out_path)
+
+    delay = 0.0
+    if cached:
+        job_id, out_url = cached.job_id, cached.out_url
+    else:
+        in_url = None
+        if result_cache:
+            in_url = result_cache.get_upload(DOLBY_KEY, content_hash)
+        if not in_url:
+            progress.update(infile, DOLBY, "uploading")
+            in_url = dolby.upload(infile, content_hash=content_hash)
+            if result_cache:
+                result_cache.put_upload(DOLBY_KEY, content_hash, in_url)
+        if hooks:
+            job_id, out_url = dolby.enhance(
+                in_url, webhook_url=hooks.url_for(DOLBY_KEY)
+            )
+            delay = poller.min_interval
+        else:
+            job_id, out_url = dolby.enhance(in_url)
+        if result_cache:
+            result_cache.put_job(
+                DOLBY_KEY, content_hash, params, job_id, "ENHANCE", out_url
+            )
+    progress.update(infile, DOLBY, "submitted")
+
+    update = poller.track(
+        DOLBY_KEY,
+        job_id,
+        JobType.ENHANCE,
+        on_update=lambda u: progress.update(infile, DOLBY, f"{u.status} {u.progress}%"),
+        delay=delay,
+    ).result()
+    if update.status != "Success":
+        if result_cache:
+            result_cache.forget_job(DOLBY_KEY, content_hash, params)
+        raise RuntimeError(f"Dolby.io job {job_id} ended with status {update.status}")
+
+    progress.update(infile, DOLBY, "downloading")
+    try:
+        file_path = dolby.download(out_url=out_url, out_path=out_path)
+    except Exception:
+        if result_cache:
+            result_cache.forget_job(DOLBY_KEY, content_hash, params)
+        raise
+    if result_cache:
+        result_cache.put_artifact(DOLBY_KEY, content_hash, params, file_path)
+    progress.update(infile, DOLBY, "done")
+    return file_path
+
+
+def transcribe_file(
+    client: AssemblyAI,
+    infile: Path,
+    word_boost: List[str],
+    progress: "BatchProgress",
+    poller: JobPoller,
+    result_cache: Optional[ResultCache] = None,
+    hooks: Optional[WebhookReceiver] = None,
+    upload_format: UploadFormat = UploadFormat.original,
+    out_path: Optional[Path] = None,
+) -> Path:
+    out_path = out_path or infile.parent / Path(infile.stem + ".json")
+    params = {"speaker_labels": True, "word_boost": list(word_boost)}
+    cached = None
+    if result_cache:
+        progress.update(infile, ASSEMBLY, "hashing")
+        content_hash = upload_key(file_hash(infile), upload_format)
+        cached = result_cache.get_job(ASSEMBLY_KEY, content_hash, params)
+
+    if cached and cached.has_artifact:
+        progress.update(infile, ASSEMBLY, "cached")
+        if cached.artifact.resolve() != out_path.resolve():
+            shutil.copy2(cached.artifact, out_path)
+        return out_path
+
+    delay = 0.0
+    if cached:
+        job_id = cached.job_id
+    else:
+        audio_url = None
+        if result_cache:
+            audio_url = result_cache.get_upload(ASSEMBLY_KEY, content_hash)
+        if not audio_url:
+            progress.update(infile, ASSEMBLY, "uploading")
+            audio_url = client.upload(infile, upload_format)
+            if result_cache:
+                result_cache.put_upload(ASSEMBLY_KEY, content_hash, audio_url)
+        if hooks:
+            job_id = client.transcribe(
+                audio_url=audio_url, webhook_url=hooks.url_for(ASSEMBLY_KEY), **params
+            )
+            delay = poller.min_interval
+        else:
+            job_id = client.transcribe(audio_url=audio_url, **params)
+        if result_cache:
+            result_cache.put_job(ASSEMBLY_KEY, content_hash, params, job_id)
+
+    fields = (
+        poller.track(
+            ASSEMBLY_KEY,
+            job_id,
+            on_update=lambda u: progress.update(infile, ASSEMBLY, u.status),
+            delay=delay,
+        )
+        .result()
+        .data
+    )
+
+    if fields.get("status") != "completed":
+        if result_cache:
+            result_cache.forget_job(ASSEMBLY_KEY, content_hash, params)
+        raise RuntimeError(f"AssemblyAI job {job_id}: {fields.get('error')}")
+
+    progress.update(infile, ASSEMBLY, "downloading")
+    try:
+        client.save_result(job_id, out_path)
+    except Exception:
+        if result_cache:
+            result_cache.forget_job(ASSEMBLY_KEY, content_hash, params)
+        raise
+    if result_cache:
+        result_cache.put_artifact(ASSEMBLY_KEY, content_hash, params, out_path)
+    progress.update(infile, ASSEMBLY, "done")
+    return out_path
+
+
+class BatchProgress:
+    """Thread-safe status table shared by all batch workers"""
+
+    def __init__(self, files: List[Path], providers: List[str]):
+        self.providers = providers
+        self._lock = threading.Lock()
+        self._rows: Dict[Path, Dict[str, str]] = {
+            infile: {provider: "waiting" for provider in providers} for infile in files
+        }
+        self.version = 0
+
+    def add(self, infile: Path):
+        with self._lock:
+            self._rows[infile] = {provider: "waiting" for provider in self.providers}
+            self.version += 1
+
+    def remove(self, infile: Path):
+        with self._lock:
+            self._rows.pop(infile, None)
+            self.version += 1
+
+    def statuses(self, infile: Path) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._rows.get(infile, {}))
+
+    def update(self, infile: Path, provider: str, status: str):
+        with self._lock:
+            if self._rows[infile][provider] != status:
+                self._rows[infile][provider] = status
+                self.version += 1
+
+    def table(self) -> str:
+        with self._lock:
+            rows = [
+                [infile.name] + [statuses[p] for p in self.providers]
+                for infile, statuses in self._rows.items()
+            ]
+        return tabulate(rows, headers=["File"] + self.providers)
+
+
+class ProgressRenderer(threading.Thread):
+    """Redraws the batch progress table whenever it changes"""
+
+    def __init__(self, progress: BatchProgress, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.progress = progress
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._interactive = sys.stdout.isatty()
+        self._lines = 0
+        self._version = -1
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            if self._interactive:
+                self.render()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.render()
+
+    def render(self):
+        if self.progress.version == self._version:
+            return
+        self._version = self.progress.version
+        table = self.progress.table()
+        if self._lines:
+            # Move the cursor back up over the previous table and clear it
+            typer.echo(f"\x1b[{self._lines}F\x1b[J", nl=False)
+        typer.echo(table)
+        self._lines = table.count("\n") + 1
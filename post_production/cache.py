@@ -0,0 +1,207 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "post-production" / "cache.sqlite3"
+
+DOLBY = "dolby"
+ASSEMBLYAI = "assemblyai"
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+# How long each provider keeps what we sent it. Dolby.io deletes dlb://in and
+# dlb://out media after a day, AssemblyAI expires uploads but keeps transcripts.
+UPLOAD_TTL = {DOLBY: DAY, ASSEMBLYAI: DAY}
+JOB_TTL = {DOLBY: DAY, ASSEMBLYAI: 30 * DAY}
+# Downloaded results live on our disk, so they outlast the remote copies.
+ARTIFACT_TTL = 365 * DAY
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    provider TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    url TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (provider, content_hash)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    provider TEXT NOT NULL,
+    job_key TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    params TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    job_type TEXT,
+    out_url TEXT,
+    artifact TEXT,
+    expires_at REAL NOT NULL,
+    job_expires_at REAL,
+    PRIMARY KEY (provider, job_key)
+);
+"""
+
+
+def read_file(filename, chunk_size=5242880):
+    with open(filename, "rb") as _file:
+        while True:
+            data = _file.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+
+def file_hash(file_path: Path, chunk_size: int = 5242880) -> str:
+    """SHA-256 of a file, read in chunks so large masters never sit in memory"""
+    digest = hashlib.sha256()
+    for chunk in read_file(file_path, chunk_size=chunk_size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def job_key(content_hash: str, params: Dict[str, Any]) -> str:
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{content_hash}:{canonical}".encode()).hexdigest()
+
+
+@dataclass
+class CachedJob:
+    job_id: str
+    job_type: Optional[str]
+    out_url: Optional[str]
+    artifact: Optional[Path]
+
+    @property
+    def has_artifact(self) -> bool:
+        return self.artifact is not None and self.artifact.exists()
+
+
+class ResultCache:
+    """Maps file content and job parameters to remote uploads, jobs and local results
+
+    Entries expire when the provider would have deleted the remote copy, so a
+    cached url or job id is only reused while it can still be fetched.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = Path(path or os.environ.get("TPPP_CACHE") or DEFAULT_CACHE_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "job_expires_at" not in columns:
+                # Caches from before the remote job's expiry was kept apart
+                conn.execute("ALTER TABLE jobs ADD COLUMN job_expires_at REAL")
+        self.evict_expired()
+
+    def _connect(self) -> sqlite3.Connection:
+        # One short-lived connection per call keeps the cache safe to share
+        # between worker threads.
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _execute(self, sql: str, params=()) -> list:
+        with closing(self._connect()) as conn:
+            with conn:
+                return conn.execute(sql, params).fetchall()
+
+    def evict_expired(self) -> int:
+        now = time.time()
+        with closing(self._connect()) as conn:
+            with conn:
+                removed = conn.execute(
+                    "DELETE FROM uploads WHERE expires_at < ?", (now,)
+                ).rowcount
+                removed += conn.execute(
+                    "DELETE FROM jobs WHERE expires_at < ?", (now,)
+                ).rowcount
+        if removed:
+            logger.info(f"Evicted {removed} expired cache entries")
+        return removed
+
+    def get_upload(self, provider: str, content_hash: str) -> Optional[str]:
+        rows = self._execute(
+            "SELECT url FROM uploads "
+            "WHERE provider = ? AND content_hash = ? AND expires_at >= ?",
+            (provider, content_hash, time.time()),
+        )
+        return rows[0][0] if rows else None
+
+    def put_upload(self, provider: str, content_hash: str, url: str):
+        self._execute(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)",
+            (provider, content_hash, url, time.time() + UPLOAD_TTL[provider]),
+        )
+
+    def get_job(
+        self, provider: str, content_hash: str, params: Dict[str, Any]
+    ) -> Optional[CachedJob]:
+        rows = self._execute(
+            "SELECT job_id, job_type, out_url, artifact, job_expires_at FROM jobs "
+            "WHERE provider = ? AND job_key = ? AND expires_at >= ?",
+            (provider, job_key(content_hash, params), time.time()),
+        )
+        if not rows:
+            return None
+        job_id, job_type, out_url, artifact, job_expires_at = rows[0]
+        cached = CachedJob(
+            job_id, job_type, out_url, Path(artifact) if artifact else None
+        )
+        if not cached.has_artifact and (job_expires_at or 0) < time.time():
+            # The result was deleted here, and the provider has deleted its copy
+            return None
+        return cached
+
+    def put_job(
+        self,
+        provider: str,
+        content_hash: str,
+        params: Dict[str, Any],
+        job_id: str,
+        job_type: Optional[str] = None,
+        out_url: Optional[str] = None,
+    ):
+        # The artifact row outlives the remote job, so both expiries are kept
+        expires_at = time.time() + JOB_TTL[provider]
+        self._execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?, ?)",
+            (
+                provider,
+                job_key(content_hash, params),
+                content_hash,
+                json.dumps(params, sort_keys=True),
+                job_id,
+                job_type,
+                out_url,
+                expires_at,
+                expires_at,
+            ),
+        )
+
+    def forget_job(self, provider: str, content_hash: str, params: Dict[str, Any]):
+        """Drop a job that failed or whose result could not be downloaded"""
+        self._execute(
+            "DELETE FROM jobs WHERE provider = ? AND job_key = ?",
+            (provider, job_key(content_hash, params)),
+        )
+
+    def put_artifact(
+        self, provider: str, content_hash: str, params: Dict[str, Any], artifact: Path
+    ):
+        self._execute(
+            "UPDATE jobs SET artifact = ?, expires_at = ? "
+            "WHERE provider = ? AND job_key = ?",
+            (
+                str(Path(artifact).resolve()),
+                time.time() + ARTIFACT_TTL,
+                provider,
+                job_key(content_hash, params),
+            ),
+        )
@@ -1,14 +1,24 @@
 import logging
 import os
-import shutil
+import time
 from enum import Enum
 from pathlib import Path
-from typing import Optional, Tuple, Union
+from typing import Any, Dict, Optional, Tuple, Union
 from urllib.parse import quote, unquote
 
-import requests
 from requests.models import InvalidURL
 
+from post_production.cache import DOLBY
+from post_production.metrics import metrics
+from post_production.scheduler import Priority, ScheduledSession
+from post_production.transfer import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_WORKERS,
+    ChunkedUpload,
+    RangedDownload,
+    pooled_session,
+)
+
 logger = logging.getLogger(__name__)
 
 
@@ -36,19 +46,22 @@ CONTENT_TYPES = {
 
 
 class DolbyIO:
-    def __init__(self, api_key: str):
+    api_endpoint = "https://api.dolby.com/media"
+
+    def __init__(self, api_key: str, pool_size: int = DEFAULT_WORKERS):
         headers = {
             "x-api-key": api_key,
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
-        self._session = requests.Session()
+        self._session = ScheduledSession(DOLBY, self)
+        pooled_session(pool_size, self._session)
         self._session.headers.update(headers)
+        self._session.hooks["response"].append(metrics.request_hook(DOLBY, self))
         self._api_key = api_key
 
-    @staticmethod
-    def endpoint(job_type: JobType) -> str:
-        return f"https://api.dolby.com/media/{job_type.value}"
+    def endpoint(self, job_type: JobType) -> str:
+        return f"{self.api_endpoint}/{job_type.value}"
 
     @property
     def api_key(self):
@@ -59,35 +72,74 @@ class DolbyIO:
         self._api_key = key
         self._session.headers["x-api-key"] = key
 
-    def upload(self, file_path: Path) -> str:
+    def upload(
+        self,
+        file_path: Path,
+        chunked: bool = False,
+        workers: int = DEFAULT_WORKERS,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        content_hash: Optional[str] = None,
+    ) -> str:
         """For a given file, upload it and return a Dolby-compatible url
 
         Args:
             in_file (Path): path to local file
+            chunked (bool, optional): Send the file as parallel, resumable byte ranges. The storage behind the pre-signed url must accept Content-Range PUTs. Defaults to False.
+            workers (int, optional): Number of parts to send at once when chunked. Defaults to 4.
+            chunk_size (int, optional): Bytes in each part when chunked. Defaults to 8 MiB.
+            content_hash (Optional[str], optional): Hash of the file's content, to upload it under. Files with the same name then no longer replace each other's uploads. Defaults to None.
 
         Returns:
             str: string to remote path
         """
         url = self.endpoint(JobType.UPLOAD)
 
-        in_url = f"dlb://in/{quote(file_path.name)}"
+        in_url = input_url(file_path, content_hash)
 
         body = {
             "url": in_url,
         }
 
-        r = self._session.post(url, json=body)
-        r.raise_for_status()
-        logger.info(f"Created endpoint for {in_url}")
-
-        data = r.json()
-        presigned_url = data["url"]
-        # Upload your media to the pre-signed url response
-
-        with open(file_path, "rb") as input_file:
-            self._session.put(presigned_url, data=input_file)
-
-        logger.info(f"Uploaded {file_path.name} to {in_url}")
+        with metrics.stage("upload", DOLBY, file=file_path.name) as stage:
+            # An interrupted chunked upload carries on with the url it had
+            presigned_url = (
+                ChunkedUpload.saved_url(file_path, in_url, chunk_size)
+                if chunked
+                else None
+            )
+            if presigned_url:
+                logger.info(f"Resuming the upload of {file_path.name} to {in_url}")
+            else:
+                # Asking for the same input url again is harmless
+                r = self._session.post(
+                    url, json=body, priority=Priority.TRANSFER, idempotent=True
+                )
+                r.raise_for_status()
+                logger.info(f"Created endpoint for {in_url}")
+
+                data = r.json()
+                presigned_url = data["url"]
+            # Upload your media to the pre-signed url response
+
+            if chunked:
+                stats = ChunkedUpload(
+                    presigned_url,
+                    file_path,
+                    chunk_size=chunk_size,
+                    workers=workers,
+                    destination=in_url,
+                ).run()
+                rate = stats.bytes_per_second
+                stage.update(bytes=stats.transferred_bytes, retries=stats.retries)
+            else:
+                start = time.monotonic()
+                with open(file_path, "rb") as input_file:
+                    r = self._session.put(presigned_url, data=input_file)
+                    r.raise_for_status()
+                rate = file_path.stat().st_size / max(time.monotonic() - start, 1e-9)
+                stage["bytes"] = file_path.stat().st_size
+
+        logger.info(f"Uploaded {file_path.name} to {in_url} at {rate:.0f} bytes/s")
         return in_url
 
     def enhance(
@@ -104,6 +156,7 @@ class DolbyIO:
         dynamic_eq: bool = True,
         high_pass_filter: bool = True,
         content_type: str = "interview",
+        webhook_url: Optional[str] = None,
     ) -> Tuple[str, str]:
         """Process an uploaded url and return a file once completed
 
@@ -120,6 +173,7 @@ class DolbyIO:
             dynamic_eq (bool, optional): Enable Dynamic EQ filtering. Defaults to True.
             high_pass_filter (bool, optional): Enable High Pass filtering. Defaults to True.
             content_type (str, optional): Set content type for processing. Defaults to "interview".
+            webhook_url (Optional[str], optional): Url Dolby.io calls when the job completes. Defaults to None.
 
         Raises:
             InvalidURL: If a valid output url cannot be generated
@@ -129,46 +183,24 @@ class DolbyIO:
             Tuple[str, str]: A tuple of the job-id and output url
         """
 
-        if in_url.startswith("dlb://"):
-            out_url = in_url.replace("dlb://in/", "dlb://out/")
-        elif not out_url:
-            raise InvalidURL(
-                "in_url is not a Dolby-provided URL and an out_url was not provided."
-            )
-
-        if content_type not in CONTENT_TYPES:
-            raise ValueError(
-                f'Content type must be a valid type for dolby.io. "{content_type}" is not valid.'
-            )
-
-        body = {
-            "content": {"type": content_type},
-            "audio": {
-                "loudness": {
-                    "enable": loudness,
-                    "dialog_intelligence": dialog_intelligence,
-                    "target_level": loudness_target,
-                },
-                "dynamics": {
-                    "range_control": {
-                        "enable": dynamic_range_control,
-                        "amount": dynamic_range_control_amount,
-                    }
-                },
-                "noise": {
-                    "reduction": {
-                        "enable": noise_reduction,
-                        "amount": noise_reduction_amount,
-                    }
-                },
-                "filter": {
-                    "dynamic_eq": {"enable": dynamic_eq},
-                    "high_pass": {"enable": high_pass_filter},
-                },
-            },
-            "input": in_url,
-            "output": out_url,
-        }
+        out_url = enhanced_url(in_url, out_url)
+
+        body = enhance_body(
+            in_url,
+            out_url,
+            loudness=loudness,
+            loudness_target=loudness_target,
+            dialog_intelligence=dialog_intelligence,
+            dynamic_range_control=dynamic_range_control,
+            dynamic_range_control_amount=dynamic_range_control_amount,
+            noise_reduction=noise_reduction,
+            noise_reduction_amount=noise_reduction_amount,
+            dynamic_eq=dynamic_eq,
+            high_pass_filter=high_pass_filter,
+            content_type=content_type,
+        )
+        if webhook_url:
+            body["on_complete"] = {"url": webhook_url}
 
         url = self.endpoint(JobType.ENHANCE)
 
@@ -182,25 +214,31 @@ class DolbyIO:
         return job_id, out_url
 
     def analyze(
-        self, in_url: str, out_url: Optional[str] = None, speech: bool = False
+        self,
+        in_url: str,
+        out_url: Optional[str] = None,
+        speech: bool = False,
+        webhook_url: Optional[str] = None,
     ) -> Tuple[str, str]:
         """Analyzes an uploaded url and returns a json file once completed
 
         Args:
             in_url (str): path to Dolby-compatible file
             out_url (str): path to JSON analysis report
+            speech (bool, optional): Use speech analysis. Defaults to False.
+            webhook_url (Optional[str], optional): Url Dolby.io calls when the job completes. Defaults to None.
 
         Returns:
             str: path to json analysis
         """
-        out_frags = in_url.split(".")[:-1]
-        out_frags.append("json")
-        out_url = ".".join(out_frags).replace("dlb://in/", "dlb://out/")
+        out_url = analysis_url(in_url, speech)
 
         body = {
             "input": in_url,
             "output": out_url,
         }
+        if webhook_url:
+            body["on_complete"] = {"url": webhook_url}
         if speech:
             url = self.endpoint(JobType.SPEECH_ANALYZE)
             logger.info(f"Beginning speech analysis for {in_url}")
@@ -240,30 +278,24 @@ class DolbyIO:
         out_url: str,
         out_path: Optional[Path] = None,
         job_type: JobType = JobType.ENHANCE,
+        workers: int = DEFAULT_WORKERS,
     ) -> Path:
         """Download files from the Dolby.io Media endpoints
 
+        The file is fetched in parallel byte ranges, resumes if a previous
+        download of the same output was interrupted, and only appears at its
+        final path once its size and checksum have been verified.
+
         Args:
             out_url (str): The path to the dolby.io media
             out_path (Optional[Path], optional): The folder to save the file. Defaults to output/ under the current working directory.
             job_type (JobType, optional): The job type for naming conventions. Defaults to JobType.ENHANCE.
+            workers (int, optional): Number of ranges to fetch at once. Defaults to 4.
 
         Returns:
             [Path]: The pathlib link to the downloaded file
         """
-        if not out_path:
-            out_path = Path(__file__).parent / "output"
-
-        if job_type == JobType.ANALYZE:
-            file_tag = " - Analyzed"
-        elif job_type == JobType.SPEECH_ANALYZE:
-            file_tag = " - Speech Analyzed"
-        else:
-            file_tag = " - Enhanced"
-
-        filename = unquote(out_url.split("/")[-1])
-        out_file = out_path / (Path(filename).stem + file_tag + Path(filename).suffix)
-        out_path.mkdir(parents=True, exist_ok=True)
+        out_file = download_path(out_url, out_path, job_type)
 
         url = self.endpoint(JobType.DOWNLOAD)
 
@@ -271,11 +303,116 @@ class DolbyIO:
             "url": out_url,
         }
         logger.info(f"Downloading file from {out_url} to {out_file}")
-        with self._session.get(url, params=args, stream=True) as response:
-            response.raise_for_status()
-            response.raw.decode_content = True
-            logger.info(f"Downloading from {out_url} into {out_file}")
-            with open(out_file, "wb") as output_file:
-                shutil.copyfileobj(response.raw, output_file)
+        with metrics.stage("download", DOLBY, file=out_file.name) as stage:
+            stats = RangedDownload(
+                url, out_file, session=self._session, params=args, workers=workers
+            ).run()
+            stage.update(bytes=stats.transferred_bytes, retries=stats.retries)
 
         return out_file
+
+
+def enhance_body(
+    in_url: Optional[str],
+    out_url: Optional[str],
+    loudness: bool = True,
+    loudness_target: float = -23.0,
+    dialog_intelligence: bool = True,
+    dynamic_range_control: bool = True,
+    dynamic_range_control_amount: str = "medium",
+    noise_reduction: bool = True,
+    noise_reduction_amount: str = "auto",
+    dynamic_eq: bool = True,
+    high_pass_filter: bool = True,
+    content_type: str = "interview",
+) -> Dict[str, Any]:
+    """Build the request body for an enhance job. See DolbyIO.enhance for the arguments.
+
+    Raises:
+        ValueError: Checks for valid content types
+    """
+    if content_type not in CONTENT_TYPES:
+        raise ValueError(
+            f'Content type must be a valid type for dolby.io. "{content_type}" is not valid.'
+        )
+
+    return {
+        "content": {"type": content_type},
+        "audio": {
+            "loudness": {
+                "enable": loudness,
+                "dialog_intelligence": dialog_intelligence,
+                "target_level": loudness_target,
+            },
+            "dynamics": {
+                "range_control": {
+                    "enable": dynamic_range_control,
+                    "amount": dynamic_range_control_amount,
+                }
+            },
+            "noise": {
+                "reduction": {
+                    "enable": noise_reduction,
+                    "amount": noise_reduction_amount,
+                }
+            },
+            "filter": {
+                "dynamic_eq": {"enable": dynamic_eq},
+                "high_pass": {"enable": high_pass_filter},
+            },
+        },
+        "input": in_url,
+        "output": out_url,
+    }
+
+
+def input_url(file_path: Path, content_hash: Optional[str] = None) -> str:
+    """The dlb://in url a file is uploaded to, in a folder named by its content if known"""
+    folder = f"{content_hash[:32]}/" if content_hash else ""
+    return f"dlb://in/{folder}{quote(Path(file_path).name)}"
+
+
+def enhanced_url(in_url: str, out_url: Optional[str] = None) -> str:
+    """The output url for an enhance job
+
+    Raises:
+        InvalidURL: If a valid output url cannot be generated
+    """
+    if in_url.startswith("dlb://"):
+        return in_url.replace("dlb://in/", "dlb://out/")
+    elif not out_url:
+        raise InvalidURL(
+            "in_url is not a Dolby-provided URL and an out_url was not provided."
+        )
+    return out_url
+
+
+def analysis_url(in_url: str, speech: bool = False) -> str:
+    """The output url for the JSON report of an analyze job
+
+    Speech reports go to their own folder, so both analyses of one upload can
+    run at the same time.
+    """
+    out_frags = in_url.split(".")[:-1]
+    out_frags.append("json")
+    out_dir = "dlb://out/speech/" if speech else "dlb://out/"
+    return ".".join(out_frags).replace("dlb://in/", out_dir)
+
+
+def download_path(
+    out_url: str, out_path: Optional[Path] = None, job_type: JobType = JobType.ENHANCE
+) -> Path:
+    """The local file a Dolby.io output is saved to, creating its folder if needed"""
+    if not out_path:
+        out_path = Path(__file__).parent / "output"
+
+    if job_type == JobType.ANALYZE:
+        file_tag = " - Analyzed"
+    elif job_type == JobType.SPEECH_ANALYZE:
+        file_tag = " - Speech Analyzed"
+    else:
+        file_tag = " - Enhanced"
+
+    filename = unquote(out_url.split("/")[-1])
+    out_path.mkdir(parents=True, exist_ok=True)
+    return out_path / (Path(filename).stem + file_tag + Path(filename).suffix)
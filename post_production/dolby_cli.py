@@ -1,12 +1,24 @@
 import logging
 import os
-import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Dict, Tuple
 
 import click_spinner
 import typer
 
-from post_production.dolby import DolbyIO, JobType
+from post_production.cache import DOLBY, ResultCache, file_hash
+from post_production.dolby import DolbyIO, JobType, enhance_body
+from post_production.journal import JobJournal, Stage
+from post_production.poller import JobPoller, JobUpdate
+from post_production.transfer import DEFAULT_WORKERS
+
+JOB_LABELS = {
+    JobType.ENHANCE: "Processing",
+    JobType.ANALYZE: "Analyzing",
+    JobType.SPEECH_ANALYZE: "Analyzing speech in",
+}
 
 
 def enhance(
@@ -14,45 +26,211 @@ def enhance(
     output: Path = typer.Option(None, help="Output file."),
     analyze: bool = typer.Option(False, help="Analyze audio"),
     analyze_speech: bool = typer.Option(False, help="Use Dolby speech analysis."),
+    all_jobs: bool = typer.Option(
+        False,
+        "--all",
+        help="Enhance, analyze and analyze speech at once from a single upload.",
+    ),
+    cache: bool = typer.Option(
+        True, help="Reuse uploads and results for unchanged files."
+    ),
+    local_analysis: bool = typer.Option(
+        False, help="Analyze loudness, clipping and silence locally instead."
+    ),
+    skip_compliant: bool = typer.Option(
+        False,
+        help="Measure loudness locally first and skip enhancing files that "
+        "already meet the target.",
+    ),
+    journal: bool = typer.Option(
+        True, help="Record jobs so that tppp resume can finish them after a crash."
+    ),
 ):
+    """Enhance an episode with Dolby.io, optionally analyzing it too."""
     banner()
 
     # Make sure we have a valid Dolby API key
     API_KEY = get_dolby_key()
-    dolby = DolbyIO(API_KEY)
-
-    if not typer.confirm(
-        f"Are you ready to upload {infile.name}? You may incur costs.", default=True
-    ):
-        typer.echo("Aborting. Goodbye")
-        return
-
-    typer.echo(f"Uploading {infile}...")
-    with click_spinner.spinner():
-        in_url = dolby.upload(infile)
 
-    if analyze:
-        typer.echo(f"Analyzing {in_url}...")
-        job_id, out_url = dolby.analyze(in_url)
-        job_type = JobType.ANALYZE
+    if all_jobs:
+        job_types = [JobType.ENHANCE, JobType.ANALYZE, JobType.SPEECH_ANALYZE]
+    elif analyze:
+        job_types = [JobType.ANALYZE]
     elif analyze_speech:
-        typer.echo(f"Analyzing speech in {in_url}...")
-        job_id, out_url = dolby.analyze(in_url, speech=True)
-        job_type = JobType.SPEECH_ANALYZE
+        job_types = [JobType.SPEECH_ANALYZE]
     else:
-        typer.echo(f"Processing {in_url}...")
-        job_id, out_url = dolby.enhance(in_url)
-        job_type = JobType.ENHANCE
-
-    display_status(dolby, job_id, job_type)
+        job_types = [JobType.ENHANCE]
+    # Each download fetches byte ranges in parallel, and the downloads run at once
+    dolby = DolbyIO(API_KEY, pool_size=len(job_types) * DEFAULT_WORKERS)
 
     if output:
         out_path = Path(output)
     else:
         out_path = infile.parent / "output"
-    typer.echo(f"Downloading file from {out_url} to {out_path}")
-    file_path = dolby.download(out_url=out_url, out_path=out_path, job_type=job_type)
-    typer.echo(f"File {infile} processed and saved to {file_path}")
+
+    if local_analysis or skip_compliant:
+        # Imported here, so that only local analysis loads numpy
+        from post_production.loudness import (
+            analysis_path,
+            analyze_file,
+            is_compliant,
+            save_report,
+        )
+
+        typer.echo(f"Measuring {infile.name} locally...")
+        try:
+            report = analyze_file(infile)
+        except RuntimeError as e:
+            typer.echo(str(e))
+            raise typer.Exit(code=1)
+        if local_analysis:
+            file_path = save_report(report, analysis_path(infile, out_path))
+            typer.echo(f"File {infile} analyzed locally and saved to {file_path}")
+            job_types = [t for t in job_types if t != JobType.ANALYZE]
+        if skip_compliant and is_compliant(report) and JobType.ENHANCE in job_types:
+            typer.echo(f"{infile.name} already meets the loudness target. Skipping.")
+            job_types = [t for t in job_types if t != JobType.ENHANCE]
+
+    result_cache = content_hash = None
+    if cache:
+        result_cache = ResultCache()
+        content_hash = file_hash(infile)
+
+    job_journal = JobJournal() if journal else None
+
+    def record(job_type: JobType, stage: Stage, **details):
+        if job_journal:
+            job_journal.record(DOLBY, infile, stage, job_type.name, **details)
+
+    jobs: Dict[JobType, Tuple[str, str]] = {}
+    reused = set()
+    for job_type in job_types:
+        cached = None
+        if cache:
+            cached = result_cache.get_job(DOLBY, content_hash, job_params(job_type))
+        if cached and cached.has_artifact:
+            file_path = copy_artifact(cached.artifact, out_path)
+            typer.echo(f"File {infile} already processed. Using cached {file_path}")
+            reused.add(job_type)
+        elif cached:
+            jobs[job_type] = (cached.job_id, cached.out_url)
+            typer.echo(f"Re-attaching to job {cached.job_id} for {infile.name}...")
+            record(
+                job_type,
+                Stage.SUBMITTED,
+                job_id=cached.job_id,
+                out_url=cached.out_url,
+                out_path=out_path,
+                content_hash=content_hash,
+            )
+
+    pending = [t for t in job_types if t not in jobs and t not in reused]
+    if pending:
+        in_url = result_cache.get_upload(DOLBY, content_hash) if cache else None
+        if in_url:
+            typer.echo(f"Using previous upload {in_url}")
+        else:
+            if not typer.confirm(
+                f"Are you ready to upload {infile.name}? You may incur costs.",
+                default=True,
+            ):
+                typer.echo("Aborting. Goodbye")
+                return
+
+            typer.echo(f"Uploading {infile}...")
+            with click_spinner.spinner():
+                in_url = dolby.upload(infile, content_hash=content_hash)
+            if cache:
+                result_cache.put_upload(DOLBY, content_hash, in_url)
+
+        # Every job reads the same dlb://in url, so the file is uploaded once
+        for job_type in pending:
+            record(
+                job_type,
+                Stage.UPLOADED,
+                in_url=in_url,
+                out_path=out_path,
+                content_hash=content_hash,
+            )
+            typer.echo(f"{JOB_LABELS[job_type]} {in_url}...")
+            job_id, out_url = start_job(dolby, job_type, in_url)
+            record(job_type, Stage.SUBMITTED, job_id=job_id, out_url=out_url)
+            jobs[job_type] = (job_id, out_url)
+            if cache:
+                result_cache.put_job(
+                    DOLBY,
+                    content_hash,
+                    job_params(job_type),
+                    job_id,
+                    job_type.name,
+                    out_url,
+                )
+    if not jobs:
+        return
+
+    updates = display_status(dolby, {t: job_id for t, (job_id, _) in jobs.items()})
+    failed = {t: u for t, u in updates.items() if u.status != "Success"}
+    for job_type, update in failed.items():
+        typer.echo(f"Job {jobs[job_type][0]} ended with status {update.status}")
+        record(job_type, Stage.FAILED, status=update.status)
+        if cache:
+            result_cache.forget_job(DOLBY, content_hash, job_params(job_type))
+
+    done = [t for t in jobs if t not in failed]
+    for job_type in done:
+        record(job_type, Stage.COMPLETED)
+    for job_type in done:
+        typer.echo(f"Downloading file from {jobs[job_type][1]} to {out_path}")
+    with ThreadPoolExecutor(max_workers=max(len(done), 1)) as pool:
+        downloads = {
+            job_type: pool.submit(
+                dolby.download,
+                out_url=jobs[job_type][1],
+                out_path=out_path,
+                job_type=job_type,
+            )
+            for job_type in done
+        }
+    for job_type, download in downloads.items():
+        try:
+            file_path = download.result()
+        except Exception:
+            # The job's output may be gone, so the next run starts a new job
+            if cache:
+                result_cache.forget_job(DOLBY, content_hash, job_params(job_type))
+            raise
+        record(job_type, Stage.DOWNLOADED, file=file_path)
+        if cache:
+            result_cache.put_artifact(
+                DOLBY, content_hash, job_params(job_type), file_path
+            )
+        typer.echo(f"File {infile} processed and saved to {file_path}")
+    if failed:
+        raise typer.Exit(code=1)
+
+
+def start_job(dolby: DolbyIO, job_type: JobType, in_url: str) -> Tuple[str, str]:
+    """Start a job on an uploaded file and return its id and output url"""
+    if job_type == JobType.ENHANCE:
+        return dolby.enhance(in_url)
+    return dolby.analyze(in_url, speech=job_type == JobType.SPEECH_ANALYZE)
+
+
+def job_params(job_type: JobType) -> dict:
+    """The settings that decide a job's output, used as part of its cache key"""
+    params = {"job_type": job_type.value}
+    if job_type == JobType.ENHANCE:
+        body = enhance_body(None, None)
+        params["body"] = {k: v for k, v in body.items() if k not in ("input", "output")}
+    return params
+
+
+def copy_artifact(artifact: Path, out_path: Path) -> Path:
+    target = out_path / artifact.name
+    if target.resolve() != artifact.resolve():
+        out_path.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(artifact, target)
+    return target
 
 
 def banner():
@@ -78,17 +256,30 @@ def get_dolby_key() -> str:
     return typer.prompt("Enter your Dolby.io API key")
 
 
-def display_status(dolby, job_id, job_type):
-    status, pct = dolby.get_status(job_id, job_type=job_type)
+def display_status(dolby, jobs: Dict[JobType, str]) -> Dict[JobType, JobUpdate]:
+    """Track jobs together, showing the progress of the slowest one"""
+    progress = {job_type: 0 for job_type in jobs}
+
+    def on_update(job_type: JobType):
+        def update_progress(update: JobUpdate):
+            progress[job_type] = update.progress or 0
+
+        return update_progress
+
     last_pct = 0
-    with typer.progressbar(
-        length=100, label="Processing file", show_percent=True
-    ) as bar:
-        while pct < 100:
-            status, pct = dolby.get_status(job_id, job_type=job_type)
-            if pct > last_pct:
-                bar.update(pct - last_pct)
-                last_pct = pct
-            if status not in ("Pending", "Running"):
-                break
-            time.sleep(1)
+    with JobPoller() as poller:
+        poller.register(DOLBY, dolby)
+        futures = {
+            job_type: poller.track(DOLBY, job_id, job_type, on_update(job_type))
+            for job_type, job_id in jobs.items()
+        }
+        with typer.progressbar(
+            length=100, label="Processing file", show_percent=True
+        ) as bar:
+            while not all(future.done() for future in futures.values()):
+                wait(futures.values(), timeout=0.2)
+                pct = min(progress.values())
+                if pct > last_pct:
+                    bar.update(pct - last_pct)
+                    last_pct = pct
+        return {job_type: future.result() for job_type, future in futures.items()}
@@ -0,0 +1,442 @@
+import json
+import logging
+from abc import ABC, abstractmethod
+from contextlib import ExitStack
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    TextIO,
+    Tuple,
+)
+
+import typer
+
+from post_production.cache import read_file
+from post_production.metrics import metrics
+from post_production.transcript import STREAM_CHUNK_SIZE, iter_transcript
+
+logger = logging.getLogger(__name__)
+
+SENTENCE_ENDS = (".", "?", "!")
+
+
+class ExportFormat(Enum):
+    TXT = "txt"
+    SRT = "srt"
+    VTT = "vtt"
+    CHAPTERS = "chapters"
+    JSONL = "jsonl"
+
+
+SpeakerName = Callable[[Optional[str]], str]
+
+
+def export(
+    transcript: Path = typer.Argument(
+        ..., exists=True, help="Transcript JSON saved by transcribe or batch."
+    ),
+    formats: List[ExportFormat] = typer.Option(
+        list(ExportFormat), "--format", help="Format to write. Can be repeated."
+    ),
+    speakers: Optional[Path] = typer.Option(
+        None,
+        exists=True,
+        help='Speaker names, as JSON like {"A": "Sean"} or lines like A=Sean.',
+    ),
+    out_dir: Optional[Path] = typer.Option(
+        None, help="Folder for the exports. Defaults to the transcript's folder."
+    ),
+    max_line_length: int = typer.Option(42, min=10, help="Caption line length."),
+    max_lines: int = typer.Option(2, min=1, help="Lines per caption."),
+    max_caption_seconds: float = typer.Option(7.0, help="Longest caption on screen."),
+):
+    """Write text, captions, chapters and JSONL from a transcript in one pass."""
+    names = load_speaker_map(speakers) if speakers else {}
+    out_dir = out_dir or transcript.parent
+    out_dir.mkdir(parents=True, exist_ok=True)
+    caption_limits = CaptionLimits(
+        max_line_length, max_lines, int(max_caption_seconds * 1000)
+    )
+    paths = export_file(transcript, out_dir, formats, names, caption_limits)
+    for path in paths:
+        typer.echo(f"Wrote {path}")
+
+
+@dataclass
+class CaptionLimits:
+    max_line_length: int = 42
+    max_lines: int = 2
+    max_duration: int = 7000
+
+
+def load_speaker_map(path: Path) -> Dict[str, str]:
+    """Read speaker names from a JSON object or from `label=name` lines"""
+    text = Path(path).read_text()
+    if Path(path).suffix == ".json":
+        return {str(label): str(name) for label, name in json.loads(text).items()}
+    names = {}
+    for line in text.splitlines():
+        label, sep, name = line.partition("=")
+        if sep and label.strip():
+            names[label.strip()] = name.strip()
+    return names
+
+
+def speaker_namer(names: Mapping[str, str]) -> SpeakerName:
+    def speaker_name(label: Optional[str]) -> str:
+        if label is None:
+            return "Speaker"
+        return names.get(label) or f"Speaker {label}"
+
+    return speaker_name
+
+
+def export_file(
+    transcript: Path,
+    out_dir: Path,
+    formats: Iterable[ExportFormat],
+    names: Mapping[str, str],
+    caption_limits: Optional[CaptionLimits] = None,
+) -> List[Path]:
+    """Stream a saved transcript into one file per format"""
+    stem = transcript.stem
+    paths = {
+        ExportFormat.TXT: out_dir / f"{stem} - transcript.txt",
+        ExportFormat.SRT: out_dir / f"{stem}.srt",
+        ExportFormat.VTT: out_dir / f"{stem}.vtt",
+        ExportFormat.CHAPTERS: out_dir / f"{stem} - chapters.txt",
+        ExportFormat.JSONL: out_dir / f"{stem}.jsonl",
+    }
+    formats = list(dict.fromkeys(formats))
+    cue_cache = CueCache()
+    with ExitStack() as stack:
+        stage = stack.enter_context(
+            metrics.stage(
+                "export", file=transcript.name, bytes=transcript.stat().st_size
+            )
+        )
+        writers = [
+            make_writer(
+                fmt,
+                stack.enter_context(paths[fmt].open("w")),
+                caption_limits,
+                cue_cache,
+            )
+            for fmt in formats
+        ]
+        exporter = Exporter(writers, speaker_namer(names))
+        count = exporter.export(saved_utterances(transcript))
+        stage["utterances"] = count
+    logger.info(
+        f"Exported {count} utterances from {transcript} to {len(formats)} files"
+    )
+    return [paths[fmt] for fmt in formats]
+
+
+def saved_utterances(transcript: Path) -> Iterator[Mapping]:
+    """Utterances of a saved transcript, read one at a time
+
+    Transcripts made without speaker labels have no utterances. Those are
+    read a second time and their words grouped into sentences instead.
+    """
+    found = False
+    chunks = read_file(transcript, STREAM_CHUNK_SIZE)
+    for key, value in iter_transcript(chunks, skip=("text", "words")):
+        if key == "utterances" and value:
+            found = True
+            yield value
+    if not found:
+        chunks = read_file(transcript, STREAM_CHUNK_SIZE)
+        words = (
+            value
+            for key, value in iter_transcript(chunks, skip=("text", "utterances"))
+            if key == "words" and value
+        )
+        yield from sentences(words)
+
+
+def sentences(words: Iterable[Mapping]) -> Iterator[Dict]:
+    """Group words without speakers into one utterance per sentence"""
+    spoken: List[Mapping] = []
+    for word in words:
+        spoken.append(word)
+        if word["text"].endswith(SENTENCE_ENDS):
+            yield utterance_of(spoken)
+            spoken = []
+    if spoken:
+        yield utterance_of(spoken)
+
+
+def utterance_of(words: List[Mapping]) -> Dict:
+    return {
+        "speaker": words[0].get("speaker"),
+        "text": " ".join(w["text"] for w in words),
+        "start": words[0]["start"],
+        "end": words[-1]["end"],
+        "confidence": sum(w.get("confidence") or 0 for w in words) / len(words),
+        "words": words,
+    }
+
+
+def utterance_words(utterance: Mapping) -> List[Mapping]:
+    """The words of an utterance, spread evenly over it when it has none"""
+    words = utterance.get("words")
+    if words:
+        return list(words)
+    tokens = (utterance.get("text") or "").split()
+    start, duration = utterance["start"], utterance["end"] - utterance["start"]
+    total = sum(len(token) for token in tokens) or 1
+    spread, chars = [], 0
+    for token in tokens:
+        word_start = start + duration * chars // total
+        chars += len(token)
+        word_end = start + duration * chars // total
+        spread.append({"text": token, "start": word_start, "end": word_end})
+    return spread
+
+
+def make_writer(
+    fmt: ExportFormat,
+    out: TextIO,
+    caption_limits: Optional[CaptionLimits] = None,
+    cue_cache: Optional["CueCache"] = None,
+) -> "TranscriptWriter":
+    if fmt is ExportFormat.TXT:
+        return TxtWriter(out)
+    if fmt is ExportFormat.SRT:
+        return SrtWriter(out, caption_limits, cue_cache)
+    if fmt is ExportFormat.VTT:
+        return VttWriter(out, caption_limits, cue_cache)
+    if fmt is ExportFormat.CHAPTERS:
+        return ChapterWriter(out)
+    return JsonlWriter(out)
+
+
+class Exporter:
+    """Feeds every utterance to several writers in a single pass
+
+    Usage:
+        with open("episode.srt", "w") as srt, open("episode.vtt", "w") as vtt:
+            Exporter([SrtWriter(srt), VttWriter(vtt)], speaker_name).export(utterances)
+    """
+
+    def __init__(self, writers: List["TranscriptWriter"], speaker_name: SpeakerName):
+        self.writers = writers
+        self.speaker_name = speaker_name
+
+    def export(self, utterances: Iterable[Mapping]) -> int:
+        for writer in self.writers:
+            writer.start()
+        count = 0
+        for count, utterance in enumerate(utterances, start=1):
+            speaker = self.speaker_name(utterance.get("speaker"))
+            words = utterance_words(utterance)
+            for writer in self.writers:
+                writer.utterance(utterance, speaker, words)
+        for writer in self.writers:
+            writer.finish()
+        return count
+
+
+class TranscriptWriter(ABC):
+    """One export format. Utterances arrive in order, each with its words."""
+
+    def __init__(self, out: TextIO):
+        self.out = out
+
+    def start(self):
+        pass
+
+    @abstractmethod
+    def utterance(self, utterance: Mapping, speaker: str, words: List[Mapping]):
+        """Write one utterance, spoken by `speaker`"""
+
+    def finish(self):
+        pass
+
+
+class TxtWriter(TranscriptWriter):
+    """The same layout as TranscriptResult.as_txt"""
+
+    def __init__(self, out: TextIO):
+        super().__init__(out)
+        self._first = True
+
+    def utterance(self, utterance: Mapping, speaker: str, words: List[Mapping]):
+        separator = "" if self._first else "\n"
+        self._first = False
+        self.out.write(f"{separator}{speaker}:\n{utterance.get('text')}\n")
+
+
+class JsonlWriter(TranscriptWriter):
+    def utterance(self, utterance: Mapping, speaker: str, words: List[Mapping]):
+        record = {
+            "speaker": speaker,
+            "label": utterance.get("speaker"),
+            "start": utterance["start"],
+            "end": utterance["end"],
+            "confidence": utterance.get("confidence"),
+            "text": utterance.get("text"),
+        }
+        self.out.write(json.dumps(record) + "\n")
+
+
+class CueCache:
+    """Lets caption writers with the same limits split each utterance only once"""
+
+    def __init__(self):
+        self._words: Optional[List[Mapping]] = None
+        self._limits: Optional[CaptionLimits] = None
+        self._cues: List[Tuple[int, int, List[str]]] = []
+
+    def cues(
+        self, words: List[Mapping], limits: CaptionLimits
+    ) -> List[Tuple[int, int, List[str]]]:
+        # Holding on to `words` means a new list can never be mistaken for it
+        if words is not self._words or limits != self._limits:
+            self._words, self._limits = words, limits
+            self._cues = list(caption_cues(words, limits))
+        return self._cues
+
+
+class CaptionWriter(TranscriptWriter):
+    """Splits utterances into cues that respect line, length and duration limits"""
+
+    def __init__(
+        self,
+        out: TextIO,
+        limits: Optional[CaptionLimits] = None,
+        cue_cache: Optional[CueCache] = None,
+    ):
+        super().__init__(out)
+        self.limits = limits or CaptionLimits()
+        self.cue_cache = cue_cache or CueCache()
+        self.cues = 0
+
+    def utterance(self, utterance: Mapping, speaker: str, words: List[Mapping]):
+        for start, end, lines in self.cue_cache.cues(words, self.limits):
+            self.cues += 1
+            self.write_cue(start, end, lines, speaker)
+
+    @abstractmethod
+    def write_cue(self, start: int, end: int, lines: List[str], speaker: str):
+        """Write cue number `self.cues`, from `start` to `end` ms"""
+
+
+class SrtWriter(CaptionWriter):
+    def write_cue(self, start: int, end: int, lines: List[str], speaker: str):
+        text = "\n".join(lines)
+        self.out.write(
+            f"{self.cues}\n{timestamp(start, ',')} --> {timestamp(end, ',')}\n"
+            f"{text}\n\n"
+        )
+
+
+class VttWriter(CaptionWriter):
+    def start(self):
+        self.out.write("WEBVTT\n\n")
+
+    def write_cue(self, start: int, end: int, lines: List[str], speaker: str):
+        text = "\n".join(lines)
+        self.out.write(
+            f"{timestamp(start)} --> {timestamp(end)}\n<v {speaker}>{text}\n\n"
+        )
+
+
+class ChapterWriter(TranscriptWriter):
+    """Show-notes chapter markers placed at pauses between utterances
+
+    A chapter starts at the first pause of at least `min_gap` once the
+    current chapter is `min_length` long, or at the next utterance once it
+    is `max_length` long. It is titled with its opening words.
+    """
+
+    def __init__(
+        self,
+        out: TextIO,
+        min_length: int = 120_000,
+        max_length: int = 600_000,
+        min_gap: int = 1500,
+        title_length: int = 60,
+    ):
+        super().__init__(out)
+        self.min_length = min_length
+        self.max_length = max_length
+        self.min_gap = min_gap
+        self.title_length = title_length
+        self._chapter_start: Optional[int] = None
+        self._last_end = 0
+
+    def utterance(self, utterance: Mapping, speaker: str, words: List[Mapping]):
+        start = utterance["start"]
+        if self._chapter_start is None:
+            # Podcast apps expect the first chapter at 00:00
+            self.write_chapter(0, utterance)
+        else:
+            length = start - self._chapter_start
+            gap = start - self._last_end
+            if length >= self.max_length or (
+                length >= self.min_length and gap >= self.min_gap
+            ):
+                self.write_chapter(start, utterance)
+        self._last_end = utterance["end"]
+
+    def write_chapter(self, start: int, utterance: Mapping):
+        self._chapter_start = start
+        title = self.title(utterance.get("text") or "")
+        self.out.write(f"{chapter_timestamp(start)} {title}\n")
+
+    def title(self, text: str) -> str:
+        if len(text) <= self.title_length:
+            return text
+        return text[: self.title_length].rsplit(" ", 1)[0] + "…"
+
+
+def caption_cues(
+    words: Iterable[Mapping], limits: CaptionLimits
+) -> Iterator[Tuple[int, int, List[str]]]:
+    """Group words into (start, end, lines) cues within the caption limits"""
+    lines: List[str] = []
+    line = ""
+    start = end = None
+    for word in words:
+        text = word["text"]
+        if start is not None and word["end"] - start > limits.max_duration:
+            yield start, end, lines + [line]
+            lines, line, start = [], "", None
+        if line and len(line) + 1 + len(text) > limits.max_line_length:
+            lines.append(line)
+            line = ""
+            if len(lines) == limits.max_lines:
+                yield start, end, lines
+                lines, start = [], None
+        if start is None:
+            start = word["start"]
+        line = f"{line} {text}" if line else text
+        end = word["end"]
+    if line:
+        yield start, end, lines + [line]
+
+
+def timestamp(ms: int, separator: str = ".") -> str:
+    """HH:MM:SS.mmm as WebVTT wants, or with a comma for SRT"""
+    seconds, ms = divmod(max(ms, 0), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02}:{minutes:02}:{seconds:02}{separator}{ms:03}"
+
+
+def chapter_timestamp(ms: int) -> str:
+    minutes, seconds = divmod(ms // 1000, 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{minutes:02}:{seconds:02}"
@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from post_production.cache import DEFAULT_CACHE_PATH, JOB_TTL, UPLOAD_TTL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOURNAL_PATH = DEFAULT_CACHE_PATH.parent / "journal.sqlite3"
+# Finished jobs are forgotten once their provider would have deleted them
+KEEP_FINISHED = max(JOB_TTL.values())
+
+
+class Stage(str, Enum):
+    UPLOADED = "uploaded"
+    SUBMITTED = "submitted"
+    COMPLETED = "completed"
+    DOWNLOADED = "downloaded"
+    FAILED = "failed"
+
+
+FINISHED = (Stage.DOWNLOADED, Stage.FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    input_file TEXT NOT NULL,
+    job_type TEXT,
+    stage TEXT NOT NULL,
+    details TEXT NOT NULL,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_task ON entries (task, id);
+"""
+
+
+def task_name(provider: str, input_file: Path, job_type: Optional[str]) -> str:
+    """One job of one input, e.g. the enhancement of an episode"""
+    return f"{provider}:{Path(input_file).resolve()}:{job_type or ''}"
+
+
+@dataclass
+class JournalTask:
+    """What the entries of a task add up to
+
+    details collects every field recorded so far, such as the uploaded
+    `in_url`, the `job_id`, the `out_url` and `out_path` of the result, the
+    job `params`, and the `content_hash` the result cache knows the input by.
+    """
+
+    task: str
+    provider: str
+    input_file: Path
+    job_type: Optional[str]
+    stage: Stage
+    details: Dict[str, Any] = field(default_factory=dict)
+    uploaded_at: Optional[float] = None
+    submitted_at: Optional[float] = None
+    updated_at: float = 0.0
+
+    @property
+    def job_id(self) -> Optional[str]:
+        return self.details.get("job_id")
+
+    @property
+    def finished(self) -> bool:
+        return self.stage in FINISHED
+
+    @property
+    def expired(self) -> bool:
+        """Whether the provider has deleted what the task would resume from"""
+        now = time.time()
+        if self.submitted_at is not None:
+            return now - self.submitted_at > JOB_TTL[self.provider]
+        if self.uploaded_at is not None:
+            return now - self.uploaded_at > UPLOAD_TTL[self.provider]
+        return False
+
+
+class JobJournal:
+    """An append-only record of each job's progress through upload, submission,
+    completion and download
+
+    Every transition is committed before the run moves on, so a run that is
+    killed leaves behind which jobs it paid for and how far they got.
+    `tppp resume` re-attaches to those jobs rather than uploading again.
+
+    Usage:
+        journal = JobJournal()
+        journal.record(DOLBY, infile, Stage.UPLOADED, "ENHANCE", in_url=url)
+        journal.record(DOLBY, infile, Stage.SUBMITTED, "ENHANCE", job_id=job_id)
+        for task in journal.outstanding():
+            ...
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = Path(path or os.environ.get("TPPP_JOURNAL") or DEFAULT_JOURNAL_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+        self.prune()
+
+    def _connect(self) -> sqlite3.Connection:
+        # One short-lived connection per call, as in the result cache, so
+        # worker threads can share the journal
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(
+        self,
+        provider: str,
+        input_file: Path,
+        stage: Stage,
+        job_type: Optional[str] = None,
+        **details: Any,
+    ):
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.execute(
+                    "INSERT INTO entries (task, provider, input_file, job_type, "
+                    "stage, details, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        task_name(provider, input_file, job_type),
+                        provider,
+                        str(Path(input_file).resolve()),
+                        job_type,
+                        Stage(stage).value,
+                        json.dumps(details, default=str),
+                        time.time(),
+                    ),
+                )
+
+    def tasks(self) -> List[JournalTask]:
+        """Every task in the journal, in the order they were started"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT task, provider, input_file, job_type, stage, details, "
+                "recorded_at FROM entries ORDER BY id"
+            ).fetchall()
+        tasks: Dict[str, JournalTask] = {}
+        for name, provider, input_file, job_type, stage, details, at in rows:
+            task = tasks.get(name)
+            if task is None or task.finished or stage == Stage.UPLOADED.value:
+                # A task run again from the start replaces the earlier one
+                tasks.pop(name, None)
+                task = tasks[name] = JournalTask(
+                    name, provider, Path(input_file), job_type, Stage(stage)
+                )
+            task.stage = Stage(stage)
+            task.details.update(json.loads(details))
+            task.updated_at = at
+            if task.stage == Stage.UPLOADED:
+                task.uploaded_at = at
+            elif task.stage == Stage.SUBMITTED:
+                task.submitted_at = at
+        return list(tasks.values())
+
+    def outstanding(self) -> List[JournalTask]:
+        """Tasks a run started and did not see through"""
+        return [task for task in self.tasks() if not task.finished]
+
+    def prune(self, keep: float = KEEP_FINISHED) -> int:
+        """Forget tasks that finished longer than `keep` seconds ago"""
+        cutoff = time.time() - keep
+        with closing(self._connect()) as conn:
+            with conn:
+                removed = conn.execute(
+                    "DELETE FROM entries WHERE task IN ("
+                    "  SELECT task FROM entries e WHERE id = "
+                    "    (SELECT MAX(id) FROM entries WHERE task = e.task)"
+                    "  AND stage IN (?, ?) AND recorded_at < ?)",
+                    (Stage.DOWNLOADED.value, Stage.FAILED.value, cutoff),
+                ).rowcount
+        if removed:
+            logger.info(f"Pruned {removed} journal entries of finished jobs")
+        return removed
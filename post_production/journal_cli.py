@@ -0,0 +1,166 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict
+
+import typer
+from tabulate import tabulate
+
+from post_production.assembly_ai import AssemblyAI
+from post_production.assembly_ai_cli import get_assemblyai_key
+from post_production.cache import ASSEMBLYAI, DOLBY, ResultCache
+from post_production.dolby import DolbyIO, JobType
+from post_production.dolby_cli import get_dolby_key, job_params, start_job
+from post_production.journal import JobJournal, JournalTask, Stage
+from post_production.poller import SUCCEEDED, JobPoller
+
+logger = logging.getLogger(__name__)
+
+
+def resume(
+    submit: bool = typer.Option(
+        True, help="Start the jobs of files that were uploaded but never submitted."
+    ),
+    workers: int = typer.Option(4, min=1, help="Jobs to wait on and download at once."),
+):
+    """Re-attach to jobs an interrupted run left behind and download their results."""
+    journal = JobJournal()
+    tasks = journal.outstanding()
+    if not tasks:
+        typer.echo(f"No unfinished jobs in {journal.path}")
+        return
+
+    typer.echo(
+        tabulate(
+            [
+                [
+                    task.provider,
+                    task.input_file.name,
+                    task.job_type or "",
+                    task.stage.value,
+                    task.job_id or "",
+                    f"{datetime.fromtimestamp(task.updated_at):%Y-%m-%d %H:%M}",
+                ]
+                for task in tasks
+            ],
+            headers=["Provider", "File", "Job", "Stage", "Job id", "Last seen"],
+            disable_numparse=True,
+        )
+    )
+
+    for task in [task for task in tasks if task.expired]:
+        typer.echo(
+            f"The {task.provider} copy of {task.input_file.name} has expired. "
+            "Run it again from the start."
+        )
+        record(journal, task, Stage.FAILED, status="expired")
+    tasks = [task for task in tasks if not task.expired]
+
+    unsubmitted = [task for task in tasks if task.stage == Stage.UPLOADED]
+    if unsubmitted and not (
+        submit
+        and typer.confirm(
+            f"Start {len(unsubmitted)} jobs for files that were already uploaded? "
+            "You may incur costs.",
+            default=True,
+        )
+    ):
+        tasks = [task for task in tasks if task.stage != Stage.UPLOADED]
+    if not tasks:
+        return
+
+    clients: Dict[str, Any] = {}
+    if any(task.provider == DOLBY for task in tasks):
+        clients[DOLBY] = DolbyIO(get_dolby_key())
+    if any(task.provider == ASSEMBLYAI for task in tasks):
+        clients[ASSEMBLYAI] = AssemblyAI(get_assemblyai_key())
+
+    with JobPoller() as poller:
+        for provider, client in clients.items():
+            poller.register(provider, client)
+
+        def finish(task: JournalTask) -> bool:
+            try:
+                return finish_task(journal, task, clients[task.provider], poller)
+            except Exception as e:
+                # Left in the journal, so the next resume tries again
+                logger.exception(f"Could not resume {task.task}")
+                typer.echo(f"Could not resume {task.input_file.name}: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            finished = list(pool.map(finish, tasks))
+
+    resumed = [task for task, ok in zip(tasks, finished) if ok]
+    cached = [task for task in tasks if task.details.get("content_hash")]
+    result_cache = ResultCache() if cached else None
+    for task in cached:
+        # So the next run of the command finds the result in the cache, or
+        # starts a new job instead of the one that failed
+        if task.stage == Stage.DOWNLOADED:
+            result_cache.put_artifact(
+                task.provider,
+                task.details["content_hash"],
+                task_params(task),
+                task.details["file"],
+            )
+        elif task.stage == Stage.FAILED:
+            result_cache.forget_job(
+                task.provider, task.details["content_hash"], task_params(task)
+            )
+    typer.echo(f"Resumed {len(resumed)} of {len(tasks)} jobs")
+    if len(resumed) < len(tasks):
+        raise typer.Exit(code=1)
+
+
+def task_params(task: JournalTask) -> Dict[str, Any]:
+    """The params a task's job is known by in the result cache"""
+    if task.provider == DOLBY:
+        return job_params(JobType[task.job_type])
+    return task.details["params"]
+
+
+def record(journal: JobJournal, task: JournalTask, stage: Stage, **details):
+    journal.record(task.provider, task.input_file, stage, task.job_type, **details)
+    task.stage = stage
+    task.details.update(details)
+
+
+def finish_task(
+    journal: JobJournal, task: JournalTask, client: Any, poller: JobPoller
+) -> bool:
+    """Take a task from where the journal left it to a downloaded result"""
+    name = task.input_file.name
+    job_type = JobType[task.job_type] if task.provider == DOLBY else None
+    if task.stage == Stage.UPLOADED:
+        if task.provider == DOLBY:
+            job_id, out_url = start_job(client, job_type, task.details["in_url"])
+            record(journal, task, Stage.SUBMITTED, job_id=job_id, out_url=out_url)
+        else:
+            job_id = client.transcribe(
+                audio_url=task.details["audio_url"], **task.details["params"]
+            )
+            record(journal, task, Stage.SUBMITTED, job_id=job_id)
+        typer.echo(f"Started job {job_id} for {name}")
+
+    if task.stage == Stage.SUBMITTED:
+        typer.echo(f"Re-attaching to job {task.job_id} for {name}")
+        update = poller.track(task.provider, task.job_id, job_type).result()
+        if update.status not in SUCCEEDED:
+            typer.echo(f"Job {task.job_id} for {name} ended with {update.status}")
+            record(journal, task, Stage.FAILED, status=update.status)
+            return False
+        record(journal, task, Stage.COMPLETED)
+
+    out_path = Path(task.details["out_path"])
+    if task.provider == DOLBY:
+        file_path = client.download(
+            out_url=task.details["out_url"], out_path=out_path, job_type=job_type
+        )
+    else:
+        file_path = out_path
+        client.save_result(task.job_id, file_path)
+    record(journal, task, Stage.DOWNLOADED, file=str(file_path))
+    typer.echo(f"Saved {file_path}")
+    return True
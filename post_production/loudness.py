@@ -0,0 +1,449 @@
+import json
+import logging
+import math
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import ffmpeg
+import typer
+
+from post_production.metrics import metrics
+from post_production.transcoding import encode_stream
+
+try:
+    import numpy as np
+except ImportError:  # numpy comes with the "analysis" extra
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Loudness is gated in blocks of 100 ms
+BLOCKS_PER_SECOND = 10
+# Audio decoded per step, which bounds the memory used for any length of file
+STEP_BLOCKS = 100
+
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+RANGE_GATE = -20.0
+TRUE_PEAK_OVERSAMPLING = 4
+TRUE_PEAK_TAPS = 12
+
+# Dolby.io's defaults for enhance, and the peak EBU R128 allows
+TARGET_LOUDNESS = -23.0
+TARGET_TOLERANCE = 1.0
+MAX_TRUE_PEAK = -1.0
+
+CLIP_LEVEL = 0.999
+CLIP_MIN_SAMPLES = 3
+SILENCE_LEVEL = -60.0
+SILENCE_SECONDS = 1.0
+
+DURATION = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+AUDIO_STREAM = re.compile(r"Audio: (\w+).*?, (\d+) Hz, ([^,]+)")
+
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError(
+            "Local analysis needs numpy: pip install 'post-production[analysis]'"
+        )
+
+
+def decibels(power: float) -> Optional[float]:
+    """A power ratio in dB, or None for silence, which JSON cannot hold as -inf"""
+    return round(float(10 * np.log10(power)), 2) if power > 0 else None
+
+
+def loudness(power: "np.ndarray") -> "np.ndarray":
+    """BS.1770 loudness in LUFS of mean square K-weighted powers"""
+    with np.errstate(divide="ignore"):
+        return -0.691 + 10 * np.log10(power)
+
+
+def moving_mean(values: "np.ndarray", width: int) -> "np.ndarray":
+    """Means of every run of width values, one per position, like a window"""
+    if len(values) < width:
+        return values[:0]
+    sums = np.cumsum(np.concatenate(([0.0], values)))
+    return (sums[width:] - sums[:-width]) / width
+
+
+def sections(mask: "np.ndarray", min_blocks: int = 1) -> List[Tuple[int, int]]:
+    """(first block, number of blocks) of each run of True in mask"""
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.view(np.int8), [0]))))
+    starts, ends = edges[::2], edges[1::2]
+    return [(s, e - s) for s, e in zip(starts, ends) if e - s >= min_blocks]
+
+
+def k_weighting(sample_rate: int) -> List[Tuple[Tuple[float, ...], ...]]:
+    """(b, a) coefficients of the BS.1770 high shelf and RLB high-pass
+
+    BS.1770 only lists them for 48 kHz. These come from the analog filters
+    they were made from, as in libebur128, so audio is measured at its own
+    rate without resampling.
+    """
+    k = math.tan(math.pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh**0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (
+        (
+            (vh + vb * k / q + k * k) / a0,
+            2 * (k * k - vh) / a0,
+            (vh - vb * k / q + k * k) / a0,
+        ),
+        (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0),
+    )
+    k = math.tan(math.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = (
+        (1.0, -2.0, 1.0),
+        (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0),
+    )
+    return [shelf, high_pass]
+
+
+def true_peak_filter() -> "np.ndarray":
+    """Polyphase low-pass for 4x oversampling, one row of taps per phase"""
+    taps = TRUE_PEAK_OVERSAMPLING * TRUE_PEAK_TAPS
+    n = np.arange(taps) - (taps - 1) / 2
+    h = np.sinc(n / TRUE_PEAK_OVERSAMPLING) * np.kaiser(taps, 6.0)
+    phases = h.reshape(TRUE_PEAK_TAPS, TRUE_PEAK_OVERSAMPLING).T
+    return (phases / phases.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+class LoudnessMeter:
+    """Measures float audio fed to it in steps of whole 100 ms blocks
+
+    Each step is reduced to a few numbers per block right away, so memory
+    grows by bytes per block rather than with the audio itself. Loudness
+    follows ITU-R BS.1770-4 and EBU R128, with the range as in EBU Tech 3342.
+
+    Usage:
+        meter = LoudnessMeter(channels=2, sample_rate=44100)
+        for samples in steps:
+            meter.feed(samples)
+        print(meter.integrated())
+    """
+
+    def __init__(self, channels: int, sample_rate: int):
+        require_numpy()
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.block_frames = round(sample_rate / BLOCKS_PER_SECOND)
+        self.frames = 0
+        self.sample_peak = 0.0
+        self.true_peak = 0.0
+        self._last_peak = 0.0
+        self._phases = true_peak_filter()
+        # Gain of the loudest possible inter-sample peak, to skip quiet steps
+        self._peak_gain = np.abs(self._phases).sum(axis=1).max()
+        self._history = np.zeros((TRUE_PEAK_TAPS - 1, channels), dtype=np.float32)
+        self._power: List["np.ndarray"] = []
+        self._level: List["np.ndarray"] = []
+        self._clipped: List["np.ndarray"] = []
+
+    def feed(self, samples: "np.ndarray"):
+        """Measure frames of audio, each its channels and then the K-weighted ones
+
+        samples is a (frames, 2 * channels) array, as measure_graph makes
+        ffmpeg output them. Only a final step may end part way through a
+        block; those frames count towards peaks only.
+        """
+        frames = len(samples)
+        self.frames += frames
+        raw = samples[:, : self.channels]
+        magnitude = np.abs(raw)
+        peak = float(magnitude.max()) if frames else 0.0
+        self.sample_peak = max(self.sample_peak, peak)
+        history = np.concatenate((self._history, raw))
+        self._history = history[frames:]
+        # The frames kept from the last step are filtered again with these
+        if max(peak, self._last_peak) * self._peak_gain > self.true_peak:
+            self.true_peak = max(self.true_peak, self._oversampled_peak(history))
+        self._last_peak = peak
+
+        size = self.block_frames
+        blocks = frames // size
+        whole = samples[: blocks * size].reshape(blocks, size, -1)
+        squares = np.einsum("ijk,ijk->ik", whole, whole, dtype=np.float64) / size
+        # Channels all weigh 1.0 for mono and stereo, so their powers add up
+        self._power.append(squares[:, self.channels :].sum(axis=1))
+        self._level.append(squares[:, : self.channels].mean(axis=1))
+        clipped = magnitude[: blocks * size] >= CLIP_LEVEL
+        self._clipped.append(clipped.reshape(blocks, -1).sum(axis=1))
+
+    def _oversampled_peak(self, history: "np.ndarray") -> float:
+        """Peak of the audio interpolated between its samples
+
+        An interpolated sample is at most the filter's gain times the loudest
+        sample under the filter, so only the places near samples that could
+        beat the peak so far are interpolated.
+        """
+        frames = len(history) - TRUE_PEAK_TAPS + 1
+        threshold = self.true_peak / self._peak_gain
+        loud = np.flatnonzero(np.abs(history).ravel() > threshold) // self.channels
+        # Interpolated sample n is made from history[n : n + TRUE_PEAK_TAPS]
+        starts = loud[:, None] - np.arange(TRUE_PEAK_TAPS)
+        starts = np.unique(np.clip(starts, 0, frames - 1))
+        if not len(starts):
+            return 0.0
+        if len(starts) < frames // 4:
+            windows = history[starts[:, None] + np.arange(TRUE_PEAK_TAPS)]
+            upsampled = np.einsum("pt,ktc->kpc", self._phases, windows)
+            return float(np.abs(upsampled).max())
+        peak = 0.0
+        for phase in self._phases:
+            upsampled = np.zeros((frames, self.channels), dtype=np.float32)
+            for tap, coefficient in enumerate(phase):
+                upsampled += coefficient * history[tap : tap + frames]
+            peak = max(peak, float(np.abs(upsampled).max()))
+        return peak
+
+    @property
+    def block_power(self) -> "np.ndarray":
+        """Summed mean square of the K-weighted channels in each 100 ms block"""
+        return np.concatenate(self._power) if self._power else np.zeros(0)
+
+    def momentary(self) -> "np.ndarray":
+        """Loudness of every 400 ms window, a block apart"""
+        return loudness(moving_mean(self.block_power, 4))
+
+    def short_term(self) -> "np.ndarray":
+        """Loudness of every 3 s window, a block apart"""
+        return loudness(moving_mean(self.block_power, 30))
+
+    def integrated(self) -> Optional[float]:
+        """Gated loudness of the whole programme in LUFS"""
+        power = moving_mean(self.block_power, 4)
+        power = power[loudness(power) > ABSOLUTE_GATE]
+        if not len(power):
+            return None
+        gate = loudness(power.mean()) + RELATIVE_GATE
+        return float(loudness(power[loudness(power) > gate].mean()))
+
+    def loudness_range(self) -> Optional[float]:
+        """Spread of short-term loudness in LU, between its 10th and 95th percentile"""
+        power = moving_mean(self.block_power, 30)
+        power = power[loudness(power) > ABSOLUTE_GATE]
+        if not len(power):
+            return None
+        gate = loudness(power.mean()) + RANGE_GATE
+        levels = loudness(power)
+        levels = levels[levels > gate]
+        low, high = np.percentile(levels, [10, 95])
+        return float(high - low)
+
+    def clipping(self) -> List[Tuple[int, int]]:
+        clipped = np.concatenate(self._clipped) if self._clipped else np.zeros(0)
+        return sections(clipped >= CLIP_MIN_SAMPLES)
+
+    def silence(self) -> List[Tuple[int, int]]:
+        level = np.concatenate(self._level) if self._level else np.zeros(0)
+        quiet = level < 10 ** (SILENCE_LEVEL / 10)
+        return sections(quiet, round(SILENCE_SECONDS * BLOCKS_PER_SECOND))
+
+    def report(self) -> Dict[str, Any]:
+        """The measurements, shaped like the audio of a Dolby.io analysis"""
+        seconds = 1 / BLOCKS_PER_SECOND
+        momentary, short_term = self.momentary(), self.short_term()
+        silence = self.silence()
+        blocks = max(len(self.block_power), 1)
+
+        def finite(value: Optional[float]) -> Optional[float]:
+            return round(value, 2) if value is not None else None
+
+        def peak(values: "np.ndarray") -> Optional[float]:
+            values = values[np.isfinite(values)]
+            return round(float(values.max()), 2) if len(values) else None
+
+        return {
+            "loudness": {
+                "measured": finite(self.integrated()),
+                "range": finite(self.loudness_range()),
+                "gating_mode": "level",
+                "sample_peak": decibels(self.sample_peak**2),
+                "true_peak": decibels(self.true_peak**2),
+                "momentary_max": peak(momentary),
+                "short_term_max": peak(short_term),
+            },
+            "clipping": {
+                "num_sections": len(self.clipping()),
+                "sections": [
+                    {
+                        "section_id": f"cl_{i}",
+                        "start": round(start * seconds, 2),
+                        "duration": round(length * seconds, 2),
+                    }
+                    for i, (start, length) in enumerate(self.clipping(), 1)
+                ],
+            },
+            "silence": {
+                "num_sections": len(silence),
+                "percentage": round(
+                    100 * sum(length for _, length in silence) / blocks, 2
+                ),
+                "sections": [
+                    {
+                        "section_id": f"si_{i}",
+                        "start": round(start * seconds, 2),
+                        "duration": round(length * seconds, 2),
+                    }
+                    for i, (start, length) in enumerate(silence, 1)
+                ],
+            },
+        }
+
+
+def probe_audio(input_file: Path) -> Dict[str, Any]:
+    """Codec, sample rate and channel layout of a file's first audio stream"""
+    _, stderr = (
+        ffmpeg.input(str(input_file))
+        .output("-", f="null", t=0)
+        .global_args("-hide_banner")
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    log = stderr.decode(errors="replace")
+    match = AUDIO_STREAM.search(log)
+    if not match:
+        raise ValueError(f"ffmpeg found no audio in {input_file}")
+    codec, sample_rate, layout = match.groups()
+    info = {"codec": codec, "sample_rate": int(sample_rate), "layout": layout}
+    duration = DURATION.search(log)
+    if duration:
+        hours, minutes, seconds = duration.groups()
+        info["duration"] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return info
+
+
+def measure_graph(channels: int, sample_rate: int) -> str:
+    """Filters that output the audio as floats with its K-weighted copy after it"""
+    layout = "mono" if channels == 1 else "stereo"
+    stages = ",".join(
+        "biquad=b0={}:b1={}:b2={}:a0={}:a1={}:a2={}:precision=f64".format(*b, *a)
+        for b, a in k_weighting(sample_rate)
+    )
+    return (
+        f"aformat=sample_fmts=flt:channel_layouts={layout},"
+        f"asplit[raw][k];[k]{stages}[weighted];[raw][weighted]amerge=inputs=2"
+    )
+
+
+def analyze_file(input_file: Path) -> Dict[str, Any]:
+    """Measure a file locally into a report shaped like a Dolby.io analysis
+
+    ffmpeg decodes the file and applies the K-weighting, and numpy measures
+    the samples as they stream through a pipe. Files with more than two
+    channels are measured as a stereo downmix.
+    """
+    require_numpy()
+    input_file = Path(input_file)
+    info = probe_audio(input_file)
+    channels = 1 if info["layout"] == "mono" else 2
+    meter = LoudnessMeter(channels, info["sample_rate"])
+    block_bytes = meter.block_frames * 2 * channels * 4
+
+    options = {
+        "af": measure_graph(channels, info["sample_rate"]),
+        "f": "f32le",
+        "acodec": "pcm_f32le",
+    }
+    with metrics.stage("analyze", file=input_file.name) as stage:
+        leftover = b""
+        for chunk in encode_stream(input_file, options, STEP_BLOCKS * block_bytes):
+            data = leftover + chunk
+            usable = len(data) - len(data) % block_bytes
+            if usable:
+                samples = np.frombuffer(data[:usable], dtype=np.float32)
+                samples = samples.reshape(-1, 2 * channels)
+                meter.feed(samples)
+            leftover = data[usable:]
+        if leftover:
+            samples = np.frombuffer(leftover, dtype=np.float32)
+            samples = samples[: len(samples) - len(samples) % (2 * channels)]
+            samples = samples.reshape(-1, 2 * channels)
+            meter.feed(samples)
+        duration = meter.frames / meter.sample_rate
+        stage.update(audio_seconds=round(duration, 2))
+
+    logger.info(f"Analyzed {duration:.1f}s of {input_file}")
+    return {
+        "media_info": {
+            "container": {
+                "kind": input_file.suffix.lstrip("."),
+                "duration": round(info.get("duration", duration), 3),
+                "size": input_file.stat().st_size,
+            },
+            "audio": {
+                "codec": info["codec"],
+                "sample_rate": info["sample_rate"],
+                "channels": channels,
+                "duration": round(duration, 3),
+            },
+        },
+        "processed_region": {
+            "start": 0,
+            "end": round(duration, 3),
+            "audio": meter.report(),
+        },
+    }
+
+
+def is_compliant(
+    report: Dict[str, Any],
+    target: float = TARGET_LOUDNESS,
+    tolerance: float = TARGET_TOLERANCE,
+    max_true_peak: float = MAX_TRUE_PEAK,
+) -> bool:
+    """Whether a report's loudness is on target and its true peak low enough"""
+    measured = report["processed_region"]["audio"]["loudness"]
+    if measured["measured"] is None:
+        return False
+    true_peak = measured["true_peak"]
+    return abs(measured["measured"] - target) <= tolerance and (
+        true_peak is None or true_peak <= max_true_peak
+    )
+
+
+def analysis_path(input_file: Path, out_path: Path) -> Path:
+    """Where a local report goes, named like a downloaded Dolby.io analysis"""
+    out_path.mkdir(parents=True, exist_ok=True)
+    return out_path / f"{Path(input_file).stem} - Analyzed.json"
+
+
+def save_report(report: Dict[str, Any], out_file: Path) -> Path:
+    out_file.write_text(json.dumps(report, indent=2))
+    return out_file
+
+
+def analyze(
+    input_file: Path = typer.Argument(..., exists=True),
+    output: Optional[Path] = typer.Option(
+        None, help="Folder for the report. Defaults to output/ next to the file."
+    ),
+    target: float = typer.Option(TARGET_LOUDNESS, help="Target loudness in LUFS."),
+    tolerance: float = typer.Option(
+        TARGET_TOLERANCE, help="How far off target still counts as compliant, in LU."
+    ),
+):
+    """Measure loudness, peaks, clipping and silence locally, without Dolby.io."""
+    try:
+        report = analyze_file(input_file)
+    except RuntimeError as e:
+        typer.echo(str(e))
+        raise typer.Exit(code=1)
+    out_file = save_report(
+        report, analysis_path(input_file, output or input_file.parent / "output")
+    )
+
+    measured = report["processed_region"]["audio"]["loudness"]
+    typer.echo(
+        f"{input_file.name}: {measured['measured']} LUFS, "
+        f"range {measured['range']} LU, true peak {measured['true_peak']} dBTP"
+    )
+    compliant = is_compliant(report, target, tolerance)
+    typer.echo(f"{'Meets' if compliant else 'Misses'} the {target} LUFS target")
+    typer.echo(f"Report saved to {out_file}")
@@ -1,28 +1,162 @@
+import importlib
 import logging
-import os
-import time
 from datetime import datetime
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
+import click
 import typer
 from dotenv import load_dotenv
-
-from post_production import assembly_ai_cli, dolby_cli, transcoding
+from typer.core import TyperCommand, TyperGroup
 
 log_dir = Path("logs")
-log_dir.mkdir(parents=True, exist_ok=True)
 
+# name: (module, function, summary for --help)
+# Modules are imported only when their command runs, so `tppp --help` imports
+# none of them and each command only imports what it uses.
+COMMANDS: Dict[str, Tuple[str, str, str]] = {
+    "enhance": (
+        "dolby_cli",
+        "enhance",
+        "Enhance an episode with Dolby.io, optionally analyzing it too.",
+    ),
+    "transcribe": (
+        "assembly_ai_cli",
+        "transcribe",
+        "Transcribe an episode with AssemblyAI and save the transcript.",
+    ),
+    "transcode": (
+        "transcoding",
+        "transcode",
+        "Add intro and outro music to an episode and encode it with ffmpeg.",
+    ),
+    "batch": (
+        "batch",
+        "batch",
+        "Run many episodes through Dolby.io and AssemblyAI in parallel.",
+    ),
+    "export": (
+        "export",
+        "export",
+        "Write text, captions, chapters and JSONL from a transcript in one pass.",
+    ),
+    "pipeline": (
+        "pipeline",
+        "pipeline",
+        "Run each episode through the stages of a pipeline spec, skipping unchanged "
+        "ones.",
+    ),
+    "index": (
+        "search",
+        "index",
+        "Add new and changed transcripts to the search index.",
+    ),
+    "search": (
+        "search",
+        "search",
+        "Find when words were said across all indexed episodes.",
+    ),
+    "loudness": (
+        "loudness",
+        "analyze",
+        "Measure loudness, peaks, clipping and silence locally, without Dolby.io.",
+    ),
+    "watch": (
+        "watch",
+        "watch",
+        "Process new recordings dropped into a folder as they arrive.",
+    ),
+    "resume": (
+        "journal_cli",
+        "resume",
+        "Re-attach to jobs an interrupted run left behind and download their results.",
+    ),
+    "stats": (
+        "metrics_cli",
+        "stats",
+        "Summarize stage and request timings across recent runs.",
+    ),
+}
 
-app = typer.Typer()
-app.command()(dolby_cli.enhance)
-app.command()(assembly_ai_cli.transcribe)
-app.command()(transcoding.transcode)
 
+class CommandPlaceholder(click.Command):
+    """Stands in for a command in --help until its module is imported"""
 
-@app.callback()
-def cli():
+
+class LazyGroup(TyperGroup):
+    """A command group that imports a command's module only when it runs"""
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        for name, (_, _, summary) in COMMANDS.items():
+            self.commands.setdefault(name, CommandPlaceholder(name, help=summary))
+
+    def resolve_command(
+        self, ctx: click.Context, args: List[str]
+    ) -> Tuple[Optional[str], Optional[click.Command], List[str]]:
+        name = args[0] if args else None
+        if isinstance(self.commands.get(name), CommandPlaceholder):
+            self.commands[name] = load_command(name)
+        return super().resolve_command(ctx, args)
+
+
+class SetupCommand(TyperCommand):
+    """Sets up logging and metrics once it runs, so that --help does neither"""
+
+    def invoke(self, ctx: click.Context) -> Any:
+        setup_run(ctx)
+        return super().invoke(ctx)
+
+
+def load_command(name: str) -> click.Command:
+    module_name, function, _ = COMMANDS[name]
+    module = importlib.import_module(f"post_production.{module_name}")
+    single = typer.Typer(add_completion=False, rich_markup_mode=None)
+    single.command(name=name, cls=SetupCommand)(getattr(module, function))
+    return typer.main.get_command(single)
+
+
+def setup_run(ctx: click.Context):
+    settings = ctx.find_root().obj or {}
     load_dotenv()
+    log_dir.mkdir(parents=True, exist_ok=True)
     logging.basicConfig(
         filename=log_dir / f"job_logs_{datetime.now().isoformat()}.log",
         level=logging.INFO,
     )
+    if settings.get("metrics") and ctx.info_name != "stats":
+        # Imported here, so that --help does not load sqlite3 for the cache
+        from post_production.metrics import metrics
+
+        metrics.start(ctx.info_name, settings["metrics_dir"])
+        ctx.find_root().call_on_close(
+            lambda: metrics.close(settings["prometheus_textfile"])
+        )
+
+
+app = typer.Typer(cls=LazyGroup, rich_markup_mode=None)
+
+
+@app.callback()
+def cli(
+    ctx: typer.Context,
+    record_metrics: bool = typer.Option(
+        True, "--metrics/--no-metrics", help="Record stage and request timings."
+    ),
+    metrics_dir: Optional[Path] = typer.Option(
+        None,
+        envvar="TPPP_METRICS_DIR",
+        help="Where runs are recorded as JSON lines. "
+        "Defaults to ~/.cache/post-production/metrics.",
+    ),
+    prometheus_textfile: Optional[Path] = typer.Option(
+        None,
+        envvar="TPPP_PROMETHEUS_TEXTFILE",
+        help="Write the totals of the run here, e.g. for node_exporter.",
+    ),
+):
+    ctx.obj = {
+        "metrics": record_metrics,
+        "metrics_dir": metrics_dir,
+        "prometheus_textfile": prometheus_textfile,
+    }
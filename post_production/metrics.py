@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from post_production.cache import DEFAULT_CACHE_PATH
+
+if TYPE_CHECKING:
+    # Every command records metrics, so this module stays cheap to import
+    import requests
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_PATH = DEFAULT_CACHE_PATH.parent / "metrics"
+PROMETHEUS_FILE = "tppp.prom"
+
+# Job and transcript ids in urls, so requests group by endpoint
+ID_SEGMENT = re.compile(r"/[A-Za-z0-9_-]{20,}(?=/|$)")
+
+
+def endpoint_label(url: str, api_endpoint: str) -> str:
+    """The endpoint a request went to, with ids removed. Other hosts are storage."""
+    if not url.startswith(api_endpoint):
+        return "storage"
+    path = url[len(api_endpoint) :].split("?", 1)[0]
+    return ID_SEGMENT.sub("/{id}", path) or "/"
+
+
+def body_size(request: "requests.PreparedRequest") -> int:
+    if isinstance(request.body, (bytes, str)):
+        return len(request.body)
+    return int(request.headers.get("Content-Length", 0))
+
+
+class MetricsRecorder:
+    """Collects request and stage events for one run of a command
+
+    Events are appended to a JSON lines file as they happen, so a run that
+    crashes still leaves its numbers behind. Totals are kept in memory and
+    written as a Prometheus textfile when the run closes. Until `start` is
+    called, events are dropped.
+
+    Usage:
+        metrics.start("enhance")
+        with metrics.stage("upload", DOLBY) as stage:
+            stage["bytes"] = upload(path)
+        metrics.close()
+    """
+
+    def __init__(self):
+        self.path: Optional[Path] = None
+        self.command: Optional[str] = None
+        self._lock = threading.Lock()
+        self._out = None
+        self._totals: Dict[Tuple[str, Tuple], float] = defaultdict(float)
+
+    @property
+    def enabled(self) -> bool:
+        return self._out is not None
+
+    def start(self, command: str, directory: Optional[Path] = None) -> Path:
+        self.close()
+        directory = Path(
+            directory or os.environ.get("TPPP_METRICS_DIR") or DEFAULT_METRICS_PATH
+        )
+        directory.mkdir(parents=True, exist_ok=True)
+        started = datetime.now()
+        self.command = command
+        self.path = directory / f"run-{started:%Y%m%dT%H%M%S%f}-{os.getpid()}.jsonl"
+        self._out = self.path.open("a")
+        self._totals.clear()
+        self.record("run", command=command, started=started.isoformat())
+        return self.path
+
+    def record(self, kind: str, **fields: Any):
+        if not self.enabled:
+            return
+        event = {"type": kind, "time": round(time.time(), 3), **fields}
+        line = json.dumps(event)
+        with self._lock:
+            if self._out is None:
+                return
+            self._out.write(line + "\n")
+            self._out.flush()
+            self._add_totals(event)
+
+    @contextmanager
+    def stage(self, name: str, provider: Optional[str] = None, **fields: Any):
+        """Time a stage. Add bytes, retries or anything else to the yielded dict."""
+        details: Dict[str, Any] = dict(fields)
+        start = time.monotonic()
+        status = "ok"
+        try:
+            yield details
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self.record(
+                "stage",
+                stage=name,
+                provider=provider,
+                seconds=round(time.monotonic() - start, 4),
+                status=status,
+                **details,
+            )
+
+    def request_hook(
+        self, provider: str, client: Any
+    ) -> Callable[..., "requests.Response"]:
+        """A requests response hook that records every request a client makes"""
+
+        def hook(response: "requests.Response", *args, **kwargs):
+            if self.enabled:
+                self.record_request(
+                    provider,
+                    response.request.method,
+                    endpoint_label(response.url, client.api_endpoint),
+                    response.status_code,
+                    response.elapsed.total_seconds(),
+                    body_size(response.request),
+                    int(response.headers.get("Content-Length", 0)),
+                )
+            return response
+
+        return hook
+
+    def record_request(
+        self,
+        provider: str,
+        method: str,
+        endpoint: str,
+        status: int,
+        seconds: float,
+        bytes_sent: int,
+        bytes_received: int,
+    ):
+        self.record(
+            "request",
+            provider=provider,
+            method=method,
+            endpoint=endpoint,
+            status=status,
+            seconds=round(seconds, 4),
+            bytes_sent=bytes_sent,
+            bytes_received=bytes_received,
+        )
+
+    def close(self, textfile: Optional[Path] = None):
+        """Finish the run, writing its totals as a Prometheus textfile"""
+        with self._lock:
+            if self._out is None:
+                return
+            self._out.close()
+            self._out = None
+        textfile = Path(textfile) if textfile else self.path.parent / PROMETHEUS_FILE
+        part_file = textfile.with_name(textfile.name + ".part")
+        part_file.write_text(self.prometheus())
+        os.replace(part_file, textfile)
+
+    def _add_totals(self, event: Dict[str, Any]):
+        if event["type"] == "request":
+            labels = (
+                ("provider", event["provider"]),
+                ("endpoint", event["endpoint"]),
+                ("status", str(event["status"])),
+            )
+            self._totals[("tppp_requests_total", labels)] += 1
+            self._totals[("tppp_request_seconds_total", labels)] += event["seconds"]
+            for direction in ("sent", "received"):
+                key = (
+                    "tppp_request_bytes_total",
+                    labels[:2] + (("direction", direction),),
+                )
+                self._totals[key] += event[f"bytes_{direction}"]
+        elif event["type"] == "stage":
+            labels = (
+                ("stage", event["stage"]),
+                ("provider", event["provider"] or ""),
+                ("status", event["status"]),
+            )
+            self._totals[("tppp_stages_total", labels)] += 1
+            self._totals[("tppp_stage_seconds_total", labels)] += event["seconds"]
+            for field in ("bytes", "retries"):
+                if event.get(field):
+                    self._totals[(f"tppp_stage_{field}_total", labels)] += event[field]
+        elif event["type"] == "throttle":
+            labels = (("provider", event["provider"]), ("reason", event["reason"]))
+            self._totals[("tppp_throttles_total", labels)] += 1
+            self._totals[("tppp_throttle_seconds_total", labels)] += event["seconds"]
+
+    def prometheus(self) -> str:
+        """The totals of this run in the Prometheus text exposition format"""
+        lines = [
+            "# HELP tppp_last_run_timestamp_seconds When the last tppp run finished.",
+            "# TYPE tppp_last_run_timestamp_seconds gauge",
+            f'tppp_last_run_timestamp_seconds{{command="{self.command}"}} '
+            f"{time.time():.0f}",
+        ]
+        by_metric: Dict[str, List[str]] = defaultdict(list)
+        for (metric, labels), value in sorted(self._totals.items()):
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            by_metric[metric].append(f"{metric}{{{label_text}}} {value:g}")
+        for metric, samples in by_metric.items():
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+def read_runs(
+    directory: Path = DEFAULT_METRICS_PATH, limit: Optional[int] = None
+) -> Iterator[List[Dict[str, Any]]]:
+    """The events of every recorded run, or of the latest `limit`, oldest first"""
+    paths = sorted(Path(directory).glob("run-*.jsonl"))
+    for path in paths[-limit:] if limit else paths:
+        events = []
+        with path.open() as infile:
+            for line in infile:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # The last line of a run that was killed mid-write
+                    logger.warning(f"Skipping a partial line in {path}")
+        if events:
+            yield events
+
+
+metrics = MetricsRecorder()
@@ -0,0 +1,121 @@
+import math
+import statistics
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import typer
+from tabulate import tabulate
+
+from post_production.metrics import DEFAULT_METRICS_PATH, read_runs
+
+
+def stats(
+    runs: int = typer.Option(20, min=1, help="Summarize this many of the latest runs."),
+    metrics_dir: Path = typer.Option(
+        DEFAULT_METRICS_PATH, envvar="TPPP_METRICS_DIR", help="Where runs are recorded."
+    ),
+):
+    """Summarize stage and request timings across recent runs."""
+    recent = list(read_runs(metrics_dir, limit=runs))
+    if not recent:
+        typer.echo(f"No runs recorded in {metrics_dir}")
+        raise typer.Exit(code=1)
+    events = [event for run in recent for event in run]
+    commands = Counter(run[0].get("command") for run in recent)
+    typer.echo(
+        f"{len(recent)} runs: "
+        + ", ".join(f"{count} {command}" for command, count in commands.most_common())
+    )
+
+    stages = group(events, "stage", ("stage", "provider"))
+    rows = []
+    for (name, provider), found in stages.items():
+        seconds = [e["seconds"] for e in found]
+        size = sum(e.get("bytes") or 0 for e in found)
+        rows.append(
+            [
+                name,
+                provider or "",
+                len(found),
+                sum(e["status"] != "ok" for e in found),
+                f"{statistics.mean(seconds):.2f}",
+                f"{percentile(seconds, 95):.2f}",
+                f"{sum(seconds):.1f}",
+                f"{size / 1e6:.1f}" if size else "",
+                f"{size / 1e6 / sum(seconds):.2f}" if size and sum(seconds) else "",
+                sum(e.get("retries") or 0 for e in found),
+            ]
+        )
+    headers = ["Stage", "Provider", "Count", "Errors", "Mean s", "p95 s", "Total s"]
+    typer.echo(
+        tabulate(
+            rows, headers=headers + ["MB", "MB/s", "Retries"], disable_numparse=True
+        )
+    )
+
+    requests_by = group(events, "request", ("provider", "endpoint"))
+    rows = []
+    for (provider, endpoint), found in requests_by.items():
+        ms = [e["seconds"] * 1000 for e in found]
+        rows.append(
+            [
+                provider,
+                endpoint,
+                len(found),
+                sum(e["status"] >= 400 for e in found),
+                f"{statistics.mean(ms):.0f}",
+                f"{percentile(ms, 95):.0f}",
+                f"{sum(e['bytes_sent'] for e in found) / 1e6:.1f}",
+                f"{sum(e['bytes_received'] for e in found) / 1e6:.1f}",
+            ]
+        )
+    if rows:
+        headers = ["Provider", "Endpoint", "Requests", "Errors", "Mean ms", "p95 ms"]
+        typer.echo("")
+        typer.echo(
+            tabulate(
+                rows,
+                headers=headers + ["MB sent", "MB received"],
+                disable_numparse=True,
+            )
+        )
+
+    # Time requests spent queued for the rate limit, and waiting to be retried
+    throttles = group(events, "throttle", ("provider", "reason"))
+    rows = [
+        [
+            provider,
+            reason,
+            len(found),
+            f"{sum(e['seconds'] for e in found):.1f}",
+            f"{max(e['seconds'] for e in found):.2f}",
+        ]
+        for (provider, reason), found in throttles.items()
+    ]
+    if rows:
+        typer.echo("")
+        typer.echo(
+            tabulate(
+                rows,
+                headers=["Provider", "Throttled by", "Count", "Total s", "Max s"],
+                disable_numparse=True,
+            )
+        )
+
+
+def group(
+    events: List[Dict[str, Any]], kind: str, fields: Tuple[str, ...]
+) -> Dict[Tuple, List[Dict[str, Any]]]:
+    grouped: Dict[Tuple, List[Dict[str, Any]]] = defaultdict(list)
+    for event in events:
+        if event["type"] == kind:
+            grouped[tuple(event.get(f) for f in fields)].append(event)
+    return dict(sorted(grouped.items(), key=lambda item: str(item[0])))
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[rank]
@@ -0,0 +1,382 @@
+import logging
+import math
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import ffmpeg
+
+logger = logging.getLogger(__name__)
+
+MP3 = "mp3"
+AAC = "aac"
+
+# LAME delays its output by 576 samples and an mp3 decoder adds 529 more. The
+# delay in an mp3's LAME tag is LAME's part, as decoders know their own.
+LAME_DELAY = 576
+MP3_DELAY = LAME_DELAY + 529
+# ffmpeg's aac encoder starts with a frame of priming samples
+AAC_FRAME = 1024
+AAC_DELAY = 1024
+# Audio a part's encoder reads before the part starts, so that it is in the
+# state it would be in had it encoded everything before. LAME settles within
+# a few frames. ffmpeg's aac encoder adapts its rate control over seconds.
+PREROLL_SECONDS = {MP3: 0.0, AAC: 15.0}
+
+MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# By the version bits of a frame header: MPEG-2.5, reserved, MPEG-2, MPEG-1
+MP3_SAMPLE_RATES = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+# Where a LAME tag keeps the delay and padding, and its own checksum, from
+# the start of the tag. The checksum covers the first 190 bytes of the frame.
+LAME_DELAY_OFFSET = 21
+LAME_CRC_OFFSET = 34
+LAME_CRC_BYTES = 190
+
+
+# wav format tags of the sample formats ffmpeg writes, and their raw names
+WAV_FORMATS = {(1, 16): "s16le", (3, 32): "f32le"}
+WAV_EXTENSIBLE = 0xFFFE
+
+
+@dataclass
+class PcmLayout:
+    """Where the samples of a wav file are, and how they are stored"""
+
+    channels: int
+    sample_rate: int
+    sample_format: str
+    frame_bytes: int
+    data_offset: int
+    frames: int
+
+
+@dataclass
+class Part:
+    """Frames of the joined stream one encoder makes, and the samples it reads
+
+    Its encoder reads samples start to end of the mix. The first `skip`
+    frames it makes only warm it up, the `frames` after them are kept.
+    """
+
+    index: int
+    first_frame: int
+    frames: int
+    start: int
+    end: int
+    skip: int
+
+
+def read_wav_layout(wav_file: Path) -> PcmLayout:
+    """Read the header of a 16-bit or float wav file
+
+    The data is taken to run to the end of the file, as ffmpeg cannot fill
+    in its size when it writes a wav of over 4 GB.
+    """
+    with open(wav_file, "rb") as f:
+        riff = f.read(12)
+        if riff[:4] != b"RIFF" or riff[8:] != b"WAVE":
+            raise ValueError(f"{wav_file} is not a wav file")
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{wav_file} has no data")
+            chunk, size = header[:4], struct.unpack("<I", header[4:])[0]
+            if chunk == b"data":
+                break
+            body = f.read(size + size % 2)
+            if chunk == b"fmt ":
+                fmt = body
+        data_offset = f.tell()
+        f.seek(0, 2)
+        data_bytes = f.tell() - data_offset
+    if fmt is None:
+        raise ValueError(f"{wav_file} has no format")
+    tag, channels, sample_rate, _, frame_bytes, bits = struct.unpack(
+        "<HHIIHH", fmt[:16]
+    )
+    if tag == WAV_EXTENSIBLE:
+        # The real tag starts the sub-format GUID
+        tag = struct.unpack("<H", fmt[24:26])[0]
+    if (tag, bits) not in WAV_FORMATS:
+        raise ValueError(f"{wav_file} is not 16-bit or float")
+    return PcmLayout(
+        channels,
+        sample_rate,
+        WAV_FORMATS[tag, bits],
+        frame_bytes,
+        data_offset,
+        data_bytes // frame_bytes,
+    )
+
+
+def parallel_codec(options: Dict[str, Any]) -> Optional[str]:
+    """The codec of a rendition, if its parts can be encoded apart and joined"""
+    if options.get("f") == "mp3":
+        return MP3
+    if options.get("acodec") == "aac":
+        return AAC
+    return None
+
+
+def frame_samples(codec: str, sample_rate: int) -> int:
+    if codec == AAC:
+        return AAC_FRAME
+    # MPEG-2 and 2.5 layer III frames are half as long
+    return 1152 if sample_rate >= 32000 else 576
+
+
+def plan_parts(
+    samples: int,
+    parts: int,
+    frame_length: int,
+    delay: int,
+    preroll_frames: int = 0,
+) -> List[Part]:
+    """Split a stream of `samples` into parts that start on frame boundaries
+
+    Frame j of the joined stream decodes to samples j * frame_length - delay
+    onwards. A part that starts at frame j has its encoder read from a whole
+    number of frames before it, so its frames line up with the joined stream.
+    Every encoder reads a few frames past its part for its lookahead.
+    """
+    total = math.ceil((samples + delay) / frame_length)
+    parts = max(1, min(parts, total))
+    lookahead = math.ceil(delay / frame_length) + 2
+    preroll = max(lookahead, preroll_frames)
+    cuts = [round(i * total / parts) for i in range(parts)] + [total]
+    plan = []
+    for i, (first, last) in enumerate(zip(cuts, cuts[1:])):
+        skip = min(first, preroll)
+        end = samples
+        if last < total:
+            end = min(samples, (last + lookahead) * frame_length)
+        plan.append(
+            Part(i, first, last - first, (first - skip) * frame_length, end, skip)
+        )
+    return plan
+
+
+def mp3_frames(data: bytes) -> Iterator[Tuple[int, int]]:
+    """Offset and length of each frame of an mp3 stream, after any ID3v2 tag"""
+    pos = 0
+    if data[:3] == b"ID3":
+        # The tag size is stored 7 bits to a byte
+        size = 0
+        for byte in data[6:10]:
+            size = size << 7 | byte
+        pos = 10 + size
+    while pos + 4 <= len(data):
+        header = int.from_bytes(data[pos : pos + 4], "big")
+        version = (header >> 19) & 3
+        bitrate_index, rate_index = (header >> 12) & 15, (header >> 10) & 3
+        if (
+            header >> 21 != 0x7FF
+            or version == 1
+            or bitrate_index in (0, 15)
+            or rate_index == 3
+        ):
+            raise ValueError(f"Lost mp3 frame sync at byte {pos}")
+        bitrate = MP3_BITRATES[1 if version == 3 else 2][bitrate_index]
+        sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+        padding = (header >> 9) & 1
+        length = (144 if version == 3 else 72) * bitrate * 1000 // sample_rate
+        yield pos, length + padding
+        pos += length + padding
+
+
+def adts_frames(data: bytes) -> Iterator[Tuple[int, int]]:
+    """Offset and length of each frame of an ADTS aac stream"""
+    pos = 0
+    while pos + 7 <= len(data):
+        if data[pos] != 0xFF or data[pos + 1] & 0xF0 != 0xF0:
+            raise ValueError(f"Lost ADTS frame sync at byte {pos}")
+        length = (data[pos + 3] & 3) << 11 | data[pos + 4] << 3 | data[pos + 5] >> 5
+        yield pos, length
+        pos += length
+
+
+def crc16(data: bytes, crc: int = 0) -> int:
+    """The CRC-16 LAME tags use, as ffmpeg computes it"""
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def set_mp3_padding(mp3_file: Path, delay: int, padding: int):
+    """Write the encoder delay and padding into an mp3's LAME tag
+
+    Gapless decoders skip that many samples at the start and the end. ffmpeg
+    writes zero for both when it copies a stream, as it does not know them.
+    """
+    with open(mp3_file, "r+b") as f:
+        head = bytearray(f.read(1 << 16))
+        start, length = next(mp3_frames(head))
+        frame = head[start : start + length]
+        mpeg1 = (frame[1] >> 3) & 3 == 3
+        mono = frame[3] >> 6 == 3
+        side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+        xing = 4 + side_info
+        if frame[xing : xing + 4] not in (b"Info", b"Xing"):
+            raise ValueError(f"{mp3_file} has no Info frame to hold its padding")
+        flags = struct.unpack(">I", frame[xing + 4 : xing + 8])[0]
+        # Frame count, byte count, table of contents and quality, if present
+        fields = ((1, 4), (2, 4), (4, 100), (8, 4))
+        lame = xing + 8 + sum(size for bit, size in fields if flags & bit)
+        frame[lame + LAME_DELAY_OFFSET : lame + LAME_DELAY_OFFSET + 3] = (
+            delay << 12 | padding
+        ).to_bytes(3, "big")
+        frame[lame + LAME_CRC_OFFSET : lame + LAME_CRC_OFFSET + 2] = b"\0\0"
+        struct.pack_into(
+            ">H", frame, lame + LAME_CRC_OFFSET, crc16(frame[:LAME_CRC_BYTES])
+        )
+        f.seek(start)
+        f.write(frame)
+
+
+def encode_part(
+    pcm_file: Path,
+    layout: PcmLayout,
+    part: Part,
+    options: Dict[str, Any],
+    out_file: Path,
+    chunk_frames: int = 65536,
+):
+    """Encode the samples of a part of a wav file with its own ffmpeg"""
+    process = (
+        ffmpeg.input(
+            "pipe:",
+            f=layout.sample_format,
+            ar=layout.sample_rate,
+            ac=layout.channels,
+        )
+        .output(str(out_file), **options)
+        .global_args("-loglevel", "error")
+        .run_async(pipe_stdin=True, pipe_stderr=True, overwrite_output=True)
+    )
+    with open(pcm_file, "rb") as pcm:
+        pcm.seek(layout.data_offset + part.start * layout.frame_bytes)
+        left = (part.end - part.start) * layout.frame_bytes
+        try:
+            while left > 0:
+                chunk = pcm.read(min(left, chunk_frames * layout.frame_bytes))
+                if not chunk:
+                    break
+                process.stdin.write(chunk)
+                left -= len(chunk)
+        except BrokenPipeError:
+            # ffmpeg stopped early, and its stderr says why
+            pass
+        finally:
+            process.stdin.close()
+            stderr = process.stderr.read()
+            process.wait()
+    if process.returncode:
+        raise ffmpeg.Error("ffmpeg", b"", stderr)
+
+
+def join_frames(
+    part_files: List[Path],
+    parts: List[Part],
+    frames_of: Callable[[bytes], Iterator[Tuple[int, int]]],
+    out_file: Path,
+):
+    """Write the frames each part keeps one after another"""
+    with open(out_file, "wb") as out:
+        for part, part_file in zip(parts, part_files):
+            data = memoryview(Path(part_file).read_bytes())
+            kept = list(frames_of(data))[part.skip : part.skip + part.frames]
+            if len(kept) < part.frames:
+                raise RuntimeError(
+                    f"Part {part.index} has {len(kept)} of its {part.frames} frames"
+                )
+            for offset, length in kept:
+                out.write(data[offset : offset + length])
+
+
+def encode_parallel(
+    pcm_file: Path,
+    out_file: Path,
+    options: Dict[str, Any],
+    jobs: int,
+    tmp_dir: Path,
+    overwrite: bool = False,
+) -> int:
+    """Encode a wav file as mp3 or aac in parts at once, and join them
+
+    Each part is encoded by its own ffmpeg process, starting a little before
+    its first frame so the encoder has settled by then. The frames of the
+    parts line up with those of a single encode, so they are joined as they
+    are and decode without gaps or clicks. mp3 parts are encoded without the
+    bit reservoir, so no frame depends on data in the part before it. The
+    encoder delay and padding of the whole are written where decoders look
+    for them: the LAME tag of an mp3, the edit list of an mp4.
+
+    Returns the number of parts.
+    """
+    codec = parallel_codec(options)
+    if codec is None:
+        raise ValueError(f"Cannot encode {options} in parts")
+    layout = read_wav_layout(pcm_file)
+    samples, sample_rate = layout.frames, layout.sample_rate
+
+    frame_length = frame_samples(codec, sample_rate)
+    if codec == MP3:
+        delay, frames_of = MP3_DELAY, mp3_frames
+        part_options = dict(
+            options, reservoir=0, write_xing=0, id3v2_version=0, f="mp3"
+        )
+    else:
+        delay, frames_of = AAC_DELAY, adts_frames
+        part_options = dict(options, f="adts")
+    preroll = math.ceil(PREROLL_SECONDS[codec] * sample_rate / frame_length)
+    parts = plan_parts(samples, jobs, frame_length, delay, preroll)
+    part_files = [
+        tmp_dir / f"{out_file.stem}-part{part.index}.{codec}" for part in parts
+    ]
+    logger.info(
+        f"Encoding {out_file} as {len(parts)} parts at frames "
+        + ", ".join(str(part.first_frame) for part in parts)
+    )
+
+    # The threads only feed samples, each part is encoded in its own process
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        encodes = [
+            pool.submit(encode_part, pcm_file, layout, part, part_options, part_file)
+            for part, part_file in zip(parts, part_files)
+        ]
+        for encode in encodes:
+            encode.result()
+    joined = tmp_dir / f"{out_file.stem}-joined.{codec}"
+    join_frames(part_files, parts, frames_of, joined)
+    for part_file in part_files:
+        part_file.unlink()
+
+    if codec == MP3:
+        # ffmpeg writes a fresh Info frame with the frame count and seek table
+        ffmpeg.input(str(joined), f="mp3").output(str(out_file), c="copy", f="mp3").run(
+            overwrite_output=overwrite, quiet=True
+        )
+        total = sum(part.frames for part in parts)
+        set_mp3_padding(
+            out_file, LAME_DELAY, total * frame_length - samples - LAME_DELAY
+        )
+    else:
+        # Starting the stream early gives the mp4 an edit list that skips the
+        # priming samples
+        ffmpeg.input(str(joined), f="aac", itsoffset=-delay / sample_rate).output(
+            str(out_file), c="copy", f=options.get("f", "ipod")
+        ).run(overwrite_output=overwrite, quiet=True)
+    joined.unlink()
+    return len(parts)
@@ -0,0 +1,534 @@
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import typer
+
+from post_production.assembly_ai import AssemblyAI, UploadFormat
+from post_production.assembly_ai_cli import get_assemblyai_key
+from post_production.batch import (
+    BatchProgress,
+    ProgressRenderer,
+    enhance_file,
+    find_audio_files,
+    transcribe_file,
+)
+from post_production.cache import ASSEMBLYAI, DOLBY, ResultCache, file_hash, job_key
+from post_production.dolby import DolbyIO
+from post_production.dolby_cli import get_dolby_key
+from post_production.export import (
+    CaptionLimits,
+    ExportFormat,
+    export_file,
+    load_speaker_map,
+)
+from post_production.poller import JobPoller
+from post_production.render_cache import RenderCache
+from post_production.transcoding import Rendition, _transcode
+
+logger = logging.getLogger(__name__)
+
+SOURCE = "source"
+LOCAL = "local"
+MANIFEST = "pipeline-manifest.json"
+# Bump when a stage's output changes for the same inputs, so stages run again
+MANIFEST_VERSION = 1
+
+
+def pipeline(
+    spec_file: Path = typer.Argument(..., exists=True, help="Pipeline spec in JSON."),
+    inputs: Optional[List[str]] = typer.Argument(
+        None, help="Episodes to run instead of the ones listed in the spec."
+    ),
+    local_concurrency: int = typer.Option(
+        2, min=1, help="Maximum transcode and export stages at once."
+    ),
+    dolby_concurrency: int = typer.Option(
+        4, min=1, help="Maximum Dolby.io jobs in flight."
+    ),
+    assembly_concurrency: int = typer.Option(
+        4, min=1, help="Maximum AssemblyAI jobs in flight."
+    ),
+    max_poll_interval: float = typer.Option(
+        30.0, help="Longest wait in seconds between status checks for a job."
+    ),
+    cache: bool = typer.Option(
+        True, help="Reuse uploads and results for unchanged files."
+    ),
+    force: bool = typer.Option(
+        False, help="Run every stage, even when its inputs are unchanged."
+    ),
+):
+    """Run each episode through the stages of a pipeline spec, skipping unchanged ones.
+
+    A spec lists the episodes, an output folder and the stages. Every stage
+    `uses` a step and reads the output of its `input` stage, or the episode
+    itself by default:
+
+        {"episodes": ["episodes/*.wav"], "output": "output", "stages": [
+            {"name": "transcode", "uses": "transcode",
+             "params": {"intro_music": "intro.mp3"}},
+            {"name": "enhance", "uses": "enhance", "input": "transcode"},
+            {"name": "transcribe", "uses": "transcribe", "input": "enhance"},
+            {"name": "export", "uses": "export", "input": "transcribe"}]}
+    """
+    try:
+        spec = load_spec(spec_file)
+    except ValueError as e:
+        typer.echo(f"Invalid pipeline spec {spec_file}: {e}")
+        raise typer.Exit(code=1)
+
+    if inputs:
+        files = find_audio_files(inputs)
+    else:
+        files = find_audio_files([str(spec.base / e) for e in spec.episodes])
+    if not files:
+        typer.echo("No audio files found.")
+        raise typer.Exit(code=1)
+
+    poller = JobPoller(max_interval=max_poll_interval)
+    keys = register_providers(spec, poller)
+
+    progress = BatchProgress(files, [stage.name for stage in spec.stages])
+    runner = PipelineRunner(
+        spec,
+        StageManifest(spec.output / MANIFEST),
+        progress,
+        {
+            LOCAL: local_concurrency,
+            DOLBY: dolby_concurrency,
+            ASSEMBLYAI: assembly_concurrency,
+        },
+        poller=poller,
+        result_cache=ResultCache() if cache else None,
+        keys=keys,
+        force=force,
+    )
+
+    typer.echo(f"Running {len(spec.stages)} stages over {len(files)} episodes")
+    start = time.monotonic()
+    renderer = ProgressRenderer(progress)
+    renderer.start()
+    try:
+        counts = runner.run(files)
+    finally:
+        renderer.stop()
+        poller.stop()
+
+    elapsed = time.monotonic() - start
+    typer.echo(
+        f"Finished in {elapsed:.1f}s: {counts['done']} ran, "
+        f"{counts['up to date']} up to date, {counts['failed']} failed, "
+        f"{counts['skipped']} skipped"
+    )
+    if counts["failed"]:
+        raise typer.Exit(code=1)
+
+
+@dataclass
+class Stage:
+    name: str
+    uses: str
+    input: str = SOURCE
+    params: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class PipelineSpec:
+    episodes: List[str]
+    output: Path
+    stages: List[Stage]
+    base: Path = Path(".")
+
+    def children(self, name: str) -> List[Stage]:
+        return [stage for stage in self.stages if stage.input == name]
+
+
+def load_spec(path: Path) -> PipelineSpec:
+    """Read a pipeline spec, with its stages in the order they can run"""
+    return parse_spec(json.loads(Path(path).read_text()), Path(path).parent)
+
+
+def parse_spec(data: Dict[str, Any], base: Path) -> PipelineSpec:
+    """A pipeline spec whose files are relative to `base`"""
+    try:
+        stages = [Stage(**stage) for stage in data.get("stages", [])]
+    except TypeError as e:
+        raise ValueError(f"bad stage: {e}") from e
+    if not stages:
+        raise ValueError("no stages")
+
+    by_name = {}
+    for stage in stages:
+        if stage.name in by_name or stage.name == SOURCE:
+            raise ValueError(f"duplicate stage name {stage.name!r}")
+        if stage.uses not in STAGE_TYPES:
+            raise ValueError(
+                f"stage {stage.name!r} uses unknown step {stage.uses!r}, "
+                f"expected one of {', '.join(STAGE_TYPES)}"
+            )
+        # Files the stage reads are relative to the spec, like the episodes
+        for param in STAGE_TYPES[stage.uses].file_params:
+            if stage.params.get(param):
+                stage.params[param] = str(base / stage.params[param])
+        by_name[stage.name] = stage
+
+    ordered, placed = [], {SOURCE}
+    while len(ordered) < len(stages):
+        ready = [s for s in stages if s.name not in placed and s.input in placed]
+        if not ready:
+            unplaced = [s for s in stages if s.name not in placed]
+            missing = [s for s in unplaced if s.input not in by_name]
+            if missing:
+                raise ValueError(
+                    f"stage {missing[0].name!r} reads unknown stage "
+                    f"{missing[0].input!r}"
+                )
+            raise ValueError(
+                f"stages {', '.join(s.name for s in unplaced)} form a cycle"
+            )
+        ordered.extend(ready)
+        placed.update(s.name for s in ready)
+
+    return PipelineSpec(
+        episodes=list(data.get("episodes", [])),
+        output=base / data.get("output", "output"),
+        stages=ordered,
+        base=base,
+    )
+
+
+def register_providers(spec: PipelineSpec, poller: JobPoller) -> Dict[str, str]:
+    """Register a client with the poller for each provider the stages use
+
+    Returns the API key of each provider, for the stages to make their own
+    clients with.
+    """
+    uses = {stage.uses for stage in spec.stages}
+    keys = {}
+    if "enhance" in uses:
+        keys[DOLBY] = get_dolby_key()
+        poller.register(DOLBY, DolbyIO(keys[DOLBY]))
+    if "transcribe" in uses:
+        keys[ASSEMBLYAI] = get_assemblyai_key()
+        poller.register(ASSEMBLYAI, AssemblyAI(keys[ASSEMBLYAI]))
+    return keys
+
+
+class StageManifest:
+    """Records the inputs and outputs of every stage of every episode
+
+    Like make's timestamps, but with content hashes. File hashes are kept with
+    the size and mtime they were taken at, so unchanged files are not read
+    again on the next run.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        try:
+            data = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            data = {}
+        if data.get("version") != MANIFEST_VERSION:
+            data = {"version": MANIFEST_VERSION, "files": {}, "stages": {}}
+        self._data = data
+
+    def file_hash(self, path: Path) -> str:
+        path = Path(path).resolve()
+        stat = path.stat()
+        with self._lock:
+            known = self._data["files"].get(str(path))
+        if (
+            known
+            and known["size"] == stat.st_size
+            and known["mtime"] == stat.st_mtime_ns
+        ):
+            return known["hash"]
+        digest = file_hash(path)
+        with self._lock:
+            self._data["files"][str(path)] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "hash": digest,
+            }
+        return digest
+
+    def get(self, episode: Path, stage: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._data["stages"].get(f"{Path(episode).resolve()}:{stage}")
+
+    def put(self, episode: Path, stage: str, record: Dict[str, Any]):
+        with self._lock:
+            self._data["stages"][f"{Path(episode).resolve()}:{stage}"] = record
+
+    def is_current(self, record: Dict[str, Any]) -> bool:
+        """Whether every output of a stage still has the content it was saved with"""
+        for output, digest in record["outputs"].items():
+            if not Path(output).exists() or self.file_hash(Path(output)) != digest:
+                return False
+        return True
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        part_file = self.path.with_name(self.path.name + ".part")
+        with self._lock:
+            part_file.write_text(json.dumps(self._data, indent=1))
+            os.replace(part_file, self.path)
+
+
+class StageProgress:
+    """Shows the updates of one stage on its episode's row of the progress table"""
+
+    def __init__(self, progress: BatchProgress, episode: Path, stage: str):
+        self.progress = progress
+        self.episode = episode
+        self.stage = stage
+
+    def update(self, infile: Path, provider: str, status: str):
+        self.progress.update(self.episode, self.stage, status)
+
+
+@dataclass
+class StageContext:
+    out_dir: Path
+    progress: StageProgress
+    poller: JobPoller
+    result_cache: Optional[ResultCache]
+    keys: Dict[str, str]
+    renders: RenderCache
+
+
+@dataclass
+class StageResult:
+    outputs: List[Path]
+    digest: str
+    ran: bool
+
+
+@dataclass(order=True)
+class StageTask:
+    episode_index: int
+    stage_index: int
+    episode: Path = field(compare=False)
+    stage: Stage = field(compare=False)
+    infile: Path = field(compare=False)
+    input_hash: Optional[str] = field(compare=False)
+
+
+class PipelineRunner:
+    """Runs the stages of many episodes as one DAG
+
+    A stage is queued once its input is ready and starts when its resource,
+    local work or one of the providers, has a free slot. Earlier episodes go
+    first, so episode N+1 transcodes while episode N waits on Dolby.io.
+    """
+
+    def __init__(
+        self,
+        spec: PipelineSpec,
+        manifest: StageManifest,
+        progress: BatchProgress,
+        limits: Dict[str, int],
+        poller: JobPoller,
+        result_cache: Optional[ResultCache] = None,
+        keys: Optional[Dict[str, str]] = None,
+        force: bool = False,
+        renders: Optional[RenderCache] = None,
+    ):
+        self.spec = spec
+        self.manifest = manifest
+        self.progress = progress
+        self.limits = limits
+        self.poller = poller
+        self.result_cache = result_cache
+        self.keys = keys or {}
+        self.force = force
+        self.renders = renders or RenderCache()
+        self._order = {stage.name: i for i, stage in enumerate(spec.stages)}
+
+    def run(self, episodes: List[Path]) -> Counter:
+        counts: Counter = Counter(
+            {"done": 0, "up to date": 0, "failed": 0, "skipped": 0}
+        )
+        ready: List[StageTask] = []
+        for index, episode in enumerate(episodes):
+            for stage in self.spec.children(SOURCE):
+                heapq.heappush(
+                    ready,
+                    StageTask(
+                        index, self._order[stage.name], episode, stage, episode, None
+                    ),
+                )
+
+        busy: Counter = Counter()
+        running: Dict[Future, StageTask] = {}
+        with ThreadPoolExecutor(max_workers=sum(self.limits.values())) as pool:
+            while ready or running:
+                waiting = []
+                while ready:
+                    task = heapq.heappop(ready)
+                    resource = STAGE_TYPES[task.stage.uses].resource
+                    if busy[resource] < self.limits[resource]:
+                        busy[resource] += 1
+                        running[pool.submit(self.run_stage, task)] = task
+                    else:
+                        waiting.append(task)
+                for task in waiting:
+                    heapq.heappush(ready, task)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    busy[STAGE_TYPES[task.stage.uses].resource] -= 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.exception(
+                            f"Stage {task.stage.name} of {task.episode} failed"
+                        )
+                        counts["failed"] += 1
+                        self.progress.update(
+                            task.episode, task.stage.name, f"failed: {e}"
+                        )
+                        counts["skipped"] += self.skip_after(task)
+                        continue
+                    counts["done" if result.ran else "up to date"] += 1
+                    for child in self.spec.children(task.stage.name):
+                        heapq.heappush(
+                            ready,
+                            StageTask(
+                                task.episode_index,
+                                self._order[child.name],
+                                task.episode,
+                                child,
+                                result.outputs[0],
+                                result.digest,
+                            ),
+                        )
+        return counts
+
+    def run_stage(self, task: StageTask) -> StageResult:
+        stage, episode = task.stage, task.episode
+        stage_type = STAGE_TYPES[stage.uses]
+        self.progress.update(episode, stage.name, "checking")
+        input_hash = task.input_hash or self.manifest.file_hash(task.infile)
+        params = dict(stage.params)
+        for param in stage_type.file_params:
+            if params.get(param):
+                params[param] = self.manifest.file_hash(Path(params[param]))
+        key = job_key(
+            input_hash, {"uses": stage.uses, "params": params, "input": stage.input}
+        )
+
+        record = self.manifest.get(episode, stage.name)
+        if not self.force and record and record["key"] == key:
+            if self.manifest.is_current(record):
+                self.progress.update(episode, stage.name, "up to date")
+                return StageResult(
+                    [Path(p) for p in record["outputs"]], record["digest"], False
+                )
+
+        out_dir = self.spec.output / episode.stem
+        out_dir.mkdir(parents=True, exist_ok=True)
+        context = StageContext(
+            out_dir,
+            StageProgress(self.progress, episode, stage.name),
+            self.poller,
+            self.result_cache,
+            self.keys,
+            self.renders,
+        )
+        self.progress.update(episode, stage.name, "running")
+        outputs = stage_type.run(task.infile, stage.params, context)
+        hashes = {str(p.resolve()): self.manifest.file_hash(p) for p in outputs}
+        digest = hashes[str(outputs[0].resolve())]
+        self.manifest.put(
+            episode, stage.name, {"key": key, "outputs": hashes, "digest": digest}
+        )
+        self.manifest.save()
+        self.progress.update(episode, stage.name, "done")
+        return StageResult(outputs, digest, True)
+
+    def skip_after(self, task: StageTask) -> int:
+        """Mark every stage downstream of a failed one as skipped"""
+        skipped, names = 0, [task.stage.name]
+        while names:
+            for child in self.spec.children(names.pop()):
+                self.progress.update(task.episode, child.name, "skipped")
+                names.append(child.name)
+                skipped += 1
+        return skipped
+
+
+def transcode_stage(infile: Path, params: Dict[str, Any], ctx: StageContext):
+    renditions = [Rendition(r) for r in params.get("renditions", ["master"])]
+    paths = _transcode(
+        infile,
+        ctx.out_dir / f"{infile.stem}.mp3",
+        Path(params["intro_music"]) if params.get("intro_music") else None,
+        Path(params["outro_music"]) if params.get("outro_music") else None,
+        ctx.renders,
+        renditions,
+        overwrite=True,
+        quiet=True,
+        jobs=int(params.get("jobs", 1)),
+    )
+    return list(paths.values())
+
+
+def enhance_stage(infile: Path, params: Dict[str, Any], ctx: StageContext):
+    dolby = DolbyIO(ctx.keys[DOLBY])
+    return [
+        enhance_file(
+            dolby, infile, ctx.out_dir, ctx.progress, ctx.poller, ctx.result_cache
+        )
+    ]
+
+
+def transcribe_stage(infile: Path, params: Dict[str, Any], ctx: StageContext):
+    client = AssemblyAI(ctx.keys[ASSEMBLYAI])
+    word_boost = params.get("word_boost", [])
+    return [
+        transcribe_file(
+            client,
+            infile,
+            word_boost,
+            ctx.progress,
+            ctx.poller,
+            ctx.result_cache,
+            upload_format=UploadFormat(params.get("upload_format", "original")),
+            out_path=ctx.out_dir / f"{infile.stem}.json",
+        )
+    ]
+
+
+def export_stage(infile: Path, params: Dict[str, Any], ctx: StageContext):
+    formats = [ExportFormat(f) for f in params.get("formats", ["txt", "srt", "vtt"])]
+    names = load_speaker_map(Path(params["speakers"])) if params.get("speakers") else {}
+    limits = CaptionLimits(**params.get("captions", {}))
+    return export_file(infile, ctx.out_dir, formats, names, limits)
+
+
+@dataclass
+class StageType:
+    run: Callable[[Path, Dict[str, Any], StageContext], List[Path]]
+    resource: str
+    # Params naming files whose content, not path, is part of the stage's inputs
+    file_params: Tuple[str, ...] = ()
+
+
+STAGE_TYPES = {
+    "transcode": StageType(transcode_stage, LOCAL, ("intro_music", "outro_music")),
+    "enhance": StageType(enhance_stage, DOLBY),
+    "transcribe": StageType(transcribe_stage, ASSEMBLYAI),
+    "export": StageType(export_stage, LOCAL, ("speakers",)),
+}
@@ -0,0 +1,349 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from post_production.assembly_ai import AssemblyAI
+from post_production.cache import ASSEMBLYAI, DOLBY
+from post_production.dolby import DolbyIO, JobType
+from post_production.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DOLBY_ACTIVE = ("Pending", "Running")
+ASSEMBLYAI_ACTIVE = ("queued", "processing")
+# Statuses of jobs the provider has not started on yet
+QUEUED = ("Pending", "queued")
+SUCCEEDED = ("Success", "completed")
+# Pokes for jobs not tracked yet, e.g. a webhook that beat track(), are kept
+# this long and at most this many at once
+EARLY_POKE_TTL = 300.0
+MAX_EARLY_POKES = 1000
+
+
+@dataclass
+class JobUpdate:
+    status: str
+    progress: Optional[int] = None
+    data: Any = None
+
+
+def dolby_status(client: DolbyIO, job_id: str, job_type: JobType) -> JobUpdate:
+    status, progress = client.get_status(job_id, job_type=job_type)
+    return JobUpdate(status, progress)
+
+
+def assemblyai_status(client: AssemblyAI, job_id: str, job_type=None) -> JobUpdate:
+    fields = client.status(job_id)
+    return JobUpdate(fields.get("status"), None, fields)
+
+
+# provider: (status check, statuses that mean the job is still running)
+STATUS_CHECKS: Dict[str, Tuple[Callable[..., JobUpdate], Tuple[str, ...]]] = {
+    DOLBY: (dolby_status, DOLBY_ACTIVE),
+    ASSEMBLYAI: (assemblyai_status, ASSEMBLYAI_ACTIVE),
+}
+
+
+@dataclass
+class TrackedJob:
+    provider: str
+    job_id: str
+    job_type: Optional[JobType]
+    future: Future
+    on_update: Optional[Callable[[JobUpdate], None]] = None
+    update: Optional[JobUpdate] = None
+    interval: float = 0.0
+    entry: int = -1
+    checking: bool = False
+    poked: bool = False
+    requests: int = 0
+    errors: int = 0
+    history: List[Tuple[float, int]] = field(default_factory=list)
+    tracked: float = field(default_factory=time.monotonic)
+    started: Optional[float] = None
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.provider, self.job_id
+
+
+@dataclass
+class PollerStats:
+    requests: int = 0
+    completed: int = 0
+    errors: int = 0
+
+    @property
+    def requests_per_job(self) -> float:
+        return self.requests / self.completed if self.completed else 0.0
+
+
+class JobPoller:
+    """Polls many Dolby.io and AssemblyAI jobs from one scheduler thread
+
+    Each tracked job is checked on its own schedule. Jobs that report progress
+    are checked again around the time they are expected to finish, and jobs
+    that do not report progress back off exponentially. Status checks share one
+    client, and so one pooled session, per provider.
+
+    Usage:
+        with JobPoller() as poller:
+            poller.register(DOLBY, dolby)
+            future = poller.track(DOLBY, job_id, JobType.ENHANCE)
+            update = future.result()
+    """
+
+    def __init__(
+        self,
+        min_interval: float = 1.0,
+        max_interval: float = 30.0,
+        backoff: float = 1.5,
+        workers: int = 4,
+        max_errors: int = 5,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.workers = workers
+        self.max_errors = max_errors
+        self.stats = PollerStats()
+
+        self._clients: Dict[str, Any] = {}
+        self._jobs: Dict[Tuple[str, str], TrackedJob] = {}
+        self._early_pokes: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._heap: List[Tuple[float, int, TrackedJob]] = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def register(self, provider: str, client):
+        """Use `client` for every status check against `provider`"""
+        if provider not in STATUS_CHECKS:
+            raise ValueError(f"No status check for provider {provider!r}")
+        self._clients[provider] = client
+
+    def track(
+        self,
+        provider: str,
+        job_id: str,
+        job_type: Optional[JobType] = None,
+        on_update: Optional[Callable[[JobUpdate], None]] = None,
+        delay: float = 0.0,
+    ) -> Future:
+        """Start polling a job. The future resolves with its final JobUpdate.
+
+        The first check happens after `delay` seconds, unless the job was
+        already poked, e.g. by a webhook that arrived before it was tracked.
+        """
+        if provider not in self._clients:
+            raise ValueError(f"Register a client for {provider!r} before tracking")
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            job = self._jobs.get((provider, job_id))
+            if job:
+                return job.future
+            job = TrackedJob(provider, job_id, job_type, Future(), on_update)
+            self._jobs[job.key] = job
+            poked = self._early_pokes.pop(job.key, None)
+            if poked is not None and time.monotonic() - poked < EARLY_POKE_TTL:
+                delay = 0.0
+            self._schedule(job, delay)
+        return job.future
+
+    def poke(self, provider: str, job_id: str) -> bool:
+        """Check a tracked job right away, e.g. when a webhook says it changed
+
+        A poke for a job that is not tracked is remembered for a while, in case
+        it is about to be. Only the most recent of those are kept.
+        """
+        with self._cond:
+            job = self._jobs.get((provider, job_id))
+            if not job:
+                self._remember_poke((provider, job_id))
+                return False
+            if job.checking:
+                job.poked = True
+            else:
+                self._schedule(job, 0.0)
+        return True
+
+    def _remember_poke(self, key: Tuple[str, str]):
+        now = time.monotonic()
+        self._early_pokes.pop(key, None)
+        self._early_pokes[key] = now
+        while self._early_pokes:
+            oldest, poked = next(iter(self._early_pokes.items()))
+            if (
+                now - poked < EARLY_POKE_TTL
+                and len(self._early_pokes) <= MAX_EARLY_POKES
+            ):
+                break
+            del self._early_pokes[oldest]
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._jobs)
+
+    def start(self) -> "JobPoller":
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        if self._pool:
+            self._pool.shutdown(wait=True)
+        for job in list(self._jobs.values()):
+            job.future.cancel()
+        if self.stats.completed:
+            logger.info(
+                f"Polled {self.stats.completed} jobs with {self.stats.requests} "
+                f"status requests ({self.stats.requests_per_job:.1f} per job)"
+            )
+
+    def __enter__(self) -> "JobPoller":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _schedule(self, job: TrackedJob, delay: float):
+        # Rescheduling supersedes any earlier heap entry for the job
+        job.entry = next(self._counter)
+        heapq.heappush(self._heap, (time.monotonic() + delay, job.entry, job))
+        self._cond.notify()
+
+    def _reschedule(self, job: TrackedJob):
+        job.checking = False
+        delay = 0.0 if job.poked else self._next_interval(job)
+        job.poked = False
+        self._schedule(job, delay)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._heap:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                due, entry, job = self._heap[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                if entry != job.entry or self._jobs.get(job.key) is not job:
+                    continue
+                job.checking = True
+            self._pool.submit(self._check, job)
+
+    def _check(self, job: TrackedJob):
+        check, active = STATUS_CHECKS[job.provider]
+        try:
+            update = check(self._clients[job.provider], job.job_id, job.job_type)
+        except Exception as e:
+            with self._cond:
+                job.requests += 1
+                job.errors += 1
+                self.stats.requests += 1
+                self.stats.errors += 1
+                if self._jobs.get(job.key) is not job:
+                    return
+                if job.errors >= self.max_errors:
+                    del self._jobs[job.key]
+                    job.future.set_exception(e)
+                    return
+                logger.warning(f"Status check for {job.job_id} failed: {e}")
+                self._reschedule(job)
+            return
+
+        now = time.monotonic()
+        with self._cond:
+            job.requests += 1
+            job.errors = 0
+            job.update = update
+            self.stats.requests += 1
+            if update.progress is not None:
+                job.history.append((now, update.progress))
+            started = job.started is None and update.status not in QUEUED
+            if started:
+                job.started = now
+
+        if started:
+            metrics.record(
+                "stage",
+                stage="queued",
+                provider=job.provider,
+                job_id=job.job_id,
+                seconds=round(now - job.tracked, 4),
+                status="ok",
+            )
+
+        if job.on_update:
+            try:
+                job.on_update(update)
+            except Exception as e:
+                # Fail the job, or whoever waits on its future waits forever
+                with self._cond:
+                    if self._jobs.get(job.key) is not job:
+                        return
+                    del self._jobs[job.key]
+                job.future.set_exception(e)
+                return
+
+        with self._cond:
+            if self._jobs.get(job.key) is not job:
+                return
+            if update.status in active:
+                self._reschedule(job)
+                return
+            del self._jobs[job.key]
+            self.stats.completed += 1
+        metrics.record(
+            "stage",
+            stage="job",
+            provider=job.provider,
+            job_id=job.job_id,
+            seconds=round(now - job.tracked, 4),
+            status="ok" if update.status in SUCCEEDED else "error",
+            polls=job.requests,
+        )
+        logger.info(
+            f"Job {job.job_id} finished with {update.status} "
+            f"after {job.requests} status requests"
+        )
+        job.future.set_result(update)
+
+    def _next_interval(self, job: TrackedJob) -> float:
+        """Estimate when the job will finish from its progress, else back off"""
+        estimate = None
+        if len(job.history) >= 2:
+            (t0, p0), (t1, p1) = job.history[0], job.history[-1]
+            if p1 > p0 and t1 > t0:
+                rate = (p1 - p0) / (t1 - t0)
+                estimate = (100 - p1) / rate / 2
+
+        if estimate is None:
+            interval = (
+                job.interval * self.backoff if job.interval else self.min_interval
+            )
+        else:
+            interval = estimate
+        job.interval = min(self.max_interval, max(self.min_interval, interval))
+        # Jitter keeps jobs submitted together from polling in lockstep
+        return job.interval * random.uniform(0.9, 1.1)
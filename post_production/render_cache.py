@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import re
+import tempfile
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+import ffmpeg
+
+from post_production.cache import DEFAULT_CACHE_PATH, file_hash, job_key
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RENDER_PATH = DEFAULT_CACHE_PATH.parent / "renders"
+DEFAULT_RENDER_CACHE_SIZE = 512 * 1024 * 1024
+
+# Bump when the way renders are produced changes, so old renders are not reused
+RENDER_VERSION = 1
+RENDER_SUFFIX = ".flac"
+
+LOUDNORM_STATS = re.compile(r"\{[^{}]*\"input_i\"[^{}]*\}")
+
+
+@dataclass(frozen=True)
+class Loudnorm:
+    """Target loudness for music beds, in the terms of ffmpeg's loudnorm filter"""
+
+    i: float = -23.0
+    tp: float = -2.0
+    lra: float = 7.0
+    dual_mono: bool = True
+    sample_rate: int = 48000
+
+    def options(self) -> Dict[str, str]:
+        return {
+            "i": str(self.i),
+            "tp": str(self.tp),
+            "lra": str(self.lra),
+            "dual_mono": str(self.dual_mono).lower(),
+        }
+
+
+def measure_loudness(asset: Path, target: Loudnorm) -> Dict[str, str]:
+    """First loudnorm pass, which only analyses the asset"""
+    _, stderr = (
+        ffmpeg.input(str(asset))
+        .filter("loudnorm", print_format="json", **target.options())
+        .output("-", f="null")
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    match = LOUDNORM_STATS.search(stderr.decode(errors="replace"))
+    if not match:
+        raise ValueError(f"ffmpeg did not report the loudness of {asset}")
+    return json.loads(match.group())
+
+
+def normalize_loudness(asset: Path, out_file: Path, target: Loudnorm) -> Path:
+    """Two-pass loudnorm: measure the asset, then apply a linear gain to the target
+
+    Single-pass loudnorm has to guess from the audio it has seen so far and
+    falls back to dynamic compression, which pumps on music.
+    """
+    stats = measure_loudness(asset, target)
+    (
+        ffmpeg.input(str(asset))
+        .filter(
+            "loudnorm",
+            measured_i=stats["input_i"],
+            measured_tp=stats["input_tp"],
+            measured_lra=stats["input_lra"],
+            measured_thresh=stats["input_thresh"],
+            offset=stats["target_offset"],
+            linear="true",
+            **target.options(),
+        )
+        .output(str(out_file), ar=target.sample_rate, f="flac")
+        .run(overwrite_output=True, quiet=True)
+    )
+    return Path(out_file)
+
+
+class RenderCache:
+    """Loudness-normalized renders of intro and outro music, kept on disk
+
+    Renders are keyed by the asset's content and the loudness target, so an
+    edited asset or a new target renders again. The least recently used
+    renders are removed once the cache grows past max_bytes.
+
+    Usage:
+        renders = RenderCache()
+        intro = ffmpeg.input(str(renders.render(Path("intro.mp3"))))
+    """
+
+    def __init__(
+        self,
+        path: Path = DEFAULT_RENDER_PATH,
+        max_bytes: Optional[int] = DEFAULT_RENDER_CACHE_SIZE,
+        target: Loudnorm = Loudnorm(),
+    ):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.target = target
+
+    def key(self, asset: Path) -> str:
+        params = {"loudnorm": asdict(self.target), "version": RENDER_VERSION}
+        return job_key(file_hash(asset), params)
+
+    def render(self, asset: Path) -> Path:
+        """The normalized render of an asset, made on the first request"""
+        rendered = self.path / (self.key(asset) + RENDER_SUFFIX)
+        if rendered.exists():
+            logger.info(f"Using cached render of {asset}")
+            # Reads do not reliably update atime, so recency is kept in mtime
+            os.utime(rendered)
+            return rendered
+
+        logger.info(f"Rendering {asset} at {self.target.i} LUFS")
+        # Stages rendering the same asset at once each write their own part file
+        fd, part_name = tempfile.mkstemp(
+            dir=self.path, prefix=rendered.stem + ".", suffix=".part"
+        )
+        os.close(fd)
+        part_file = Path(part_name)
+        try:
+            normalize_loudness(asset, part_file, self.target)
+            os.replace(part_file, rendered)
+        finally:
+            part_file.unlink(missing_ok=True)
+        self.evict(keep=rendered)
+        return rendered
+
+    def size(self) -> int:
+        return sum(p.stat().st_size for p in self.path.glob("*" + RENDER_SUFFIX))
+
+    def evict(self, keep: Optional[Path] = None) -> int:
+        """Remove the least recently used renders until the cache fits max_bytes"""
+        if self.max_bytes is None:
+            return 0
+        renders = sorted(
+            (p.stat().st_mtime_ns, p.stat().st_size, p)
+            for p in self.path.glob("*" + RENDER_SUFFIX)
+        )
+        total = sum(size for _, size, _ in renders)
+        removed = 0
+        for _, size, render in renders:
+            if total <= self.max_bytes:
+                break
+            if render == keep:
+                continue
+            render.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"Evicted {removed} renders from {self.path}")
+        return removed
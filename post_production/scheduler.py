@@ -0,0 +1,407 @@
+import asyncio
+import email.utils
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from post_production.cache import ASSEMBLYAI, DOLBY
+from post_production.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Order in which queued requests to a provider go out, lowest first
+
+    Status checks and downloads finish work that is already paid for, so
+    they go ahead of uploads, which go ahead of new jobs.
+    """
+
+    POLL = 0
+    TRANSFER = 1
+    SUBMIT = 2
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """Requests per second, how many may be sent at once above that, and how
+    many may be in flight"""
+
+    rate: float
+    burst: int
+    concurrency: int
+
+
+RATE_LIMITS: Dict[str, RateLimit] = {
+    DOLBY: RateLimit(rate=10.0, burst=10, concurrency=8),
+    ASSEMBLYAI: RateLimit(rate=10.0, burst=10, concurrency=8),
+}
+
+# Statuses that mean "not now": 429 is a throttle, 503 an overloaded server.
+# Neither has acted on the request, so even a new job may be sent again.
+THROTTLE_STATUSES = {429, 503}
+# Statuses a repeated request may get past. Only idempotent requests are
+# repeated after these, as the provider may have acted on the first one.
+RETRY_STATUSES = THROTTLE_STATUSES | {500, 502, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# Longest Retry-After to wait out, rather than give up on the request
+MAX_RETRY_AFTER = 300.0
+
+
+@dataclass
+class SchedulerStats:
+    requests: int = 0
+    retries: int = 0
+    throttled: int = 0
+    queued_seconds: float = 0.0
+    throttle_seconds: float = 0.0
+
+
+class RequestScheduler:
+    """Paces the requests of every client of one provider
+
+    A token bucket keeps requests under the provider's rate and a cap keeps
+    the number in flight down. Requests that have to wait go out by
+    priority, then in the order they arrived. A throttled response pauses
+    every request to the provider until its Retry-After has passed.
+
+    Coroutines wait their turn with acquire_async, in the same queue as
+    threads, without tying up a thread while they wait.
+
+    Usage:
+        scheduler = scheduler_for(DOLBY)
+        scheduler.acquire(Priority.POLL)
+        try:
+            response = session.get(url)
+        finally:
+            scheduler.release()
+    """
+
+    def __init__(self, provider: str, limit: RateLimit):
+        self.provider = provider
+        self.limit = limit
+        self.stats = SchedulerStats()
+        self._tokens = float(limit.burst)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._active = 0
+        self._waiting: List[Tuple[int, int]] = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        # Futures of coroutines in acquire_async, woken along with the threads
+        self._wakers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def acquire(self, priority: Priority = Priority.POLL) -> float:
+        """Wait for a turn to send a request and return the seconds waited"""
+        ticket = (int(priority), next(self._counter))
+        start = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                taken, timeout = self._take(ticket)
+                if taken:
+                    break
+                self._cond.wait(timeout)
+        return self._waited(start)
+
+    async def acquire_async(self, priority: Priority = Priority.POLL) -> float:
+        """Wait for a turn on the event loop. A cancelled wait gives up its place."""
+        ticket = (int(priority), next(self._counter))
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+        try:
+            while True:
+                woken = loop.create_future()
+                with self._cond:
+                    taken, timeout = self._take(ticket)
+                    if taken:
+                        break
+                    self._wakers.append((loop, woken))
+                try:
+                    await asyncio.wait_for(woken, timeout)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self._cond:
+                        self._wakers.remove((loop, woken))
+        except BaseException:
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._notify()
+            raise
+        return self._waited(start)
+
+    def _take(self, ticket: Tuple[int, int]) -> Tuple[bool, Optional[float]]:
+        """Give a waiting ticket its turn if it is due, or say how long to wait
+
+        Returns whether the turn was taken, and otherwise the seconds until it
+        may be, or None to wait until another request is done.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if self._paused_until > now:
+            return False, self._paused_until - now
+        if self._waiting[0] != ticket or self._active >= self.limit.concurrency:
+            return False, None
+        if self._tokens < 1:
+            return False, (1 - self._tokens) / self.limit.rate
+        heapq.heappop(self._waiting)
+        self._tokens -= 1
+        self._active += 1
+        self.stats.requests += 1
+        self._notify()
+        return True, None
+
+    def _notify(self):
+        """Wake every waiting thread and coroutine to check its turn again"""
+        self._cond.notify_all()
+        for loop, woken in self._wakers:
+            try:
+                loop.call_soon_threadsafe(_wake, woken)
+            except RuntimeError:
+                # The loop has closed, and its waiter with it
+                pass
+
+    def _waited(self, start: float) -> float:
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            self.stats.queued_seconds += waited
+            metrics.record(
+                "throttle",
+                provider=self.provider,
+                reason="queue",
+                seconds=round(waited, 4),
+            )
+        return waited
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._notify()
+
+    def count_retry(self):
+        with self._cond:
+            self.stats.retries += 1
+
+    def pause(self, seconds: float):
+        """Hold back every request to the provider for a while"""
+        with self._cond:
+            now = time.monotonic()
+            until = now + seconds
+            # Pauses asked for by requests in flight at once overlap
+            self.stats.throttle_seconds += max(
+                0.0, until - max(self._paused_until, now)
+            )
+            self.stats.throttled += 1
+            self._paused_until = max(self._paused_until, until)
+            # Start again slowly rather than with a full bucket
+            self._tokens = min(self._tokens, 1.0)
+            self._notify()
+
+    def _refill(self, now: float):
+        elapsed = now - self._refilled
+        self._refilled = now
+        self._tokens = min(self.limit.burst, self._tokens + elapsed * self.limit.rate)
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+_schedulers: Dict[str, RequestScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler_for(provider: str) -> RequestScheduler:
+    """The scheduler every client of a provider in this process shares"""
+    with _schedulers_lock:
+        if provider not in _schedulers:
+            _schedulers[provider] = RequestScheduler(provider, RATE_LIMITS[provider])
+        return _schedulers[provider]
+
+
+def retry_after(response: requests.Response) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given in seconds or as a date"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def replayable(body) -> bool:
+    """Whether a request body can be sent again, rewinding it if it is a file"""
+    if body is None or isinstance(body, (bytes, str, dict, list, tuple)):
+        return True
+    if hasattr(body, "seek"):
+        body.seek(0)
+        return True
+    # A generator, e.g. ffmpeg's output, is used up by the first attempt
+    return False
+
+
+class RetryRules(ABC):
+    """When a paced request to a provider is sent again
+
+    Failed idempotent requests are retried with jittered exponential backoff,
+    or after the Retry-After the provider asked for. Requests that create
+    something, like a new job, are only sent again after a 429 or 503 or a
+    failed connection, when the provider cannot have acted on them. A
+    throttled response pauses the provider's scheduler.
+    """
+
+    provider: str
+    scheduler: RequestScheduler
+    max_retries: int
+    backoff: float
+    max_backoff: float
+
+    @abstractmethod
+    def _never_sent(self, error: Exception) -> bool:
+        """Whether a failed request cannot have reached the provider"""
+
+    def _retry_wait(
+        self,
+        response: Optional[Any],
+        error: Optional[Exception],
+        idempotent: bool,
+        attempt: int,
+    ) -> Optional[float]:
+        """Seconds to wait before sending a request again, or None to give up"""
+        if attempt >= self.max_retries:
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if error is not None:
+            return delay if idempotent or self._never_sent(error) else None
+        status = response.status_code
+        if status not in RETRY_STATUSES:
+            return None
+        if status not in THROTTLE_STATUSES and not idempotent:
+            return None
+        wait = retry_after(response)
+        if wait is None:
+            wait = delay
+        elif wait > MAX_RETRY_AFTER:
+            return None
+        if status in THROTTLE_STATUSES:
+            self.scheduler.pause(wait)
+        return wait
+
+    def _count_retry(
+        self,
+        method: str,
+        url: str,
+        response: Optional[Any],
+        error: Optional[Exception],
+        wait: float,
+        attempt: int,
+    ):
+        reason = response.status_code if response is not None else type(error).__name__
+        logger.warning(
+            f"Retrying {method} {url} in {wait:.1f}s after {reason} "
+            f"(attempt {attempt + 1} of {self.max_retries})"
+        )
+        self.scheduler.count_retry()
+        metrics.record(
+            "throttle",
+            provider=self.provider,
+            reason=str(reason),
+            seconds=round(wait, 4),
+        )
+
+
+class ScheduledSession(RetryRules, requests.Session):
+    """A session whose requests to a provider's API wait their turn and retry
+
+    Requests to other hosts, such as pre-signed storage urls, go straight
+    out. API requests are paced by the provider's RequestScheduler and sent
+    again as RetryRules allow.
+
+    Usage:
+        session = ScheduledSession(DOLBY, dolby)
+        session.post(url, json=body, priority=Priority.SUBMIT)
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        client: Any,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ):
+        super().__init__()
+        self.provider = provider
+        # The client's api_endpoint is read for every request, as it may change
+        self.client = client
+        self.scheduler = scheduler_for(provider)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        *args,
+        priority: Optional[Priority] = None,
+        idempotent: Optional[bool] = None,
+        **kwargs,
+    ) -> requests.Response:
+        if not url.startswith(self.client.api_endpoint):
+            return super().request(method, url, *args, **kwargs)
+        method = method.upper()
+        if priority is None:
+            priority = Priority.SUBMIT if method == "POST" else Priority.POLL
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            self.scheduler.acquire(priority)
+            try:
+                response = super().request(method, url, *args, **kwargs)
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response, error = None, e
+            finally:
+                self.scheduler.release()
+
+            wait = self._retry_wait(response, error, idempotent, attempt)
+            if wait is None or not replayable(kwargs.get("data")):
+                if error:
+                    raise error
+                return response
+            self._count_retry(method, url, response, error, wait, attempt)
+            if response is not None:
+                response.close()
+            time.sleep(wait)
+            attempt += 1
+
+    def _never_sent(self, error: Exception) -> bool:
+        # A refused connection never reached the provider
+        return isinstance(error, requests.ConnectTimeout) or (
+            isinstance(error, requests.ConnectionError)
+            and "NewConnectionError" in repr(error)
+        )
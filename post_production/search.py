@@ -0,0 +1,431 @@
+import bisect
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+from collections.abc import Sequence
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import typer
+from tabulate import tabulate
+
+from post_production.cache import DEFAULT_CACHE_PATH, read_file
+from post_production.export import chapter_timestamp
+from post_production.transcript import STREAM_CHUNK_SIZE, iter_transcript
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_PATH = DEFAULT_CACHE_PATH.parent / "index"
+MANIFEST = "manifest.json"
+MAGIC = b"TPPPIDX1"
+# magic, number of terms
+HEADER = struct.Struct("<8sI4x")
+# Posting columns, each an int32 array in term order
+EPISODE, POSITION, START, SPEAKER = range(4)
+SEGMENT_SIZE = 64
+# Sidecars written by transfer.py next to downloads, and by older versions
+# next to uploads
+SIDECAR_SUFFIXES = (".upload.json", ".part.json")
+
+NON_TERM = re.compile(r"[^\w']+")
+
+
+def index(
+    paths: List[Path] = typer.Argument(
+        ..., exists=True, help="Transcript files or folders to search for them."
+    ),
+    index_dir: Path = typer.Option(DEFAULT_INDEX_PATH, help="Where the index lives."),
+    rebuild: bool = typer.Option(False, help="Discard the index and build it again."),
+    segment_size: int = typer.Option(
+        SEGMENT_SIZE, min=1, help="Transcripts per index segment."
+    ),
+):
+    """Add new and changed transcripts to the search index."""
+    transcripts = find_transcripts(paths)
+    archive = TranscriptIndex(index_dir)
+    if rebuild:
+        archive.clear()
+    start = time.monotonic()
+    stats = archive.update(transcripts, segment_size=segment_size)
+    typer.echo(
+        f"Indexed {stats.added} transcripts ({stats.words} words), "
+        f"{stats.unchanged} unchanged, {stats.removed} removed "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+
+
+def search(
+    query: str = typer.Argument(
+        ..., help='Words in order, like "data science". End a word with * for prefixes.'
+    ),
+    index_dir: Path = typer.Option(DEFAULT_INDEX_PATH, help="Where the index lives."),
+    limit: int = typer.Option(20, min=1, help="Most results to show."),
+):
+    """Find when words were said across all indexed episodes."""
+    archive = TranscriptIndex(index_dir)
+    start = time.perf_counter()
+    hits = archive.search(query, limit=limit)
+    elapsed = (time.perf_counter() - start) * 1000
+    if not hits:
+        typer.echo(f"No matches for {query!r}")
+        raise typer.Exit(code=1)
+    rows = [
+        [Path(hit.episode).stem, chapter_timestamp(hit.start), hit.speaker, hit.text]
+        for hit in hits
+    ]
+    typer.echo(tabulate(rows, headers=["Episode", "Time", "Speaker", "Match"]))
+    typer.echo(f"{len(hits)} matches in {elapsed:.1f} ms")
+
+
+def find_transcripts(paths: Iterable[Path]) -> List[Path]:
+    found = set()
+    for path in paths:
+        candidates = Path(path).rglob("*.json") if Path(path).is_dir() else [path]
+        for candidate in candidates:
+            if not candidate.name.endswith(SIDECAR_SUFFIXES):
+                found.add(Path(candidate))
+    return sorted(found)
+
+
+def normalize(text: str) -> str:
+    """The term a transcript word or query word is indexed under"""
+    return NON_TERM.sub("", text.lower()).strip("'")
+
+
+def parse_query(query: str) -> List[Tuple[str, bool]]:
+    """(term, is_prefix) for each word of a query"""
+    terms = []
+    for word in query.split():
+        prefix = word.rstrip('"').endswith("*")
+        term = normalize(word)
+        if term:
+            terms.append((term, prefix))
+    return terms
+
+
+@dataclass
+class Hit:
+    episode: str
+    start: int
+    speaker: Optional[str]
+    text: str
+
+
+@dataclass
+class IndexStats:
+    added: int = 0
+    unchanged: int = 0
+    removed: int = 0
+    words: int = 0
+
+
+class Segment:
+    """One read-only, memory-mapped part of the index
+
+    The file holds a sorted term dictionary followed by posting columns.
+    Looking up a term is a binary search that only touches the pages it
+    reads, so opening a segment costs nothing until it is queried.
+    """
+
+    def __init__(self, path: Path, meta: Dict[str, Any]):
+        self.path = path
+        self.episodes = meta["episodes"]
+        self.speakers = meta["speakers"]
+        self.deleted = set(meta["deleted"])
+        with path.open("rb") as segment_file:
+            self._mmap = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} is not an index segment for this machine")
+
+        view = memoryview(self._mmap)
+        offset = HEADER.size
+        size = 4 * (count + 1)
+        self._term_offsets = view[offset : offset + size].cast("I")
+        self._posting_offsets = view[offset + size : offset + 2 * size].cast("I")
+        self._blob = offset + 2 * size
+        blob_size = self._term_offsets[count]
+        offset = self._blob + blob_size + (-blob_size % 4)
+        total = 4 * self._posting_offsets[count]
+        self._columns = [
+            view[offset + total * i : offset + total * (i + 1)].cast("i")
+            for i in range(4)
+        ]
+        self.terms = _Terms(self, count)
+
+    def term(self, i: int) -> str:
+        start = self._blob + self._term_offsets[i]
+        end = self._blob + self._term_offsets[i + 1]
+        return self._mmap[start:end].decode()
+
+    def term_range(self, term: str, prefix: bool = False) -> range:
+        lo = bisect.bisect_left(self.terms, term)
+        if prefix:
+            hi = bisect.bisect_left(self.terms, term + "\U0010ffff", lo)
+        else:
+            hi = lo + 1 if lo < len(self.terms) and self.terms[lo] == term else lo
+        return range(lo, hi)
+
+    def postings(self, i: int) -> range:
+        return range(self._posting_offsets[i], self._posting_offsets[i + 1])
+
+    def search(self, terms: List[Tuple[str, bool]]) -> Iterator[Hit]:
+        episodes, positions = self._columns[EPISODE], self._columns[POSITION]
+        if len(terms) == 1:
+            for t in self.term_range(*terms[0]):
+                word = self.term(t)
+                for p in self.postings(t):
+                    if episodes[p] not in self.deleted:
+                        yield self.hit(p, word)
+            return
+
+        # Phrases: key every posting by where its phrase would start
+        matches: Optional[Dict[Tuple[int, int], Tuple[int, str]]] = None
+        for offset, (term, prefix) in enumerate(terms):
+            found = {}
+            for t in self.term_range(term, prefix):
+                word = self.term(t)
+                for p in self.postings(t):
+                    found[episodes[p], positions[p] - offset] = (p, word)
+            if matches is None:
+                matches = found
+            else:
+                matches = {
+                    key: (first, f"{words} {found[key][1]}")
+                    for key, (first, words) in matches.items()
+                    if key in found
+                }
+            if not matches:
+                return
+        for (episode, _), (first, words) in sorted(matches.items()):
+            if episode not in self.deleted:
+                yield self.hit(first, words)
+
+    def hit(self, p: int, text: str) -> Hit:
+        code = self._columns[SPEAKER][p]
+        return Hit(
+            episode=self.episodes[self._columns[EPISODE][p]]["path"],
+            start=self._columns[START][p],
+            speaker=self.speakers[code] if code >= 0 else None,
+            text=text,
+        )
+
+
+class _Terms(Sequence):
+    """The sorted terms of a segment, decoded only when bisect looks at them"""
+
+    def __init__(self, segment: Segment, count: int):
+        self._segment = segment
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> str:
+        return self._segment.term(i)
+
+
+class TranscriptIndex:
+    """A persistent inverted index from transcript words to where they were said
+
+    Transcripts are indexed in segments of up to `segment_size` episodes, so
+    updates only write new segments. A changed or deleted transcript is
+    marked deleted in its old segment and indexed again in a new one. The
+    manifest lists every segment and episode, and segments are only opened
+    and memory-mapped by the first search that needs them.
+
+    Usage:
+        archive = TranscriptIndex()
+        archive.update(find_transcripts([Path("episodes")]))
+        for hit in archive.search("pandas data*"):
+            print(hit.episode, hit.start, hit.speaker)
+    """
+
+    def __init__(self, path: Path = DEFAULT_INDEX_PATH):
+        self.path = Path(path)
+        self._manifest = self._load_manifest()
+        self._segments: Dict[str, Segment] = {}
+
+    @property
+    def episodes(self) -> int:
+        return len(self._manifest["episodes"])
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        manifest_path = self.path / MANIFEST
+        if manifest_path.exists():
+            return json.loads(manifest_path.read_text())
+        return empty_manifest()
+
+    def _save_manifest(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path / f"{MANIFEST}.tmp"
+        tmp_path.write_text(json.dumps(self._manifest))
+        os.replace(tmp_path, self.path / MANIFEST)
+
+    def segment(self, name: str) -> Segment:
+        if name not in self._segments:
+            meta = self._manifest["segments"][name]
+            self._segments[name] = Segment(self.path / f"{name}.idx", meta)
+        return self._segments[name]
+
+    def clear(self):
+        for name in self._manifest["segments"]:
+            (self.path / f"{name}.idx").unlink(missing_ok=True)
+        self._manifest = empty_manifest()
+        self._segments.clear()
+        self._save_manifest()
+
+    def search(self, query: str, limit: int = 20) -> List[Hit]:
+        terms = parse_query(query)
+        hits: List[Hit] = []
+        if not terms:
+            return hits
+        for name in self._manifest["segments"]:
+            for hit in self.segment(name).search(terms):
+                hits.append(hit)
+                if len(hits) >= limit:
+                    return hits
+        return hits
+
+    def update(
+        self, transcripts: Iterable[Path], segment_size: int = SEGMENT_SIZE
+    ) -> IndexStats:
+        """Index transcripts that are new or changed, and drop deleted ones"""
+        stats = IndexStats()
+        episodes = self._manifest["episodes"]
+        pending = []
+        own_files = self.path.resolve()
+        for transcript in transcripts:
+            resolved = Path(transcript).resolve()
+            if own_files in resolved.parents:
+                continue
+            key = str(resolved)
+            stat = resolved.stat()
+            if key in episodes:
+                name, local = episodes[key]
+                known = self._manifest["segments"][name]["episodes"][local]
+                if (known["size"], known["mtime_ns"]) == (
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ):
+                    stats.unchanged += 1
+                    continue
+                self._remove(key)
+            pending.append((key, stat))
+
+        for key in list(episodes):
+            if not Path(key).exists():
+                self._remove(key)
+                stats.removed += 1
+
+        for first in range(0, len(pending), segment_size):
+            batch = pending[first : first + segment_size]
+            stats.words += self._write_segment(batch)
+            stats.added += len(batch)
+        self._save_manifest()
+        return stats
+
+    def _remove(self, key: str):
+        name, local = self._manifest["episodes"].pop(key)
+        meta = self._manifest["segments"][name]
+        meta["deleted"].append(local)
+        self._segments.pop(name, None)
+        if len(meta["deleted"]) == len(meta["episodes"]):
+            del self._manifest["segments"][name]
+            (self.path / f"{name}.idx").unlink(missing_ok=True)
+
+    def _write_segment(self, batch: List[Tuple[str, os.stat_result]]) -> int:
+        name = f"seg-{self._manifest['next_segment']:06}"
+        self._manifest["next_segment"] += 1
+        postings: Dict[str, array] = {}
+        speakers: List[str] = []
+        codes: Dict[str, int] = {}
+        episodes = []
+        total = 0
+        for local, (key, stat) in enumerate(batch):
+            count = 0
+            try:
+                for word in transcript_words(Path(key)):
+                    term = normalize(word.get("text") or "")
+                    if not term:
+                        continue
+                    speaker = word.get("speaker")
+                    if speaker is None:
+                        code = -1
+                    elif speaker in codes:
+                        code = codes[speaker]
+                    else:
+                        code = codes[speaker] = len(speakers)
+                        speakers.append(speaker)
+                    entries = postings.setdefault(term, array("i"))
+                    entries.extend((local, count, word["start"], code))
+                    count += 1
+            except ValueError as e:
+                logger.warning(f"Skipping {key}, not a transcript: {e}")
+            episodes.append(
+                {
+                    "path": key,
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "words": count,
+                }
+            )
+            self._manifest["episodes"][key] = [name, local]
+            total += count
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        write_segment(self.path / f"{name}.idx", postings)
+        self._manifest["segments"][name] = {
+            "episodes": episodes,
+            "speakers": speakers,
+            "deleted": [],
+            "byteorder": sys.byteorder,
+        }
+        logger.info(f"Wrote index segment {name} with {len(batch)} transcripts")
+        return total
+
+
+def empty_manifest() -> Dict[str, Any]:
+    return {"version": 1, "next_segment": 1, "segments": {}, "episodes": {}}
+
+
+def transcript_words(transcript: Path) -> Iterator[Dict[str, Any]]:
+    """Words of a saved transcript, read one at a time"""
+    chunks = read_file(transcript, STREAM_CHUNK_SIZE)
+    for key, value in iter_transcript(chunks, skip=("text", "utterances")):
+        if key == "words" and isinstance(value, dict):
+            yield value
+
+
+def write_segment(path: Path, postings: Dict[str, array]):
+    """Write terms in sorted order, then one int32 column per posting field"""
+    terms = sorted(postings)
+    blob = bytearray()
+    term_offsets = array("I", [0])
+    posting_offsets = array("I", [0])
+    columns = [array("i") for _ in range(4)]
+    for term in terms:
+        blob += term.encode()
+        term_offsets.append(len(blob))
+        entries = postings[term]
+        for i, column in enumerate(columns):
+            column.extend(entries[i::4])
+        posting_offsets.append(len(columns[0]))
+    blob += bytes(-len(blob) % 4)
+
+    tmp_path = path.with_suffix(".tmp")
+    with tmp_path.open("wb") as segment_file:
+        segment_file.write(HEADER.pack(MAGIC, len(terms)))
+        segment_file.write(term_offsets.tobytes())
+        segment_file.write(posting_offsets.tobytes())
+        segment_file.write(blob)
+        for column in columns:
+            segment_file.write(column.tobytes())
+    os.replace(tmp_path, path)
@@ -0,0 +1,273 @@
+import json
+import logging
+import math
+import os
+import re
+import string
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import groupby
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import ffmpeg
+
+from post_production.assembly_ai import AssemblyAI, UploadFormat
+from post_production.cache import ASSEMBLYAI, ResultCache
+from post_production.poller import JobPoller
+from post_production.transcript import TranscriptResult
+
+logger = logging.getLogger(__name__)
+
+# Audio each segment shares with the next. It is transcribed twice, so that
+# the speakers of both segments can be matched by the words they share.
+OVERLAP_SECONDS = 30.0
+SILENCE_NOISE = "-35dB"
+SILENCE_SECONDS = 0.4
+
+SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+SILENCE_END = re.compile(r"silence_end: ([\d.]+)")
+DURATION = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+@dataclass
+class Segment:
+    """A part of an episode in seconds. Its audio runs on to audio_end."""
+
+    index: int
+    start: float
+    end: float
+    audio_end: float
+
+    @property
+    def offset_ms(self) -> int:
+        return round(self.start * 1000)
+
+
+def find_silences(
+    input_file: Path, noise: str = SILENCE_NOISE, min_seconds: float = SILENCE_SECONDS
+) -> Tuple[List[Tuple[float, float]], float]:
+    """Silences in a file as (start, end) seconds, and the length of the file"""
+    _, stderr = (
+        ffmpeg.input(str(input_file))
+        .filter("silencedetect", n=noise, d=min_seconds)
+        .output("-", f="null")
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    log = stderr.decode(errors="replace")
+    match = DURATION.search(log)
+    if not match:
+        raise ValueError(f"ffmpeg did not report the duration of {input_file}")
+    hours, minutes, seconds = match.groups()
+    duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    starts = [max(0.0, float(start)) for start in SILENCE_START.findall(log)]
+    ends = [float(end) for end in SILENCE_END.findall(log)]
+    # A file that ends in silence reports no end for it
+    ends += [duration] * (len(starts) - len(ends))
+    return list(zip(starts, ends)), duration
+
+
+def plan_segments(
+    silences: List[Tuple[float, float]],
+    duration: float,
+    segment_seconds: float,
+    overlap: float = OVERLAP_SECONDS,
+) -> List[Segment]:
+    """Cut an episode into parts of at most about segment_seconds
+
+    Each cut goes in the middle of the silence nearest to where an even split
+    would put it, looking up to a quarter of a part either way. Without a
+    silence there, the cut is made at the even split.
+    """
+    count = max(1, math.ceil(duration / segment_seconds))
+    length = duration / count
+    middles = [(start + end) / 2 for start, end in silences]
+    cuts = [0.0]
+    for i in range(1, count):
+        target = i * length
+        near = [m for m in middles if abs(m - target) <= length / 4]
+        cuts.append(min(near, key=lambda m: abs(m - target)) if near else target)
+    cuts.append(duration)
+    return [
+        Segment(i, start, end, min(duration, end + overlap))
+        for i, (start, end) in enumerate(zip(cuts, cuts[1:]))
+    ]
+
+
+def match_speakers(
+    previous: List[Dict[str, Any]], current: List[Dict[str, Any]]
+) -> Dict[str, str]:
+    """Map speaker labels of one segment to those of the segment before it
+
+    Both lists hold words on the episode's timeline. Words the two segments
+    transcribed from the same audio vote, by how long they overlap, for the
+    labels being the same speaker. Labels are matched one to one, most votes
+    first.
+    """
+    votes: Dict[Tuple[str, str], int] = defaultdict(int)
+    j = 0
+    for word in current:
+        # Both lists are in time order, so skip what ended before this word
+        while j < len(previous) and previous[j]["end"] <= word["start"]:
+            j += 1
+        k = j
+        while k < len(previous) and previous[k]["start"] < word["end"]:
+            theirs, ours = previous[k].get("speaker"), word.get("speaker")
+            if theirs is not None and ours is not None:
+                shared = min(word["end"], previous[k]["end"]) - max(
+                    word["start"], previous[k]["start"]
+                )
+                votes[ours, theirs] += max(shared, 1)
+            k += 1
+
+    mapping: Dict[str, str] = {}
+    taken: Set[str] = set()
+    for (ours, theirs), _ in sorted(votes.items(), key=lambda item: -item[1]):
+        if ours not in mapping and theirs not in taken:
+            mapping[ours] = theirs
+            taken.add(theirs)
+    return mapping
+
+
+def new_labels(in_use: Set[str]) -> Iterator[str]:
+    """Speaker labels in AssemblyAI's style that are not in use yet"""
+    for label in string.ascii_uppercase:
+        if label not in in_use:
+            yield label
+    n = 1
+    while True:
+        if f"S{n}" not in in_use:
+            yield f"S{n}"
+        n += 1
+
+
+def stitch(segments: List[Segment], results: List[Dict[str, Any]]) -> TranscriptResult:
+    """Join the transcripts of the segments into one on the episode's timeline
+
+    Each segment keeps its words that start before the next segment does.
+    Speakers keep the labels of the first segment they are matched to. A
+    speaker who says nothing in an overlap cannot be matched and gets a new
+    label.
+    """
+    kept: List[Dict[str, Any]] = []
+    previous: List[Dict[str, Any]] = []
+    in_use: Set[str] = set()
+    for segment, result in zip(segments, results):
+        offset = segment.offset_ms
+        words = [
+            {**word, "start": word["start"] + offset, "end": word["end"] + offset}
+            for word in result.get("words") or ()
+        ]
+        mapping = match_speakers(previous, words) if previous else {}
+        fresh = new_labels(in_use | set(mapping.values()))
+        for word in words:
+            speaker = word.get("speaker")
+            if speaker is None:
+                continue
+            if speaker not in mapping:
+                mapping[speaker] = speaker if not previous else next(fresh)
+            word["speaker"] = mapping[speaker]
+        in_use.update(mapping.values())
+
+        end_ms = round(segment.end * 1000)
+        last = segment is segments[-1]
+        kept.extend(
+            word
+            for word in words
+            if word["start"] >= offset and (last or word["start"] < end_ms)
+        )
+        previous = words
+
+    transcript = TranscriptResult(
+        status="completed",
+        text=" ".join(word["text"] for word in kept),
+        audio_duration=segments[-1].end if segments else 0,
+        confidence=(
+            sum(word["confidence"] for word in kept) / len(kept) if kept else None
+        ),
+        words=kept,
+        segment_ids=[result.get("id") for result in results],
+    )
+    # Utterances are turns of one speaker, which may now run across a cut
+    for speaker, group in groupby(kept, key=lambda word: word.get("speaker")):
+        if speaker is None:
+            continue
+        turn = list(group)
+        transcript.add_utterance(
+            {
+                "speaker": speaker,
+                "text": " ".join(word["text"] for word in turn),
+                "start": turn[0]["start"],
+                "end": turn[-1]["end"],
+                "confidence": sum(word["confidence"] for word in turn) / len(turn),
+            }
+        )
+    return transcript
+
+
+def transcribe_segments(
+    client: AssemblyAI,
+    input_file: Path,
+    out_file: Path,
+    params: Dict[str, Any],
+    poller: JobPoller,
+    segment_seconds: float,
+    upload_format: UploadFormat = UploadFormat.flac,
+    workers: int = 4,
+    result_cache: Optional[ResultCache] = None,
+    content_hash: Optional[str] = None,
+) -> TranscriptResult:
+    """Transcribe an episode as parts cut at silences, in parallel, and save
+    the stitched transcript to out_file
+
+    The poller must have a client registered for AssemblyAI. With a cache,
+    the job of every part is kept, so an interrupted run picks them up again.
+    """
+    silences, duration = find_silences(input_file)
+    segments = plan_segments(silences, duration, segment_seconds)
+    upload_format = UploadFormat(upload_format)
+    # Parts are cut by ffmpeg anyway, and flac keeps the original's quality
+    if upload_format == UploadFormat.original:
+        upload_format = UploadFormat.flac
+    logger.info(
+        f"Transcribing {input_file} as {len(segments)} parts, cut at "
+        + ", ".join(f"{s.start:.1f}s" for s in segments[1:])
+    )
+
+    def run(segment: Segment) -> Dict[str, Any]:
+        key = cached = None
+        if result_cache and content_hash:
+            key = (
+                f"{content_hash}:{upload_format.value}:"
+                f"{segment.start:.3f}-{segment.audio_end:.3f}"
+            )
+            cached = result_cache.get_job(ASSEMBLYAI, key, params)
+        if cached:
+            job_id = cached.job_id
+        else:
+            audio_url = client.upload(
+                input_file,
+                upload_format,
+                start=segment.start,
+                duration=segment.audio_end - segment.start,
+            )
+            job_id = client.transcribe(audio_url=audio_url, **params)
+            if key:
+                result_cache.put_job(ASSEMBLYAI, key, params, job_id)
+        update = poller.track(ASSEMBLYAI, job_id).result()
+        if update.data.get("status") != "completed":
+            if key:
+                result_cache.forget_job(ASSEMBLYAI, key, params)
+            raise RuntimeError(f"AssemblyAI job {job_id}: {update.data.get('error')}")
+        return client.result(job_id)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, segments))
+
+    transcript = stitch(segments, results)
+    part_file = Path(f"{out_file}.part")
+    with part_file.open("w") as outfile:
+        json.dump(transcript.as_dict(), outfile)
+    os.replace(part_file, out_file)
+    return transcript
@@ -0,0 +1,568 @@
+"""Local HTTP stand-ins for the remote services, for offline tests and benchmarks"""
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from post_production.transfer import parse_content_range
+
+logger = logging.getLogger(__name__)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    server: "StandInHTTPServer"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.read_throttled(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        return self.read_throttled(int(self.headers.get("Content-Length", 0)))
+
+    def read_throttled(self, length: int) -> bytes:
+        rate = self.server.connection_rate
+        if not rate:
+            return self.rfile.read(length)
+        # Throttle uploads like responses, as a single slow TCP stream
+        step, chunks = max(1, int(rate / 20)), []
+        for start in range(0, length, step):
+            chunks.append(self.rfile.read(min(step, length - start)))
+            time.sleep(len(chunks[-1]) / rate)
+        return b"".join(chunks)
+
+    def send_bytes(self, status: int, body: bytes = b"", headers: dict = None):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        rate = self.server.connection_rate
+        if not rate:
+            self.wfile.write(body)
+            return
+        # Throttle each response like a single slow TCP stream
+        step = max(1, int(rate / 20))
+        for start in range(0, len(body), step):
+            self.wfile.write(body[start : start + step])
+            time.sleep(step / rate)
+
+    def injected_failure(self) -> bool:
+        if self.server.take_failure():
+            self.send_bytes(503, b"injected failure")
+            return True
+        return False
+
+    def do_PUT(self):
+        body = self.read_body()
+        if self.injected_failure():
+            return
+        path = urlsplit(self.path).path
+        content_range = self.headers.get("Content-Range")
+        if content_range:
+            start, end, total = parse_content_range(content_range)
+            self.server.write_range(path, start, body, total)
+        else:
+            self.server.files[path] = bytearray(body)
+        self.send_bytes(200)
+
+    def do_POST(self):
+        self.do_PUT()
+
+    def do_GET(self):
+        if self.injected_failure():
+            return
+        data = self.server.files.get(urlsplit(self.path).path)
+        if data is None:
+            self.send_bytes(404)
+            return
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Accept-Ranges": "bytes",
+            "ETag": self.server.etag(urlsplit(self.path).path, data),
+        }
+        requested = self.headers.get("Range")
+        if not requested or not self.server.ranges:
+            self.send_bytes(200, bytes(data), headers)
+            return
+        start, end = parse_range(requested, len(data))
+        if start >= len(data):
+            self.send_bytes(416, headers={"Content-Range": f"bytes */{len(data)}"})
+            return
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        self.send_bytes(206, bytes(data[start : end + 1]), headers)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+
+class StandInHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler=StandInHandler):
+        super().__init__(address, handler)
+        self.files: Dict[str, bytearray] = {}
+        self.failures = 0
+        self.error_rate = 0.0
+        self.latency = 0.0
+        self.ranges = True
+        self.connection_rate: Optional[float] = None
+        self._etags: Dict[tuple, str] = {}
+        self._lock = threading.Lock()
+        # Seeded, so runs with the same error rate fail the same requests
+        self._random = random.Random(0)
+
+    def handle_error(self, request, client_address):
+        # Clients hang up mid-response on purpose, e.g. after a Range probe
+        logger.debug(f"Request from {client_address} failed", exc_info=True)
+
+    def take_failure(self) -> bool:
+        with self._lock:
+            if self.failures > 0:
+                self.failures -= 1
+                return True
+            return self._random.random() < self.error_rate
+
+    def etag(self, path: str, data: bytearray) -> str:
+        key = (path, id(data), len(data))
+        with self._lock:
+            if key not in self._etags:
+                self._etags[key] = f'"{hashlib.md5(data).hexdigest()}"'
+            return self._etags[key]
+
+    def write_range(self, path: str, start: int, data: bytes, total: int):
+        with self._lock:
+            self._etags.clear()
+            buffer = self.files.setdefault(path, bytearray(total))
+            if len(buffer) < total:
+                buffer.extend(bytes(total - len(buffer)))
+            buffer[start : start + len(data)] = data
+
+
+def parse_range(header: str, size: int) -> Tuple[int, int]:
+    """Parse a single `bytes=start-end` Range header into inclusive offsets"""
+    start, _, end = header.split("=", 1)[1].split(",")[0].strip().partition("-")
+    if not start:
+        return max(0, size - int(end)), size - 1
+    return int(start), min(int(end), size - 1) if end else size - 1
+
+
+class StandInServer:
+    """Runs a stand-in HTTP server on a background thread
+
+    Files PUT or POSTed to any path are kept in memory, with `Content-Range`
+    parts written at their offsets, and can be fetched back with GET, whole
+    or by `Range`. Set `failures` to make the next requests fail with a 503,
+    `error_rate` to fail that fraction of requests, `latency` to delay every
+    response by that many seconds, `connection_rate` to cap each request and
+    response at that many bytes per second and `ranges` to False to ignore
+    Range headers.
+
+    Usage:
+        with StandInServer() as server:
+            ChunkedUpload(server.url("/media/episode.wav"), path).run()
+            assert server.files["/media/episode.wav"] == path.read_bytes()
+    """
+
+    handler = StandInHandler
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.httpd = StandInHTTPServer((host, port), self.handler)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def files(self) -> Dict[str, bytearray]:
+        return self.httpd.files
+
+    @property
+    def failures(self) -> int:
+        return self.httpd.failures
+
+    @failures.setter
+    def failures(self, count: int):
+        self.httpd.failures = count
+
+    @property
+    def error_rate(self) -> float:
+        return self.httpd.error_rate
+
+    @error_rate.setter
+    def error_rate(self, rate: float):
+        self.httpd.error_rate = rate
+
+    @property
+    def latency(self) -> float:
+        return self.httpd.latency
+
+    @latency.setter
+    def latency(self, seconds: float):
+        self.httpd.latency = seconds
+
+    @property
+    def connection_rate(self) -> Optional[float]:
+        return self.httpd.connection_rate
+
+    @connection_rate.setter
+    def connection_rate(self, bytes_per_second: Optional[float]):
+        self.httpd.connection_rate = bytes_per_second
+
+    @property
+    def ranges(self) -> bool:
+        return self.httpd.ranges
+
+    @ranges.setter
+    def ranges(self, enabled: bool):
+        self.httpd.ranges = enabled
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, path: str) -> str:
+        return self.base_url + path
+
+    def start(self) -> "StandInServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self) -> "StandInServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+@dataclass
+class FakeJob:
+    job_id: str
+    kind: str
+    body: dict
+    created: float
+    duration: float
+    webhook_url: Optional[str] = None
+    failed: bool = False
+
+    def progress(self) -> int:
+        elapsed = time.monotonic() - self.created
+        if self.duration <= 0:
+            return 100
+        return min(100, int(elapsed / self.duration * 100))
+
+
+class FakeProviderHandler(StandInHandler):
+    server: "FakeProviderHTTPServer"
+
+    def send_json(self, data, status: int = 200):
+        body = json.dumps(data).encode()
+        self.send_bytes(status, body, {"Content-Type": "application/json"})
+
+    def over_quota(self) -> bool:
+        wait = self.server.take_quota()
+        if wait is None:
+            return False
+        # Fractions of a second, which real APIs round up, keep tests fast
+        self.send_bytes(429, b"rate limit exceeded", {"Retry-After": f"{wait:.3f}"})
+        return True
+
+    def json_body(self) -> dict:
+        body = self.read_body()
+        return json.loads(body) if body else {}
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        if path.startswith("/storage/"):
+            return super().do_PUT()
+        if path == "/v2/upload":
+            body = self.read_body()
+            if self.injected_failure() or self.over_quota():
+                return
+            upload_path = f"/storage/upload/{uuid.uuid4()}"
+            self.server.files[upload_path] = bytearray(body)
+            return self.send_json({"upload_url": self.server.url(upload_path)})
+
+        body = self.json_body()
+        if self.injected_failure() or self.over_quota():
+            return
+        if path == "/media/input":
+            storage = "/storage/" + body["url"][len("dlb://") :]
+            # Signed anew for every request, like S3 pre-signed urls
+            signature = (
+                f"?X-Amz-Date={time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}"
+                f"&X-Amz-Expires=3600&X-Amz-Signature={uuid.uuid4().hex}"
+            )
+            return self.send_json({"url": self.server.url(storage) + signature})
+        if path in DOLBY_JOBS:
+            job = self.server.create_job(
+                path, body, body.get("on_complete", {}).get("url")
+            )
+            return self.send_json({"job_id": job.job_id})
+        if path == "/v2/transcript":
+            job = self.server.create_job(path, body, body.get("webhook_url"))
+            return self.send_json(self.server.transcript(job))
+        self.send_bytes(404)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if parts.path.startswith("/storage/"):
+            return super().do_GET()
+        if self.injected_failure() or self.over_quota():
+            return
+        if parts.path in DOLBY_JOBS:
+            job = self.server.jobs.get(query.get("job_id", [""])[0])
+            if not job:
+                return self.send_bytes(404)
+            progress = job.progress()
+            status = "Running"
+            if progress >= 100:
+                status = "Failed" if job.failed else "Success"
+            return self.send_json(
+                {"path": parts.path, "status": status, "progress": progress}
+            )
+        if parts.path == "/media/output":
+            storage = "/storage/" + query["url"][0][len("dlb://") :]
+            return self.send_bytes(302, headers={"Location": self.server.url(storage)})
+        if parts.path.startswith("/v2/transcript/"):
+            job = self.server.jobs.get(parts.path.rsplit("/", 1)[-1])
+            if not job:
+                return self.send_bytes(404)
+            return self.send_json(self.server.transcript(job))
+        self.send_bytes(404)
+
+
+DOLBY_JOBS = {"/media/enhance", "/media/analyze", "/media/analyze/speech"}
+
+
+class FakeProviderHTTPServer(StandInHTTPServer):
+    def __init__(self, address, handler=FakeProviderHandler):
+        super().__init__(address, handler)
+        self.jobs: Dict[str, FakeJob] = {}
+        self.job_duration = 0.5
+        self.fail_jobs = False
+        self.callbacks_sent = 0
+        self.rate_limit: Optional[float] = None
+        self.throttled = 0
+        self._quota = 0.0
+        self._quota_time = time.monotonic()
+
+    def take_quota(self) -> Optional[float]:
+        """None if an API request is within the rate limit, else the seconds
+        until it would be"""
+        if not self.rate_limit:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            # A bucket of one second's worth of requests
+            self._quota = min(
+                self.rate_limit,
+                self._quota + (now - self._quota_time) * self.rate_limit,
+            )
+            self._quota_time = now
+            if self._quota >= 1:
+                self._quota -= 1
+                return None
+            self.throttled += 1
+            return (1 - self._quota) / self.rate_limit
+
+    def url(self, path: str) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def create_job(self, kind: str, body: dict, webhook_url: Optional[str]) -> FakeJob:
+        job = FakeJob(
+            str(uuid.uuid4()), kind, body, time.monotonic(), self.job_duration
+        )
+        job.webhook_url = webhook_url
+        job.failed = self.fail_jobs
+        with self._lock:
+            self.jobs[job.job_id] = job
+        timer = threading.Timer(job.duration, self.finish_job, args=(job,))
+        timer.daemon = True
+        timer.start()
+        return job
+
+    def finish_job(self, job: FakeJob):
+        if job.failed:
+            payload = {"job_id": job.job_id, "transcript_id": job.job_id}
+            payload["status"] = "Failed" if job.kind in DOLBY_JOBS else "error"
+        elif job.kind in DOLBY_JOBS:
+            source = self.files.get("/storage/" + job.body["input"][len("dlb://") :])
+            output = "/storage/" + job.body["output"][len("dlb://") :]
+            if job.kind == "/media/enhance":
+                self.files[output] = bytearray(source or b"")
+            else:
+                report = {"audio": {"loudness": {"measured": -23.0}}}
+                self.files[output] = bytearray(json.dumps(report).encode())
+            payload = {"job_id": job.job_id, "status": "Success"}
+        else:
+            payload = {"transcript_id": job.job_id, "status": "completed"}
+
+        if job.webhook_url:
+            request = urllib.request.Request(
+                job.webhook_url,
+                data=json.dumps(payload).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+                self.callbacks_sent += 1
+            except OSError as e:
+                logger.warning(f"Callback to {job.webhook_url} failed: {e}")
+
+    def transcript(self, job: FakeJob) -> dict:
+        progress = job.progress()
+        response = {
+            "id": job.job_id,
+            "status": "processing",
+            "audio_url": job.body.get("audio_url"),
+            "speaker_labels": job.body.get("speaker_labels"),
+            "word_boost": job.body.get("word_boost"),
+            "webhook_url": job.webhook_url,
+            "text": None,
+            "words": None,
+            "utterances": None,
+        }
+        if progress < 100:
+            return response
+        if job.failed:
+            response.update(status="error", error="Audio file is corrupt")
+            return response
+        words = [
+            {
+                "text": "Welcome",
+                "start": 0,
+                "end": 500,
+                "confidence": 0.98,
+                "speaker": "A",
+            },
+            {
+                "text": "back.",
+                "start": 500,
+                "end": 900,
+                "confidence": 0.97,
+                "speaker": "A",
+            },
+            {
+                "text": "Thanks",
+                "start": 1200,
+                "end": 1600,
+                "confidence": 0.95,
+                "speaker": "B",
+            },
+            {
+                "text": "Sean.",
+                "start": 1600,
+                "end": 2000,
+                "confidence": 0.91,
+                "speaker": "B",
+            },
+        ]
+        utterances = [
+            {
+                "speaker": speaker,
+                "text": " ".join(w["text"] for w in spoken),
+                "start": spoken[0]["start"],
+                "end": spoken[-1]["end"],
+                "confidence": sum(w["confidence"] for w in spoken) / len(spoken),
+                "words": spoken,
+            }
+            for speaker, spoken in (("A", words[:2]), ("B", words[2:]))
+        ]
+        response.update(
+            status="completed",
+            text=" ".join(w["text"] for w in words),
+            words=words,
+            utterances=utterances,
+            audio_duration=2,
+        )
+        return response
+
+
+class FakeProviderServer(StandInServer):
+    """A stand-in for the Dolby.io Media and AssemblyAI APIs
+
+    Implements the endpoints DolbyIO and AssemblyAI call. Jobs finish after
+    `job_duration` seconds and then POST to their webhook url, if they have one.
+    With a `rate_limit`, API requests beyond that many per second get a 429
+    with a Retry-After, and are counted in `throttled`. Jobs created while
+    `fail_jobs` is set end as failed.
+
+    Usage:
+        with FakeProviderServer() as server:
+            dolby = DolbyIO("key")
+            dolby.api_endpoint = server.url("/media")
+            assembly = AssemblyAI("key")
+            assembly.api_endpoint = server.url("/v2")
+    """
+
+    handler = FakeProviderHandler
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.httpd = FakeProviderHTTPServer((host, port), self.handler)
+        self._thread = None
+
+    @property
+    def jobs(self) -> Dict[str, FakeJob]:
+        return self.httpd.jobs
+
+    @property
+    def job_duration(self) -> float:
+        return self.httpd.job_duration
+
+    @job_duration.setter
+    def job_duration(self, seconds: float):
+        self.httpd.job_duration = seconds
+
+    @property
+    def fail_jobs(self) -> bool:
+        return self.httpd.fail_jobs
+
+    @fail_jobs.setter
+    def fail_jobs(self, fail: bool):
+        self.httpd.fail_jobs = fail
+
+    @property
+    def callbacks_sent(self) -> int:
+        return self.httpd.callbacks_sent
+
+    @property
+    def rate_limit(self) -> Optional[float]:
+        return self.httpd.rate_limit
+
+    @rate_limit.setter
+    def rate_limit(self, requests_per_second: Optional[float]):
+        self.httpd.rate_limit = requests_per_second
+
+    @property
+    def throttled(self) -> int:
+        return self.httpd.throttled
@@ -1,13 +1,53 @@
 import logging
+import tempfile
+import time
+from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, Iterator, List, Optional
 
 import ffmpeg
 import typer
+from tabulate import tabulate
+
+from post_production.metrics import metrics
+from post_production.parallel_encoding import encode_parallel, parallel_codec
+from post_production.render_cache import RenderCache
 
 logger = logging.getLogger(__name__)
 
 
+class Rendition(str, Enum):
+    master = "master"
+    mobile = "mobile"
+    opus = "opus"
+    aac = "aac"
+    transcription = "transcription"
+
+
+@dataclass
+class RenditionProfile:
+    suffix: str
+    options: Dict[str, Any]
+
+
+RENDITION_PROFILES = {
+    Rendition.master: RenditionProfile(".mp3", {"ac": 1, "ab": "160k", "f": "mp3"}),
+    Rendition.mobile: RenditionProfile(
+        ".mp3", {"ac": 1, "ab": "64k", "ar": 22050, "f": "mp3"}
+    ),
+    Rendition.opus: RenditionProfile(
+        ".opus", {"ac": 1, "ab": "48k", "acodec": "libopus", "f": "opus"}
+    ),
+    Rendition.aac: RenditionProfile(
+        ".m4a", {"ac": 1, "ab": "96k", "acodec": "aac", "f": "ipod"}
+    ),
+    Rendition.transcription: RenditionProfile(
+        ".wav", {"ac": 1, "ar": 16000, "acodec": "pcm_s16le", "f": "wav"}
+    ),
+}
+
+
 def transcode(
     input_file: Path = typer.Argument(..., exists=True),
     output_file: Optional[Path] = typer.Option(
@@ -19,24 +59,161 @@ def transcode(
     outro_music: Optional[Path] = typer.Option(
         None, exists=True, help="Outro music to add after file."
     ),
+    cache: bool = typer.Option(
+        True, help="Reuse loudness-normalized intro and outro renders."
+    ),
+    rendition: List[Rendition] = typer.Option(
+        [Rendition.master.value],
+        help="Renditions to encode from one decode of the episode. Repeatable.",
+    ),
+    jobs: int = typer.Option(
+        1,
+        min=1,
+        help="Encode MP3 and AAC renditions in this many parts at once, each by "
+        "its own ffmpeg.",
+    ),
 ):
-    main_episode = ffmpeg.input(input_file)
+    """Add intro and outro music to an episode and encode it with ffmpeg."""
+    with tempfile.TemporaryDirectory() as tmp:
+        # Without the cache, renders are still two-pass but thrown away after
+        renders = RenderCache() if cache else RenderCache(Path(tmp), max_bytes=None)
+        start = time.monotonic()
+        outputs = _transcode(
+            input_file,
+            output_file,
+            intro_music,
+            outro_music,
+            renders,
+            rendition,
+            jobs=jobs,
+        )
+    elapsed = time.monotonic() - start
+    rows = [
+        (name.value, path, f"{path.stat().st_size / 1e6:.1f} MB")
+        for name, path in outputs.items()
+    ]
+    typer.echo(tabulate(rows, headers=["Rendition", "File", "Size"]))
+    typer.echo(f"Encoded {len(outputs)} renditions from one decode in {elapsed:.1f}s")
+
+
+def _transcode(
+    input_file: Path,
+    output_file: Optional[Path],
+    intro_music: Optional[Path],
+    outro_music: Optional[Path],
+    renders: RenderCache,
+    renditions: List[Rendition] = (Rendition.master,),
+    overwrite: bool = False,
+    quiet: bool = False,
+    jobs: int = 1,
+) -> Dict[Rendition, Path]:
+    main_episode = ffmpeg.input(str(input_file))
     if intro_music:
         logger.info(f"Adding intro music from {intro_music}")
-        intro = ffmpeg.input(intro_music).filter("loudnorm", i=-23, dual_mono="true")
+        intro = ffmpeg.input(str(renders.render(intro_music)))
         main_episode = ffmpeg.filter(
             [intro, main_episode], "acrossfade", d=4, c1="tri", c2="nofade"
         )
     if outro_music:
         logger.info(f"Adding outro music from {outro_music}")
-        outro = ffmpeg.input(outro_music).filter("loudnorm", i=-23, dual_mono="true")
+        outro = ffmpeg.input(str(renders.render(outro_music)))
         main_episode = ffmpeg.filter(
             [main_episode, outro], "acrossfade", d=1, c1="nofade", c2="tri"
         )
     if output_file:
         output_path = Path(output_file)
     else:
-        output_path = Path(input_file).stem + ".mp3"
+        output_path = Path(Path(input_file).stem + ".mp3")
+
+    renditions = list(dict.fromkeys(Rendition(r) for r in renditions))
+    paths = {r: rendition_path(output_path, r) for r in renditions}
+    split = [
+        r
+        for r in renditions
+        if jobs > 1 and parallel_codec(RENDITION_PROFILES[r].options)
+    ]
+    with tempfile.TemporaryDirectory(
+        dir=output_path.parent, prefix=".transcode-"
+    ) as tmp:
+        # Renditions encoded in parts get the mix as float wav instead, one
+        # for each channel count and sample rate they need
+        targets = {paths[r]: RENDITION_PROFILES[r].options for r in renditions}
+        mixes = {}
+        for r in split:
+            pcm_options = {
+                k: v
+                for k, v in RENDITION_PROFILES[r].options.items()
+                if k in ("ac", "ar")
+            }
+            name = "-".join(f"{k}{v}" for k, v in sorted(pcm_options.items()))
+            mixes[r] = Path(tmp) / f"mix-{name}.wav"
+            del targets[paths[r]]
+            targets[mixes[r]] = dict(pcm_options, acodec="pcm_f32le", f="wav")
+
+        # The mix is decoded once and asplit hands a copy to every encoder
+        if len(targets) > 1:
+            mix = main_episode.filter_multi_output("asplit", len(targets))
+            streams = [mix[i] for i in range(len(targets))]
+        else:
+            streams = [main_episode]
+        outputs = [
+            stream.output(str(path), **options)
+            for stream, (path, options) in zip(streams, targets.items())
+        ]
+        logger.info(
+            f"Processing file and writing to {', '.join(map(str, paths.values()))}"
+        )
+        with metrics.stage("transcode", file=Path(input_file).name) as stage:
+            ffmpeg.merge_outputs(*outputs).run(overwrite_output=overwrite, quiet=quiet)
+            for r in split:
+                options = {
+                    k: v
+                    for k, v in RENDITION_PROFILES[r].options.items()
+                    if k not in ("ac", "ar")
+                }
+                stage["parts"] = encode_parallel(
+                    mixes[r], paths[r], options, jobs, Path(tmp), overwrite
+                )
+            stage["bytes"] = sum(p.stat().st_size for p in paths.values())
+    return paths
+
+
+def rendition_path(output_path: Path, rendition: Rendition) -> Path:
+    """The master goes to output_path, other renditions sit next to it"""
+    if rendition == Rendition.master:
+        return output_path
+    suffix = RENDITION_PROFILES[rendition].suffix
+    return output_path.with_name(f"{output_path.stem} - {rendition.value}{suffix}")
+
+
+def encode_stream(
+    input_file: Path,
+    options: Dict[str, Any],
+    chunk_size: int = 65536,
+    input_options: Optional[Dict[str, Any]] = None,
+) -> Iterator[bytes]:
+    """Encode a file with ffmpeg and yield the output as it is produced
 
-    logger.info(f"Processing file and writing to {output_path}")
-    main_episode.output(str(output_path), ac=1, ab="160k", f="mp3").run()
+    Nothing is written to disk, so the output can go straight into a request
+    body while ffmpeg is still encoding. The format in options must be one
+    that can be written to a pipe. Input options such as ss and t select a
+    part of the file. Raises ffmpeg.Error if ffmpeg fails.
+    """
+    process = (
+        ffmpeg.input(str(input_file), **(input_options or {}))
+        .output("pipe:", **options)
+        .global_args("-nostdin", "-loglevel", "error")
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+    try:
+        for chunk in iter(lambda: process.stdout.read(chunk_size), b""):
+            yield chunk
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.wait()
+    if process.returncode:
+        raise ffmpeg.Error("ffmpeg", b"", stderr)
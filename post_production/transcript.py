@@ -0,0 +1,558 @@
+import bisect
+import codecs
+import json
+import re
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+NO_SPEAKER = -1
+
+# Response fields whose items are parsed one at a time
+STREAMED_FIELDS = ("words", "utterances")
+SUMMARY_FIELDS = ("id", "status", "text", "audio_duration", "confidence")
+STREAM_CHUNK_SIZE = 65536
+
+WHITESPACE = " \t\r\n"
+# Characters that can follow a complete value
+ENDS = WHITESPACE + ",:]}"
+
+# Unrolled so that every input matches one way, which keeps failures linear
+STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+PLAIN = r'[^\[\]{}"]*'
+FLAT_OBJECT = rf"\{{{PLAIN}(?:{STRING}{PLAIN})*\}}"
+# Scalars, strings and objects without nesting, skipped in one regex match
+FLAT_RUN = re.compile(rf"{PLAIN}(?:(?:{STRING}|{FLAT_OBJECT}){PLAIN})*")
+
+START, KEY, COLON, VALUE, ITEMS, SKIP, DONE = range(7)
+_INCOMPLETE = object()
+
+
+class StringTable:
+    """Many short strings kept as one str and an array of offsets into it"""
+
+    __slots__ = ("_text", "_pending", "_offsets")
+
+    def __init__(self):
+        self._text = ""
+        self._pending: List[str] = []
+        self._offsets = array("q", [0])
+
+    def append(self, value: str) -> int:
+        self._pending.append(value)
+        self._offsets.append(self._offsets[-1] + len(value))
+        return len(self._offsets) - 2
+
+    def __getitem__(self, index: int) -> str:
+        if self._pending:
+            self._text += "".join(self._pending)
+            self._pending.clear()
+        return self._text[self._offsets[index] : self._offsets[index + 1]]
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+
+class Columns:
+    """Parallel arrays holding one row per word or utterance
+
+    Times are milliseconds, speakers are codes into `labels` and text is an
+    index into a string table shared with the rest of the transcript.
+    Rows are expected in start order, as AssemblyAI returns them.
+    """
+
+    __slots__ = ("table", "labels", "start", "end", "confidence", "speaker", "text")
+
+    def __init__(self, table: StringTable, labels: List[str]):
+        self.table = table
+        self.labels = labels
+        self.start = array("i")
+        self.end = array("i")
+        self.confidence = array("f")
+        self.speaker = array("h")
+        self.text = array("i")
+
+    def append(self, text: str, start: int, end: int, confidence: float, code: int):
+        self.text.append(self.table.append(text))
+        self.start.append(start)
+        self.end.append(end)
+        self.confidence.append(confidence)
+        self.speaker.append(code)
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+
+class UtteranceColumns(Columns):
+    """Columns for utterances, which also record the range of their words"""
+
+    __slots__ = ("first_word", "last_word")
+
+    def __init__(self, table: StringTable, labels: List[str]):
+        super().__init__(table, labels)
+        self.first_word = array("i")
+        self.last_word = array("i")
+
+
+class Word(Mapping):
+    """A lazy view of one row, readable like the dict AssemblyAI returned"""
+
+    __slots__ = ("_columns", "_index")
+    _keys = ("text", "start", "end", "confidence", "speaker")
+
+    def __init__(self, columns: Columns, index: int):
+        self._columns = columns
+        self._index = index
+
+    @property
+    def text(self) -> str:
+        return self._columns.table[self._columns.text[self._index]]
+
+    @property
+    def start(self) -> int:
+        return self._columns.start[self._index]
+
+    @property
+    def end(self) -> int:
+        return self._columns.end[self._index]
+
+    @property
+    def confidence(self) -> float:
+        # Undo the float32 rounding of the stored value
+        return round(self._columns.confidence[self._index], 6)
+
+    @property
+    def speaker(self) -> Optional[str]:
+        code = self._columns.speaker[self._index]
+        return None if code == NO_SPEAKER else self._columns.labels[code]
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self)!r})"
+
+
+class Utterance(Word):
+    __slots__ = ("_words",)
+    _keys = Word._keys + ("words",)
+
+    def __init__(self, columns: UtteranceColumns, index: int, words: Columns):
+        super().__init__(columns, index)
+        self._words = words
+
+    @property
+    def words(self) -> "Rows":
+        first = self._columns.first_word[self._index]
+        last = self._columns.last_word[self._index]
+        return Rows(self._words, first, last, Word)
+
+
+class Rows(Sequence):
+    """A lazy, sliceable sequence of words or utterances"""
+
+    __slots__ = ("_columns", "_lo", "_hi", "_view")
+
+    def __init__(
+        self,
+        columns: Columns,
+        lo: int,
+        hi: int,
+        view: Callable[[Columns, int], Word],
+    ):
+        self._columns = columns
+        self._lo = lo
+        self._hi = hi
+        self._view = view
+
+    def __len__(self) -> int:
+        return self._hi - self._lo
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            stop = max(start, stop)
+            return Rows(self._columns, self._lo + start, self._lo + stop, self._view)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return self._view(self._columns, self._lo + index)
+
+    def __iter__(self) -> Iterator[Word]:
+        columns, view = self._columns, self._view
+        return (view(columns, i) for i in range(self._lo, self._hi))
+
+    def column(self, name: str) -> array:
+        """A copy of one column for these rows, for fast bulk work
+
+        `name` is one of start, end, confidence or speaker. Speakers come back
+        as codes into `TranscriptResult.speaker_ids`, or -1 for none.
+        """
+        if name not in ("start", "end", "confidence", "speaker"):
+            raise ValueError(f"No column named {name!r}")
+        return getattr(self._columns, name)[self._lo : self._hi]
+
+    def between(self, start: int, end: int) -> "Rows":
+        """Rows that overlap the time range [start, end) in milliseconds"""
+        columns = self._columns
+        # Rows are in order and do not overlap, so their ends are sorted too
+        lo = bisect.bisect_right(columns.end, start, self._lo, self._hi)
+        hi = bisect.bisect_left(columns.start, end, lo, self._hi)
+        return Rows(columns, lo, hi, self._view)
+
+    def text(self) -> str:
+        columns = self._columns
+        return " ".join(
+            columns.table[columns.text[i]] for i in range(self._lo, self._hi)
+        )
+
+
+class TranscriptParser:
+    """Incremental parser for an AssemblyAI transcript response
+
+    Feed it the body a chunk at a time. Top-level fields come out as
+    (key, value) pairs once they are complete. The items of `words` and
+    `utterances` come out one at a time under their field name, so memory
+    use depends on the size of one item rather than the whole transcript.
+
+    Fields named in `skip` are scanned past without being decoded, which is
+    much cheaper when a consumer only needs, say, the utterances.
+
+    Usage:
+        parser = TranscriptParser(skip=("words",))
+        for chunk in response.iter_content(65536):
+            for key, value in parser.feed(chunk):
+                ...
+        for key, value in parser.close():
+            ...
+    """
+
+    def __init__(self, skip: Iterable[str] = ()):
+        self.skip = frozenset(skip)
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._state = START
+        self._key: Optional[str] = None
+        self._depth = 0
+
+    def feed(self, chunk: bytes) -> Iterator[Tuple[str, Any]]:
+        self._buffer = self._buffer[self._pos :] + self._utf8.decode(chunk)
+        self._pos = 0
+        return self._parse(final=False)
+
+    def close(self) -> Iterator[Tuple[str, Any]]:
+        self._buffer = self._buffer[self._pos :] + self._utf8.decode(b"", final=True)
+        self._pos = 0
+        yield from self._parse(final=True)
+        if self._state != DONE:
+            raise ValueError("Transcript response ended early")
+
+    def _parse(self, final: bool) -> Iterator[Tuple[str, Any]]:
+        buffer = self._buffer
+        while True:
+            while self._pos < len(buffer) and buffer[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos == len(buffer):
+                return
+            char = buffer[self._pos]
+
+            if self._state == START:
+                self._expect(char, "{", KEY)
+            elif self._state == KEY:
+                if char == "}":
+                    self._expect(char, "}", DONE)
+                elif char == ",":
+                    self._pos += 1
+                else:
+                    key = self._value(final)
+                    if key is _INCOMPLETE:
+                        return
+                    self._key = key
+                    self._state = COLON
+            elif self._state == COLON:
+                self._expect(char, ":", VALUE)
+            elif self._state == VALUE and char in "[{" and self._key in self.skip:
+                self._expect(char, char, SKIP)
+                self._depth = 1
+            elif self._state == SKIP:
+                if not self._skip():
+                    return
+                self._state = KEY
+            elif self._state == VALUE and char == "[" and self._key in STREAMED_FIELDS:
+                self._expect(char, "[", ITEMS)
+            elif self._state == VALUE:
+                value = self._value(final)
+                if value is _INCOMPLETE:
+                    return
+                self._state = KEY
+                if self._key not in self.skip:
+                    yield self._key, value
+            elif self._state == ITEMS:
+                if char == "]":
+                    self._expect(char, "]", KEY)
+                elif char == ",":
+                    self._pos += 1
+                else:
+                    value = self._value(final)
+                    if value is _INCOMPLETE:
+                        return
+                    yield self._key, value
+            else:
+                raise ValueError(f"Unexpected {char!r} after the transcript")
+
+    def _expect(self, char: str, expected: str, state: int):
+        if char != expected:
+            raise ValueError(f"Expected {expected!r} but found {char!r}")
+        self._pos += 1
+        self._state = state
+
+    def _skip(self) -> bool:
+        """Scan to the end of a skipped array or object, False if it continues"""
+        buffer = self._buffer
+        while True:
+            self._pos = FLAT_RUN.match(buffer, self._pos).end()
+            if self._pos == len(buffer):
+                return False
+            char = buffer[self._pos]
+            if char == '"':
+                # A string cut off by the end of the chunk
+                return False
+            self._pos += 1
+            if char in "[{":
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if not self._depth:
+                    return True
+
+    def _value(self, final: bool) -> Any:
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return _INCOMPLETE
+        if not final and (end == len(self._buffer) or self._buffer[end] not in ENDS):
+            # A number cut off by the chunk, like "0." or "12", may continue
+            return _INCOMPLETE
+        self._pos = end
+        return value
+
+
+def iter_transcript(
+    chunks: Iterable[bytes], skip: Iterable[str] = ()
+) -> Iterator[Tuple[str, Any]]:
+    """Parse a transcript response from chunks of its body, see TranscriptParser"""
+    parser = TranscriptParser(skip)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def iter_txt(
+    utterances: Iterable[Mapping], speaker_name: Callable[[Mapping], Optional[str]]
+) -> Iterator[str]:
+    """Plain-text transcript pieces, one per utterance, as they become available"""
+    for i, utterance in enumerate(utterances):
+        separator = "\n" if i else ""
+        yield f"{separator}{speaker_name(utterance)}:\n{utterance.get('text')}\n"
+
+
+class TranscriptResult:
+    """A finished AssemblyAI transcript stored column-wise
+
+    Words and utterances are kept in typed arrays rather than one dict per
+    word, which takes a fraction of the memory for a long episode. `words`
+    and `utterances` are lazy views that read like the original lists of
+    dicts. Other fields of the response are available as attributes.
+
+    Usage:
+        transcript = TranscriptResult(**client.result(job_id))
+        for utterance in transcript.utterances.between(60_000, 120_000):
+            print(utterance["speaker"], utterance["text"])
+    """
+
+    __slots__ = (
+        "id",
+        "status",
+        "text",
+        "audio_duration",
+        "confidence",
+        "speakers",
+        "extra",
+        "_table",
+        "_labels",
+        "_codes",
+        "_words",
+        "_utterances",
+    )
+
+    def __init__(
+        self,
+        id: Optional[str] = None,
+        status: Optional[str] = None,
+        text: Optional[str] = None,
+        audio_duration: Optional[float] = None,
+        confidence: Optional[float] = None,
+        words: Optional[Iterable[Dict[str, Any]]] = None,
+        utterances: Optional[Iterable[Dict[str, Any]]] = None,
+        **extra,
+    ):
+        self.id = id
+        self.status = status
+        self.text = text
+        self.audio_duration = audio_duration
+        self.confidence = confidence
+        self.extra = extra
+        self.speakers: Dict[Optional[str], str] = {}
+
+        self._table = StringTable()
+        self._labels: List[str] = []
+        self._codes: Dict[str, int] = {}
+        self._words = Columns(self._table, self._labels)
+        self._utterances = UtteranceColumns(self._table, self._labels)
+        for word in words or ():
+            self.add_word(word)
+        # Without top-level words, take them from the utterances instead
+        with_words = not self._words
+        for utterance in utterances or ():
+            self.add_utterance(utterance, with_words)
+
+    @classmethod
+    def from_events(cls, events: Iterable[Tuple[str, Any]]) -> "TranscriptResult":
+        """Build a transcript from parsed (key, value) pairs, see iter_transcript"""
+        transcript = cls()
+        with_words = None
+        for key, value in events:
+            if key == "words" and isinstance(value, dict):
+                if not with_words:
+                    transcript.add_word(value)
+            elif key == "utterances" and isinstance(value, dict):
+                if with_words is None:
+                    with_words = not transcript._words
+                transcript.add_utterance(value, with_words)
+            elif key in SUMMARY_FIELDS:
+                setattr(transcript, key, value)
+            elif key not in STREAMED_FIELDS:
+                transcript.extra[key] = value
+        return transcript
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "extra":
+            raise AttributeError(name)
+        try:
+            return self.extra[name]
+        except KeyError:
+            raise AttributeError(
+                f"{type(self).__name__!r} object has no attribute {name!r}"
+            ) from None
+
+    @property
+    def words(self) -> Rows:
+        return Rows(self._words, 0, len(self._words), Word)
+
+    @property
+    def utterances(self) -> Rows:
+        return Rows(self._utterances, 0, len(self._utterances), self._utterance)
+
+    @property
+    def speaker_ids(self) -> List[str]:
+        """Speaker labels in the order they first speak"""
+        return list(self._labels)
+
+    def add_word(self, word: Dict[str, Any]):
+        self._words.append(
+            word.get("text") or "",
+            word["start"],
+            word["end"],
+            word.get("confidence") or 0.0,
+            self._speaker_code(word.get("speaker")),
+        )
+
+    def add_utterance(self, utterance: Dict[str, Any], with_words: bool = False):
+        """Add an utterance, after its words if they were added separately"""
+        words = self._words
+        if with_words:
+            first = len(words)
+            for word in utterance.get("words") or ():
+                self.add_word(word)
+            last = len(words)
+        else:
+            first = bisect.bisect_left(words.start, utterance["start"])
+            last = bisect.bisect_left(words.start, utterance["end"], first)
+        self._utterances.append(
+            utterance.get("text") or "",
+            utterance["start"],
+            utterance["end"],
+            utterance.get("confidence") or 0.0,
+            self._speaker_code(utterance.get("speaker")),
+        )
+        self._utterances.first_word.append(first)
+        self._utterances.last_word.append(last)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """The transcript in the shape AssemblyAI returns it, e.g. to save as json"""
+        return {
+            "id": self.id,
+            "status": self.status,
+            "text": self.text,
+            "audio_duration": self.audio_duration,
+            "confidence": self.confidence,
+            **self.extra,
+            "words": [dict(word) for word in self.words],
+            "utterances": [
+                {**utterance, "words": [dict(word) for word in utterance.words]}
+                for utterance in self.utterances
+            ],
+        }
+
+    def as_txt(self, prompt_speaker_labels: bool = True):
+        if prompt_speaker_labels:
+            speaker_name = self.get_speaker
+        else:
+            speaker_name = lambda utterance: utterance.get("speaker")
+        return "".join(iter_txt(self.utterances, speaker_name))
+
+    def get_speaker(self, utterance) -> str:
+        speaker = utterance.get("speaker")
+        speaker_name = self.speakers.get(speaker)
+        if not speaker_name:
+            print(f"Speaker {speaker} not found for {utterance.get('text')}")
+            speaker_name = input("Enter speaker label for this section: ")
+            self.speakers[speaker] = speaker_name
+        return speaker_name
+
+    def _utterance(self, columns: UtteranceColumns, index: int) -> Utterance:
+        return Utterance(columns, index, self._words)
+
+    def _speaker_code(self, speaker: Optional[str]) -> int:
+        if speaker is None:
+            return NO_SPEAKER
+        code = self._codes.get(speaker)
+        if code is None:
+            code = self._codes[speaker] = len(self._labels)
+            self._labels.append(speaker)
+        return code
@@ -0,0 +1,508 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional, Set
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 8388608
+DEFAULT_WORKERS = 4
+# Progress of interrupted uploads, kept away from the files being uploaded
+DEFAULT_UPLOAD_STATE_PATH = Path.home() / ".cache" / "post-production" / "uploads"
+# How long a pre-signed url that does not say when it expires is trusted
+PRESIGNED_URL_TTL = 3600
+# Not worth resuming with a url that expires sooner than this
+URL_EXPIRY_MARGIN = 300
+
+
+@dataclass
+class TransferStats:
+    total_bytes: int
+    transferred_bytes: int
+    resumed_bytes: int
+    seconds: float
+    retries: int = 0
+
+    @property
+    def bytes_per_second(self) -> float:
+        if self.seconds <= 0:
+            return 0.0
+        return self.transferred_bytes / self.seconds
+
+
+def pooled_session(
+    workers: int = DEFAULT_WORKERS, session: Optional[requests.Session] = None
+) -> requests.Session:
+    """Mount connection pools large enough for `workers` concurrent requests
+
+    Call it when the session is built. Mounting replaces the adapters, and the
+    connections other threads are using with them, so a session whose pools
+    are already large enough is left alone.
+    """
+    session = session or requests.Session()
+    if all(pool_size(session, prefix) >= workers for prefix in ("http://", "https://")):
+        return session
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def pool_size(session: requests.Session, prefix: str) -> int:
+    """How many connections per host the session keeps for urls under `prefix`"""
+    return getattr(session.adapters.get(prefix), "_pool_maxsize", 0)
+
+
+def sidecar_path(file_path: Path, suffix: str) -> Path:
+    return file_path.with_name(file_path.name + suffix)
+
+
+def upload_state_dir() -> Path:
+    return Path(os.environ.get("TPPP_UPLOAD_STATE") or DEFAULT_UPLOAD_STATE_PATH)
+
+
+def url_expires_at(url: str, issued_at: float) -> float:
+    """When a pre-signed url stops working, from its signature parameters if it has them"""
+    query = parse_qs(urlsplit(url).query)
+    if "X-Amz-Expires" in query:
+        if "X-Amz-Date" in query:
+            signed = datetime.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ")
+            issued_at = signed.replace(tzinfo=timezone.utc).timestamp()
+        return issued_at + int(query["X-Amz-Expires"][0])
+    if "Expires" in query:
+        return float(query["Expires"][0])
+    return issued_at + PRESIGNED_URL_TTL
+
+
+class ChunkedUpload:
+    """Uploads a file as byte ranges in parallel, resuming from a saved state file
+
+    Every part is sent as its own request with a `Content-Range` header, so a
+    failed part can be retried without touching the rest of the file. Finished
+    part numbers are recorded under the cache folder, keyed by the file and
+    its `destination`, and skipped when the same file is uploaded there again
+    with the same url. Pre-signed urls change with every request for one, so
+    the url is saved too and `saved_url` hands it back until it expires.
+    `destination` defaults to the url itself.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        file_path: Path,
+        session: Optional[requests.Session] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        workers: int = DEFAULT_WORKERS,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        method: str = "PUT",
+        destination: Optional[str] = None,
+        state_dir: Optional[Path] = None,
+    ):
+        self.url = url
+        self.file_path = Path(file_path)
+        self.session = session or pooled_session(workers)
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.method = method
+        self.destination = destination or url
+        self.state_path = upload_state_path(self.file_path, self.destination, state_dir)
+
+        self.size = self.file_path.stat().st_size
+        self._issued_at = time.time()
+        self._lock = threading.Lock()
+        self._completed: Set[int] = set()
+        self._retries = 0
+
+    @staticmethod
+    def saved_url(
+        file_path: Path,
+        destination: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        state_dir: Optional[Path] = None,
+    ) -> Optional[str]:
+        """The url an interrupted upload of this file to `destination` was
+        using, if it has parts to resume and is still valid"""
+        state = read_upload_state(
+            upload_state_path(file_path, destination, state_dir),
+            upload_identity(file_path, destination, chunk_size),
+        )
+        if not state.get("completed") or not state.get("url"):
+            return None
+        if state.get("expires_at", 0) - URL_EXPIRY_MARGIN < time.time():
+            return None
+        return state["url"]
+
+    @property
+    def parts(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    def run(self) -> TransferStats:
+        self._completed = self._load_state()
+        pending = [part for part in range(self.parts) if part not in self._completed]
+        resumed = sum(self._part_length(part) for part in self._completed)
+        if resumed:
+            logger.info(
+                f"Resuming upload of {self.file_path.name}: "
+                f"{len(self._completed)}/{self.parts} parts already sent"
+            )
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # list() re-raises the first part that ran out of retries
+            list(pool.map(self._send_part, pending))
+        elapsed = time.monotonic() - start
+
+        self.state_path.unlink(missing_ok=True)
+        stats = TransferStats(
+            total_bytes=self.size,
+            transferred_bytes=self.size - resumed,
+            resumed_bytes=resumed,
+            seconds=elapsed,
+            retries=self._retries,
+        )
+        logger.info(
+            f"Uploaded {self.file_path.name} in {self.parts} parts "
+            f"at {stats.bytes_per_second / 1e6:.2f} MB/s"
+        )
+        return stats
+
+    def _part_length(self, part: int) -> int:
+        return min(self.chunk_size, self.size - part * self.chunk_size)
+
+    def _send_part(self, part: int):
+        offset = part * self.chunk_size
+        length = self._part_length(part)
+        with open(self.file_path, "rb") as input_file:
+            input_file.seek(offset)
+            data = input_file.read(length)
+
+        headers = {"Content-Range": content_range(offset, length, self.size)}
+        attempt = 0
+        while True:
+            try:
+                r = self.session.request(
+                    self.method, self.url, data=data, headers=headers
+                )
+                r.raise_for_status()
+                break
+            except requests.RequestException as e:
+                if attempt >= self.max_retries:
+                    logger.error(f"Part {part} of {self.file_path.name} failed: {e}")
+                    raise
+                attempt += 1
+                with self._lock:
+                    self._retries += 1
+                logger.warning(f"Retrying part {part} of {self.file_path.name}: {e}")
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+        with self._lock:
+            self._completed.add(part)
+            self._save_state()
+
+    def _identity(self) -> dict:
+        return upload_identity(self.file_path, self.destination, self.chunk_size)
+
+    def _read_state(self) -> dict:
+        return read_upload_state(self.state_path, self._identity())
+
+    def _load_state(self) -> Set[int]:
+        state = self._read_state()
+        if state.get("url") != self.url:
+            # Parts sent with another url may have gone elsewhere
+            return set()
+        self._issued_at = state.get("issued_at", self._issued_at)
+        return set(state.get("completed", []))
+
+    def _save_state(self):
+        state = {
+            "identity": self._identity(),
+            "url": self.url,
+            "issued_at": self._issued_at,
+            "expires_at": url_expires_at(self.url, self._issued_at),
+            "completed": sorted(self._completed),
+        }
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, self.state_path)
+
+
+def upload_identity(file_path: Path, destination: str, chunk_size: int) -> dict:
+    """What an upload's saved progress is only valid for"""
+    stat = Path(file_path).stat()
+    return {
+        "destination": destination,
+        "file": str(Path(file_path).resolve()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "chunk_size": chunk_size,
+    }
+
+
+def read_upload_state(state_path: Path, identity: dict) -> dict:
+    try:
+        state = json.loads(state_path.read_text())
+    except (OSError, ValueError):
+        return {}
+    return state if state.get("identity") == identity else {}
+
+
+def upload_state_path(
+    file_path: Path, destination: str, state_dir: Optional[Path] = None
+) -> Path:
+    key = f"{destination}\n{Path(file_path).resolve()}"
+    name = hashlib.sha256(key.encode()).hexdigest()[:32]
+    return Path(state_dir or upload_state_dir()) / f"{name}.json"
+
+
+def content_range(offset: int, length: int, total: int) -> str:
+    if length == 0:
+        return f"bytes */{total}"
+    return f"bytes {offset}-{offset + length - 1}/{total}"
+
+
+def parse_content_range(header: str) -> List[int]:
+    """Parse `bytes start-end/total` into [start, end, total]"""
+    unit, _, spec = header.partition(" ")
+    if unit != "bytes":
+        raise ValueError(f"Unsupported range unit in {header!r}")
+    span, _, total = spec.partition("/")
+    if span == "*":
+        return [0, -1, int(total)]
+    start, _, end = span.partition("-")
+    return [int(start), int(end), int(total)]
+
+
+class RangedDownload:
+    """Downloads a url with parallel Range requests into a preallocated file
+
+    Data lands in `<name>.part` next to the destination, written in place
+    with os.pwrite, and finished parts are recorded in `<name>.part.json` so
+    an interrupted download resumes from what is already on disk. Once every
+    part is in, the size is checked, the file is hashed (and compared to
+    `sha256` or a plain MD5 ETag when available) and renamed into place.
+    Servers that ignore Range get a single streamed GET instead.
+    """
+
+    state_suffix = ".part.json"
+
+    def __init__(
+        self,
+        url: str,
+        out_file: Path,
+        session: Optional[requests.Session] = None,
+        params: Optional[dict] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        workers: int = DEFAULT_WORKERS,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        sha256: Optional[str] = None,
+    ):
+        self.url = url
+        self.params = params
+        self.out_file = Path(out_file)
+        self.session = session or pooled_session(workers)
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.expected_sha256 = sha256
+        self.part_path = sidecar_path(self.out_file, ".part")
+        self.state_path = sidecar_path(self.out_file, self.state_suffix)
+        self.sha256: Optional[str] = None
+
+        self.size = 0
+        self._source = url
+        self._etag: Optional[str] = None
+        self._lock = threading.Lock()
+        self._completed: Set[int] = set()
+        self._retries = 0
+
+    @property
+    def parts(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    def run(self) -> TransferStats:
+        start = time.monotonic()
+        ranged = self._probe()
+        if not ranged:
+            self._stream_whole()
+            resumed = 0
+        else:
+            self._completed = self._load_state()
+            resumed = sum(self._part_length(part) for part in self._completed)
+            if resumed:
+                logger.info(
+                    f"Resuming download of {self.out_file.name}: "
+                    f"{len(self._completed)}/{self.parts} parts on disk"
+                )
+            mode = "r+b" if self.part_path.exists() else "w+b"
+            with open(self.part_path, mode) as part_file:
+                part_file.truncate(self.size)
+                pending = [p for p in range(self.parts) if p not in self._completed]
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    list(pool.map(lambda p: self._fetch_part(part_file, p), pending))
+        elapsed = time.monotonic() - start
+
+        self._verify()
+        os.replace(self.part_path, self.out_file)
+        self.state_path.unlink(missing_ok=True)
+
+        stats = TransferStats(
+            total_bytes=self.size,
+            transferred_bytes=self.size - resumed,
+            resumed_bytes=resumed,
+            seconds=elapsed,
+            retries=self._retries,
+        )
+        logger.info(
+            f"Downloaded {self.out_file.name} in {self.parts if ranged else 1} parts "
+            f"at {stats.bytes_per_second / 1e6:.2f} MB/s"
+        )
+        return stats
+
+    def _probe(self) -> bool:
+        """Ask for the first byte to learn the size, final url and Range support"""
+        headers = {"Range": "bytes=0-0"}
+        with self.session.get(
+            self.url, params=self.params, headers=headers, stream=True
+        ) as r:
+            if r.status_code == 416:
+                # Nothing to range over in an empty file
+                return False
+            r.raise_for_status()
+            self._etag = r.headers.get("ETag")
+            if r.status_code != 206 or "Content-Range" not in r.headers:
+                return False
+            self.size = parse_content_range(r.headers["Content-Range"])[2]
+            # Later ranges go straight to wherever the url redirected to
+            self._source = r.url
+        return True
+
+    def _stream_whole(self):
+        self.part_path.unlink(missing_ok=True)
+        with self.session.get(self.url, params=self.params, stream=True) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            with open(self.part_path, "wb") as part_file:
+                shutil.copyfileobj(r.raw, part_file)
+        self.size = self.part_path.stat().st_size
+
+    def _part_length(self, part: int) -> int:
+        return min(self.chunk_size, self.size - part * self.chunk_size)
+
+    def _fetch_part(self, part_file, part: int):
+        offset = part * self.chunk_size
+        length = self._part_length(part)
+        headers = {"Range": f"bytes={offset}-{offset + length - 1}"}
+        attempt = 0
+        while True:
+            try:
+                with self.session.get(self._source, headers=headers, stream=True) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise requests.HTTPError(
+                            f"Expected a partial response, got {r.status_code}",
+                            response=r,
+                        )
+                    position = offset
+                    for chunk in r.iter_content(65536):
+                        pwrite(part_file, chunk, position)
+                        position += len(chunk)
+                if position - offset != length:
+                    raise requests.ConnectionError(
+                        f"Part {part} ended after {position - offset} of {length} bytes"
+                    )
+                break
+            except requests.RequestException as e:
+                if attempt >= self.max_retries:
+                    logger.error(f"Part {part} of {self.out_file.name} failed: {e}")
+                    raise
+                attempt += 1
+                with self._lock:
+                    self._retries += 1
+                logger.warning(f"Retrying part {part} of {self.out_file.name}: {e}")
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+        with self._lock:
+            self._completed.add(part)
+            part_file.flush()
+            self._save_state()
+
+    def _verify(self):
+        actual_size = self.part_path.stat().st_size
+        if actual_size != self.size:
+            raise IOError(
+                f"{self.out_file.name}: expected {self.size} bytes, got {actual_size}"
+            )
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        with open(self.part_path, "rb") as part_file:
+            for chunk in iter(lambda: part_file.read(DEFAULT_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+                md5.update(chunk)
+        self.sha256 = sha256.hexdigest()
+
+        etag = (self._etag or "").strip('W/"')
+        mismatch = None
+        if self.expected_sha256 and self.sha256 != self.expected_sha256:
+            mismatch = f"sha256 {self.sha256} != {self.expected_sha256}"
+        elif len(etag) == 32 and "-" not in etag and md5.hexdigest() != etag:
+            mismatch = f"md5 {md5.hexdigest()} != ETag {etag}"
+        if mismatch:
+            # A corrupt part file cannot be resumed; start over next time
+            self.part_path.unlink()
+            self.state_path.unlink(missing_ok=True)
+            raise IOError(f"{self.out_file.name} failed verification: {mismatch}")
+
+    def _identity(self) -> dict:
+        return {
+            "url": self.url,
+            "params": self.params,
+            "size": self.size,
+            "etag": self._etag,
+            "chunk_size": self.chunk_size,
+        }
+
+    def _load_state(self) -> Set[int]:
+        try:
+            state = json.loads(self.state_path.read_text())
+        except (OSError, ValueError):
+            state = {}
+        if state.get("identity") != self._identity() or not self.part_path.exists():
+            return set()
+        return set(state.get("completed", []))
+
+    def _save_state(self):
+        state = {"identity": self._identity(), "completed": sorted(self._completed)}
+        tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, self.state_path)
+
+
+_pwrite_lock = threading.Lock()
+
+
+def pwrite(output_file, data: bytes, offset: int):
+    """Write at an offset without moving the shared file position"""
+    if hasattr(os, "pwrite"):
+        os.pwrite(output_file.fileno(), data, offset)
+    else:
+        with _pwrite_lock:
+            output_file.seek(offset)
+            output_file.write(data)
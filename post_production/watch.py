@@ -0,0 +1,588 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import queue
+import select
+import signal
+import stat
+import struct
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import typer
+
+from post_production.batch import AUDIO_EXTENSIONS, BatchProgress
+from post_production.cache import ASSEMBLYAI, DOLBY, ResultCache
+from post_production.pipeline import (
+    LOCAL,
+    MANIFEST,
+    PipelineRunner,
+    StageManifest,
+    load_spec,
+    parse_spec,
+    register_providers,
+)
+from post_production.poller import JobPoller
+
+logger = logging.getLogger(__name__)
+
+# What a recording goes through when no spec is given
+DEFAULT_STAGES = [
+    {"name": "transcode", "uses": "transcode"},
+    {"name": "enhance", "uses": "enhance", "input": "transcode"},
+    {"name": "transcribe", "uses": "transcribe", "input": "enhance"},
+    {"name": "export", "uses": "export", "input": "transcribe"},
+]
+# Longest the watcher and the workers block before checking for shutdown
+TICK = 0.25
+# A watcher that has not come round for this long is reported as stalled
+STALLED_AFTER = 30.0
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def watch(
+    folder: Path = typer.Argument(
+        ..., exists=True, file_okay=False, help="Folder the recordings are saved to."
+    ),
+    spec_file: Optional[Path] = typer.Option(
+        None,
+        "--spec",
+        exists=True,
+        dir_okay=False,
+        help="Pipeline spec whose stages each recording runs through. "
+        "Defaults to transcode, enhance, transcribe and export into FOLDER/output.",
+    ),
+    workers: int = typer.Option(2, min=1, help="Recordings to process at once."),
+    queue_size: int = typer.Option(
+        8,
+        min=1,
+        help="Recordings waiting for a worker. Once full, new ones wait on disk.",
+    ),
+    settle: float = typer.Option(
+        2.0, help="Seconds a file's size must stay the same before it is processed."
+    ),
+    poll_interval: float = typer.Option(
+        2.0, help="Seconds between scans of the folder when inotify is not used."
+    ),
+    inotify: bool = typer.Option(
+        True, help="Use inotify where available, rather than scanning the folder."
+    ),
+    existing: bool = typer.Option(
+        True, help="Also process recordings already in the folder that are not done."
+    ),
+    health_port: int = typer.Option(
+        8766, help="Local port for the /health and /status endpoints, 0 for none."
+    ),
+    max_poll_interval: float = typer.Option(
+        30.0, help="Longest wait in seconds between status checks for a job."
+    ),
+    cache: bool = typer.Option(
+        True, help="Reuse uploads and results for unchanged files."
+    ),
+):
+    """Process new recordings dropped into a folder as they arrive.
+
+    Every recording runs through the stages of a pipeline spec once it has
+    stopped growing. Recordings that have not changed since they were last
+    processed are not run again. Stops on Ctrl-C or SIGTERM after finishing
+    the recordings in progress.
+    """
+    try:
+        if spec_file:
+            spec = load_spec(spec_file)
+        else:
+            spec = parse_spec({"stages": DEFAULT_STAGES}, folder)
+    except ValueError as e:
+        typer.echo(f"Invalid pipeline spec {spec_file}: {e}")
+        raise typer.Exit(code=1)
+
+    poller = JobPoller(max_interval=max_poll_interval)
+    keys = register_providers(spec, poller)
+    progress = BatchProgress([], [stage.name for stage in spec.stages])
+    # Each worker runs one recording, so a recording needs one slot of each
+    runner = PipelineRunner(
+        spec,
+        StageManifest(spec.output / MANIFEST),
+        progress,
+        {LOCAL: 1, DOLBY: 1, ASSEMBLYAI: 1},
+        poller=poller,
+        result_cache=ResultCache() if cache else None,
+        keys=keys,
+    )
+
+    def process(recording: Path):
+        progress.add(recording)
+        try:
+            typer.echo(f"Processing {recording.name}")
+            counts = runner.run([recording])
+        finally:
+            progress.remove(recording)
+        if counts["failed"]:
+            typer.echo(f"Failed {recording.name}, see the log for details")
+            raise RuntimeError(f"{counts['failed']} stages of {recording} failed")
+        typer.echo(
+            f"Finished {recording.name}: {counts['done']} ran, "
+            f"{counts['up to date']} up to date"
+        )
+
+    daemon = WatchDaemon(
+        folder,
+        process,
+        workers=workers,
+        queue_size=queue_size,
+        settle=settle,
+        poll_interval=poll_interval,
+        inotify=inotify,
+        existing=existing,
+        describe=progress.statuses,
+    )
+    health = HealthServer(daemon, port=health_port) if health_port else None
+    stopped = threading.Event()
+    handlers = {
+        signum: signal.signal(signum, lambda *args: stopped.set())
+        for signum in (signal.SIGINT, signal.SIGTERM)
+    }
+    try:
+        daemon.start()
+        if health:
+            health.start()
+        typer.echo(
+            f"Watching {folder} with {daemon.watcher.name}, results in {spec.output}"
+            + (f", status at {health.url('/status')}" if health else "")
+        )
+        while not stopped.wait(1) and not daemon.error:
+            pass
+    finally:
+        # A second Ctrl-C stops at once; `tppp resume` picks up its jobs
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        typer.echo("Stopping once the recordings in progress are done")
+        daemon.stop()
+        if health:
+            health.stop()
+        poller.stop()
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    status = daemon.status()
+    typer.echo(f"Processed {status['processed']}, failed {status['failed']}")
+    if status["error"]:
+        typer.echo(f"Stopped watching: {status['error']}")
+        raise typer.Exit(code=1)
+
+
+def is_recording(path: Path) -> bool:
+    # Dot files are the partial uploads of rsync and the like
+    return path.suffix.lower() in AUDIO_EXTENSIONS and not path.name.startswith(".")
+
+
+def list_recordings(folder: Path) -> List[Path]:
+    return sorted(p for p in Path(folder).iterdir() if is_recording(p))
+
+
+class PollingWatcher:
+    """Reports every recording in the folder each `interval` seconds"""
+
+    name = "polling"
+
+    def __init__(self, folder: Path, interval: float = 2.0):
+        self.folder = Path(folder)
+        self.interval = interval
+        self._next_scan = time.monotonic()
+
+    def changes(self, timeout: float) -> List[Path]:
+        wait = self._next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, wait))
+        self._next_scan = time.monotonic() + self.interval
+        return list_recordings(self.folder)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Reports the recordings the kernel says were written to or moved into a folder
+
+    Uses inotify through ctypes, so it needs Linux but no extra package.
+    Raises OSError when inotify is not available.
+    """
+
+    name = "inotify"
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+    def __init__(self, folder: Path):
+        self.folder = Path(folder)
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this system")
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self._fd, os.fsencode(self.folder), self.mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, os.strerror(errno), str(self.folder))
+
+    def changes(self, timeout: float) -> List[Path]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # The kernel dropped events, so look at everything
+                    logger.warning(
+                        f"inotify queue overflowed, rescanning {self.folder}"
+                    )
+                    changed.update(list_recordings(self.folder))
+                elif mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    raise OSError(f"{self.folder} was removed or moved")
+                elif name:
+                    path = self.folder / os.fsdecode(name)
+                    if is_recording(path):
+                        changed.add(path)
+        return sorted(changed)
+
+    def close(self):
+        os.close(self._fd)
+
+
+def open_watcher(folder: Path, poll_interval: float, inotify: bool = True):
+    if inotify:
+        try:
+            return InotifyWatcher(folder)
+        except OSError as e:
+            logger.warning(f"Falling back to polling {folder}: {e}")
+    return PollingWatcher(folder, poll_interval)
+
+
+class SettlingFiles:
+    """Recordings that changed lately, held until they stop changing
+
+    A recording is ready once its size and modification time have stayed
+    the same for `settle` seconds. Recording machines and network shares
+    often write a file in bursts, with a close in between, so the close
+    alone does not mean a recording is finished. Empty files are never
+    ready, and a file is ready again only after it changes.
+    """
+
+    def __init__(self, settle: float = 2.0):
+        self.settle = settle
+        self._pending: Dict[Path, Tuple[Optional[Tuple[int, int]], float]] = {}
+        self._taken: Dict[Path, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def saw(self, path: Path):
+        self._pending.setdefault(path, (None, 0.0))
+
+    def ready(self, now: Optional[float] = None) -> List[Path]:
+        """Settled recordings, the longest settled first"""
+        now = time.monotonic() if now is None else now
+        ready = []
+        for path, (last, since) in list(self._pending.items()):
+            try:
+                info = path.stat()
+            except FileNotFoundError:
+                del self._pending[path]
+                self._taken.pop(path, None)
+                continue
+            if not stat.S_ISREG(info.st_mode):
+                del self._pending[path]
+                continue
+            signature = (info.st_size, info.st_mtime_ns)
+            if signature == self._taken.get(path):
+                del self._pending[path]
+            elif signature != last:
+                self._pending[path] = (signature, now)
+            elif info.st_size and now - since >= self.settle:
+                ready.append(path)
+        return sorted(ready, key=lambda path: self._pending[path][1])
+
+    def take(self, path: Path):
+        signature, _ = self._pending.pop(path)
+        self._taken[path] = signature
+
+    def skip(self, path: Path):
+        """Treat a recording as taken as it is now, so only a change makes it ready"""
+        info = path.stat()
+        self._pending.pop(path, None)
+        self._taken[path] = (info.st_size, info.st_mtime_ns)
+
+
+class WatchDaemon:
+    """Watches a folder and processes each finished recording with a pool of workers
+
+    The watcher thread puts settled recordings on a bounded queue. When the
+    queue is full they wait on disk, so a burst of recordings never piles
+    up in memory and is taken in as workers free up. `stop` lets the
+    running recordings finish; queued ones are left for the next start.
+
+    Usage:
+        daemon = WatchDaemon(folder, process, workers=2).start()
+        ...
+        daemon.stop()
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        process: Callable[[Path], Any],
+        workers: int = 2,
+        queue_size: int = 8,
+        settle: float = 2.0,
+        poll_interval: float = 2.0,
+        inotify: bool = True,
+        existing: bool = True,
+        describe: Optional[Callable[[Path], Dict[str, str]]] = None,
+    ):
+        self.folder = Path(folder)
+        self.process = process
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.inotify = inotify
+        self.existing = existing
+        self.describe = describe
+        self.queue: "queue.Queue[Path]" = queue.Queue(maxsize=queue_size)
+        self.settling = SettlingFiles(settle)
+        self.watcher = None
+        self.processed = 0
+        self.failed = 0
+        self.held = 0
+        self.error: Optional[str] = None
+        self.recent: Deque[Dict[str, Any]] = deque(maxlen=20)
+        self._running: Dict[Path, float] = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._started_at = 0.0
+        self._last_tick = 0.0
+
+    def start(self) -> "WatchDaemon":
+        self.watcher = open_watcher(self.folder, self.poll_interval, self.inotify)
+        for path in list_recordings(self.folder):
+            if self.existing:
+                self.settling.saw(path)
+            else:
+                self.settling.skip(path)
+        self._started_at = self._last_tick = time.monotonic()
+        self._threads = [threading.Thread(target=self._watch, daemon=True)]
+        self._threads += [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Watching {self.folder} with {self.watcher.name}")
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        if self.watcher:
+            self.watcher.close()
+        logger.info(f"Stopped watching {self.folder}")
+
+    def __enter__(self) -> "WatchDaemon":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def state(self) -> str:
+        if self.error:
+            return "failed"
+        if self._stopping.is_set():
+            return "stopping"
+        if time.monotonic() - self._last_tick > STALLED_AFTER:
+            return "stalled"
+        return "ok"
+
+    @property
+    def healthy(self) -> bool:
+        return self.state == "ok"
+
+    def status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            running = [
+                {
+                    "file": path.name,
+                    "seconds": round(now - started, 1),
+                    "stages": self.describe(path) if self.describe else {},
+                }
+                for path, started in self._running.items()
+            ]
+            recent = list(self.recent)
+        return {
+            "status": self.state,
+            "folder": str(self.folder),
+            "watcher": self.watcher.name if self.watcher else None,
+            "uptime_seconds": round(now - self._started_at, 1),
+            "settling": len(self.settling),
+            "held": self.held,
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "workers": self.workers,
+            "running": running,
+            "processed": self.processed,
+            "failed": self.failed,
+            "recent": recent,
+            "error": self.error,
+        }
+
+    def _watch(self):
+        try:
+            while not self._stopping.is_set():
+                for path in self.watcher.changes(TICK):
+                    self.settling.saw(path)
+                self._enqueue_ready()
+                self._last_tick = time.monotonic()
+        except Exception as e:
+            logger.exception(f"Stopped watching {self.folder}")
+            self.error = str(e)
+
+    def _enqueue_ready(self):
+        ready = self.settling.ready()
+        for queued, path in enumerate(ready):
+            try:
+                self.queue.put_nowait(path)
+            except queue.Full:
+                # Held in `settling` and queued once a worker frees a slot
+                self.held = len(ready) - queued
+                return
+            self.settling.take(path)
+            logger.info(f"Queued {path}")
+        self.held = 0
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                path = self.queue.get(timeout=TICK)
+            except queue.Empty:
+                continue
+            if self._stopping.is_set():
+                break
+            start = time.monotonic()
+            with self._lock:
+                self._running[path] = start
+            try:
+                self.process(path)
+                ok = True
+            except Exception:
+                logger.exception(f"Processing {path} failed")
+                ok = False
+            with self._lock:
+                del self._running[path]
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+                self.recent.append(
+                    {
+                        "file": path.name,
+                        "ok": ok,
+                        "seconds": round(time.monotonic() - start, 1),
+                        "finished_at": time.time(),
+                    }
+                )
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    server: "HealthHTTPServer"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def send_json(self, data: Dict[str, Any], status: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        path = self.path.split("?")[0]
+        if path == "/health":
+            state = daemon.state
+            self.send_json({"status": state}, 200 if state == "ok" else 503)
+        elif path == "/status":
+            self.send_json(daemon.status())
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+
+class HealthHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, daemon: WatchDaemon):
+        super().__init__(address, HealthHandler)
+        self.daemon = daemon
+
+
+class HealthServer:
+    """Serves the state of a watch daemon on localhost
+
+    GET /health answers 200 while the daemon is watching and 503 once it is
+    stopping, has stalled or has failed, for supervisors and load balancers.
+    GET /status gives the queue, the running recordings and recent results.
+    """
+
+    def __init__(self, daemon: WatchDaemon, host: str = "127.0.0.1", port: int = 0):
+        self.httpd = HealthHTTPServer((host, port), daemon)
+        self._thread: Optional[threading.Thread] = None
+
+    def url(self, path: str) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def start(self) -> "HealthServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self) -> "HealthServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
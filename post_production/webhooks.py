@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import secrets
+import threading
+from typing import Optional
+from urllib.parse import urlsplit
+
+from post_production.cache import ASSEMBLYAI, DOLBY
+from post_production.poller import JobPoller
+
+logger = logging.getLogger(__name__)
+
+# Where each provider puts the job id in its completion callback
+JOB_ID_FIELDS = {DOLBY: "job_id", ASSEMBLYAI: "transcript_id"}
+
+RESPONSES = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Not Allowed"}
+
+
+class WebhookReceiver:
+    """Embedded HTTP server that turns provider callbacks into immediate status checks
+
+    Jobs stay tracked by the JobPoller, which only polls them as a slow
+    fallback. When a callback arrives the poller checks that job right away,
+    so it resolves as soon as the provider says it is done. Callback urls
+    carry a random token, and requests without it are rejected.
+
+    `public_url` is the address the providers can reach, for example a
+    tunnel or reverse proxy that forwards to `host:port`. It defaults to the
+    local address, which is enough for the local stand-in providers.
+
+    Usage:
+        with WebhookReceiver(poller, public_url="https://hooks.example.com") as hooks:
+            job_id = assembly.transcribe(url, webhook_url=hooks.url_for(ASSEMBLYAI))
+            poller.track(ASSEMBLYAI, job_id, delay=poller.min_interval)
+    """
+
+    def __init__(
+        self,
+        poller: JobPoller,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        public_url: Optional[str] = None,
+    ):
+        self.poller = poller
+        self.host = host
+        self.port = port
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.token = secrets.token_urlsafe(16)
+        self.received = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self) -> str:
+        return self.public_url or f"http://{self.host}:{self.port}"
+
+    def url_for(self, provider: str) -> str:
+        return f"{self.base_url}/{self.token}/{provider}"
+
+    def start(self) -> "WebhookReceiver":
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self) -> "WebhookReceiver":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _serve(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Listening for webhooks on {self.host}:{self.port}")
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            status = await self._receive(reader)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Malformed webhook request: {e}")
+            status = 400
+        writer.write(
+            f"HTTP/1.1 {status} {RESPONSES[status]}\r\n"
+            "Content-Length: 0\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        writer.close()
+
+    async def _receive(self, reader: asyncio.StreamReader) -> int:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) < 2:
+            raise ValueError("missing request line")
+        method, path = request_line[:2]
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        if method != "POST":
+            return 405
+        provider = self._provider_for(urlsplit(path).path)
+        if not provider:
+            return 404
+
+        payload = json.loads(body or b"{}")
+        if not isinstance(payload, dict):
+            raise ValueError(f"{provider} callback body is not a JSON object")
+        job_id = payload.get(JOB_ID_FIELDS[provider])
+        if not job_id:
+            raise ValueError(f"{provider} callback without a job id")
+        self.received += 1
+        logger.info(f"Webhook for {provider} job {job_id}")
+        self.poller.poke(provider, job_id)
+        return 200
+
+    def _provider_for(self, path: str) -> Optional[str]:
+        """The provider a callback path is for, under `public_url`'s path or not
+
+        A reverse proxy may pass on the path it was called with, e.g.
+        /hooks/<token>/dolby, or strip its own prefix first.
+        """
+        for provider in JOB_ID_FIELDS:
+            local = f"/{self.token}/{provider}"
+            if path in (urlsplit(self.url_for(provider)).path, local):
+                return provider
+        return None
@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(tmp_path, monkeypatch):
+    """Keep runs from touching the journal, caches and metrics under ~/.cache"""
+    monkeypatch.setenv("TPPP_JOURNAL", str(tmp_path / "journal.sqlite3"))
+    monkeypatch.setenv("TPPP_CACHE", str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setenv("TPPP_UPLOAD_STATE", str(tmp_path / "uploads"))
+    monkeypatch.setenv("TPPP_METRICS_DIR", str(tmp_path / "metrics"))
@@ -0,0 +1,150 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from post_production import scheduler
+from post_production.async_clients import (
+    AsyncAssemblyAI,
+    AsyncDolbyIO,
+    connection_pool,
+)
+from post_production.cache import ASSEMBLYAI, DOLBY
+from post_production.metrics import metrics, read_runs
+from post_production.scheduler import RateLimit, RequestScheduler
+from post_production.stand_in import FakeProviderServer
+
+
+@pytest.fixture
+def provider():
+    with FakeProviderServer() as server:
+        server.job_duration = 0.2
+        yield server
+
+
+@pytest.fixture
+def schedulers(monkeypatch):
+    """Fast schedulers in place of the process-wide ones, for the test to inspect"""
+    fast = {
+        provider: RequestScheduler(
+            provider, RateLimit(rate=1000.0, burst=1000, concurrency=8)
+        )
+        for provider in (DOLBY, ASSEMBLYAI)
+    }
+    for provider, scheduler_ in fast.items():
+        monkeypatch.setitem(scheduler._schedulers, provider, scheduler_)
+    return fast
+
+
+def make_episodes(tmp_path, count, size=100000):
+    episodes = []
+    for number in range(count):
+        path = tmp_path / f"episode {number}.wav"
+        path.write_bytes(bytes([number]) * size)
+        episodes.append(path)
+    return episodes
+
+
+def test_a_season_runs_on_one_small_pool(provider, schedulers, tmp_path):
+    episodes = make_episodes(tmp_path, 8)
+
+    async def process(dolby, assembly, episode):
+        in_url = await dolby.upload(episode)
+        job_id, out_url = await dolby.enhance(in_url)
+        transcript_id = await assembly.transcribe(await assembly.upload(episode))
+        status, _ = await dolby.wait(job_id, min_interval=0.05)
+        assert status == "Success"
+        fields = await assembly.wait(transcript_id, min_interval=0.05)
+        assert fields["status"] == "completed"
+        saved = await assembly.save_result(
+            transcript_id, tmp_path / f"{episode.stem}.json"
+        )
+        return await dolby.download(out_url, tmp_path / "output"), saved
+
+    async def main():
+        pool = connection_pool(max_connections=4)
+        async with AsyncDolbyIO("key", pool) as dolby, AsyncAssemblyAI(
+            "key", pool
+        ) as assembly:
+            dolby.api_endpoint = provider.url("/media")
+            assembly.api_endpoint = provider.url("/v2")
+            results = await asyncio.gather(
+                *(process(dolby, assembly, episode) for episode in episodes)
+            )
+        await pool.aclose()
+        return results
+
+    metrics.start("test", tmp_path / "metrics")
+    try:
+        results = asyncio.run(main())
+    finally:
+        metrics.close()
+
+    for episode, (output, saved) in zip(episodes, results):
+        assert output.name == f"{episode.stem} - Enhanced.wav"
+        assert output.read_bytes() == episode.read_bytes()
+        assert saved["status"] == "completed"
+        transcript = json.loads((tmp_path / f"{episode.stem}.json").read_text())
+        assert transcript["words"]
+    assert not list(tmp_path.glob("**/*.part"))
+
+    # API requests went through the schedulers the sync clients use
+    assert schedulers[DOLBY].stats.requests >= 3 * len(episodes)
+    assert schedulers[ASSEMBLYAI].stats.requests >= 4 * len(episodes)
+    (events,) = read_runs(tmp_path / "metrics")
+    requests = [e for e in events if e["type"] == "request"]
+    assert {(e["provider"], e["endpoint"]) for e in requests} >= {
+        (DOLBY, "/input"),
+        (DOLBY, "/enhance"),
+        (DOLBY, "storage"),
+        (ASSEMBLYAI, "/upload"),
+        (ASSEMBLYAI, "/transcript/{id}"),
+    }
+    downloads = [e for e in events if e["type"] == "stage" and e["stage"] == "download"]
+    assert len(downloads) == 2 * len(episodes)
+
+
+def test_throttled_requests_are_sent_again_unless_their_body_is_gone(
+    provider, schedulers, tmp_path
+):
+    (episode,) = make_episodes(tmp_path, 1)
+
+    async def main():
+        async with AsyncAssemblyAI("key") as assembly:
+            assembly.api_endpoint = provider.url("/v2")
+            provider.failures = 2
+            job_id = await assembly.transcribe("https://example.com/episode.wav")
+            # The file was streamed into the first attempt and cannot be resent
+            provider.failures = 1
+            with pytest.raises(httpx.HTTPStatusError):
+                await assembly.upload(episode)
+            return job_id
+
+    job_id = asyncio.run(main())
+
+    assert job_id in provider.jobs
+    assert len(provider.jobs) == 1
+    assert schedulers[ASSEMBLYAI].stats.retries == 2
+    assert not [path for path in provider.files if "upload" in path]
+
+
+def test_a_cancelled_download_leaves_nothing_behind(provider, schedulers, tmp_path):
+    (episode,) = make_episodes(tmp_path, 1, size=400000)
+    out_path = tmp_path / "output"
+
+    async def main():
+        async with AsyncDolbyIO("key") as dolby:
+            dolby.api_endpoint = provider.url("/media")
+            job_id, out_url = await dolby.enhance(await dolby.upload(episode))
+            await dolby.wait(job_id, min_interval=0.05)
+            provider.connection_rate = 200000
+            download = asyncio.ensure_future(dolby.download(out_url, out_path))
+            await asyncio.sleep(0.3)
+            download.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await download
+
+    asyncio.run(main())
+
+    assert list(out_path.iterdir()) == []
@@ -0,0 +1,33 @@
+from pathlib import Path
+
+from post_production.batch import BatchProgress, find_audio_files
+
+
+def test_find_audio_files(tmp_path):
+    (tmp_path / "ep1.wav").write_bytes(b"")
+    (tmp_path / "ep2.MP3").write_bytes(b"")
+    (tmp_path / "notes.txt").write_text("")
+    nested = tmp_path / "season2"
+    nested.mkdir()
+    (nested / "ep3.wav").write_bytes(b"")
+
+    assert find_audio_files([str(tmp_path)]) == [
+        tmp_path / "ep1.wav",
+        tmp_path / "ep2.MP3",
+    ]
+    assert find_audio_files([str(tmp_path / "**" / "*.wav")]) == [
+        tmp_path / "ep1.wav",
+        nested / "ep3.wav",
+    ]
+
+
+def test_batch_progress_table():
+    files = [Path("ep1.wav"), Path("ep2.wav")]
+    progress = BatchProgress(files, ["Dolby.io", "AssemblyAI"])
+    progress.update(files[0], "Dolby.io", "Running 40%")
+    progress.update(files[0], "Dolby.io", "Running 40%")
+
+    assert progress.version == 1
+    table = progress.table()
+    assert "Running 40%" in table
+    assert "ep2.wav" in table
@@ -0,0 +1,72 @@
+import hashlib
+import time
+
+from post_production import cache
+from post_production.cache import ResultCache, file_hash
+
+
+def test_file_hash_streams_in_chunks(tmp_path):
+    path = tmp_path / "episode.wav"
+    data = bytes(range(256)) * 1000
+    path.write_bytes(data)
+
+    assert file_hash(path, chunk_size=1000) == hashlib.sha256(data).hexdigest()
+
+
+def test_jobs_are_keyed_by_content_and_params(tmp_path):
+    results = ResultCache(tmp_path / "cache.sqlite3")
+    params = {"speaker_labels": True, "word_boost": ["python"]}
+    results.put_upload(cache.ASSEMBLYAI, "abc", "https://cdn/upload/1")
+    results.put_job(cache.ASSEMBLYAI, "abc", params, "job-1")
+
+    assert results.get_upload(cache.ASSEMBLYAI, "abc") == "https://cdn/upload/1"
+    assert results.get_upload(cache.DOLBY, "abc") is None
+    assert results.get_job(cache.ASSEMBLYAI, "abc", params).job_id == "job-1"
+    assert results.get_job(cache.ASSEMBLYAI, "abc", {"speaker_labels": True}) is None
+
+    artifact = tmp_path / "episode.json"
+    artifact.write_text("{}")
+    results.put_artifact(cache.ASSEMBLYAI, "abc", params, artifact)
+    assert results.get_job(cache.ASSEMBLYAI, "abc", params).has_artifact
+
+
+def test_expired_entries_are_evicted(tmp_path, monkeypatch):
+    results = ResultCache(tmp_path / "cache.sqlite3")
+    results.put_upload(cache.DOLBY, "abc", "dlb://in/episode.wav")
+    results.put_job(cache.DOLBY, "abc", {}, "job-1", "ENHANCE", "dlb://out/x.wav")
+
+    later = time.time() + cache.UPLOAD_TTL[cache.DOLBY] + 1
+    monkeypatch.setattr(time, "time", lambda: later)
+
+    assert results.get_upload(cache.DOLBY, "abc") is None
+    assert results.evict_expired() == 2
+
+
+def test_failed_jobs_are_forgotten(tmp_path):
+    results = ResultCache(tmp_path / "cache.sqlite3")
+    results.put_job(cache.DOLBY, "abc", {"job_type": "enhance"}, "job-1")
+    results.put_job(cache.DOLBY, "abc", {"job_type": "analyze"}, "job-2")
+
+    results.forget_job(cache.DOLBY, "abc", {"job_type": "enhance"})
+
+    assert results.get_job(cache.DOLBY, "abc", {"job_type": "enhance"}) is None
+    assert (
+        results.get_job(cache.DOLBY, "abc", {"job_type": "analyze"}).job_id == "job-2"
+    )
+
+
+def test_jobs_whose_results_are_gone_everywhere_are_not_reused(tmp_path, monkeypatch):
+    results = ResultCache(tmp_path / "cache.sqlite3")
+    params = {"job_type": "enhance"}
+    artifact = tmp_path / "episode - Enhanced.wav"
+    artifact.write_bytes(b"RIFF")
+    results.put_job(cache.DOLBY, "abc", params, "job-1", "ENHANCE", "dlb://out/x")
+    results.put_artifact(cache.DOLBY, "abc", params, artifact)
+    artifact.unlink()
+
+    # While Dolby.io still has the output, the job is downloaded again
+    assert results.get_job(cache.DOLBY, "abc", params).job_id == "job-1"
+
+    now = time.time()
+    monkeypatch.setattr(cache.time, "time", lambda: now + 2 * cache.DAY)
+    assert results.get_job(cache.DOLBY, "abc", params) is None
@@ -0,0 +1,109 @@
+import contextlib
+import json
+from pathlib import Path
+
+import click_spinner
+from typer.testing import CliRunner
+
+from post_production.dolby import DolbyIO, analysis_url, input_url
+from post_production.main import app
+from post_production.stand_in import FakeProviderServer
+
+
+def test_analysis_reports_do_not_collide():
+    assert analysis_url("dlb://in/ep.wav") == "dlb://out/ep.json"
+    assert analysis_url("dlb://in/ep.wav", speech=True) == "dlb://out/speech/ep.json"
+
+
+def test_uploads_are_named_by_content():
+    assert input_url(Path("a/ep one.wav")) == "dlb://in/ep%20one.wav"
+    assert input_url(Path("a/ep.wav"), "ab" * 32) == f"dlb://in/{'ab' * 16}/ep.wav"
+    assert analysis_url(input_url(Path("ep.wav"), "cd" * 32)) == (
+        f"dlb://out/{'cd' * 16}/ep.json"
+    )
+
+
+def test_all_jobs_share_one_upload(tmp_path, monkeypatch):
+    audio = tmp_path / "episode.wav"
+    audio.write_bytes(b"RIFF" + bytes(5000))
+    monkeypatch.setenv("DOLBY_API_KEY", "key")
+
+    with FakeProviderServer() as provider:
+        provider.job_duration = 0.2
+        monkeypatch.setattr(DolbyIO, "api_endpoint", provider.url("/media"))
+        result = CliRunner().invoke(
+            app,
+            ["enhance", str(audio), "--all", "--no-cache", "--output", str(tmp_path)],
+            input="y\n",
+        )
+        uploads = [path for path in provider.files if path.startswith("/storage/in/")]
+
+    assert result.exit_code == 0, result.output
+    assert len(uploads) == 1
+    assert (tmp_path / "episode - Enhanced.wav").read_bytes() == audio.read_bytes()
+    for tag in ("Analyzed", "Speech Analyzed"):
+        report = json.loads((tmp_path / f"episode - {tag}.json").read_text())
+        assert report["audio"]["loudness"]
+
+
+def test_failed_jobs_are_started_again(tmp_path, monkeypatch):
+    monkeypatch.setenv("DOLBY_API_KEY", "key")
+    # Two episodes with the same name, e.g. from different seasons
+    for season, content in (("s1", b"first"), ("s2", b"second")):
+        (tmp_path / season).mkdir()
+        (tmp_path / season / "episode.wav").write_bytes(b"RIFF" + content)
+    runner = CliRunner()
+    # The spinner keeps writing to the output of the first run
+    monkeypatch.setattr(click_spinner, "spinner", contextlib.nullcontext)
+
+    def enhance(season):
+        audio = tmp_path / season / "episode.wav"
+        return runner.invoke(app, ["enhance", str(audio)], input="y\n")
+
+    with FakeProviderServer() as provider:
+        provider.job_duration = 0.1
+        monkeypatch.setattr(DolbyIO, "api_endpoint", provider.url("/media"))
+        provider.fail_jobs = True
+        failed = enhance("s1")
+        provider.fail_jobs = False
+        second = enhance("s2")
+        retried = enhance("s1")
+        uploads = [path for path in provider.files if path.startswith("/storage/in/")]
+
+    assert failed.exit_code == 1
+    assert "ended with status Failed" in failed.output
+    assert second.exit_code == 0, second.output
+    # A new job rather than the failed one, from the upload that is still there
+    assert retried.exit_code == 0, retried.output
+    assert "Re-attaching" not in retried.output
+    assert "Using previous upload" in retried.output
+    assert len(provider.jobs) == 3
+    assert len(uploads) == 2
+    for season, content in (("s1", b"first"), ("s2", b"second")):
+        enhanced = tmp_path / season / "output" / "episode - Enhanced.wav"
+        assert enhanced.read_bytes() == b"RIFF" + content
+
+
+def test_jobs_whose_download_fails_are_started_again(tmp_path, monkeypatch):
+    monkeypatch.setenv("DOLBY_API_KEY", "key")
+    audio = tmp_path / "episode.wav"
+    audio.write_bytes(b"RIFF" + bytes(100))
+    runner = CliRunner()
+    monkeypatch.setattr(click_spinner, "spinner", contextlib.nullcontext)
+    download = DolbyIO.download
+
+    def expired(self, *args, **kwargs):
+        raise RuntimeError("dlb://out media has expired")
+
+    with FakeProviderServer() as provider:
+        provider.job_duration = 0.1
+        monkeypatch.setattr(DolbyIO, "api_endpoint", provider.url("/media"))
+        monkeypatch.setattr(DolbyIO, "download", expired)
+        failed = runner.invoke(app, ["enhance", str(audio)], input="y\n")
+        monkeypatch.setattr(DolbyIO, "download", download)
+        retried = runner.invoke(app, ["enhance", str(audio)], input="y\n")
+
+    assert failed.exit_code == 1
+    assert retried.exit_code == 0, retried.output
+    assert "Re-attaching" not in retried.output
+    assert len(provider.jobs) == 2
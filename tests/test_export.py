@@ -0,0 +1,128 @@
+import io
+import json
+
+import pytest
+
+from post_production.export import (
+    CaptionLimits,
+    CaptionWriter,
+    ChapterWriter,
+    ExportFormat,
+    TranscriptWriter,
+    caption_cues,
+    export_file,
+    load_speaker_map,
+)
+
+
+def words_of(text, start=0, step=500):
+    return [
+        {"text": token, "start": start + i * step, "end": start + (i + 1) * step}
+        for i, token in enumerate(text.split())
+    ]
+
+
+def test_caption_cues_respect_limits():
+    words = words_of("one two three four five six seven eight nine ten", step=1000)
+    cues = list(caption_cues(words, CaptionLimits(10, 2, 3500)))
+
+    assert cues == [
+        (0, 3000, ["one two", "three"]),
+        (3000, 6000, ["four five", "six"]),
+        (6000, 9000, ["seven", "eight nine"]),
+        (9000, 10000, ["ten"]),
+    ]
+    for start, end, lines in caption_cues(words_of("a " * 200), CaptionLimits()):
+        assert len(lines) <= 2 and all(len(line) <= 42 for line in lines)
+        assert end - start <= 7000
+
+
+def test_chapters_start_at_pauses():
+    out = io.StringIO()
+    chapters = ChapterWriter(out, min_length=10_000, max_length=60_000, min_gap=1000)
+    utterances = [
+        {"start": 0, "end": 8000, "text": "Welcome to the show."},
+        {"start": 8200, "end": 12000, "text": "No pause here."},
+        {"start": 14000, "end": 30000, "text": "Our guest today is a teacher."},
+        {"start": 30100, "end": 95000, "text": "A long answer."},
+        {"start": 95100, "end": 96000, "text": "Forced break."},
+    ]
+    for utterance in utterances:
+        chapters.utterance(utterance, "A", [])
+
+    assert out.getvalue() == (
+        "00:00 Welcome to the show.\n"
+        "00:14 Our guest today is a teacher.\n"
+        "01:35 Forced break.\n"
+    )
+
+
+def test_writers_must_write_utterances_and_cues():
+    class Captions(CaptionWriter):
+        pass
+
+    with pytest.raises(TypeError):
+        TranscriptWriter(io.StringIO())
+    with pytest.raises(TypeError):
+        Captions(io.StringIO())
+
+
+def test_export_writes_every_format_in_one_pass(tmp_path):
+    words = words_of("Welcome back. Thanks Sean.")
+    for word in words:
+        word["speaker"] = "A" if word["start"] < 1000 else "B"
+    utterances = [
+        {
+            "speaker": "A",
+            "text": "Welcome back.",
+            "start": 0,
+            "end": 1000,
+            "words": words[:2],
+        },
+        {
+            "speaker": "B",
+            "text": "Thanks Sean.",
+            "start": 1000,
+            "end": 2000,
+            "words": words[2:],
+        },
+    ]
+    transcript = tmp_path / "episode.json"
+    transcript.write_text(json.dumps({"words": words, "utterances": utterances}))
+    speakers = tmp_path / "speakers.txt"
+    speakers.write_text("A = Kelly\nB=Sean\n")
+
+    paths = export_file(
+        transcript, tmp_path, list(ExportFormat), load_speaker_map(speakers)
+    )
+
+    assert [p.name for p in paths] == [
+        "episode - transcript.txt",
+        "episode.srt",
+        "episode.vtt",
+        "episode - chapters.txt",
+        "episode.jsonl",
+    ]
+    assert paths[0].read_text() == "Kelly:\nWelcome back.\n\nSean:\nThanks Sean.\n"
+    assert (
+        paths[1]
+        .read_text()
+        .startswith("1\n00:00:00,000 --> 00:00:01,000\nWelcome back.\n\n2\n")
+    )
+    assert (
+        "00:00:01.000 --> 00:00:02.000\n<v Sean>Thanks Sean.\n" in paths[2].read_text()
+    )
+    assert paths[3].read_text() == "00:00 Welcome back.\n"
+    records = [json.loads(line) for line in paths[4].read_text().splitlines()]
+    assert [r["speaker"] for r in records] == ["Kelly", "Sean"]
+
+
+def test_export_without_utterances_groups_sentences(tmp_path):
+    transcript = tmp_path / "episode.json"
+    transcript.write_text(
+        json.dumps({"words": words_of("Hi there. Bye now."), "utterances": None})
+    )
+
+    (path,) = export_file(transcript, tmp_path, [ExportFormat.TXT], {})
+
+    assert path.read_text() == "Speaker:\nHi there.\n\nSpeaker:\nBye now.\n"
@@ -0,0 +1,124 @@
+import json
+import time
+
+from typer.testing import CliRunner
+
+from post_production import dolby_cli
+from post_production.assembly_ai import AssemblyAI
+from post_production.cache import ASSEMBLYAI, DOLBY
+from post_production.dolby import DolbyIO
+from post_production.journal import JobJournal, Stage
+from post_production.main import app
+from post_production.stand_in import FakeProviderServer
+
+
+def test_tasks_add_up_their_entries(tmp_path, monkeypatch):
+    journal = JobJournal(tmp_path / "journal.sqlite3")
+    episode = tmp_path / "episode.wav"
+
+    journal.record(DOLBY, episode, Stage.UPLOADED, "ENHANCE", in_url="dlb://in/a")
+    journal.record(DOLBY, episode, Stage.SUBMITTED, "ENHANCE", job_id="job-1")
+    journal.record(DOLBY, episode, Stage.UPLOADED, "ANALYZE", in_url="dlb://in/a")
+    journal.record(ASSEMBLYAI, episode, Stage.UPLOADED, audio_url="https://x/a")
+    journal.record(ASSEMBLYAI, episode, Stage.SUBMITTED, job_id="tx-1")
+    journal.record(ASSEMBLYAI, episode, Stage.COMPLETED)
+    journal.record(ASSEMBLYAI, episode, Stage.DOWNLOADED, file="episode.json")
+
+    enhance, analyze = journal.outstanding()
+    assert (enhance.job_type, enhance.stage, enhance.job_id) == (
+        "ENHANCE",
+        Stage.SUBMITTED,
+        "job-1",
+    )
+    assert enhance.details["in_url"] == "dlb://in/a"
+    assert enhance.input_file == episode.resolve()
+    assert (analyze.stage, analyze.job_id) == (Stage.UPLOADED, None)
+
+    # A new upload starts the task over, forgetting the old job
+    journal.record(DOLBY, episode, Stage.UPLOADED, "ENHANCE", in_url="dlb://in/b")
+    enhance = [t for t in journal.outstanding() if t.job_type == "ENHANCE"][0]
+    assert (enhance.stage, enhance.job_id) == (Stage.UPLOADED, None)
+    assert not enhance.expired
+
+    # Finished tasks are pruned once their provider has forgotten them
+    assert len(journal.tasks()) == 3
+    later = time.time() + 31 * 24 * 3600
+    monkeypatch.setattr(time, "time", lambda: later)
+    assert enhance.expired
+    journal.prune()
+    assert [t.provider for t in journal.tasks()] == [DOLBY, DOLBY]
+
+
+def test_resume_finishes_jobs_of_a_killed_enhance(tmp_path, monkeypatch):
+    audio = tmp_path / "episode.wav"
+    audio.write_bytes(b"RIFF" + bytes(5000))
+    monkeypatch.setenv("DOLBY_API_KEY", "key")
+
+    def killed(dolby, jobs):
+        raise RuntimeError("killed")
+
+    with FakeProviderServer() as provider:
+        provider.job_duration = 0.2
+        monkeypatch.setattr(DolbyIO, "api_endpoint", provider.url("/media"))
+        runner = CliRunner()
+        with monkeypatch.context() as crash:
+            crash.setattr(dolby_cli, "display_status", killed)
+            result = runner.invoke(
+                app,
+                [
+                    "enhance",
+                    str(audio),
+                    "--all",
+                    "--no-cache",
+                    "--output",
+                    str(tmp_path),
+                ],
+                input="y\n",
+            )
+        assert str(result.exception) == "killed"
+
+        result = runner.invoke(app, ["resume"])
+        again = runner.invoke(app, ["resume"])
+        uploads = [path for path in provider.files if path.startswith("/storage/in/")]
+
+    assert result.exit_code == 0, result.output
+    assert "Resumed 3 of 3 jobs" in result.output
+    # Nothing was uploaded or submitted again
+    assert len(uploads) == 1
+    assert len(provider.jobs) == 3
+    assert (tmp_path / "episode - Enhanced.wav").read_bytes() == audio.read_bytes()
+    for tag in ("Analyzed", "Speech Analyzed"):
+        assert json.loads((tmp_path / f"episode - {tag}.json").read_text())
+    assert "No unfinished jobs" in again.output
+
+
+def test_resume_submits_an_uploaded_transcription(tmp_path, monkeypatch):
+    audio = tmp_path / "episode.wav"
+    audio.write_bytes(b"RIFF" + bytes(5000))
+    monkeypatch.setenv("ASSEMBLYAI_API_KEY", "key")
+
+    def killed(self, **params):
+        raise RuntimeError("killed")
+
+    with FakeProviderServer() as provider:
+        provider.job_duration = 0.2
+        monkeypatch.setattr(AssemblyAI, "api_endpoint", provider.url("/v2"))
+        runner = CliRunner()
+        with monkeypatch.context() as crash:
+            crash.setattr(AssemblyAI, "transcribe", killed)
+            result = runner.invoke(
+                app, ["transcribe", str(audio), "--no-cache"], input="n\nn\n"
+            )
+        assert str(result.exception) == "killed"
+
+        declined = runner.invoke(app, ["resume"], input="n\n")
+        result = runner.invoke(app, ["resume"], input="y\n")
+
+    assert declined.exit_code == 0
+    assert "Started job" not in declined.output
+    assert result.exit_code == 0, result.output
+    assert "Started job" in result.output
+    assert len(provider.jobs) == 1
+    assert len([path for path in provider.files if "upload" in path]) == 1
+    transcript = json.loads((tmp_path / "episode.json").read_text())
+    assert transcript["status"] == "completed"
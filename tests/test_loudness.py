@@ -0,0 +1,128 @@
+import json
+import re
+import shutil
+
+import ffmpeg
+import pytest
+from typer.testing import CliRunner
+
+from post_production.dolby import DolbyIO
+from post_production.main import app
+from post_production.stand_in import FakeProviderServer
+
+np = pytest.importorskip("numpy")
+
+from post_production.loudness import analyze_file, is_compliant  # noqa: E402
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="no ffmpeg")
+
+
+def stereo(path, expression, seconds):
+    """Write a 44.1 kHz file with the same aevalsrc expression in both channels"""
+    (
+        ffmpeg.input(f"aevalsrc={expression}:c=stereo:s=44100:d={seconds}", f="lavfi")
+        .output(str(path))
+        .run(overwrite_output=True, quiet=True)
+    )
+    return path
+
+
+def ebur128(path):
+    """The summary of ffmpeg's own loudness meter"""
+    _, stderr = (
+        ffmpeg.input(str(path))
+        .filter("ebur128", peak="true")
+        .output("-", f="null")
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    summary = stderr.decode().rsplit("Summary:", 1)[1]
+    return {
+        name: float(re.search(rf"{name}:\s+(-?[\d.]+)", summary).group(1))
+        for name in ("I", "LRA", "Peak")
+    }
+
+
+def test_tone_with_a_pause(tmp_path):
+    # A 997 Hz sine at -20 dBFS in both channels reads -20 LUFS
+    tone = "if(between(t\\,5\\,8)\\,0\\,0.1*sin(2*PI*997*t))"
+    episode = stereo(tmp_path / "episode.wav", tone, 13)
+
+    report = analyze_file(episode)
+
+    assert report["media_info"]["audio"]["channels"] == 2
+    assert report["processed_region"]["end"] == pytest.approx(13.0, abs=0.01)
+    audio = report["processed_region"]["audio"]
+    # Blocks that run into the pause pull the average down a little
+    assert audio["loudness"]["measured"] == pytest.approx(-20.1, abs=0.05)
+    assert audio["loudness"]["momentary_max"] == pytest.approx(-20.0, abs=0.05)
+    assert audio["loudness"]["true_peak"] == pytest.approx(-20.0, abs=0.05)
+    assert audio["clipping"]["num_sections"] == 0
+    [silence] = audio["silence"]["sections"]
+    assert silence["start"] == pytest.approx(5.0, abs=0.1)
+    assert silence["duration"] == pytest.approx(3.0, abs=0.1)
+    assert not is_compliant(report)
+    assert is_compliant(report, target=-20.0)
+
+
+def test_matches_ffmpeg_loudness(tmp_path):
+    # Pink noise that gets quieter, then louder, for a wide range
+    episode = tmp_path / "noise.wav"
+    (
+        ffmpeg.input("anoisesrc=d=12:a=0.3:c=pink", f="lavfi")
+        .filter("volume", "if(lt(t,4),1,if(lt(t,8),0.2,0.6))", eval="frame")
+        .output(str(episode), ac=2)
+        .run(overwrite_output=True, quiet=True)
+    )
+
+    measured = analyze_file(episode)["processed_region"]["audio"]["loudness"]
+    expected = ebur128(episode)
+
+    assert measured["measured"] == pytest.approx(expected["I"], abs=0.1)
+    assert measured["range"] == pytest.approx(expected["LRA"], abs=0.2)
+    assert measured["true_peak"] == pytest.approx(expected["Peak"], abs=0.2)
+
+
+def test_clipping_is_found(tmp_path):
+    loud = "if(lt(t\\,2)\\,0.1\\,2.5)*sin(2*PI*220*t)"
+    episode = stereo(tmp_path / "loud.wav", loud, 3)
+
+    audio = analyze_file(episode)["processed_region"]["audio"]
+
+    [clipped] = audio["clipping"]["sections"]
+    assert clipped["start"] == pytest.approx(2.0, abs=0.1)
+    assert clipped["duration"] == pytest.approx(1.0, abs=0.1)
+    assert audio["loudness"]["sample_peak"] == pytest.approx(0.0, abs=0.01)
+
+
+def test_enhance_skips_compliant_files(tmp_path, monkeypatch):
+    # -23 LUFS, the target Dolby.io would enhance it to
+    episode = stereo(tmp_path / "episode.wav", "0.0708*sin(2*PI*997*t)", 4)
+    monkeypatch.setenv("DOLBY_API_KEY", "key")
+
+    with FakeProviderServer() as provider:
+        monkeypatch.setattr(DolbyIO, "api_endpoint", provider.url("/media"))
+        result = CliRunner().invoke(
+            app,
+            [
+                "enhance",
+                str(episode),
+                "--all",
+                "--local-analysis",
+                "--skip-compliant",
+                "--no-cache",
+                "--output",
+                str(tmp_path),
+            ],
+            input="y\n",
+        )
+        uploads = [path for path in provider.files if path.startswith("/storage/in/")]
+
+    assert result.exit_code == 0, result.output
+    assert "already meets the loudness target" in result.output
+    # Only speech analysis is left for Dolby.io
+    assert len(uploads) == 1
+    assert not (tmp_path / "episode - Enhanced.wav").exists()
+    report = json.loads((tmp_path / "episode - Analyzed.json").read_text())
+    assert report["processed_region"]["audio"]["loudness"]["measured"] == (
+        pytest.approx(-23.0, abs=0.1)
+    )
@@ -0,0 +1,46 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+from post_production.main import COMMANDS, load_command
+
+PACKAGE_ROOT = Path(__file__).parent.parent
+
+LOADED_MODULES = """
+import json, sys
+from post_production.main import app
+try:
+    app(sys.argv[1:], prog_name="tppp")
+except SystemExit:
+    pass
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def loaded_modules(args, cwd):
+    result = subprocess.run(
+        [sys.executable, "-c", LOADED_MODULES, *args],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=cwd,
+        env={"PYTHONPATH": str(PACKAGE_ROOT)},
+    )
+    return set(json.loads(result.stdout.splitlines()[-1]))
+
+
+def test_help_imports_no_subcommands(tmp_path):
+    modules = loaded_modules(["--help"], tmp_path)
+    assert not modules & {"requests", "ffmpeg", "tabulate", "httpx", "sqlite3"}
+    assert not (tmp_path / "logs").exists()
+
+    modules = loaded_modules(["export", "--help"], tmp_path)
+    assert "post_production.export" in modules
+    assert not modules & {"requests", "ffmpeg", "post_production.dolby_cli"}
+    assert not (tmp_path / "logs").exists()
+
+
+def test_summaries_match_the_commands():
+    for name, (_, _, summary) in COMMANDS.items():
+        assert load_command(name).help.splitlines()[0] == summary
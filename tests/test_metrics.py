@@ -0,0 +1,82 @@
+import json
+
+from typer.testing import CliRunner
+
+from post_production.assembly_ai import AssemblyAI
+from post_production.cache import ASSEMBLYAI, DOLBY
+from post_production.dolby import DolbyIO, JobType
+from post_production.main import app
+from post_production.metrics import (
+    PROMETHEUS_FILE,
+    MetricsRecorder,
+    endpoint_label,
+    metrics,
+    read_runs,
+)
+from post_production.poller import JobPoller
+from post_production.stand_in import FakeProviderServer
+
+
+def test_endpoint_label_groups_ids():
+    api = "https://api.assemblyai.com/v2"
+    job = "c5r2z8wlu-f032-44c2-b288-f870e217db25"
+    assert endpoint_label(f"{api}/transcript/{job}", api) == "/transcript/{id}"
+    assert endpoint_label(f"{api}/transcript/{job}/srt", api) == "/transcript/{id}/srt"
+    assert endpoint_label(f"{api}/upload?x=1", api) == "/upload"
+    assert endpoint_label("https://storage.example.com/in/ep.wav", api) == "storage"
+
+
+def test_requests_and_stages_are_recorded(tmp_path, monkeypatch):
+    audio = tmp_path / "episode.wav"
+    audio.write_bytes(b"RIFF" + bytes(50000))
+    run_file = metrics.start("test", tmp_path / "metrics")
+    try:
+        with FakeProviderServer() as provider:
+            provider.job_duration = 0.1
+            monkeypatch.setattr(DolbyIO, "api_endpoint", provider.url("/media"))
+            monkeypatch.setattr(AssemblyAI, "api_endpoint", provider.url("/v2"))
+            dolby, assembly = DolbyIO("key"), AssemblyAI("key")
+            in_url = dolby.upload(audio)
+            job_id, out_url = dolby.enhance(in_url)
+            with JobPoller(min_interval=0.05, max_interval=0.1) as poller:
+                poller.register(DOLBY, dolby)
+                poller.track(DOLBY, job_id, JobType.ENHANCE).result()
+            dolby.download(out_url, out_path=tmp_path / "out.wav")
+            assembly.upload(audio)
+    finally:
+        metrics.close()
+
+    events = [json.loads(line) for line in run_file.read_text().splitlines()]
+    assert events[0] == {**events[0], "type": "run", "command": "test"}
+    stages = {(e["stage"], e["provider"]): e for e in events if e["type"] == "stage"}
+    assert stages["upload", DOLBY]["bytes"] == audio.stat().st_size
+    assert stages["download", DOLBY]["bytes"] == audio.stat().st_size
+    assert stages["job", DOLBY]["polls"] >= 1
+    assert ("upload", ASSEMBLYAI) in stages
+
+    requests = [e for e in events if e["type"] == "request"]
+    assert {e["endpoint"] for e in requests} >= {"/input", "/enhance", "storage"}
+    uploads = [e for e in requests if e["method"] == "PUT"]
+    assert uploads[0]["bytes_sent"] == audio.stat().st_size
+
+    textfile = (tmp_path / "metrics" / PROMETHEUS_FILE).read_text()
+    assert (
+        'tppp_stages_total{stage="upload",provider="dolby",status="ok"} 1' in textfile
+    )
+    assert 'tppp_request_bytes_total{provider="dolby",endpoint="storage"' in textfile
+
+
+def test_stats_summarizes_runs(tmp_path):
+    recorder = MetricsRecorder()
+    for seconds in (1.0, 3.0):
+        recorder.start("enhance", tmp_path)
+        recorder.record(
+            "stage", stage="upload", provider=DOLBY, seconds=seconds, status="ok"
+        )
+        recorder.close()
+    assert len(list(read_runs(tmp_path))) == 2
+
+    result = CliRunner().invoke(app, ["stats", "--metrics-dir", str(tmp_path)])
+    assert result.exit_code == 0, result.output
+    assert "2 runs: 2 enhance" in result.output
+    assert "upload" in result.output and "4.0" in result.output
@@ -0,0 +1,76 @@
+import array
+import shutil
+
+import ffmpeg
+import pytest
+
+from post_production.parallel_encoding import MP3_DELAY, mp3_frames, plan_parts
+from post_production.render_cache import RenderCache
+from post_production.transcoding import Rendition, _transcode
+from tests.test_render_cache import tone
+
+
+def decode(path):
+    """The samples of a file as ffmpeg's decoders give them, gapless info applied"""
+    out, _ = (
+        ffmpeg.input(str(path))
+        .output("-", f="s16le", ac=1)
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return array.array("h", out)
+
+
+def test_parts_start_on_frame_boundaries():
+    parts = plan_parts(100_000, 3, 1152, MP3_DELAY)
+
+    # ceil((100000 + 1105) / 1152) frames in all, in three near equal parts
+    assert [(p.first_frame, p.frames) for p in parts] == [(0, 29), (29, 30), (59, 29)]
+    for part in parts:
+        assert part.start % 1152 == 0
+        assert part.start == (part.first_frame - part.skip) * 1152
+    assert [p.skip for p in parts] == [0, 3, 3]
+    # Each encoder reads on past its part, but not past the end
+    assert parts[0].end == (29 + 3) * 1152
+    assert parts[-1].end == 100_000
+
+    # A long warm up is cut short by the start of the stream
+    parts = plan_parts(100_000, 3, 1024, 1024, preroll_frames=40)
+    assert [p.skip for p in parts] == [0, 33, 40]
+    assert plan_parts(1000, 8, 1152, MP3_DELAY)[-1].index == 1
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="no ffmpeg")
+def test_parts_join_into_the_same_audio(tmp_path):
+    episode = tone(tmp_path / "episode.wav", seconds=20)
+    intro = tone(tmp_path / "intro.wav", frequency=880, seconds=5)
+    outro = tone(tmp_path / "outro.wav", frequency=660, seconds=3)
+    renditions = [Rendition.master, Rendition.mobile, Rendition.aac, Rendition.opus]
+    renders = RenderCache(tmp_path / "renders")
+
+    serial = _transcode(
+        episode, tmp_path / "serial.mp3", intro, outro, renders, renditions
+    )
+    parallel = _transcode(
+        episode, tmp_path / "parallel.mp3", intro, outro, renders, renditions, jobs=3
+    )
+
+    for rendition in renditions:
+        expected, found = decode(serial[rendition]), decode(parallel[rendition])
+        # Not a sample more or less, so the joins add no gaps
+        assert len(found) == len(expected), rendition
+        # Lossy encoders differ a little, a gap or click at a join by far more
+        worst = max(abs(a - b) for a, b in zip(expected, found))
+        assert worst < 0.05 * 32768 * 0.1, rendition
+    data = parallel[Rendition.master].read_bytes()
+    assert data.startswith(b"ID3")
+    assert len(list(mp3_frames(data))) == len(
+        list(mp3_frames(serial[Rendition.master].read_bytes()))
+    )
+    # Only the outputs are left behind
+    assert sorted(p.name for p in tmp_path.glob("parallel*")) == [
+        "parallel - aac.m4a",
+        "parallel - mobile.mp3",
+        "parallel - opus.opus",
+        "parallel.mp3",
+    ]
+    assert not list(tmp_path.glob(".transcode-*"))
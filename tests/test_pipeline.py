@@ -0,0 +1,118 @@
+import json
+import shutil
+
+import pytest
+
+from post_production.assembly_ai import AssemblyAI
+from post_production.batch import BatchProgress
+from post_production.cache import ASSEMBLYAI, DOLBY
+from post_production.dolby import DolbyIO
+from post_production.pipeline import (
+    LOCAL,
+    MANIFEST,
+    PipelineRunner,
+    StageManifest,
+    load_spec,
+)
+from post_production.poller import JobPoller
+from post_production.render_cache import RenderCache
+from post_production.stand_in import FakeProviderServer
+from tests.test_render_cache import tone
+
+STAGES = [
+    {"name": "export", "uses": "export", "input": "transcribe"},
+    {"name": "transcode", "uses": "transcode", "params": {"intro_music": "intro.wav"}},
+    {"name": "enhance", "uses": "enhance", "input": "transcode"},
+    {"name": "transcribe", "uses": "transcribe", "input": "enhance"},
+]
+
+
+def write_spec(path, stages):
+    path.write_text(json.dumps({"episodes": ["*.wav"], "stages": stages}))
+    return path
+
+
+def test_spec_stages_are_ordered_and_checked(tmp_path):
+    spec = load_spec(write_spec(tmp_path / "spec.json", STAGES))
+
+    assert [s.name for s in spec.stages] == [
+        "transcode",
+        "enhance",
+        "transcribe",
+        "export",
+    ]
+    assert spec.stages[0].params["intro_music"] == str(tmp_path / "intro.wav")
+    assert spec.output == tmp_path / "output"
+
+    cycle = [
+        {"name": "a", "uses": "export", "input": "b"},
+        {"name": "b", "uses": "export", "input": "a"},
+    ]
+    with pytest.raises(ValueError, match="cycle"):
+        load_spec(write_spec(tmp_path / "cycle.json", cycle))
+    with pytest.raises(ValueError, match="unknown step"):
+        load_spec(write_spec(tmp_path / "bad.json", [{"name": "a", "uses": "mix"}]))
+
+
+def run_pipeline(spec_file, episodes, renders):
+    spec = load_spec(spec_file)
+    progress = BatchProgress(episodes, [s.name for s in spec.stages])
+    with JobPoller(min_interval=0.05, max_interval=0.1) as poller:
+        poller.register(DOLBY, DolbyIO("key"))
+        poller.register(ASSEMBLYAI, AssemblyAI("key"))
+        runner = PipelineRunner(
+            spec,
+            StageManifest(spec.output / MANIFEST),
+            progress,
+            {LOCAL: 1, DOLBY: 2, ASSEMBLYAI: 2},
+            poller,
+            keys={DOLBY: "key", ASSEMBLYAI: "key"},
+            renders=renders,
+        )
+        return runner.run(episodes)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="no ffmpeg")
+def test_unchanged_stages_are_skipped(tmp_path, monkeypatch):
+    episodes = [tone(tmp_path / f"ep{i}.wav", frequency=220 * (i + 1)) for i in (0, 1)]
+    tone(tmp_path / "intro.wav", frequency=880, seconds=5)
+    stages = [dict(stage) for stage in STAGES]
+    spec_file = write_spec(tmp_path / "spec.json", stages)
+
+    def run(spec_file):
+        return run_pipeline(spec_file, episodes, RenderCache(tmp_path / "renders"))
+
+    with FakeProviderServer() as provider:
+        provider.job_duration = 0.1
+        monkeypatch.setattr(DolbyIO, "api_endpoint", provider.url("/media"))
+        monkeypatch.setattr(AssemblyAI, "api_endpoint", provider.url("/v2"))
+
+        assert run(spec_file)["done"] == 8
+        exported = tmp_path / "output" / "ep1" / "ep1 - Enhanced - transcript.txt"
+        assert "Welcome back." in exported.read_text()
+        assert run(spec_file)["up to date"] == 8
+
+        # Only the stage whose params changed, and nothing upstream, runs again
+        stages[0]["params"] = {"formats": ["vtt"]}
+        counts = run(write_spec(spec_file, stages))
+        assert (counts["done"], counts["up to date"]) == (2, 6)
+
+        tone(tmp_path / "intro.wav", frequency=440, seconds=5)
+        counts = run(spec_file)
+        assert (counts["done"], counts["up to date"]) == (8, 0)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="no ffmpeg")
+def test_transcripts_are_written_to_the_output(tmp_path, monkeypatch):
+    episode = tone(tmp_path / "ep0.wav")
+    stages = [{"name": "transcribe", "uses": "transcribe"}]
+    spec_file = write_spec(tmp_path / "spec.json", stages)
+
+    with FakeProviderServer() as provider:
+        provider.job_duration = 0.1
+        monkeypatch.setattr(AssemblyAI, "api_endpoint", provider.url("/v2"))
+        counts = run_pipeline(spec_file, [episode], RenderCache(tmp_path / "renders"))
+
+    assert counts["done"] == 1
+    assert (tmp_path / "output" / "ep0" / "ep0.json").exists()
+    assert not (tmp_path / "ep0.json").exists()
@@ -0,0 +1,97 @@
+import requests
+
+from post_production import poller as poller_module
+from post_production.cache import ASSEMBLYAI, DOLBY
+from post_production.dolby import JobType
+from post_production.poller import JobPoller
+
+
+class FakeDolby:
+    def __init__(self, steps):
+        self._session = requests.Session()
+        self.steps = steps
+        self.calls = 0
+
+    def get_status(self, job_id, job_type=JobType.ENHANCE):
+        step = self.steps[min(self.calls, len(self.steps) - 1)]
+        self.calls += 1
+        return step
+
+
+class FakeAssemblyAI:
+    def __init__(self, finish_after):
+        self._session = requests.Session()
+        self.finish_after = finish_after
+        self.calls = 0
+
+    def status(self, job_id):
+        self.calls += 1
+        status = "completed" if self.calls > self.finish_after else "processing"
+        return {"id": job_id, "status": status}
+
+
+def test_poller_resolves_jobs_from_both_providers():
+    dolby = FakeDolby([("Running", 20), ("Running", 60), ("Success", 100)])
+    assembly = FakeAssemblyAI(finish_after=2)
+    updates = []
+
+    with JobPoller(min_interval=0.01, max_interval=0.05) as poller:
+        poller.register(DOLBY, dolby)
+        poller.register(ASSEMBLYAI, assembly)
+        enhanced = poller.track(DOLBY, "job-1", JobType.ENHANCE, updates.append)
+        transcript = poller.track(ASSEMBLYAI, "job-2")
+
+        assert enhanced.result(timeout=5).status == "Success"
+        assert transcript.result(timeout=5).data["status"] == "completed"
+
+    assert [u.progress for u in updates] == [20, 60, 100]
+    assert poller.stats.completed == 2
+    assert poller.stats.requests == dolby.calls + assembly.calls
+    assert poller.stats.requests_per_job == 3.0
+
+
+def test_poller_backs_off_without_progress():
+    poller = JobPoller(min_interval=1, max_interval=10, backoff=2)
+    poller.register(ASSEMBLYAI, FakeAssemblyAI(finish_after=100))
+    job = type("Job", (), {"interval": 0.0, "history": []})()
+
+    intervals = [poller._next_interval(job) for _ in range(6)]
+
+    assert intervals[0] < intervals[2] < intervals[4]
+    assert job.interval == 10
+
+
+def test_poller_waits_for_estimated_completion():
+    poller = JobPoller(min_interval=1, max_interval=60)
+    job = type("Job", (), {"interval": 1.0, "history": [(0.0, 10), (10.0, 20)]})()
+
+    # 10% per 10 seconds with 80% to go: check again in about 40 seconds
+    assert 36 <= poller._next_interval(job) <= 44
+
+
+def test_poller_fails_jobs_whose_callback_raises():
+    def on_update(update):
+        raise RuntimeError("display went away")
+
+    with JobPoller(min_interval=0.01) as poller:
+        poller.register(DOLBY, FakeDolby([("Running", 20)]))
+        future = poller.track(DOLBY, "job-1", JobType.ENHANCE, on_update)
+
+        assert isinstance(future.exception(timeout=5), RuntimeError)
+        assert poller.pending() == 0
+
+
+def test_early_pokes_are_remembered_for_a_while(monkeypatch):
+    monkeypatch.setattr(poller_module, "MAX_EARLY_POKES", 2)
+    dolby = FakeDolby([("Success", 100)])
+
+    with JobPoller(min_interval=0.01) as poller:
+        poller.register(DOLBY, dolby)
+        # A webhook that beats track() still cuts the wait short
+        assert not poller.poke(DOLBY, "job-1")
+        future = poller.track(DOLBY, "job-1", JobType.ENHANCE, delay=60)
+        assert future.result(timeout=5).status == "Success"
+
+        for job_id in ("job-2", "job-3", "job-4"):
+            poller.poke(DOLBY, job_id)
+        assert list(poller._early_pokes) == [(DOLBY, "job-3"), (DOLBY, "job-4")]
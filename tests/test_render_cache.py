@@ -0,0 +1,79 @@
+import os
+import shutil
+import threading
+import time
+
+import ffmpeg
+import pytest
+
+from post_production import render_cache
+from post_production.render_cache import Loudnorm, RenderCache, measure_loudness
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="no ffmpeg")
+
+
+def tone(path, frequency=440, seconds=3, volume=0.1):
+    (
+        ffmpeg.input(f"sine=f={frequency}:d={seconds}", f="lavfi")
+        .filter("volume", volume)
+        .output(str(path))
+        .run(overwrite_output=True, quiet=True)
+    )
+    return path
+
+
+def test_renders_are_normalized_and_reused(tmp_path, monkeypatch):
+    intro = tone(tmp_path / "intro.wav", volume=0.05)
+    renders = RenderCache(tmp_path / "renders")
+
+    rendered = renders.render(intro)
+    measured = measure_loudness(rendered, Loudnorm())
+    assert abs(float(measured["input_i"]) - -23) < 1
+
+    def render_again(*args):
+        raise AssertionError("cached render was not reused")
+
+    monkeypatch.setattr(render_cache, "normalize_loudness", render_again)
+    assert renders.render(intro) == rendered
+    assert RenderCache(tmp_path / "renders").render(intro) == rendered
+    assert renders.key(intro) != RenderCache(target=Loudnorm(i=-16)).key(intro)
+
+
+def test_least_recently_used_renders_are_evicted(tmp_path):
+    assets = [tone(tmp_path / f"{f}.wav", frequency=f) for f in (220, 440, 880)]
+    renders = RenderCache(tmp_path / "renders", max_bytes=None)
+    first, second, _ = [renders.render(asset) for asset in assets]
+    os.utime(first, ns=(1, 1))
+    os.utime(second, ns=(2, 2))
+    renders.render(assets[0])
+
+    renders.max_bytes = renders.size() - 1
+    assert renders.evict() == 1
+    assert first.exists() and not second.exists()
+
+
+def test_the_same_asset_renders_from_two_threads(tmp_path, monkeypatch):
+    intro = tone(tmp_path / "intro.wav")
+    renders = RenderCache(tmp_path / "renders")
+    normalize = render_cache.normalize_loudness
+    both_rendering = threading.Barrier(2)
+
+    def slow_normalize(asset, out_file, target):
+        both_rendering.wait(5)
+        normalize(asset, out_file, target)
+        time.sleep(0.1)
+
+    monkeypatch.setattr(render_cache, "normalize_loudness", slow_normalize)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(renders.render(intro)))
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 2 and results[0] == results[1]
+    assert abs(float(measure_loudness(results[0], Loudnorm())["input_i"]) + 23) < 1
+    assert not list(renders.path.glob("*.part"))
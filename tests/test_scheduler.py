@@ -0,0 +1,152 @@
+import asyncio
+import io
+import threading
+import time
+
+import pytest
+import requests
+
+from post_production.assembly_ai import AssemblyAI
+from post_production.cache import ASSEMBLYAI
+from post_production.scheduler import (
+    Priority,
+    RateLimit,
+    RequestScheduler,
+    ScheduledSession,
+    replayable,
+    retry_after,
+)
+from post_production.stand_in import FakeProviderServer
+
+
+def response(status, **headers):
+    r = requests.Response()
+    r.status_code = status
+    r.headers.update(headers)
+    return r
+
+
+def test_bucket_paces_requests_after_a_burst():
+    scheduler = RequestScheduler("test", RateLimit(rate=20.0, burst=5, concurrency=8))
+
+    start = time.monotonic()
+    for _ in range(10):
+        scheduler.acquire()
+        scheduler.release()
+    elapsed = time.monotonic() - start
+
+    # Five go at once, the other five at 20 a second
+    assert 0.2 <= elapsed < 0.5
+    assert scheduler.stats.requests == 10
+    assert scheduler.stats.queued_seconds > 0
+
+
+def test_waiting_requests_go_by_priority():
+    scheduler = RequestScheduler("test", RateLimit(rate=100.0, burst=10, concurrency=1))
+    order = []
+    scheduler.acquire()
+
+    def send(name, priority):
+        scheduler.acquire(priority)
+        order.append(name)
+        scheduler.release()
+
+    threads = []
+    for name, priority in [
+        ("submit", Priority.SUBMIT),
+        ("upload", Priority.TRANSFER),
+        ("poll", Priority.POLL),
+    ]:
+        threads.append(threading.Thread(target=send, args=(name, priority)))
+        threads[-1].start()
+        time.sleep(0.05)
+    scheduler.release()
+    for thread in threads:
+        thread.join()
+
+    assert order == ["poll", "upload", "submit"]
+
+
+def test_coroutines_wait_in_the_same_queue_as_threads():
+    scheduler = RequestScheduler("test", RateLimit(rate=100.0, burst=10, concurrency=1))
+
+    async def main():
+        scheduler.acquire()
+        cancelled = asyncio.ensure_future(scheduler.acquire_async(Priority.POLL))
+        await asyncio.sleep(0.05)
+        assert not cancelled.done()
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+
+        # A thread's release wakes the coroutine, which is not stuck behind
+        # the cancelled request
+        threading.Timer(0.1, scheduler.release).start()
+        waited = await asyncio.wait_for(scheduler.acquire_async(Priority.SUBMIT), 1)
+        scheduler.release()
+        return waited
+
+    assert asyncio.run(main()) >= 0.09
+    assert scheduler.stats.requests == 2
+
+
+def test_retry_after_is_honored(monkeypatch):
+    with FakeProviderServer() as provider:
+        provider.rate_limit = 5
+        monkeypatch.setattr(AssemblyAI, "api_endpoint", provider.url("/v2"))
+        client = AssemblyAI("key")
+        client._session.scheduler = RequestScheduler(
+            ASSEMBLYAI, RateLimit(rate=1000.0, burst=1000, concurrency=8)
+        )
+
+        job_ids = [client.transcribe(audio_url="https://x/a.mp3") for _ in range(8)]
+        stats = client._session.scheduler.stats
+
+    # Every job was created once, despite the 429s
+    assert len(set(job_ids)) == 8
+    assert len(provider.jobs) == 8
+    assert provider.throttled > 0
+    assert stats.retries == provider.throttled
+    assert stats.throttled == provider.throttled
+    assert stats.throttle_seconds > 0
+
+
+def test_new_jobs_are_only_resent_when_the_provider_refused_them():
+    session = ScheduledSession(ASSEMBLYAI, AssemblyAI("key"), backoff=0.01)
+    session.scheduler = RequestScheduler(
+        ASSEMBLYAI, RateLimit(rate=1000.0, burst=1000, concurrency=8)
+    )
+
+    # The job may have been created before the server failed
+    assert session._retry_wait(response(500), None, False, 0) is None
+    assert session._retry_wait(response(500), None, True, 0) is not None
+    assert session._retry_wait(response(429), None, False, 0) is not None
+    assert (
+        session._retry_wait(response(503, **{"Retry-After": "2"}), None, False, 0) == 2
+    )
+    assert session._retry_wait(response(400), None, True, 0) is None
+    # A read timeout may have reached the provider, a refused connect did not
+    assert session._retry_wait(None, requests.ReadTimeout(), False, 0) is None
+    assert session._retry_wait(None, requests.ConnectTimeout(), False, 0) is not None
+    assert session._retry_wait(response(429), None, True, 5) is None
+    # A long Retry-After is given up on
+    assert (
+        session._retry_wait(response(429, **{"Retry-After": "3600"}), None, True, 0)
+        is None
+    )
+
+
+def test_retry_after_and_replayable_bodies():
+    assert retry_after(response(429, **{"Retry-After": "1.5"})) == 1.5
+    assert (
+        retry_after(response(429, **{"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}))
+        == 0
+    )
+    assert retry_after(response(429)) is None
+
+    body = io.BytesIO(b"audio")
+    body.read()
+    assert replayable(body)
+    assert body.read() == b"audio"
+    assert replayable(b"audio")
+    assert not replayable(chunk for chunk in [b"audio"])
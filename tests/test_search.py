@@ -0,0 +1,64 @@
+import json
+import os
+
+from post_production.search import TranscriptIndex, find_transcripts
+
+
+def write_transcript(path, text, speaker="A", step=500):
+    words = [
+        {"text": token, "start": i * step, "end": (i + 1) * step, "speaker": speaker}
+        for i, token in enumerate(text.split())
+    ]
+    path.write_text(json.dumps({"status": "completed", "text": text, "words": words}))
+
+
+def test_search_terms_prefixes_and_phrases(tmp_path):
+    write_transcript(tmp_path / "ep1.json", "We love Pandas. Pandas and data science.")
+    write_transcript(tmp_path / "ep2.json", "Data scientists use pandas too", "B")
+    archive = TranscriptIndex(tmp_path / "index")
+    archive.update(find_transcripts([tmp_path]), segment_size=1)
+
+    hits = TranscriptIndex(tmp_path / "index").search("pandas")
+    assert [(os.path.basename(h.episode), h.start, h.speaker) for h in hits] == [
+        ("ep1.json", 1000, "A"),
+        ("ep1.json", 1500, "A"),
+        ("ep2.json", 1500, "B"),
+    ]
+    assert [h.text for h in archive.search("data scien*")] == [
+        "data science",
+        "data scientists",
+    ]
+    assert [h.start for h in archive.search('"pandas and"')] == [1500]
+    assert archive.search("science pandas") == []
+    assert len(archive.search("pandas", limit=2)) == 2
+
+
+def test_update_only_indexes_new_and_changed_transcripts(tmp_path):
+    first, second = tmp_path / "ep1.json", tmp_path / "ep2.json"
+    write_transcript(first, "talking about python")
+    write_transcript(second, "talking about turtles")
+    archive = TranscriptIndex(tmp_path / "index")
+    assert archive.update([first, second]).added == 2
+
+    write_transcript(first, "talking about pandas")
+    os.utime(first, ns=(1, 1))
+    second.unlink()
+    stats = archive.update(find_transcripts([tmp_path]))
+
+    assert (stats.added, stats.unchanged, stats.removed) == (1, 0, 1)
+    assert archive.search("python") == []
+    assert archive.search("turtles") == []
+    assert [os.path.basename(h.episode) for h in archive.search("pandas")] == [
+        "ep1.json"
+    ]
+    assert archive.update([first]).unchanged == 1
+
+
+def test_segments_open_on_first_search(tmp_path):
+    write_transcript(tmp_path / "ep1.json", "hello world")
+    TranscriptIndex(tmp_path / "index").update([tmp_path / "ep1.json"])
+
+    archive = TranscriptIndex(tmp_path / "index")
+    assert archive._segments == {}
+    assert archive.search("hello")[0].start == 0
+    assert len(archive._segments) == 1
@@ -0,0 +1,144 @@
+import json
+import shutil
+
+import ffmpeg
+import pytest
+
+from post_production.assembly_ai import AssemblyAI, UploadFormat
+from post_production.cache import ASSEMBLYAI, ResultCache
+from post_production.poller import JobPoller
+from post_production.segments import (
+    Segment,
+    find_silences,
+    plan_segments,
+    stitch,
+    transcribe_segments,
+)
+from post_production.stand_in import FakeProviderServer
+
+
+def word(text, start, end, speaker):
+    return {
+        "text": text,
+        "start": start,
+        "end": end,
+        "confidence": 0.9,
+        "speaker": speaker,
+    }
+
+
+def test_cuts_go_in_the_nearest_silence():
+    silences = [(290.0, 291.0), (330.0, 332.0), (640.0, 650.0)]
+    segments = plan_segments(silences, 900.0, 300.0, overlap=30.0)
+
+    assert [(s.start, s.end) for s in segments] == [
+        (0.0, 290.5),
+        (290.5, 645.0),
+        (645.0, 900.0),
+    ]
+    assert [s.audio_end for s in segments] == [320.5, 675.0, 900.0]
+
+    # Nothing within a quarter of a part of the even split
+    segments = plan_segments([(100.0, 101.0)], 600.0, 300.0)
+    assert [(s.start, s.end) for s in segments] == [(0.0, 300.0), (300.0, 600.0)]
+    assert plan_segments([], 120.0, 300.0) == [Segment(0, 0.0, 120.0, 120.0)]
+
+
+def test_stitching_offsets_words_and_matches_speakers():
+    segments = [Segment(0, 0.0, 10.0, 12.0), Segment(1, 10.0, 20.0, 20.0)]
+    first = {
+        "id": "job-1",
+        "words": [
+            word("Hi", 1000, 1500, "A"),
+            word("there.", 9000, 9800, "B"),
+            word("Shared", 10200, 10800, "B"),
+            word("words.", 11000, 11800, "A"),
+        ],
+    }
+    # AssemblyAI labels the second part's speakers in its own order
+    second = {
+        "id": "job-2",
+        "words": [
+            word("Shared", 200, 800, "A"),
+            word("words.", 1000, 1800, "B"),
+            word("New", 5000, 5500, "C"),
+            word("voice.", 6000, 6500, "B"),
+        ],
+    }
+
+    transcript = stitch(segments, [first, second])
+
+    assert [(w["text"], w["start"], w["speaker"]) for w in transcript.words] == [
+        ("Hi", 1000, "A"),
+        ("there.", 9000, "B"),
+        ("Shared", 10200, "B"),
+        ("words.", 11000, "A"),
+        ("New", 15000, "C"),
+        ("voice.", 16000, "A"),
+    ]
+    assert [(u["speaker"], u["text"]) for u in transcript.utterances] == [
+        ("A", "Hi"),
+        ("B", "there. Shared"),
+        ("A", "words."),
+        ("C", "New"),
+        ("A", "voice."),
+    ]
+    assert transcript.text == "Hi there. Shared words. New voice."
+    assert transcript.segment_ids == ["job-1", "job-2"]
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="no ffmpeg")
+def test_parts_are_cut_at_silences_and_stitched(tmp_path, monkeypatch):
+    # 6 s of tone, 2 s of silence, 6 s of tone
+    episode = tmp_path / "episode.wav"
+    tone = ffmpeg.input("sine=f=440:d=6", f="lavfi")
+    silence = ffmpeg.input("anullsrc=r=44100:cl=mono:d=2", f="lavfi")
+    (
+        ffmpeg.concat(
+            tone, silence, ffmpeg.input("sine=f=440:d=6", f="lavfi"), v=0, a=1
+        )
+        .output(str(episode), ar=44100, ac=1)
+        .run(overwrite_output=True, quiet=True)
+    )
+
+    silences, duration = find_silences(episode)
+    assert duration == pytest.approx(14.0, abs=0.05)
+    assert len(silences) == 1
+    assert silences[0][0] == pytest.approx(6.0, abs=0.1)
+    assert silences[0][1] == pytest.approx(8.0, abs=0.1)
+
+    out_file = tmp_path / "episode.json"
+    with FakeProviderServer() as provider:
+        provider.job_duration = 0.1
+        monkeypatch.setattr(AssemblyAI, "api_endpoint", provider.url("/v2"))
+        client = AssemblyAI("key")
+        result_cache = ResultCache(tmp_path / "cache.db")
+        with JobPoller(min_interval=0.05, max_interval=0.1) as poller:
+            poller.register(ASSEMBLYAI, client)
+            transcript = transcribe_segments(
+                client,
+                episode,
+                out_file,
+                {"speaker_labels": True},
+                poller,
+                segment_seconds=10,
+                upload_format=UploadFormat.original,
+                workers=2,
+                result_cache=result_cache,
+                content_hash="abc",
+            )
+        uploads = [body for path, body in provider.files.items() if "upload" in path]
+
+    # Both parts went up as flac, cut in the middle of the silence
+    assert len(uploads) == 2
+    assert all(bytes(body).startswith(b"fLaC") for body in uploads)
+    assert len(transcript.segment_ids) == 2
+    starts = [w["start"] for w in transcript.words]
+    assert starts == [0, 500, 1200, 1600, 7000, 7500, 8200, 8600]
+    # The fake says nothing where the parts overlap, so no speaker is matched
+    assert transcript.speaker_ids == ["A", "B", "C", "D"]
+
+    saved = json.loads(out_file.read_text())
+    assert saved["segment_ids"] == transcript.segment_ids
+    assert len(saved["utterances"]) == 4
+    assert not (tmp_path / "episode.json.part").exists()
@@ -0,0 +1,72 @@
+import shutil
+import wave
+from pathlib import Path
+from urllib.parse import urlparse
+
+import ffmpeg
+import pytest
+
+from post_production.assembly_ai import AssemblyAI, UploadFormat
+from post_production.render_cache import RenderCache
+from post_production.stand_in import FakeProviderServer
+from post_production.transcoding import (
+    Rendition,
+    _transcode,
+    encode_stream,
+    rendition_path,
+)
+from tests.test_render_cache import tone
+
+
+def test_rendition_paths_sit_next_to_the_master():
+    master = Path("out/episode.mp3")
+    assert rendition_path(master, Rendition.master) == master
+    assert rendition_path(master, Rendition.mobile) == Path("out/episode - mobile.mp3")
+    assert rendition_path(master, Rendition.transcription) == Path(
+        "out/episode - transcription.wav"
+    )
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="no ffmpeg")
+def test_renditions_share_one_graph(tmp_path):
+    episode = tone(tmp_path / "episode.wav", seconds=6)
+    intro = tone(tmp_path / "intro.wav", frequency=880, seconds=5)
+    renditions = [Rendition.master, Rendition.opus, Rendition.transcription]
+
+    paths = _transcode(
+        episode,
+        tmp_path / "episode.mp3",
+        intro,
+        None,
+        RenderCache(tmp_path / "renders"),
+        renditions,
+    )
+
+    assert list(paths) == renditions
+    assert all(path.stat().st_size > 0 for path in paths.values())
+    with wave.open(str(paths[Rendition.transcription])) as transcription:
+        assert transcription.getframerate() == 16000
+        assert transcription.getnchannels() == 1
+        # 5 s of intro crossfaded over 4 s into 6 s of episode
+        assert transcription.getnframes() == pytest.approx(7 * 16000, rel=0.01)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="no ffmpeg")
+def test_compressed_uploads_stream_from_ffmpeg(tmp_path, monkeypatch):
+    episode = tone(tmp_path / "episode.wav", seconds=20)
+    with FakeProviderServer() as provider:
+        monkeypatch.setattr(AssemblyAI, "api_endpoint", provider.url("/v2"))
+        client = AssemblyAI("key")
+        urls = {f: client.upload(episode, f) for f in UploadFormat}
+        bodies = {f: bytes(provider.files[urlparse(u).path]) for f, u in urls.items()}
+
+    assert bodies[UploadFormat.original] == episode.read_bytes()
+    assert bodies[UploadFormat.flac].startswith(b"fLaC")
+    assert bodies[UploadFormat.opus].startswith(b"OggS")
+    assert len(bodies[UploadFormat.opus]) * 10 < episode.stat().st_size
+    assert list(tmp_path.iterdir()) == [episode]
+
+    not_audio = tmp_path / "notes.wav"
+    not_audio.write_text("not audio")
+    with pytest.raises(ffmpeg.Error):
+        list(encode_stream(not_audio, {"f": "flac"}))
@@ -0,0 +1,194 @@
+import contextlib
+import json
+import time
+
+import click_spinner
+from typer.testing import CliRunner
+
+from post_production import assembly_ai_cli, main
+from post_production.assembly_ai import AssemblyAI, TranscriptResult
+from post_production.stand_in import FakeProviderServer
+from post_production.transcript import TranscriptParser, iter_transcript
+
+
+def make_words():
+    return [
+        {"text": "Hello", "start": 0, "end": 400, "confidence": 0.98, "speaker": "A"},
+        {
+            "text": "everyone.",
+            "start": 400,
+            "end": 900,
+            "confidence": 0.9,
+            "speaker": "A",
+        },
+        {"text": "Hi", "start": 1000, "end": 1200, "confidence": 0.95, "speaker": "B"},
+        {
+            "text": "Kelly.",
+            "start": 1200,
+            "end": 1600,
+            "confidence": 0.87,
+            "speaker": "B",
+        },
+    ]
+
+
+def make_result():
+    words = make_words()
+    utterances = [
+        {
+            "speaker": speaker,
+            "text": " ".join(w["text"] for w in spoken),
+            "start": spoken[0]["start"],
+            "end": spoken[-1]["end"],
+            "confidence": 0.93,
+            "words": spoken,
+        }
+        for speaker, spoken in (("A", words[:2]), ("B", words[2:]))
+    ]
+    return {
+        "id": "transcript-1",
+        "status": "completed",
+        "text": " ".join(w["text"] for w in words),
+        "words": words,
+        "utterances": utterances,
+        "audio_duration": 2,
+        "speaker_labels": True,
+    }
+
+
+def test_rows_read_like_the_response():
+    transcript = TranscriptResult(**make_result())
+
+    assert transcript.id == "transcript-1"
+    assert transcript.speaker_labels is True
+    assert [dict(w) for w in transcript.words] == make_words()
+    assert transcript.words[-1]["text"] == "Kelly."
+    assert transcript.speaker_ids == ["A", "B"]
+
+    second = transcript.utterances[1]
+    assert second.get("speaker") == "B"
+    assert second["text"] == "Hi Kelly."
+    assert [w.text for w in second.words] == ["Hi", "Kelly."]
+
+
+def test_words_come_from_utterances_without_top_level_words():
+    result = make_result()
+    del result["words"]
+    transcript = TranscriptResult(**result)
+
+    assert len(transcript.words) == 4
+    assert transcript.utterances[0].words.text() == "Hello everyone."
+
+
+def test_between_slices_by_time():
+    transcript = TranscriptResult(**make_result())
+
+    assert [w.text for w in transcript.words.between(350, 1100)] == [
+        "Hello",
+        "everyone.",
+        "Hi",
+    ]
+    assert len(transcript.words.between(900, 1000)) == 0
+    assert [u.speaker for u in transcript.utterances.between(1500, 5000)] == ["B"]
+    assert transcript.words[1:3].between(0, 5000).text() == "everyone. Hi"
+
+
+def test_as_txt_without_prompts():
+    transcript = TranscriptResult(**make_result())
+
+    assert transcript.as_txt(prompt_speaker_labels=False) == (
+        "A:\nHello everyone.\n\nB:\nHi Kelly.\n"
+    )
+
+
+def test_parser_yields_items_across_chunk_boundaries():
+    result = make_result()
+    result["confidence"] = 0.91234
+    body = json.dumps(result).encode()
+    parser = TranscriptParser()
+    events = []
+    for i in range(len(body)):
+        events.extend(parser.feed(body[i : i + 1]))
+    events.extend(parser.close())
+
+    assert [v for k, v in events if k == "words"] == result["words"]
+    assert [v["text"] for k, v in events if k == "utterances"] == [
+        "Hello everyone.",
+        "Hi Kelly.",
+    ]
+    assert ("confidence", 0.91234) in events
+    assert ("words", None) not in events
+
+
+def test_from_events_matches_the_dict_form():
+    result = make_result()
+    body = json.dumps(result).encode()
+    chunks = [body[i : i + 7] for i in range(0, len(body), 7)]
+    streamed = TranscriptResult.from_events(iter_transcript(chunks))
+
+    assert streamed.id == "transcript-1"
+    assert streamed.speaker_labels is True
+    assert [dict(w) for w in streamed.words] == result["words"]
+    assert streamed.as_txt(prompt_speaker_labels=False) == TranscriptResult(
+        **result
+    ).as_txt(prompt_speaker_labels=False)
+
+
+def test_stream_result_saves_while_parsing(tmp_path):
+    with FakeProviderServer() as provider:
+        provider.job_duration = 0.0
+        assembly = AssemblyAI("key")
+        assembly.api_endpoint = provider.url("/v2")
+        job_id = assembly.transcribe("http://example.com/episode.wav")
+        time.sleep(0.05)
+
+        assert assembly.status(job_id)["status"] == "completed"
+        out_file = tmp_path / "episode.json"
+        words = [v for k, v in assembly.stream_result(job_id, out_file) if k == "words"]
+
+    saved = json.loads(out_file.read_text())
+    assert saved["words"] == words
+    assert not (tmp_path / "episode.json.part").exists()
+
+
+def test_plain_text_is_written_while_the_transcript_downloads(tmp_path, monkeypatch):
+    audio = tmp_path / "episode.wav"
+    audio.write_bytes(b"RIFF" + bytes(5000))
+    monkeypatch.setenv("ASSEMBLYAI_API_KEY", "key")
+    monkeypatch.setattr(click_spinner, "spinner", contextlib.nullcontext)
+
+    def reread(*args):
+        raise AssertionError("the saved transcript was read again")
+
+    monkeypatch.setattr(assembly_ai_cli, "read_file", reread)
+
+    with FakeProviderServer() as provider:
+        provider.job_duration = 0.0
+        monkeypatch.setattr(AssemblyAI, "api_endpoint", provider.url("/v2"))
+        result = CliRunner().invoke(
+            main.app,
+            ["transcribe", str(audio), "--no-cache"],
+            input="n\ny\nSean\nKelly\n",
+        )
+
+    assert result.exit_code == 0, result.output
+    assert result.output.index("plain-text") < result.output.index("Uploading")
+    txt = (tmp_path / "episode - transcript.txt").read_text()
+    assert txt == "Sean:\nWelcome back.\n\nKelly:\nThanks Sean.\n"
+    assert json.loads((tmp_path / "episode.json").read_text())["utterances"]
+
+
+def test_parser_skips_fields_without_decoding_them():
+    body = json.dumps(
+        {
+            "words": [{"text": 'odd "]}', "n": [1, {"x": "["}]}, {"text": "\\"}],
+            "flat": {"a": "}"},
+            "utterances": [{"text": "kept"}],
+            "status": "completed",
+        }
+    ).encode()
+    expected = [("utterances", {"text": "kept"}), ("status", "completed")]
+
+    for size in (1, 3, 8, len(body)):
+        chunks = [body[i : i + size] for i in range(0, len(body), size)]
+        assert list(iter_transcript(chunks, skip=("words", "flat"))) == expected
@@ -0,0 +1,226 @@
+import hashlib
+import os
+import time
+
+import pytest
+import requests
+
+from post_production.dolby import DolbyIO
+from post_production.stand_in import FakeProviderServer, StandInServer
+from post_production.transfer import (
+    ChunkedUpload,
+    RangedDownload,
+    pooled_session,
+    sidecar_path,
+)
+
+
+@pytest.fixture
+def server():
+    with StandInServer() as server:
+        yield server
+
+
+@pytest.fixture
+def audio_file(tmp_path):
+    path = tmp_path / "episode.wav"
+    path.write_bytes(os.urandom(1000003))
+    return path
+
+
+def test_chunked_upload(server, audio_file, tmp_path):
+    upload = ChunkedUpload(
+        server.url("/in/episode.wav"),
+        audio_file,
+        chunk_size=65536,
+        workers=4,
+        state_dir=tmp_path / "state",
+    )
+    stats = upload.run()
+
+    assert server.files["/in/episode.wav"] == audio_file.read_bytes()
+    assert stats.transferred_bytes == audio_file.stat().st_size
+    assert stats.bytes_per_second > 0
+    assert not upload.state_path.exists()
+
+
+def test_chunked_upload_retries_failed_parts(server, audio_file, tmp_path):
+    server.failures = 3
+    stats = ChunkedUpload(
+        server.url("/in/episode.wav"),
+        audio_file,
+        chunk_size=65536,
+        backoff=0,
+        state_dir=tmp_path / "state",
+    ).run()
+
+    assert stats.retries == 3
+    assert server.files["/in/episode.wav"] == audio_file.read_bytes()
+
+
+def test_chunked_upload_resumes(server, audio_file, tmp_path):
+    url = server.url("/in/episode.wav")
+    state_dir = tmp_path / "state"
+    server.failures = 1000
+    with pytest.raises(requests.HTTPError):
+        ChunkedUpload(
+            url, audio_file, chunk_size=65536, max_retries=0, state_dir=state_dir
+        ).run()
+
+    # Pretend the first five parts made it before the connection dropped
+    first = ChunkedUpload(url, audio_file, chunk_size=65536, state_dir=state_dir)
+    first._completed = set(range(5))
+    first._save_state()
+    data = audio_file.read_bytes()
+    server.files["/in/episode.wav"] = bytearray(data[: 5 * 65536])
+    # The state is kept with the cache, not with the file
+    assert first.state_path.parent == state_dir
+    assert list(audio_file.parent.iterdir()) == [audio_file, state_dir]
+
+    server.failures = 0
+    stats = ChunkedUpload(url, audio_file, chunk_size=65536, state_dir=state_dir).run()
+
+    assert stats.resumed_bytes == 5 * 65536
+    assert stats.transferred_bytes == len(data) - 5 * 65536
+    assert server.files["/in/episode.wav"] == data
+
+
+def test_dolby_upload_resumes_with_its_presigned_url(tmp_path, monkeypatch):
+    audio = tmp_path / "episode.wav"
+    audio.write_bytes(os.urandom(3 * 65536 + 100))
+    original_init, send_part = ChunkedUpload.__init__, ChunkedUpload._send_part
+    sent, dropped = [], []
+
+    def no_retries(self, url, file_path, **kwargs):
+        original_init(self, url, file_path, max_retries=0, **kwargs)
+
+    def drop_third_part_once(self, part):
+        sent.append(part)
+        if part == 2 and not dropped:
+            dropped.append(part)
+            raise requests.ConnectionError("connection dropped")
+        send_part(self, part)
+
+    monkeypatch.setattr(ChunkedUpload, "__init__", no_retries)
+    monkeypatch.setattr(ChunkedUpload, "_send_part", drop_third_part_once)
+
+    with FakeProviderServer() as provider:
+        monkeypatch.setattr(DolbyIO, "api_endpoint", provider.url("/media"))
+        dolby = DolbyIO("key")
+        with pytest.raises(requests.ConnectionError):
+            dolby.upload(audio, chunked=True, workers=1, chunk_size=65536)
+        saved = ChunkedUpload.saved_url(audio, "dlb://in/episode.wav", 65536)
+        assert saved and "X-Amz-Signature" in saved
+
+        sent.clear()
+        in_url = dolby.upload(audio, chunked=True, workers=1, chunk_size=65536)
+        stored = provider.files["/storage/in/episode.wav"]
+
+    # Only the part that failed was sent again, with the url it was sent to
+    assert sent == [2]
+    assert in_url == "dlb://in/episode.wav"
+    assert stored == audio.read_bytes()
+    assert ChunkedUpload.saved_url(audio, in_url, 65536) is None
+
+
+def test_ranged_download(server, audio_file, tmp_path):
+    server.files["/out/episode.wav"] = bytearray(audio_file.read_bytes())
+    out_file = tmp_path / "downloaded.wav"
+
+    stats = RangedDownload(
+        server.url("/out/episode.wav"), out_file, chunk_size=65536, workers=4
+    ).run()
+
+    assert out_file.read_bytes() == audio_file.read_bytes()
+    assert stats.total_bytes == audio_file.stat().st_size
+    assert not sidecar_path(out_file, ".part").exists()
+    assert not sidecar_path(out_file, ".part.json").exists()
+
+
+def test_transfers_keep_the_sessions_pools(server, audio_file, tmp_path):
+    server.files["/out/episode.wav"] = bytearray(audio_file.read_bytes())
+    session = pooled_session(16)
+    adapter = session.get_adapter(server.url("/"))
+
+    assert adapter._pool_maxsize == 16
+    assert pooled_session(8, session) is session
+    RangedDownload(
+        server.url("/out/episode.wav"), tmp_path / "out.wav", session=session
+    ).run()
+    # The pools other threads are using are not swapped out from under them
+    assert session.get_adapter(server.url("/")) is adapter
+
+
+def test_dolby_sizes_its_pools_for_parallel_downloads(server, audio_file, tmp_path):
+    server.files["/out/episode.wav"] = bytearray(audio_file.read_bytes())
+    dolby = DolbyIO("key", pool_size=12)
+    adapter = dolby._session.get_adapter(server.url("/"))
+
+    assert adapter._pool_maxsize == 12
+    RangedDownload(
+        server.url("/out/episode.wav"), tmp_path / "out.wav", session=dolby._session
+    ).run()
+    assert dolby._session.get_adapter(server.url("/")) is adapter
+
+
+def test_ranged_download_resumes_and_verifies(server, audio_file, tmp_path):
+    data = audio_file.read_bytes()
+    server.files["/out/episode.wav"] = bytearray(data)
+    out_file = tmp_path / "downloaded.wav"
+    url = server.url("/out/episode.wav")
+
+    server.failures = 1000
+    with pytest.raises(requests.HTTPError):
+        RangedDownload(url, out_file, chunk_size=65536, max_retries=0).run()
+    assert not out_file.exists()
+
+    # Pretend the first three parts landed before the interruption
+    first = RangedDownload(url, out_file, chunk_size=65536)
+    server.failures = 0
+    first._probe()
+    with open(first.part_path, "wb") as part_file:
+        part_file.write(data[: 3 * 65536])
+    first._completed = {0, 1, 2}
+    first._save_state()
+
+    stats = RangedDownload(
+        url, out_file, chunk_size=65536, sha256=hashlib.sha256(data).hexdigest()
+    ).run()
+
+    assert stats.resumed_bytes == 3 * 65536
+    assert out_file.read_bytes() == data
+
+
+def test_ranged_download_rejects_bad_checksum(server, tmp_path):
+    server.files["/out/episode.wav"] = bytearray(b"enhanced audio")
+    out_file = tmp_path / "downloaded.wav"
+
+    with pytest.raises(IOError):
+        RangedDownload(server.url("/out/episode.wav"), out_file, sha256="0" * 64).run()
+    assert not out_file.exists()
+
+
+def test_download_without_range_support(server, tmp_path):
+    server.ranges = False
+    server.files["/out/episode.json"] = bytearray(b'{"status": "completed"}')
+    out_file = tmp_path / "episode.json"
+
+    RangedDownload(server.url("/out/episode.json"), out_file).run()
+
+    assert out_file.read_bytes() == b'{"status": "completed"}'
+
+
+def test_stand_in_latency_error_rate_and_upload_cap(server):
+    server.latency = 0.01
+    server.error_rate = 0.5
+    start = time.monotonic()
+    statuses = [requests.get(server.url("/missing")).status_code for _ in range(40)]
+    assert time.monotonic() - start >= 0.4
+    assert set(statuses) == {404, 503}
+    assert 10 < statuses.count(503) < 30
+
+    server.latency = server.error_rate = 0
+    server.connection_rate = 400_000
+    start = time.monotonic()
+    requests.put(server.url("/in/episode.wav"), data=bytes(200_000))
+    assert time.monotonic() - start >= 0.4
@@ -0,0 +1,181 @@
+import json
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from typer.testing import CliRunner
+
+from post_production.main import app
+from post_production.watch import HealthServer, SettlingFiles, WatchDaemon
+from tests.test_render_cache import tone
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def get_json(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_recordings_are_ready_once_they_stop_growing(tmp_path):
+    settling = SettlingFiles(settle=2.0)
+    recording = tmp_path / "episode.wav"
+    recording.write_bytes(b"RIFF")
+    empty = tmp_path / "empty.wav"
+    empty.touch()
+    settling.saw(recording)
+    settling.saw(empty)
+
+    assert settling.ready(now=0.0) == []
+    assert settling.ready(now=1.0) == []
+    with recording.open("ab") as f:
+        f.write(bytes(100))
+    assert settling.ready(now=2.5) == []
+    assert settling.ready(now=4.4) == []
+    assert settling.ready(now=4.5) == [recording]
+
+    settling.take(recording)
+    settling.saw(recording)
+    assert settling.ready(now=10.0) == []
+    # Only the empty file is left, and it is never ready
+    assert len(settling) == 1
+    assert settling.ready(now=20.0) == []
+
+    # A new take of the same recording is ready again
+    recording.write_bytes(b"RIFF" + bytes(200))
+    settling.saw(recording)
+    assert settling.ready(now=21.0) == []
+    assert settling.ready(now=23.0) == [recording]
+
+
+@pytest.mark.parametrize("inotify", [True, False])
+def test_dropped_recordings_are_processed_once(tmp_path, inotify):
+    processed = []
+    (tmp_path / "output").mkdir()
+    (tmp_path / "old.wav").write_bytes(b"RIFF" + bytes(10))
+    daemon = WatchDaemon(
+        tmp_path,
+        processed.append,
+        settle=0.3,
+        poll_interval=0.1,
+        inotify=inotify,
+        existing=False,
+    )
+
+    with daemon, HealthServer(daemon) as health:
+        if inotify and sys.platform.startswith("linux"):
+            assert daemon.watcher.name == "inotify"
+        recording = tmp_path / "episode.wav"
+        with recording.open("wb") as f:
+            for _ in range(3):
+                f.write(bytes(1000))
+                f.flush()
+                time.sleep(0.15)
+        (tmp_path / ".episode.mp3.part").write_bytes(bytes(10))
+        (tmp_path / "notes.txt").write_text("not audio")
+        wait_for(lambda: daemon.processed == 1)
+        time.sleep(0.5)
+        status, health_status = get_json(health.url("/health"))
+        _, full = get_json(health.url("/status"))
+
+    assert processed == [recording]
+    assert (status, health_status) == (200, {"status": "ok"})
+    assert full["processed"] == 1
+    assert full["recent"][0]["file"] == "episode.wav"
+    assert daemon.status()["status"] == "stopping"
+
+
+def test_full_queue_holds_recordings_until_a_worker_is_free(tmp_path):
+    release = threading.Event()
+    processed = []
+
+    def process(path):
+        release.wait()
+        processed.append(path.name)
+
+    daemon = WatchDaemon(
+        tmp_path, process, workers=1, queue_size=1, settle=0.1, poll_interval=0.05
+    )
+    with HealthServer(daemon) as health:
+        daemon.start()
+        for i in range(4):
+            (tmp_path / f"ep{i}.wav").write_bytes(bytes(100))
+            time.sleep(0.02)
+        wait_for(lambda: daemon.held == 2)
+        status = daemon.status()
+        assert [r["file"] for r in status["running"]] == ["ep0.wav"]
+        assert (status["queued"], status["held"]) == (1, 2)
+        assert get_json(health.url("/health"))[0] == 200
+
+        release.set()
+        wait_for(lambda: daemon.processed == 4)
+        assert processed == ["ep0.wav", "ep1.wav", "ep2.wav", "ep3.wav"]
+
+        # Stopping waits for the recording in progress
+        release.clear()
+        (tmp_path / "ep4.wav").write_bytes(bytes(100))
+        wait_for(lambda: daemon.status()["running"])
+        stopping = threading.Thread(target=daemon.stop)
+        stopping.start()
+        time.sleep(0.3)
+        assert stopping.is_alive()
+        assert get_json(health.url("/health")) == (503, {"status": "stopping"})
+        release.set()
+        stopping.join(5)
+
+    assert processed[-1] == "ep4.wav"
+    assert daemon.processed == 5
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="no ffmpeg")
+def test_watch_runs_recordings_through_a_spec_until_terminated(tmp_path):
+    drop = tmp_path / "drop"
+    drop.mkdir()
+    tone(drop / "episode.wav")
+    spec = tmp_path / "spec.json"
+    spec.write_text(
+        json.dumps({"stages": [{"name": "transcode", "uses": "transcode"}]})
+    )
+    out = tmp_path / "output" / "episode" / "episode.mp3"
+
+    def terminate_when_done():
+        deadline = time.monotonic() + 30
+        while not out.exists() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        time.sleep(0.5)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=terminate_when_done, daemon=True).start()
+    result = CliRunner().invoke(
+        app,
+        [
+            "watch",
+            str(drop),
+            "--spec",
+            str(spec),
+            "--settle",
+            "0.2",
+            "--health-port",
+            "0",
+        ],
+    )
+
+    assert result.exit_code == 0, result.output
+    assert "Finished episode.wav: 1 ran" in result.output
+    assert "Processed 1, failed 0" in result.output
+    assert out.exists()
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
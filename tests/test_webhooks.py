@@ -0,0 +1,75 @@
+import time
+
+import pytest
+import requests
+
+from post_production.assembly_ai import AssemblyAI
+from post_production.cache import ASSEMBLYAI, DOLBY
+from post_production.dolby import DolbyIO, JobType
+from post_production.poller import JobPoller
+from post_production.stand_in import FakeProviderServer
+from post_production.webhooks import WebhookReceiver
+
+
+@pytest.fixture
+def provider():
+    with FakeProviderServer() as server:
+        server.job_duration = 0.2
+        yield server
+
+
+def test_callbacks_resolve_jobs_without_idle_polling(provider, tmp_path):
+    dolby = DolbyIO("key")
+    dolby.api_endpoint = provider.url("/media")
+    assembly = AssemblyAI("key")
+    assembly.api_endpoint = provider.url("/v2")
+    audio = tmp_path / "episode.wav"
+    audio.write_bytes(b"RIFF" + bytes(1000))
+
+    # Fallback polling is far slower than the jobs, so only callbacks can finish them
+    with JobPoller(min_interval=60, max_interval=60) as poller:
+        poller.register(DOLBY, dolby)
+        poller.register(ASSEMBLYAI, assembly)
+        with WebhookReceiver(poller) as hooks:
+            start = time.monotonic()
+            in_url = dolby.upload(audio)
+            enhance_id, out_url = dolby.enhance(
+                in_url, webhook_url=hooks.url_for(DOLBY)
+            )
+            transcript_id = assembly.transcribe(
+                assembly.upload(audio), webhook_url=hooks.url_for(ASSEMBLYAI)
+            )
+            enhanced = poller.track(DOLBY, enhance_id, JobType.ENHANCE, delay=60)
+            transcript = poller.track(ASSEMBLYAI, transcript_id, delay=60)
+
+            assert enhanced.result(timeout=5).status == "Success"
+            assert transcript.result(timeout=5).data["status"] == "completed"
+            assert time.monotonic() - start < 5
+            assert hooks.received == 2
+
+    assert poller.stats.requests == 2
+    assert provider.files["/storage/out/episode.wav"] == audio.read_bytes()
+
+
+def test_receiver_rejects_unknown_token():
+    poller = JobPoller()
+    with WebhookReceiver(poller) as hooks:
+        bad_url = hooks.url_for(DOLBY).replace(hooks.token, "wrong")
+        assert requests.post(bad_url, json={"job_id": "1"}).status_code == 404
+        r = requests.post(hooks.url_for(DOLBY), json={"job_id": "1"})
+        assert r.status_code == 200
+    assert hooks.received == 1
+
+
+def test_receiver_answers_callbacks_behind_a_path_prefix():
+    poller = JobPoller()
+    with WebhookReceiver(poller, public_url="https://example.com/hooks/") as hooks:
+        local = f"http://{hooks.host}:{hooks.port}"
+        proxied = hooks.url_for(DOLBY).replace("https://example.com", local)
+        assert proxied == f"{local}/hooks/{hooks.token}/dolby"
+        assert requests.post(proxied, json={"job_id": "1"}).status_code == 200
+        stripped = f"{local}/{hooks.token}/dolby"
+        assert requests.post(stripped, json={"job_id": "2"}).status_code == 200
+        for body in (b"[]", b'"x"', b"null"):
+            assert requests.post(proxied, data=body).status_code == 400
+    assert hooks.received == 2